@@ -29,6 +29,7 @@
 
 from neubot.http.message import Message
 from neubot.http.server import ServerHTTP
+from neubot.utils_random import RandomBody
 
 #
 # The default body size is small enough that the body, and
@@ -38,8 +39,12 @@ from neubot.http.server import ServerHTTP
 DASH_DEFAULT_BODY_SIZE = 1000
 
 #
-# XXX We don't serve bodies larger than this size. To serve
-# larger bodies we need to adopt an iterator approach.
+# We don't serve bodies larger than this size.  The body is
+# never in memory as a whole: RandomBody hands the stream one
+# slice of the shared random payload at a time, and the stream
+# asks for the next slice only when the previous one has been
+# sent.  So, the memory we use depends neither on the body size
+# nor on the number of clients.
 #
 DASH_MAXIMUM_BODY_SIZE = 104857600
 
@@ -105,19 +110,7 @@ class DASHServerSmpl(ServerHTTP):
             if body_size > DASH_MAXIMUM_BODY_SIZE:
                 body_size = DASH_MAXIMUM_BODY_SIZE
 
-            #
-            # XXX We don't have a quick solution for generating
-            # and sending many random bytes from Python.
-            #
-            # Or, better, we have a couple of ideas, but they
-            # have not been implemented into Neubot yet.
-            #
-            pattern = request["Authorization"]
-            if not pattern:
-                pattern = "deadbeef"
-            body = pattern * ((body_size / len(pattern)) + 1)
-            if len(body) > body_size:
-                body = body[:body_size]
+            body = RandomBody(body_size)
 
             response = Message()
             response.compose(code="200", reason="Ok", body=body,
@@ -48,6 +48,7 @@ from neubot import privacy
 from neubot import log_api
 from neubot import runner_api
 from neubot import utils
+from neubot import api_aggregate
 from neubot import api_data
 from neubot import api_results
 from neubot import utils_hier
@@ -63,6 +64,7 @@ class ServerAPI(ServerHTTP):
         self._dispatch = {
             "/api": self._api,
             "/api/": self._api,
+            "/api/aggregate": api_aggregate.api_aggregate,
             "/api/data": api_data.api_data,
             "/api/config": config_api.config_api,
             "/api/debug": self._api_debug,
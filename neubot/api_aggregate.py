@@ -0,0 +1,76 @@
+# neubot/api_aggregate.py
+
+#
+# Copyright (c) 2013
+#     Nexa Center for Internet & Society, Politecnico di Torino (DAUIN),
+#     and Simone Basso <bassosimone@gmail.com>
+#
+# This file is part of Neubot <http://www.neubot.org/>.
+#
+# Neubot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Neubot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Neubot.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+''' API to fetch per-day and per-server summaries of results '''
+
+#
+# Usage: /api/aggregate?test=speedtest&by=day[&since=T][&until=T]
+#
+# Returns the list of the per-day (by=day, the default) or per-server
+# (by=server) summaries of the results of test, sorted by key, i.e.
+# by day or by server address.  For per-day summaries, since and until
+# select the days that contain them.  Summaries are precomputed when
+# results are saved (see neubot/database/table_aggregate.py), so the
+# cost of this API does not depend on the number of results.
+#
+
+import cgi
+
+from neubot.compat import json
+from neubot.database import DATABASE
+from neubot.database import table_aggregate
+from neubot.http.message import Message
+from neubot.utils_api import NotImplementedTest
+
+from neubot import utils
+
+def api_aggregate(stream, request, query):
+    ''' Get summaries of the results stored on the local database '''
+    since, until = -1, -1
+    test, kind = '', 'day'
+
+    dictionary = cgi.parse_qs(query)
+
+    if "test" in dictionary:
+        test = str(dictionary["test"][0])
+    if "by" in dictionary:
+        kind = str(dictionary["by"][0])
+    if "since" in dictionary:
+        since = int(dictionary["since"][0])
+    if "until" in dictionary:
+        until = int(dictionary["until"][0])
+
+    if kind not in table_aggregate.KINDS:
+        raise NotImplementedTest("Summary not implemented")
+
+    indent, mimetype, sort_keys = None, "application/json", False
+    if "debug" in dictionary and utils.intify(dictionary["debug"][0]):
+        indent, mimetype, sort_keys = 4, "text/plain", True
+
+    lst = table_aggregate.listify(DATABASE.connection(), test, kind,
+                                  since, until)
+
+    response = Message()
+    body = json.dumps(lst, indent=indent, sort_keys=sort_keys)
+    response.compose(code="200", reason="Ok", body=body, mimetype=mimetype)
+    stream.send_response(request, response)
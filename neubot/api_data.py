@@ -31,22 +31,79 @@
 # to build results.html dynamically.
 #
 
+#
+# Results are streamed: we read them from the database (or from the
+# backend, for generic tests) as the client consumes the response, and
+# we send the JSON list using the chunked transfer encoding.  So, the
+# memory we use does not depend on how many results we have.
+#
+# The client may also read results a page at a time, passing `limit`,
+# i.e. the maximum number of results.  If there are more results, the
+# response contains a Link header (RFC 5988) with rel="next", and its
+# URI contains `cursor`, which tells us where the next page starts.
+# The cursor is "timestamp:skip", i.e. start from results not newer
+# than timestamp, and skip the first skip results with that timestamp
+# (which we have already sent, because timestamps are not unique).
+# Since results are sorted from the newest to the oldest one, results
+# saved while the client is paginating do not shift the pages.
+#
+# This is the order in which /api/data always returned results, with
+# or without limit and cursor: the database-based tests sorted them
+# by descending timestamp, and the generic tests walked them back
+# from the newest one.  Results with the same timestamp are sorted
+# by descending id, i.e. from the last saved one.
+#
+
 import cgi
+import itertools
+import urllib
 
 from neubot.backend import BACKEND
 
-from neubot.compat import json
 from neubot.database import DATABASE
 from neubot.database import table_bittorrent
 from neubot.database import table_speedtest
 from neubot.database import table_raw
 from neubot.http.message import Message
+from neubot.json_stream import JSONStream
 
 from neubot import utils
 
+def _parse_cursor(cursor):
+    ''' Parse the cursor and return timestamp and skip '''
+    vector = cursor.split(":")
+    if len(vector) != 2:
+        raise ValueError("api_data: invalid cursor")
+    start, skip = int(vector[0]), int(vector[1])
+    if start < 0 or skip < 0:
+        raise ValueError("api_data: invalid cursor")
+    return start, skip
+
+def _skip(results, start, skip):
+    ''' Skip the first skip results with timestamp equal to start '''
+    for result in results:
+        if skip > 0 and result.get("timestamp") == start:
+            skip -= 1
+            continue
+        skip = 0
+        yield result
+
+def _next_cursor(page, start, skip):
+    ''' Return the cursor of the page after page '''
+    timestamp = page[-1].get("timestamp")
+    count = 0
+    for result in reversed(page):
+        if result.get("timestamp") != timestamp:
+            break
+        count += 1
+    if timestamp == start:
+        count += skip
+    return "%d:%d" % (timestamp, count)
+
 def api_data(stream, request, query):
     ''' Get data stored on the local database '''
     since, until = -1, -1
+    limit, start, skip = -1, -1, 0
     test = ''
 
     dictionary = cgi.parse_qs(query)
@@ -57,6 +114,10 @@ def api_data(stream, request, query):
         since = int(dictionary["since"][0])
     if "until" in dictionary:
         until = int(dictionary["until"][0])
+    if "limit" in dictionary:
+        limit = int(dictionary["limit"][0])
+    if "cursor" in dictionary:
+        start, skip = _parse_cursor(dictionary["cursor"][0])
 
     if test == 'bittorrent':
         table = table_bittorrent
@@ -74,7 +135,7 @@ def api_data(stream, request, query):
     response = Message()
 
     if table:
-        lst = table.listify(DATABASE.connection(), since, until)
+        results = table.walk(DATABASE.connection(), since, until, start)
 
     #
     # TODO We should migrate all the tests to use the new
@@ -82,32 +143,42 @@ def api_data(stream, request, query):
     # the API to access "pages" of data by index.
     #
     # Until we change the API, we have an API that allows
-    # the caller to specify date ranges. For this reason
-    # below we emulate the date-ranges semantics provided
-    # by database-based tests.
+    # the caller to specify date ranges, and the backend
+    # emulates the date-ranges semantics provided by the
+    # database-based tests.
     #
     # Note: we assume that, whatever the test structure,
     # there is a field called "timestamp".
     #
     else:
-        lst = []
-        indexes = [None]
-        indexes.extend(range(16))
-        for index in indexes:
-            tmp = BACKEND.walk_generic(test, index)
-            if not tmp:
-                break
-            found_start = False
-            for elem in reversed(tmp):
-                if until >= 0 and elem["timestamp"] > until:
-                    continue
-                if since >= 0 and elem["timestamp"] < since:
-                    found_start = True
-                    break
-                lst.append(elem)
-            if found_start:
-                break
-
-    body = json.dumps(lst, indent=indent, sort_keys=sort_keys)
-    response.compose(code="200", reason="Ok", body=body, mimetype=mimetype)
+        if start >= 0 and (until < 0 or until > start):
+            until = start
+        results = BACKEND.walk_generic_range(test, since, until)
+
+    if start >= 0:
+        results = _skip(results, start, skip)
+
+    link = None
+    if limit >= 0:
+        # Read one more result to know whether there is a next page
+        page = list(itertools.islice(results, limit + 1))
+        results = page[:limit]
+        if len(page) > limit and limit > 0:
+            dictionary["cursor"] = [_next_cursor(results, start, skip)]
+            link = "</api/data?%s>; rel=\"next\"" % urllib.urlencode(
+              sorted(dictionary.items()), True)
+
+    # HTTP/1.0 clients don't know chunked, so close when done
+    if request.protocol == "HTTP/1.0":
+        body = JSONStream(results, False, indent, sort_keys)
+        response.compose(code="200", reason="Ok", up_to_eof=True,
+                         mimetype=mimetype, keepalive=False)
+        response.body = body
+        response.length = -1
+    else:
+        body = JSONStream(results, True, indent, sort_keys)
+        response.compose(code="200", reason="Ok", chunked=body,
+                         mimetype=mimetype)
+    if link:
+        response["link"] = link
     stream.send_response(request, response)
@@ -50,6 +50,26 @@ COPY_CONFIG_VARIABLES = (
     'www_no_title',
 )
 
+#
+# We keep the content of the description files in memory, and we read
+# a file again only when its modification time or size changes.  So
+# you don't need to restart the daemon after you have changed them.
+#
+CACHE = {}
+
+def _read_cached(path):
+    ''' Read the content of path, or return the cached one '''
+    stat = os.stat(path)
+    version = (stat.st_mtime, stat.st_size)
+    entry = CACHE.get(path)
+    if entry and entry[0] == version:
+        return entry[1]
+    filep = open(path, 'rb')
+    content = filep.read()
+    filep.close()
+    CACHE[path] = (version, content)
+    return content
+
 def api_results(stream, request, query):
     ''' Populates www/results.html page '''
 
@@ -78,11 +98,9 @@ def api_results(stream, request, query):
         raise RuntimeError("api_results: append() path failed")
     localfilepath = filepath + '.local'
     if os.path.isfile(localfilepath):
-        filep = open(localfilepath, 'rb')
+        response_body = json.loads(_read_cached(localfilepath))
     else:
-        filep = open(filepath, 'rb')
-    response_body = json.loads(filep.read())
-    filep.close()
+        response_body = json.loads(_read_cached(filepath))
 
     # Add extra information needed to populate results.html selection that
     # allows to select which test results must be shown.
@@ -91,9 +109,7 @@ def api_results(stream, request, query):
 
     descrpath = filepath.replace('.json', '.html')
     if os.path.isfile(descrpath):
-        filep = open(descrpath, 'rb')
-        response_body['description'] = filep.read()
-        filep.close()
+        response_body['description'] = _read_cached(descrpath)
 
     # Provide the web user interface some settings it needs, but only if they
     # were not already provided by the `.local` file.
@@ -279,6 +279,7 @@ def main(args):
     BACKEND.speedtest_store(msg)
     BACKEND.store_raw(msg)
     BACKEND.store_generic("generictest", msg)
+    BACKEND.flush()
 
 if __name__ == '__main__':
     main(sys.argv)
@@ -25,19 +25,22 @@
 
 #
 # Follows closely the M-Lab specification for saving results
-# in a very scalable way.
+# in a very scalable way.  The results of each test are appended
+# to rolling compressed segments, see neubot/segment_writer.py.
 #
 
-import gzip
 import time
 
-from neubot.compat import json
-
 from neubot.backend_null import BackendNull
+from neubot.segment_writer import SegmentWriter
 
 class BackendMLab(BackendNull):
     ''' M-Lab backend '''
 
+    def __init__(self, proxy):
+        BackendNull.__init__(self, proxy)
+        self.writers = {}
+
     def bittorrent_store(self, message):
         ''' Saves the results of a bittorrent test '''
         self.do_store('bittorrent', message)
@@ -56,46 +59,26 @@ class BackendMLab(BackendNull):
 
     def do_store(self, test, message):
         ''' Saves the results of the given test '''
+        writer = self.writers.get(test)
+        if not writer:
+            writer = SegmentWriter(test, self.proxy.datadir_touch)
+            self.writers[test] = writer
+        writer.append(message, time.time())
 
-        # Get time information
-        thetime = time.time()
-        gmt = time.gmtime(thetime)
-        nanosec = int((thetime % 1.0) * 1000000000)
-
-        #
-        # Build path components.
-        # The time format is ISO8601, except that we use nanosecond
-        # and not microsecond precision.
-        #
-        components = [
-                      time.strftime('%Y', gmt),
-                      time.strftime('%m', gmt),
-                      time.strftime('%d', gmt),
-                      '%s.%09dZ_%s.gz' % (
-                        time.strftime('%Y%m%dT%H:%M:%S', gmt),
-                        nanosec, test)
-                     ]
-
-        #
-        # Make sure that the path exists and that ownership
-        # and permissions are OK.
-        #
-        fullpath = self.proxy.datadir_touch(components)
-
-        #
-        # Open the output file for appending, write into
-        # it the message and close.
-        # We open for appending just in case two tests
-        # terminates at the same time (unlikely!).
-        #
-        filep = gzip.open(fullpath, 'ab')
-        json.dump(message, filep)
-        filep.close()
+    def flush(self):
+        ''' Write the buffered results '''
+        for writer in self.writers.values():
+            writer.flush()
 
     def walk_generic(self, test, index):
         """ Walk over the results of a generic test """
         return []
 
+    def walk_generic_range(self, test, since, until):
+        """ Walk over the results of a generic test saved between since
+            and until, from the newest to the oldest one """
+        return []
+
     def datadir_init(self, uname=None, datadir=None):
         ''' Initialize datadir (if needed) '''
         self.proxy.really_init_datadir(uname, datadir)
@@ -32,29 +32,24 @@
 import logging
 import os
 
-try:
-    import cPickle as pickle
-except ImportError:
-    import pickle
-
 from neubot.database import DATABASE
+from neubot.database import table_aggregate
 from neubot.database import table_bittorrent
 from neubot.database import table_speedtest
 from neubot.database import table_raw
 
 from neubot.backend_null import BackendNull
+from neubot.segment_store import SegmentStore
 
 from neubot import utils_path
 
-SPLIT_INTERVAL = 1024
-SPLIT_NUM_FILES = 15
-
 class BackendNeubot(BackendNull):
     ''' Neubot backend '''
 
     def __init__(self, proxy):
         BackendNull.__init__(self, proxy)
         self.generic = {}
+        self.readers = {}
 
     def bittorrent_store(self, message):
         ''' Saves the results of a bittorrent test '''
@@ -81,83 +76,106 @@ class BackendNeubot(BackendNull):
         table_speedtest.insert(DATABASE.connection(), message)
 
     #
-    # 'Generic' load/store functions. We append test results into a vector,
-    # which is also serialized to disk using pickle. When the number of
-    # items in the vector exceeds a threshold, we rotate the logfiles created
-    # using pickle, and we start over with an empty vector.
+    # 'Generic' load/store functions. We append test results into a
+    # segment, i.e. a file containing one JSON object per line. When the
+    # number of items in the segment reaches a threshold, we rotate the
+    # segments, and we start over with an empty segment. This replaces
+    # the lists of results serialized to disk using pickle, which we
+    # convert into segments the first time we access a test.
     #
     # Also we access results by index, as the Twitter API does. Each index
-    # is the number of a logfile. When there is no index, we serve the logfile
-    # that is currently being written.
+    # is the number of a segment. When there is no index, we serve the
+    # segment that is currently being written.
     #
     # Dash Elhauge had the original idea behind this implementation, my
     # fault if it took too much to implement it.
     #
+    # Reads do not write into datadir: until we store a result of a
+    # test we read its segments using a readonly store.
+    #
 
-    def store_generic(self, test, results):
-        """ Store the results of a generic test """
-
-        components = [ "%s.pickle" % test ]
-        fullpath = self.proxy.datadir_touch(components)
-
-        # Load
+    def _segments(self, test):
+        """ Return the segment store of a test, or None """
         if not test in self.generic:
-            filep = open(fullpath, "rb")
-            content = filep.read()
-            filep.close()
-            if content:
-                self.generic[test] = pickle.loads(content)
-            else:
-                self.generic[test] = []
-
-        # Rotate
-        if len(self.generic[test]) >= SPLIT_INTERVAL:
-
-            tmppath = fullpath + "." + str(SPLIT_NUM_FILES)
-            if os.path.isfile(tmppath):
-                os.unlink(tmppath)
-
-            for index in range(SPLIT_NUM_FILES, 0, -1):
-                srcpath = fullpath + "." + str(index - 1)
-                if not os.path.isfile(srcpath):
-                    continue
-                destpath = fullpath + "." + str(index)
-                os.rename(srcpath, destpath)
-
-            tmppath = fullpath + ".0"
-            filep = open(tmppath, "wb")
-            pickle.dump(self.generic[test], filep)
-            filep.close()
-            self.generic[test] = []
-
-        # Write
-        self.generic[test].append(results)
-        filep = open(fullpath, "wb")
-        pickle.dump(self.generic[test], filep)
-        filep.close()
+            if not utils_path.append(self.proxy.datadir, "%s.jsonl" % test,
+                                     False):
+                return None
+            self.readers.pop(test, None)
+            self.generic[test] = SegmentStore(self.proxy.datadir, test,
+                                              self._touch)
+            self._summarize(test)
+        return self.generic[test]
+
+    def _reader(self, test):
+        """ Return a store to read the segments of a test, or None """
+        if test in self.generic:
+            return self.generic[test]
+        if not test in self.readers:
+            path = utils_path.append(self.proxy.datadir, "%s.jsonl" % test,
+                                     False)
+            if not path or not os.path.isfile(path):
+                return None
+            self.readers[test] = SegmentStore(self.proxy.datadir, test,
+                                              readonly=True)
+        return self.readers[test]
 
-    def walk_generic(self, test, index):
-        """ Walk over the results of a generic test """
+    #
+    # The first time we store a result of a test that has no summaries,
+    # we summarize the results saved before we had summaries.  Unlike
+    # the database (see neubot/database/__init__.py) we do that at once,
+    # because a test has at most (SPLIT_NUM_FILES + 2) * SPLIT_INTERVAL
+    # results, which we summarize in about one second.
+    #
 
-        filename = "%s.pickle" % test
-        if index != None:
-            filename += "." + str(int(index))
+    def _summarize(self, test):
+        """ Summarize the results saved before we had summaries """
+        DATABASE.connect()
+        if DATABASE.readonly:
+            return
+        connection = DATABASE.connection()
+        if table_aggregate.has_test(connection, test):
+            return
+        segments = self.generic[test]
+        count = segments.count()
+        if count > 0:
+            logging.info("backend_neubot: summarizing %d existing %s "
+                         "results...", count, test)
+            table_aggregate.rebuild(connection, test, segments.walk())
+            logging.info("backend_neubot: summarizing %d existing %s "
+                         "results... done", count, test)
+
+    def _touch(self, filename):
+        """ Create filename below datadir """
+        return self.proxy.datadir_touch([filename])
 
-        fullpath = utils_path.append(self.proxy.datadir, filename, False)
-        if not fullpath:
-            return []
+    def store_generic(self, test, results):
+        """ Store the results of a generic test """
+        segments = self._segments(test)
+        if not segments:
+            raise RuntimeError("backend_neubot: invalid test name")
+        segments.append(results)
+        DATABASE.connect()
+        if DATABASE.readonly:
+            logging.warning('backend_neubot: readonly database')
+            return
+        table_aggregate.update(DATABASE.connection(), test, results)
 
-        if not os.path.isfile(fullpath):
+    def walk_generic(self, test, index):
+        """ Walk over the results of a generic test """
+        segments = self._reader(test)
+        if not segments:
             return []
-
-        filep = open(fullpath, "rb")
-        content = filep.read()
-        filep.close()
-
-        if not content:
+        if index != None:
+            index = int(index)
+        return segments.read(index)
+
+    def walk_generic_range(self, test, since, until):
+        """ Walk over the results of a generic test saved between since
+            and until, from the newest to the oldest one """
+        segments = self._reader(test)
+        if not segments:
             return []
-
-        return pickle.loads(content)
+        return segments.walk(since, until)
 
     def datadir_init(self, uname=None, datadir=None):
         ''' Initialize datadir (if needed) '''
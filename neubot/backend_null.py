@@ -44,5 +44,13 @@ class BackendNull(object):
     def walk_generic(self, test, index):
         """ Walk over the results of a generic test """
 
+    def walk_generic_range(self, test, since, until):
+        """ Walk over the results of a generic test saved between since
+            and until, from the newest to the oldest one """
+        return []
+
+    def flush(self):
+        ''' Write the buffered results (if any) '''
+
     def datadir_init(self, uname=None, datadir=None):
         ''' Initialize datadir (if needed) '''
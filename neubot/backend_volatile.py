@@ -24,6 +24,7 @@
 """ The volatile backend """
 
 from neubot.backend_null import BackendNull
+from neubot.segment_store import select_range
 
 class BackendVolatile(BackendNull):
     """ The volatile backend """
@@ -41,3 +42,9 @@ class BackendVolatile(BackendNull):
     def walk_generic(self, test, index):
         """ Walk over the results of a generic test """
         return self.generic.get(test, [])
+
+    def walk_generic_range(self, test, since, until):
+        """ Walk over the results of a generic test saved between since
+            and until, from the newest to the oldest one """
+        return select_range(reversed(self.generic.get(test, [])),
+                            since, until)
@@ -0,0 +1,677 @@
+# neubot/bench.py
+
+#
+# Copyright (c) 2013
+#     Nexa Center for Internet & Society, Politecnico di Torino (DAUIN),
+#     and Simone Basso <bassosimone@gmail.com>
+#
+# This file is part of Neubot <http://www.neubot.org/>.
+#
+# Neubot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Neubot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Neubot.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+''' Loopback benchmark of the server-side test components '''
+
+#
+# We fork a child process that runs the same server components
+# that `neubot server` runs (negotiate, speedtest, BitTorrent, raw
+# and DASH) on free loopback ports, and we drive N concurrent
+# synthetic clients of one test against it for a given duration.
+#
+# The clients are a plain select() loop in the parent process, and
+# they only speak as much of each protocol as needed to make the
+# server do its job (e.g., they count the bytes of the pieces but
+# do not look into them), so that their cost does not depend on
+# the code under test and they do not slow down the server much.
+#
+# The child measures its CPU time, its peak RSS and the latency of
+# its poller loop (how late a timer scheduled every PROBE_INTERVAL
+# seconds runs), and the parent prints one JSON object per run, so
+# that the results of different commits can be compared.
+#
+# The child process and the resource module are POSIX only.
+#
+
+import getopt
+import hashlib
+import logging
+import os
+import random
+import resource
+import select
+import signal
+import socket
+import struct
+import sys
+
+if __name__ == '__main__':
+    sys.path.insert(0, '.')
+
+from neubot.backend import BACKEND
+from neubot.bittorrent.config import PIECE_LEN
+from neubot.compat import json
+from neubot.config import CONFIG
+from neubot.http.server import HTTP_SERVER
+from neubot.negotiate.server import NEGOTIATE_SERVER
+from neubot.poller import POLLER
+from neubot.quantile import Quantiles
+from neubot.raw_defs import AUTH_LEN
+from neubot.raw_defs import RAWTEST
+from neubot.raw_srvr_glue import RAW_SERVER_EX
+
+from neubot import bittorrent
+from neubot import negotiate
+from neubot import utils
+from neubot import utils_modules
+from neubot import utils_net
+from neubot import utils_version
+
+import neubot.speedtest.wrapper
+
+TESTS = ('negotiate', 'speedtest', 'bittorrent', 'raw', 'dash')
+
+# Seconds between two probes of the server loop latency
+PROBE_INTERVAL = 0.01
+
+MAXRECV = 262144
+
+# Bytes per speedtest download and per DASH segment
+SPEEDTEST_BODY = 1 << 20
+DASH_BODY = 1 << 20
+
+# Number of DASH segments per session (the server allows up to 60)
+DASH_SEGMENTS = 15
+
+PRIVACY = json.dumps({
+                      'privacy_informed': 1,
+                      'privacy_can_collect': 1,
+                      'privacy_can_publish': 1,
+                     })
+
+#
+# Server side
+#
+
+def _free_port():
+    ''' Return a free loopback port '''
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = utils_net.getsockname(sock)[1]
+    sock.close()
+    return port
+
+def _maxrss():
+    ''' Return the peak RSS of this process in bytes '''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def _cputime():
+    ''' Return the CPU time used by this process '''
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+class LoopProbe(object):
+
+    ''' Measure how late the poller runs a periodic timer '''
+
+    def __init__(self):
+        self.latency = Quantiles()
+        self.expected = 0.0
+
+    def start(self):
+        ''' Start probing '''
+        self.expected = utils.ticks() + PROBE_INTERVAL
+        POLLER.sched(PROBE_INTERVAL, self._probe)
+
+    def _probe(self):
+        ''' Account for the delay of this run '''
+        now = utils.ticks()
+        self.latency.add(max(0.0, now - self.expected))
+        self.expected = now + PROBE_INTERVAL
+        POLLER.sched(PROBE_INTERVAL, self._probe)
+
+def _start_servers(clients):
+    ''' Start the server components and return their ports '''
+
+    # Unchoke all clients at once, and never drop them
+    CONFIG['negotiate.parallelism'] = clients
+    CONFIG['negotiate.min_thresh'] = max(32, clients)
+    CONFIG['negotiate.max_thresh'] = max(32, clients) + 32
+
+    BACKEND.use_backend('null')
+    ports = {
+             'http': _free_port(),
+             'bittorrent': _free_port(),
+             'raw': _free_port(),
+            }
+
+    # Adapted from neubot/server.py
+    conf = CONFIG.copy()
+    conf['http.server.rootdir'] = ''
+    HTTP_SERVER.configure(conf)
+
+    RAW_SERVER_EX.listen(('127.0.0.1', ports['raw']), 0, 0, '')
+
+    negotiate.run(POLLER, conf)
+
+    conf['bittorrent.address'] = '127.0.0.1'
+    conf['bittorrent.port'] = ports['bittorrent']
+    conf['bittorrent.listen'] = True
+    conf['bittorrent.negotiate'] = True
+    bittorrent.run(POLLER, conf)
+
+    neubot.speedtest.wrapper.run(POLLER, conf)
+
+    HTTP_SERVER.listen(('127.0.0.1', ports['http']))
+
+    utils_modules.modprobe(None, 'server', {
+        'http_server': HTTP_SERVER,
+        'negotiate_server': NEGOTIATE_SERVER,
+    })
+
+    return ports
+
+def _run_server(wfile, clients):
+    ''' Run the servers until we receive SIGTERM, then write our
+        measurements on wfile and exit '''
+    ports = _start_servers(clients)
+    probe = LoopProbe()
+    begin = _cputime()
+
+    def report(signo, frame):
+        ''' Write the measurements and exit '''
+        latency = probe.latency.quantiles((0.5, 0.99, 1.0))
+        os.write(wfile, json.dumps({
+                                    'cpu': _cputime() - begin,
+                                    'max_rss': _maxrss(),
+                                    'loop_latency_median': latency[0],
+                                    'loop_latency_p99': latency[1],
+                                    'loop_latency_max': latency[2],
+                                   }) + '\n')
+        os._exit(0)
+
+    signal.signal(signal.SIGTERM, report)
+    probe.start()
+    os.write(wfile, json.dumps(ports) + '\n')
+    POLLER.loop()
+
+class ServerProcess(object):
+
+    ''' Run the servers in a child process '''
+
+    def __init__(self, clients, verbose=0):
+        rfile, wfile = os.pipe()
+        self.pid = os.fork()
+        if self.pid == 0:
+            try:
+                os.close(rfile)
+                if not verbose:
+                    devnull = os.open(os.devnull, os.O_WRONLY)
+                    os.dup2(devnull, 2)
+                _run_server(wfile, clients)
+            finally:
+                os._exit(1)
+        os.close(wfile)
+        self.rfile = os.fdopen(rfile)
+        self.ports = self._read()
+
+    def _read(self):
+        ''' Read a message from the child '''
+        line = self.rfile.readline()
+        if not line:
+            raise RuntimeError('bench: server process died')
+        return json.loads(line)
+
+    def stop(self):
+        ''' Stop the child and return its measurements '''
+        os.kill(self.pid, signal.SIGTERM)
+        try:
+            return self._read()
+        finally:
+            self.rfile.close()
+            os.waitpid(self.pid, 0)
+
+#
+# Client side
+#
+
+class Connection(object):
+
+    ''' Nonblocking loopback connection '''
+
+    def __init__(self, client, port):
+        self.client = client
+        self.sock = socket.create_connection(('127.0.0.1', port))
+        self.sock.setblocking(False)
+        self.outgoing = ''
+        self.closed = False
+
+    def fileno(self):
+        ''' Return the socket file number '''
+        return self.sock.fileno()
+
+    def send(self, data):
+        ''' Queue data for sending '''
+        self.outgoing += data
+
+    def handle_write(self):
+        ''' Send queued data '''
+        count = self.sock.send(self.outgoing)
+        self.outgoing = self.outgoing[count:]
+
+    def handle_read(self):
+        ''' Receive data and pass it to the client '''
+        data = self.sock.recv(MAXRECV)
+        if not data:
+            self.close()
+            self.client.connection_lost(self)
+            return
+        self.client.received += len(data)
+        self.received(data)
+
+    def received(self, data):
+        ''' Process incoming data '''
+
+    def close(self):
+        ''' Close the connection '''
+        if not self.closed:
+            self.closed = True
+            self.sock.close()
+
+class HTTPConnection(Connection):
+
+    ''' Connection that parses HTTP responses '''
+
+    def __init__(self, client, port):
+        Connection.__init__(self, client, port)
+        self.incoming = ''
+        self.left = -1
+        self.code = ''
+        self.body = []
+
+    def request(self, method, uri, body='', headers=()):
+        ''' Send an HTTP request '''
+        lines = ['%s %s HTTP/1.1' % (method, uri), 'Host: 127.0.0.1',
+                 'Content-Length: %d' % len(body)]
+        lines.extend('%s: %s' % header for header in headers)
+        if body:
+            lines.append('Content-Type: application/json')
+        self.send('\r\n'.join(lines) + '\r\n\r\n' + body)
+
+    def received(self, data):
+        while data and not self.closed:
+            if self.left < 0:
+                self.incoming += data
+                if '\r\n\r\n' not in self.incoming:
+                    return
+                head, data = self.incoming.split('\r\n\r\n', 1)
+                self.incoming = ''
+                lines = head.split('\r\n')
+                self.code = lines[0].split()[1]
+                self.left = 0
+                for line in lines[1:]:
+                    name, value = line.split(':', 1)
+                    if name.lower() == 'content-length':
+                        self.left = int(value)
+            # Keep small bodies only, i.e. the JSON ones
+            amount = min(self.left, len(data))
+            if self.left <= 65536:
+                self.body.append(data[:amount])
+            data = data[amount:]
+            self.left -= amount
+            if self.left == 0:
+                body, self.body, self.left = ''.join(self.body), [], -1
+                self.client.got_response(self, self.code, body)
+
+class FramedConnection(Connection):
+
+    ''' Connection that splits |length|code|body| frames, after skipping
+        the first `skip` bytes, and passes upstream the length and the
+        code of each frame '''
+
+    def __init__(self, client, port, skip):
+        Connection.__init__(self, client, port)
+        self.left = skip
+        self.header = ''
+
+    def received(self, data):
+        offset = 0
+        while offset < len(data) and not self.closed:
+            if self.left > 0:
+                amount = min(self.left, len(data) - offset)
+                offset += amount
+                self.left -= amount
+                continue
+            amount = min(4 - len(self.header), len(data) - offset)
+            if amount > 0:
+                self.header += data[offset:offset + amount]
+                offset += amount
+                if len(self.header) < 4:
+                    break
+            length = struct.unpack('!I', self.header)[0]
+            if length == 0:
+                self.header = ''
+                self.client.got_frame(self, 0, '')
+                continue
+            if offset == len(data):
+                break
+            self.header = ''
+            self.left = length - 1
+            self.client.got_frame(self, length, data[offset])
+            offset += 1
+
+class Client(object):
+
+    ''' Synthetic client that repeats a test session '''
+
+    def __init__(self, ports):
+        self.ports = ports
+        self.connections = []
+        self.received = 0
+        self.sessions = 0
+        self.errors = 0
+
+    def connect(self, factory, *args):
+        ''' Open a new connection '''
+        connection = factory(self, *args)
+        self.connections.append(connection)
+        return connection
+
+    def start(self):
+        ''' Start a new session '''
+
+    def restart(self, success=True):
+        ''' Close all connections and start a new session '''
+        if success:
+            self.sessions += 1
+        else:
+            self.errors += 1
+        for connection in self.connections:
+            connection.close()
+        self.connections = []
+        self.start()
+
+    def connection_lost(self, connection):
+        ''' Invoked when the peer closes a connection '''
+        self.restart(False)
+
+    def got_response(self, connection, code, body):
+        ''' Invoked when we receive an HTTP response '''
+
+    def got_frame(self, connection, length, code):
+        ''' Invoked when we receive a frame '''
+
+class SpeedtestClient(Client):
+
+    ''' Download SPEEDTEST_BODY bytes over and over '''
+
+    def start(self):
+        self.http = self.connect(HTTPConnection, self.ports['http'])
+        self._download()
+
+    def _download(self):
+        ''' Send the next download request '''
+        self.http.request('GET', '/speedtest/download', headers=(('Range',
+                          'bytes=0-%d' % (SPEEDTEST_BODY - 1)),))
+
+    def got_response(self, connection, code, body):
+        if code != '200':
+            self.restart(False)
+            return
+        self.sessions += 1
+        self._download()
+
+class NegotiatedClient(Client):
+
+    ''' Negotiate, run the test and (maybe) collect '''
+
+    test = ''
+    negotiate_body = '{}'
+
+    def __init__(self, ports):
+        Client.__init__(self, ports)
+        self.http = None
+        self.authorization = ''
+
+    def start(self):
+        self.http = self.connect(HTTPConnection, self.ports['http'])
+        self.http.request('POST', '/negotiate/' + self.test,
+                          self.negotiate_body)
+
+    def got_response(self, connection, code, body):
+        if code != '200':
+            self.restart(False)
+        elif not self.authorization:
+            message = json.loads(body)
+            if not message['unchoked']:
+                self.http.request('POST', '/negotiate/' + self.test,
+                                  self.negotiate_body)
+                return
+            self.authorization = message['authorization']
+            self.run_test()
+        else:
+            self.got_test_response(connection, body)
+
+    def collect(self):
+        ''' Send the collect request '''
+        self.http.request('POST', '/collect/' + self.test, PRIVACY)
+
+    def run_test(self):
+        ''' Run the test phase '''
+
+    def got_test_response(self, connection, body):
+        ''' Invoked when we receive a response after negotiation '''
+        if connection is self.http:
+            self.restart()
+
+    def restart(self, success=True):
+        self.authorization = ''
+        Client.restart(self, success)
+
+class NegotiateClient(NegotiatedClient):
+
+    ''' Negotiate and collect (speedtest module) '''
+
+    test = 'speedtest'
+
+    def run_test(self):
+        self.collect()
+
+class BitTorrentClient(NegotiatedClient):
+
+    ''' Download pieces until the server chokes us (test version 2) '''
+
+    test = 'bittorrent'
+    negotiate_body = json.dumps({'test_version': 2, 'target_bytes': 0})
+
+    def run_test(self):
+        peer = self.connect(FramedConnection, self.ports['bittorrent'], 68)
+        sha1 = hashlib.sha1()
+        sha1.update(self.authorization)
+        infohash = ''.join(chr(random.randint(32, 126)) for _ in range(20))
+        peer.send(''.join((chr(19), 'BitTorrent protocol', '\0' * 8,
+                  infohash, sha1.digest())))
+        peer.send(struct.pack('!Ic', 1, chr(2)))                 # INTERESTED
+        peer.send(struct.pack('!IcIII', 13, chr(6),             # REQUEST
+                  random.randrange(1 << 20), 0, PIECE_LEN))
+
+    def got_frame(self, connection, length, code):
+        # We don't upload, so we don't collect
+        if code == chr(0):                                      # CHOKE
+            self.restart()
+
+class RawClient(NegotiatedClient):
+
+    ''' Receive pieces until the end of the raw test '''
+
+    test = 'raw'
+
+    def run_test(self):
+        # Skip the fake auth the server sends first
+        stream = self.connect(FramedConnection, self.ports['raw'], AUTH_LEN)
+        stream.send(self.authorization.decode('hex') + RAWTEST)
+
+    def got_frame(self, connection, length, code):
+        if length == 0:
+            connection.close()
+            self.collect()
+
+class DASHClient(NegotiatedClient):
+
+    ''' Download DASH_SEGMENTS segments per session '''
+
+    test = 'dash'
+    negotiate_body = json.dumps({'dash_rates': [100]})
+
+    def __init__(self, ports):
+        NegotiatedClient.__init__(self, ports)
+        self.segments = 0
+        self.stream = None
+
+    def run_test(self):
+        self.segments = 0
+        self.stream = self.connect(HTTPConnection, self.ports['http'])
+        self._download()
+
+    def _download(self):
+        ''' Send the next segment request '''
+        self.stream.request('GET', '/dash/download/%d' % DASH_BODY,
+          headers=(('Authorization', self.authorization),))
+
+    def got_test_response(self, connection, body):
+        if connection is self.http:
+            self.restart()
+            return
+        self.segments += 1
+        if self.segments < DASH_SEGMENTS:
+            self._download()
+            return
+        connection.close()
+        self.collect()
+
+CLIENTS = {
+           'negotiate': NegotiateClient,
+           'speedtest': SpeedtestClient,
+           'bittorrent': BitTorrentClient,
+           'raw': RawClient,
+           'dash': DASHClient,
+          }
+
+def _dispatch(connection, handler):
+    ''' Invoke handler unless the connection is closed, and restart
+        the session of the client in case of socket errors '''
+    if connection.closed:
+        return
+    try:
+        handler()
+    except socket.error:
+        logging.warning('bench: socket error', exc_info=1)
+        connection.client.restart(False)
+
+def _drive(clients, duration):
+    ''' Run clients for duration seconds and return the elapsed time '''
+    begin = utils.ticks()
+    deadline = begin + duration
+    for client in clients:
+        client.start()
+    while True:
+        timeout = deadline - utils.ticks()
+        if timeout <= 0:
+            break
+        connections = [connection for client in clients
+                       for connection in client.connections
+                       if not connection.closed]
+        readable, writable, _ = select.select(connections, [connection
+          for connection in connections if connection.outgoing], [], timeout)
+        for connection in writable:
+            _dispatch(connection, connection.handle_write)
+        for connection in readable:
+            _dispatch(connection, connection.handle_read)
+    elapsed = utils.ticks() - begin
+    for client in clients:
+        for connection in client.connections:
+            connection.close()
+    return elapsed
+
+def run(test, clients, duration, verbose=0):
+    ''' Run clients concurrent clients of test for duration
+        seconds and return the results '''
+    server = ServerProcess(clients, verbose)
+    try:
+        vector = [CLIENTS[test](server.ports) for _ in range(clients)]
+        elapsed = _drive(vector, duration)
+    finally:
+        measurements = server.stop()
+    received = sum(client.received for client in vector)
+    result = {
+              'test': test,
+              'clients': clients,
+              'duration': elapsed,
+              'bytes': received,
+              'throughput': received / elapsed,
+              'sessions': sum(client.sessions for client in vector),
+              'errors': sum(client.errors for client in vector),
+              'cpu_per_byte': None,
+              'timestamp': utils.timestamp(),
+              'version': utils_version.NUMERIC_VERSION,
+             }
+    result.update(measurements)
+    if received:
+        result['cpu_per_byte'] = measurements['cpu'] / received
+    return result
+
+USAGE = '''\
+usage: neubot bench [-v] [-c clients] [-d duration] [test ...]
+
+Runs each test (default: all) against local server components with
+each number of concurrent clients (comma separated, default: 1,8) for
+duration seconds (default: 10), and prints one JSON object per run.
+
+valid tests: %s''' % ' '.join(TESTS)
+
+def main(args):
+    ''' Main function '''
+
+    try:
+        options, arguments = getopt.getopt(args[1:], 'c:d:v')
+    except getopt.error:
+        sys.exit(USAGE)
+
+    clients = (1, 8)
+    duration = 10.0
+    verbose = 0
+    for name, value in options:
+        if name == '-c':
+            clients = [int(number) for number in value.split(',')]
+        elif name == '-d':
+            duration = float(value)
+        elif name == '-v':
+            verbose = 1
+
+    for test in arguments:
+        if test not in TESTS:
+            sys.exit(USAGE)
+    if not arguments:
+        arguments = TESTS
+
+    for test in arguments:
+        for number in clients:
+            logging.info('bench: %s with %d clients... in progress',
+                         test, number)
+            result = run(test, number, duration, verbose)
+            sys.stdout.write(json.dumps(result, sort_keys=True) + '\n')
+            sys.stdout.flush()
+            logging.info('bench: %s with %d clients... complete', test, number)
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -42,6 +42,7 @@ from neubot.database import DATABASE
 from neubot.database import table_bittorrent
 from neubot import utils_version
 from neubot.notify import NOTIFIER
+from neubot.runner_discovery import DISCOVERY_CACHE
 from neubot.state import STATE
 
 from neubot import privacy
@@ -226,4 +227,5 @@ class BitTorrentClient(ClientHTTP):
         uri = "http://%s/" % self.host_header
         logging.info("BitTorrent: connecting to %s ... failure (error: %s)",
           uri, str(exception))
+        DISCOVERY_CACHE.mark_stale(uri)
         NOTIFIER.publish(TESTDONE)
@@ -42,6 +42,9 @@ PIECE_LEN = 1 << 17
 
 MAXMESSAGE = 1 << 18
 
+# Messages larger than this are passed upstream piecewise
+SMALLMESSAGE = 1 << 14
+
 PROPERTIES = (
     ('bittorrent.address', '', 'Address to listen/connect to ("" = auto)'),
     ('bittorrent.bytes.down', 0, 'Num of bytes to download (0 = auto)'),
@@ -44,6 +44,7 @@ from neubot.net.stream import StreamHandler
 from neubot.bittorrent import config
 from neubot.config import CONFIG
 from neubot.state import STATE
+from neubot.utils_random import PAYLOAD
 
 from neubot import utils
 from neubot import utils_net
@@ -136,7 +137,7 @@ class PeerNeubot(StreamHandler):
         else:
             peer = self
         stream.attach(peer, sock, peer.conf)
-        stream.watchdog = self.conf["bittorrent.watchdog"]
+        stream.set_timeout(self.conf["bittorrent.watchdog"])
 
     def connection_ready(self, stream):
         stream.send_bitfield(str(self.bitfield))
@@ -190,13 +191,7 @@ class PeerNeubot(StreamHandler):
         if self.version == 2:
             return
 
-        #
-        # TODO Here we should use the random block
-        # generator but before we do that we should
-        # also make sure it does not slow down the
-        # bittorrent test.
-        #
-        block = chr(random.randint(32, 126)) * length
+        block = PAYLOAD.get(length)
         stream.send_piece(index, begin, block)
 
     def send_complete(self, stream):
@@ -218,13 +213,7 @@ class PeerNeubot(StreamHandler):
             if self.version == 3:
                 return
 
-            #
-            # TODO Here we should use the random block
-            # generator but before we do that we should
-            # also make sure it does not slow down the
-            # bittorrent test.
-            #
-            block = chr(random.randint(32, 126)) * PIECE_LEN
+            block = PAYLOAD.get(PIECE_LEN)
             index = random.randrange(self.numpieces)
             stream.send_piece(index, 0, block)
 
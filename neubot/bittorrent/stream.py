@@ -25,9 +25,14 @@ import struct
 import logging
 
 from neubot.bittorrent.config import MAXMESSAGE
+from neubot.bittorrent.config import SMALLMESSAGE
 
 from neubot.net.stream import Stream
 
+from neubot import log_trace
+
+TRACE = log_trace.tracer('bittorrent')
+
 # Available msgs
 MESSAGES = (CHOKE, UNCHOKE, INTERESTED, NOT_INTERESTED, HAVE, BITFIELD,
             REQUEST, PIECE, CANCEL) = [chr(num) for num in range(9)]
@@ -55,6 +60,9 @@ FLAGS = ''.join(FLAGS)
 # Protocol name (for handshake)
 PROTOCOL_NAME = 'BitTorrent protocol'
 
+# Length of the PIECE header (type, index and begin)
+PIECE_HEADER = 9
+
 def toint(data):
     ''' Converts binary data to integer '''
     return struct.unpack("!I", data)[0]
@@ -78,6 +86,8 @@ class StreamBitTorrent(Stream):
         self.count = 0
         self.id = None
         self.piece = None
+        self.big = False
+        self.smallmessage = SMALLMESSAGE
 
     def connection_made(self):
         ''' Invoked when the connection is established '''
@@ -92,62 +102,79 @@ class StreamBitTorrent(Stream):
 
     def _send_handshake(self):
         ''' Convenience function to send handshake '''
-        logging.debug("> HANDSHAKE infohash=%s id=%s",
-                      self.parent.infohash.encode("hex"),
-                      self.parent.my_id.encode("hex"))
+        if TRACE.enabled:
+            logging.debug("> HANDSHAKE infohash=%s id=%s",
+                          self.parent.infohash.encode("hex"),
+                          self.parent.my_id.encode("hex"))
         self.start_send("".join((chr(len(PROTOCOL_NAME)), PROTOCOL_NAME,
           FLAGS, self.parent.infohash, self.parent.my_id)))
 
     def send_interested(self):
         ''' Send the INTERESTED message '''
-        logging.debug("> INTERESTED")
+        if TRACE.enabled:
+            logging.debug("> INTERESTED")
         self._send_message(INTERESTED)
 
     def send_not_interested(self):
         ''' Send the NOT_INTERESTED message '''
-        logging.debug("> NOT_INTERESTED")
+        if TRACE.enabled:
+            logging.debug("> NOT_INTERESTED")
         self._send_message(NOT_INTERESTED)
 
     def send_choke(self):
         ''' Send the CHOKE message '''
-        logging.debug("> CHOKE")
+        if TRACE.enabled:
+            logging.debug("> CHOKE")
         self._send_message(CHOKE)
 
     def send_unchoke(self):
         ''' Send the UNCHOKE message '''
-        logging.debug("> UNCHOKE")
+        if TRACE.enabled:
+            logging.debug("> UNCHOKE")
         self._send_message(UNCHOKE)
 
     def send_request(self, index, begin, length):
         ''' Send the REQUEST message '''
-        logging.debug("> REQUEST %d %d %d", index, begin, length)
+        if TRACE.enabled:
+            logging.debug("> REQUEST %d %d %d", index, begin, length)
         self._send_message(struct.pack("!cIII", REQUEST, index, begin, length))
 
     def send_cancel(self, index, begin, length):
         ''' Send the CANCEL message '''
-        logging.debug("> CANCEL %d %d %d", index, begin, length)
+        if TRACE.enabled:
+            logging.debug("> CANCEL %d %d %d", index, begin, length)
         self._send_message(struct.pack("!cIII", CANCEL, index, begin, length))
 
     def send_bitfield(self, bitfield):
         ''' Send the BITFIELD message '''
-        logging.debug("> BITFIELD {bitfield}")
+        if TRACE.enabled:
+            logging.debug("> BITFIELD {bitfield}")
         self._send_message(BITFIELD, bitfield)
 
     def send_have(self, index):
         ''' Send the HAVE message '''
-        logging.debug("> HAVE %d", index)
+        if TRACE.enabled:
+            logging.debug("> HAVE %d", index)
         self._send_message(struct.pack("!cI", HAVE, index))
 
     def send_keepalive(self):
         ''' Send the KEEPALIVE message '''
-        logging.debug("> KEEPALIVE")
+        if TRACE.enabled:
+            logging.debug("> KEEPALIVE")
         self._send_message('')
 
     def send_piece(self, index, begin, block):
         ''' Send the PIECE message '''
-        logging.debug("> PIECE %d %d len=%d", index, begin, len(block))
-        self._send_message(struct.pack("!cII%ss" % len(block), PIECE,
-          index, begin, block))
+        if TRACE.enabled:
+            logging.debug("> PIECE %d %d len=%d", index, begin, len(block))
+        #
+        # We queue the header and the block separately, so that we
+        # don't copy the block, which may also be a buffer.  The stream
+        # sends them using a single vectored send, when possible.
+        #
+        self.start_send(struct.pack("!IcII", PIECE_HEADER + len(block),
+          PIECE, index, begin))
+        self.start_send(block)
 
     def _send_message(self, *msg_a):
         ''' Convenience function to send a message '''
@@ -169,6 +196,12 @@ class StreamBitTorrent(Stream):
     # of bytes we've read so far, and self.buff contains a portion
     # of the next message.
     #
+    # Messages larger than self.smallmessage are big, and we don't
+    # reassemble them: we pass upstream their first PIECE_HEADER bytes
+    # and then buffers that reference the incoming data, without
+    # copying it.  A fourth state variable, self.big, tells whether
+    # the current message is big.
+    #
     def recv_complete(self, s):
 
         ''' Invoked when recv() completes '''
@@ -185,24 +218,45 @@ class StreamBitTorrent(Stream):
                 if self.count == 4:
                     self.left = toint("".join(self.buff))
                     if self.left == 0:
-                        logging.debug("< KEEPALIVE")
+                        if TRACE.enabled:
+                            logging.debug("< KEEPALIVE")
                     elif self.left > MAXMESSAGE:
                         raise RuntimeError('Message too big')
+                    self.big = self.left > self.smallmessage
                     del self.buff[:]
                     self.count = 0
 
                 elif self.count > 4:
                     raise RuntimeError("Invalid self.count")
 
+            # Pass upstream the body of big messages
+            elif self.left > 0 and self.big and self.count >= PIECE_HEADER:
+                amt = min(len(s), self.left)
+                self._got_message_part(buffer(s, 0, amt))
+                s = buffer(s, amt)
+                self.left -= amt
+                self.count += amt
+
+                if self.left == 0:
+                    self._got_message_end()
+                    self.big = False
+                    self.count = 0
+
             # Bufferize and pass upstream messages
             elif self.left > 0:
                 amt = min(len(s), self.left)
+                if self.big:
+                    amt = min(amt, PIECE_HEADER - self.count)
                 self.buff.append(s[:amt])
                 s = buffer(s, amt)
                 self.left -= amt
                 self.count += amt
 
-                if self.left == 0:
+                if self.big and self.count == PIECE_HEADER:
+                    self._got_message_start("".join(self.buff))
+                    del self.buff[:]
+
+                elif self.left == 0:
                     self._got_message("".join(self.buff))
                     del self.buff[:]
                     self.count = 0
@@ -227,8 +281,9 @@ class StreamBitTorrent(Stream):
                 raise RuntimeError("Invalid handshake")
             self.id = message[-20:]
             infohash = message[-40:-20]
-            logging.debug("< HANDSHAKE infohash=%s id=%s",
-                          infohash.encode("hex"), self.id.encode("hex"))
+            if TRACE.enabled:
+                logging.debug("< HANDSHAKE infohash=%s id=%s",
+                              infohash.encode("hex"), self.id.encode("hex"))
 
             #
             # In Neubot the listener does not have an infohash
@@ -255,54 +310,100 @@ class StreamBitTorrent(Stream):
         self.got_anything = True
 
         if t == CHOKE:
-            logging.debug("< CHOKE")
+            if TRACE.enabled:
+                logging.debug("< CHOKE")
             self.parent.got_choke(self)
 
         elif t == UNCHOKE:
-            logging.debug("< UNCHOKE")
+            if TRACE.enabled:
+                logging.debug("< UNCHOKE")
             self.parent.got_unchoke(self)
 
         elif t == INTERESTED:
-            logging.debug("< INTERESTED")
+            if TRACE.enabled:
+                logging.debug("< INTERESTED")
             self.parent.got_interested(self)
 
         elif t == NOT_INTERESTED:
-            logging.debug("< NOT_INTERESTED")
+            if TRACE.enabled:
+                logging.debug("< NOT_INTERESTED")
             self.parent.got_not_interested(self)
 
         elif t == HAVE:
             i = struct.unpack("!xI", message)[0]
             if i >= self.parent.numpieces:
                 raise RuntimeError("HAVE: index out of bounds")
-            logging.debug("< HAVE %d", i)
+            if TRACE.enabled:
+                logging.debug("< HAVE %d", i)
             self.parent.got_have(i)
 
         elif t == BITFIELD:
-            logging.debug("< BITFIELD {bitfield}")
+            if TRACE.enabled:
+                logging.debug("< BITFIELD {bitfield}")
             self.parent.got_bitfield(message[1:])
 
         elif t == REQUEST:
             i, a, b = struct.unpack("!xIII", message)
-            logging.debug("< REQUEST %d %d %d", i, a, b)
+            if TRACE.enabled:
+                logging.debug("< REQUEST %d %d %d", i, a, b)
             if i >= self.parent.numpieces:
                 raise RuntimeError("REQUEST: index out of bounds")
             self.parent.got_request(self, i, a, b)
 
         elif t == CANCEL:
             i, a, b = struct.unpack("!xIII", message)
-            logging.debug("< CANCEL %d %d %d", i, a, b)
+            if TRACE.enabled:
+                logging.debug("< CANCEL %d %d %d", i, a, b)
             if i >= self.parent.numpieces:
                 raise RuntimeError("CANCEL: index out of bounds")
             # NOTE Ignore CANCEL message
 
         elif t == PIECE:
-            n = len(message) - 9
-            i, a, b = struct.unpack("!xII%ss" % n, message)
-            logging.debug("< PIECE %d %d len=%d", i, a, n)
+            i, a = struct.unpack("!xII", message[:PIECE_HEADER])
+            if TRACE.enabled:
+                logging.debug("< PIECE %d %d len=%d", i, a,
+                              len(message) - PIECE_HEADER)
             if i >= self.parent.numpieces:
                 raise RuntimeError("PIECE: index out of bounds")
-            self.parent.got_piece(self, i, a, b)
+            self.parent.got_piece(self, i, a, [buffer(message,
+                                                      PIECE_HEADER)])
+
+    #
+    # We don't expect big messages other than PIECE, except for the
+    # initial BITFIELD, so we reassemble them and we process them as
+    # usual.  For PIECE, we pass upstream the block as a list of
+    # buffers referencing the received data.
+    #
+
+    def _got_message_start(self, header):
+        ''' Invoked when we receive the header of a big message '''
+        self.piece = [header]
+        if header[0] != PIECE:
+            return
+        i = struct.unpack("!xII", header)[0]
+        if i >= self.parent.numpieces:
+            raise RuntimeError("PIECE: index out of bounds")
+        self.got_anything = True
+
+    def _got_message_part(self, octets):
+        ''' Invoked when we receive a part of a big message '''
+        self.piece.append(octets)
+
+    def _got_message_end(self):
+        ''' Invoked when we receive the end of a big message '''
+        header, block = self.piece[0], self.piece[1:]
+        self.piece = None
+        if header[0] != PIECE:
+            block.insert(0, header)
+            self._got_message("".join([str(elem) for elem in block]))
+            return
+        i, a = struct.unpack("!xII", header)
+        if TRACE.enabled:
+            logging.debug("< PIECE %d %d len=%d", i, a,
+                          sum([len(elem) for elem in block]))
+        self.parent.got_piece(self, i, a, block)
 
     def connection_lost(self, exception):
         ''' Invoked when the connection is lost '''
         del self.buff[:]
+        self.piece = None
@@ -25,6 +25,8 @@
 # Python3-ready: yes
 
 from collections import deque
+
+from neubot.bufpool import Slice
 from neubot import six
 
 NEWLINE = six.b('\n')
@@ -96,3 +98,70 @@ class Brigade(object):
         self.brigade.appendleft(tmp)
         self.total += len(tmp)
         return EMPTY
+
+class SliceBrigade(Brigade):
+
+    '''
+     Bucket brigade that holds Slices of pooled receive buffers
+     (see neubot/bufpool.py) and copies only what is pulled up.
+    '''
+
+    def bufferise(self, octets):
+        ''' Bufferise incoming data (a Slice or a string) '''
+        if not isinstance(octets, Slice):
+            octets = Slice(octets, 0, len(octets))
+        if octets:
+            self.brigade.append(octets)
+            self.total += len(octets)
+
+    def skip(self, length):
+        ''' Skip up to lenght bytes from brigade '''
+        if self.total >= length:
+            while length > 0:
+                bucket = self.brigade[0]
+                if len(bucket) > length:
+                    bucket.start += length
+                    self.total -= length
+                    return 0
+                self.brigade.popleft()
+                length -= len(bucket)
+                self.total -= len(bucket)
+                bucket.release()
+        return length
+
+    def pullup(self, length):
+        ''' Pullup length bytes from brigade '''
+        retval = []
+        if self.total >= length:
+            while length > 0:
+                bucket = self.brigade[0]
+                octets = bucket.tobytes(length)
+                retval.append(octets)
+                self.total -= len(octets)
+                length -= len(octets)
+                if len(octets) < len(bucket):
+                    bucket.start += len(octets)
+                else:
+                    self.brigade.popleft()
+                    bucket.release()
+        if len(retval) == 1:
+            return retval[0]
+        return EMPTY.join(retval)
+
+    def getline(self, maxline):
+        ''' Read line from brigade '''
+        count = 0
+        for bucket in self.brigade:
+            index = bucket.find(NEWLINE)
+            if index >= 0 and count + index < maxline:
+                return self.pullup(count + index + 1)
+            count += len(bucket)
+            if count >= maxline:
+                raise RuntimeError('brigade: line too long')
+        return EMPTY
+
+    def clear(self):
+        ''' Release all the buffered slices '''
+        while self.brigade:
+            self.brigade.popleft().release()
+        self.total = 0
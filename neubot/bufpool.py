@@ -0,0 +1,195 @@
+# neubot/bufpool.py
+
+#
+# Copyright (c) 2013
+#     Nexa Center for Internet & Society, Politecnico di Torino (DAUIN),
+#     and Simone Basso <bassosimone@gmail.com>
+#
+# This file is part of Neubot <http://www.neubot.org/>.
+#
+# Neubot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Neubot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Neubot.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+''' Pooled receive buffers '''
+
+# Python3-ready: yes
+
+from neubot import six
+
+EMPTY = six.b('')
+
+#
+# recv() allocates a new string each time it is invoked, and, during
+# a fast download, the allocator becomes a bottleneck.  Here we receive
+# with recv_into() in large preallocated buffers, which are handed to
+# the protocol as Slice objects (i.e. references to a region of one of
+# such buffers).  Each buffer counts its live slices: the protocol
+# invokes Slice.release() when it is done with a slice, and, when no
+# slice is alive, the buffer is rewound and filled again from the start.
+# Buffers that are full while slices are still alive are retired and
+# go back to the pool after their last slice is released.
+#
+# A slice that is never released does not cause any harm: its buffer
+# is not reused and is eventually garbage collected.
+#
+
+# Size of each pooled buffer
+BUFSIZE = 262144
+
+# When less than this room is left, use another buffer
+MINRECV = 16384
+
+# Max number of buffers kept in the pool
+MAXFREE = 16
+
+class RecvBuffer(object):
+
+    ''' A buffer filled by recv_into() '''
+
+    def __init__(self, pool, size):
+        self.pool = pool
+        self.octets = bytearray(size)
+        self.size = size
+        self.view = memoryview(self.octets)
+        self.offset = 0
+        self.refs = 0
+        self.retired = False
+
+class Slice(object):
+
+    ''' A region of a receive buffer (or of a string) '''
+
+    __slots__ = ('octets', 'start', 'end', 'rbuf')
+
+    def __init__(self, octets, start, end, rbuf=None):
+        self.octets = octets
+        self.start = start
+        self.end = end
+        self.rbuf = rbuf
+
+    def __len__(self):
+        return self.end - self.start
+
+    def find(self, sub, start=0):
+        ''' Like str.find(), but relative to this slice '''
+        index = self.octets.find(sub, self.start + start, self.end)
+        if index >= 0:
+            index -= self.start
+        return index
+
+    def tobytes(self, count=None):
+        ''' Copy up to count bytes of this slice into a string '''
+        end = self.end
+        if count is not None:
+            end = min(end, self.start + count)
+        if self.rbuf is None:
+            return self.octets[self.start:end]
+        return self.rbuf.view[self.start:end].tobytes()
+
+    def release(self):
+        ''' Tell the receive buffer we're done with this slice '''
+        rbuf = self.rbuf
+        if rbuf is None:
+            return
+        self.rbuf = None
+        self.octets = EMPTY
+        self.start = self.end = 0
+        rbuf.refs -= 1
+        if rbuf.refs == 0 and rbuf.retired:
+            rbuf.pool.put(rbuf)
+
+class BufferPool(object):
+
+    ''' Pool of receive buffers '''
+
+    def __init__(self, bufsize=BUFSIZE, maxfree=MAXFREE):
+        self.bufsize = bufsize
+        self.maxfree = maxfree
+        self.free = []
+        self.allocated = 0
+        self.reused = 0
+
+    def get(self):
+        ''' Get a receive buffer from the pool '''
+        if self.free:
+            self.reused += 1
+            return self.free.pop()
+        self.allocated += 1
+        return RecvBuffer(self, self.bufsize)
+
+    def put(self, rbuf):
+        ''' Give a receive buffer back to the pool '''
+        if len(self.free) < self.maxfree:
+            rbuf.offset = 0
+            rbuf.retired = False
+            self.free.append(rbuf)
+
+    def snap(self):
+        ''' Returns the pool counters '''
+        return {
+            'allocated': self.allocated,
+            'free': len(self.free),
+            'reused': self.reused,
+        }
+
+POOL = BufferPool()
+
+class Receiver(object):
+
+    ''' Receive data from a socket into pooled buffers '''
+
+    def __init__(self, pool=POOL):
+        self.pool = pool
+        self.rbuf = None
+
+    def recv(self, sock, maxlen):
+        ''' Receive up to maxlen bytes and return a Slice, or an
+            empty string on EOF.  Raises socket.error like recv(). '''
+
+        # Note: this is the fast path, so we avoid method calls
+        rbuf = self.rbuf
+        if rbuf is None:
+            rbuf = self.rbuf = self.pool.get()
+        elif rbuf.refs == 0:
+            rbuf.offset = 0
+        elif rbuf.size - rbuf.offset < MINRECV and (
+                rbuf.size - rbuf.offset < maxlen):
+            rbuf.retired = True
+            rbuf = self.rbuf = self.pool.get()
+
+        start = rbuf.offset
+        if start == 0:
+            if maxlen > rbuf.size:
+                maxlen = rbuf.size
+            count = sock.recv_into(rbuf.octets, maxlen)
+        else:
+            if maxlen > rbuf.size - start:
+                maxlen = rbuf.size - start
+            count = sock.recv_into(rbuf.view[start:], maxlen)
+        if count <= 0:
+            return EMPTY
+
+        rbuf.offset = start + count
+        rbuf.refs += 1
+        return Slice(rbuf.octets, start, start + count, rbuf)
+
+    def close(self):
+        ''' Give the current buffer back to the pool '''
+        rbuf, self.rbuf = self.rbuf, None
+        if rbuf is None:
+            return
+        if rbuf.refs == 0:
+            self.pool.put(rbuf)
+        else:
+            rbuf.retired = True
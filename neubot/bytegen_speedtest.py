@@ -28,7 +28,7 @@ import sys
 if __name__ == '__main__':
     sys.path.insert(0, '.')
 
-from neubot.utils_random import RANDOMBLOCKS
+from neubot.utils_random import PAYLOAD
 from neubot import utils
 
 PIECE_LEN = 262144
@@ -43,24 +43,28 @@ class BytegenSpeedtest(object):
         self.closed = False
         self.piece_len = piece_len
 
-    def read(self, count=sys.maxint):
-        ''' Read count bytes '''
+    def readbuf(self, count=sys.maxint):
+        ''' Like read() but returns a list of buffers '''
 
         if self.closed:
-            return ''
+            return []
         if count < self.piece_len:
             raise RuntimeError('Invalid count')
 
         diff = utils.ticks() - self.ticks
         if diff < self.seconds:
-            data = RANDOMBLOCKS.get_block()[:self.piece_len]
-            length = '%x\r\n' % self.piece_len
+            data = PAYLOAD.get(self.piece_len)
+            length = '%x\r\n' % len(data)
             vector = [ length, data, '\r\n' ]
         else:
             vector = [ '0\r\n', '\r\n' ]
             self.closed = True
 
-        return ''.join(vector)
+        return vector
+
+    def read(self, count=sys.maxint):
+        ''' Read count bytes '''
+        return ''.join([str(elem) for elem in self.readbuf(count)])
 
     def close(self):
         ''' Close  '''
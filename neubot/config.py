@@ -37,8 +37,11 @@ import shlex
 import logging
 
 from neubot.database import table_config
+from neubot import log_trace
 from neubot import utils
 
+TRACE = log_trace.tracer('config')
+
 def string_to_kv(string):
 
     """Convert string to (key,value).  Returns the empty tuple if
@@ -76,7 +79,8 @@ class ConfigDict(dict):
             ovalue = "(none)"
             cast = utils.smart_cast(value)
         value = cast(value)
-        logging.debug("config: %s: %s -> %s", key, ovalue, value)
+        if TRACE.enabled:
+            logging.debug("config: %s: %s -> %s", key, ovalue, value)
         dict.__setitem__(self, key, value)
 
     def update(self, *args, **kwds):
@@ -99,6 +103,7 @@ class Config(object):
         self.properties = []
         self.conf = ConfigDict()
         self.descriptions = {}
+        self.watchers = {}
 
     def register_defaults(self, kvstore):
         self.conf.update(kvstore)
@@ -117,6 +122,15 @@ class Config(object):
 
     def __setitem__(self, key, value):
         self.conf[key] = value
+        self._notify_watchers(key)
+
+    def register_watcher(self, key, func):
+        """Invoke func(key, value) each time key is set"""
+        self.watchers.setdefault(key, []).append(func)
+
+    def _notify_watchers(self, key):
+        for func in self.watchers.get(key, ()):
+            func(key, self.conf[key])
 
     def register_property(self, prop, module=""):
         if module and not prop.startswith(module):
@@ -155,6 +169,7 @@ class Config(object):
             key, value = t
             if not dry:
                 self.conf[key] = value
+                self._notify_watchers(key)
 
             else:
                 try:
@@ -204,14 +219,19 @@ CONFIG.register_defaults({
     "agent.rendezvous": True,
     "agent.use_syslog": False,
     "bittorrent_test_version": 1,
+    "database.journal_mode": "delete",
+    "database.synchronous": "normal",
     "enabled": True,
     'verbose': 0,
+    "log.trace": "all",
+    "net.listen.accept_budget": 64,
     "notifier_browser.min_interval": 86400,
     "notifier_browser.honor_enabled": False,
     "prefer_ipv6": 0,
     "privacy.informed": False,
     "privacy.can_collect": False,
     "privacy.can_publish": False,
+    "runner.discovery_ttl": 3600,
     "runner.enabled": 1,
     "speedtest_test_version": 1,
     "uuid": "",
@@ -239,14 +259,19 @@ CONFIG.register_descriptions({
     "agent.rendezvous": "Enable rendezvous client",
     "agent.use_syslog": "Force syslog usage in any case",
     "bittorrent_test_version": "Version 1 is the old one, version 2 controls duration at the sender",
+    "database.journal_mode": "Database journal mode (`delete', `truncate', `persist', `memory', `off' or `wal'; with `wal' unprivileged users cannot read the database)",
+    "database.synchronous": "Database synchronous level (`off', `normal' or `full')",
     "enabled": "Enable Neubot to perform automatic transmission tests",
     'verbose': 'Set to 1 to get more log messages',
+    "log.trace": "Modules that trace debug messages when verbose (`all', `none' or e.g. `bittorrent,http')",
+    "net.listen.accept_budget": "Max number of connections accepted per listener wakeup",
     "notifier_browser.min_interval": "Minimum interval between each browser notification",
     "notifier_browser.honor_enabled": "Set to 1 to suppress notifications when Neubot is disabled",
     "prefer_ipv6": "Prefer IPv6 over IPv4 when resolving domain names",
     "privacy.informed": "You assert that you have read and understood the privacy policy",
     "privacy.can_collect": "You give Neubot the permission to collect your Internet address for research purposes",
     "privacy.can_publish": "You give Neubot the permission to publish on the web your Internet address so that it can be reused for research purposes",
+    "runner.discovery_ttl": "Seconds for which the runner reuses the servers it discovered (0 disables caching)",
     "runner.enabled": "When true command line tests are executed in the context of the local daemon, provided that it is running",
     "speedtest_test_version": "Version 1 is the old one, version 2 controls duration at the sender",
     "uuid": "Random unique identifier of this Neubot agent",
@@ -259,7 +284,7 @@ CONFIG.register_descriptions({
     "www_no_description": "Set to nonzero to hide test description",
     "www_no_legend": "Set to nonzero to hide the plot legend",
     "www_no_plot": "Set to nonzero to hide the plot(s)",
-    "www_no_split_by_ip": "Set to nonzero to avoid split by IP address",
+    "www_no_split_by_ip": "Set to nonzero to hide the per-server summary",
     "www_no_table": "Set to nonzero to hide the table",
     "www_no_title": "Set to nonzero to hide test-specific title",
 })
@@ -31,6 +31,7 @@ import logging
 from neubot.defer import Deferred
 from neubot.pollable import Pollable
 from neubot.poller import POLLER
+from neubot.resolver import RESOLVER
 
 from neubot import utils_net
 from neubot import utils
@@ -85,7 +86,11 @@ class Connector(Pollable):
 
     def _connect(self):
         ''' Connect first available epnt '''
-        sock = utils_net.connect(self.epnts.popleft(), self.prefer_ipv6)
+        RESOLVER.connect(self.epnts.popleft(), self.prefer_ipv6,
+                         self._connect_started)
+
+    def _connect_started(self, sock):
+        ''' Invoked when we have resolved the epnt '''
         if sock:
             self.sock = sock
             self.timestamp = utils.ticks()
@@ -32,12 +32,95 @@ from neubot.database import table_log
 from neubot.database import table_speedtest
 from neubot.database import table_bittorrent
 from neubot.database import table_raw
+from neubot.database import table_aggregate
 from neubot.database import migrate
 from neubot.database import migrate2
 
+from neubot.notify import NOTIFIER
+from neubot.poller import POLLER
+
 from neubot import database_xxx
 from neubot import system
 
+#
+# Tuning.  The database uses the journal mode and the synchronous
+# level specified by the 'database.journal_mode' and the
+# 'database.synchronous' settings, which are applied again each time
+# they change.  The default is DELETE mode, i.e. the rollback journal,
+# with NORMAL synchronous level, which syncs less often than FULL.
+#
+# WAL mode is faster, and lets readers (e.g. /api/data) run concurrently
+# with the thread that writes logs (see neubot/log_writer.py), but it is
+# not the default because WAL readers need to write the -shm file, which
+# SQLite removes when the last connection is closed.  So, unprivileged
+# users, who open the database in readonly mode and cannot create files
+# in the database directory, cannot read a WAL database.  The journal
+# mode is saved in the database, and we apply the setting each time we
+# connect with enough privileges, so a database left in WAL mode goes
+# back to DELETE mode the next time the daemon connects.
+#
+# Grouped transactions.  The table functions commit after each
+# operation, unless told otherwise.  Between begin_group() and
+# end_group() commits are deferred, so that a batch of operations
+# becomes a single transaction.  Groups can be nested, and only
+# the outermost end_group() commits.
+#
+# Indexes.  Each table's create() function creates the timestamp
+# and lookup indexes, if they do not exist, so databases created by
+# older versions of Neubot get them the first time we connect.
+#
+# Summaries.  The aggregate table contains per-day and per-server
+# summaries of the results (see table_aggregate.py), updated each
+# time we insert a result.  When we create it, i.e. the first time
+# we connect to a database created by older versions of Neubot, we
+# must also summarize the results already in the database, which
+# may take minutes with many results.  So we do that in background,
+# SUMMARIZE_PAGE results every SUMMARIZE_INTERVAL seconds, from a
+# task scheduled on the poller, and we pause while a test is in
+# progress.  If we are stopped before we are done, we resume the
+# next time we connect.
+#
+
+JOURNAL_MODES = ('delete', 'truncate', 'persist', 'memory', 'wal', 'off')
+SYNCHRONOUS_LEVELS = ('off', 'normal', 'full')
+
+SUMMARIZE_PAGE = 1024
+SUMMARIZE_INTERVAL = 0.25
+SUMMARIZED_TABLES = (
+    ('bittorrent', table_bittorrent),
+    ('raw', table_raw),
+    ('speedtest', table_speedtest),
+)
+
+class Connection(sqlite3.Connection):
+
+    ''' Connection that can group many commits into one '''
+
+    def __init__(self, *args, **kwargs):
+        sqlite3.Connection.__init__(self, *args, **kwargs)
+        self.group_depth = 0
+        self.deferred = False
+
+    def begin_group(self):
+        ''' Defer commits until the matching end_group() '''
+        self.group_depth += 1
+
+    def end_group(self):
+        ''' Commit if this is the outermost group '''
+        if self.group_depth <= 0:
+            raise RuntimeError('database: end_group() without begin_group()')
+        self.group_depth -= 1
+        if self.group_depth == 0 and self.deferred:
+            self.deferred = False
+            sqlite3.Connection.commit(self)
+
+    def commit(self):
+        ''' Commit, unless we are inside a group '''
+        if self.group_depth > 0:
+            self.deferred = True
+            return
+        sqlite3.Connection.commit(self)
+
 class DatabaseManager(object):
     ''' Manages connection to database '''
 
@@ -45,6 +128,9 @@ class DatabaseManager(object):
         self.path = system.get_default_database_path()
         self.readonly = False
         self.dbc = None
+        self.watching = False
+        self.summarizing = False
+        self.forked = False
 
     def set_path(self, path):
         ''' Overrides default database path '''
@@ -62,7 +148,7 @@ class DatabaseManager(object):
                 self.path = system.check_database_path(self.path)
 
             logging.debug("* Database: %s", self.path)
-            self.dbc = sqlite3.connect(self.path)
+            self.dbc = sqlite3.connect(self.path, factory=Connection)
 
             #
             # To avoid the need to map at hand columns in
@@ -97,14 +183,157 @@ class DatabaseManager(object):
             migrate.migrate(self.dbc)
             migrate2.migrate(self.dbc)
 
-            table_speedtest.create(self.dbc)
-            table_geoloc.create(self.dbc)
-            table_bittorrent.create(self.dbc)
-            table_log.create(self.dbc)
-            table_raw.create(self.dbc)
+            # Create tables and indexes in one go
+            self.dbc.begin_group()
+            try:
+                summarize = table_aggregate.create(self.dbc)
+                table_speedtest.create(self.dbc)
+                table_geoloc.create(self.dbc)
+                table_bittorrent.create(self.dbc)
+                table_log.create(self.dbc)
+                table_raw.create(self.dbc)
+                if summarize:
+                    self._begin_summarize()
+            finally:
+                self.dbc.end_group()
+
+            self._tune()
+
+            if table_aggregate.pending(self.dbc):
+                self._summarize_later()
 
         return self.dbc
 
+    def _begin_summarize(self):
+        ''' Begin to summarize the results saved before we had
+            summaries '''
+        for name, _ in SUMMARIZED_TABLES:
+            cursor = self.dbc.execute('SELECT COUNT(*), MAX(id) FROM %s;'
+                                      % name)
+            count, max_id = cursor.fetchone()
+            if count > 0:
+                logging.info('database: summarizing %d existing %s results '
+                             'in background', count, name)
+                table_aggregate.begin_rebuild(self.dbc, name, count, max_id)
+
+    def summarize(self, page=SUMMARIZE_PAGE):
+        ''' Summarize up to page of the results saved before we had
+            summaries and return True if there are more to summarize '''
+        if not self.dbc or self.readonly:
+            return False
+        pending = table_aggregate.pending(self.dbc)
+        if not pending:
+            return False
+        name, state = pending[0]
+        tables = dict(SUMMARIZED_TABLES)
+        if name in tables:
+            rows = tables[name].walk_page(self.dbc, state['last'],
+                                          state['last_id'], page)
+        else:
+            rows = []
+        last_page = len(rows) < page
+        before = 10 * state['done'] // max(state['count'], 1)
+        self.dbc.begin_group()
+        try:
+            table_aggregate.rebuild_page(self.dbc, name, state, rows,
+                                         last_page)
+        finally:
+            self.dbc.end_group()
+        if last_page:
+            logging.info('database: summarizing existing %s results... done',
+                         name)
+        elif 10 * state['done'] // max(state['count'], 1) > before:
+            logging.info('database: summarizing existing %s results... '
+                         '%d/%d', name, state['done'], state['count'])
+        return len(pending) > 1 or not last_page
+
+    def _summarize_later(self):
+        ''' Schedule the next batch of summaries '''
+        if not self.summarizing and not self.forked:
+            self.summarizing = True
+            POLLER.sched(SUMMARIZE_INTERVAL, self._summarize_task)
+
+    def _summarize_task(self):
+        ''' Summarize a batch of results, unless a test is running '''
+        self.summarizing = False
+        if self.forked:
+            return
+        if NOTIFIER.is_subscribed('testdone'):
+            self._summarize_later()
+        elif self.summarize():
+            self._summarize_later()
+
+    def _tune(self):
+        ''' Apply the tuning settings and follow their changes '''
+        # Lazy import because neubot/config.py imports this module
+        from neubot.config import CONFIG
+        if not self.watching:
+            self.watching = True
+            CONFIG.register_watcher('database.journal_mode', self._changed)
+            CONFIG.register_watcher('database.synchronous', self._changed)
+        self.set_journal_mode(CONFIG['database.journal_mode'])
+        self.set_synchronous(CONFIG['database.synchronous'])
+
+    def _changed(self, key, value):
+        ''' Invoked when a tuning setting changes '''
+        if key == 'database.journal_mode':
+            self.set_journal_mode(value)
+        else:
+            self.set_synchronous(value)
+
+    def set_journal_mode(self, mode):
+        ''' Set the journal mode of the database '''
+        if not self.dbc or self.readonly or self.path == ':memory:':
+            return
+        mode = str(mode).lower()
+        if mode not in JOURNAL_MODES:
+            logging.warning('database: invalid journal mode: %s', mode)
+            return
+        try:
+            cursor = self.dbc.execute('PRAGMA journal_mode=%s;' % mode)
+            result = cursor.fetchone()[0]
+            cursor.close()
+        except sqlite3.Error:
+            logging.warning('database: cannot set journal mode', exc_info=1)
+            return
+        if result != mode:
+            logging.warning('database: journal mode is %s instead of %s',
+                            result, mode)
+        if result == 'wal':
+            #
+            # The WAL files are created by the first transaction,
+            # which we run now, while we still have the privileges
+            # to give them to the unprivileged user.
+            #
+            self.dbc.execute('SELECT COUNT(*) FROM sqlite_master;').fetchone()
+            system.check_database_journal(self.path)
+
+    def set_synchronous(self, level):
+        ''' Set the synchronous level of the connection '''
+        if not self.dbc or self.readonly:
+            return
+        level = str(level).lower()
+        if level not in SYNCHRONOUS_LEVELS:
+            logging.warning('database: invalid synchronous level: %s', level)
+            return
+        self.dbc.execute('PRAGMA synchronous=%s;' % level)
+
+    def begin_group(self):
+        ''' Group the following commits into a single transaction '''
+        self.connection().begin_group()
+
+    def end_group(self):
+        ''' Commit the operations performed since begin_group() '''
+        self.connection().end_group()
+
+    def after_fork(self):
+        ''' Forget the connection inherited from the parent, which
+            must not be used across fork(), and leave it to the parent
+            to summarize the existing results '''
+        # Closing it could affect the parent's connection
+        self.dbc = None
+        self.forked = True
+
     def close(self):
         ''' Close connection to database '''
         if self.dbc:
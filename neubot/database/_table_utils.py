@@ -92,6 +92,17 @@ def make_create_table(table, template):
     query = "".join(vector)
     return query
 
+def make_create_index(table, column):
+
+    '''
+     Given the table name and the name of a column, this function
+     returns the query to create an index on that column, named
+     after the table and the column, unless it already exists.
+    '''
+
+    return "CREATE INDEX IF NOT EXISTS %s_%s_index ON %s (%s);" % (
+      __check(table), __check(column), __check(table), __check(column))
+
 def make_insert_into(table, template):
 
     '''
@@ -192,6 +203,99 @@ def make_select(table, template, **kwargs):
     query = "".join(vector)
     return query
 
+#
+# Rows are walked from the newest to the oldest one, a page at a
+# time, and each page starts just after the last row of the previous
+# one, i.e. (timestamp, id) < (:last, :last_id).  We don't keep a
+# cursor open across pages, because commit() resets the cursors of
+# the connection, and it is cheap to find where the page starts
+# using the timestamp index (which implicitly includes the id).
+#
+
+WALK_PAGE = 256
+WALK_FOREVER = 1 << 62
+
+def make_walk(table, template):
+
+    '''
+     Given the table name and a template dictionary, this function
+     builds the query to read a page of the given table, for use
+     with do_walk().
+    '''
+
+    if not "timestamp" in template:
+        raise ValueError("Template does not contain 'timestamp'")
+
+    vector = [ "SELECT id" ]
+
+    for items in template.items():
+        vector.append(", ")
+        vector.append("%s" % __check(items[0]))
+
+    vector.append(" FROM %s" % __check(table))
+    vector.append(" WHERE timestamp >= :since AND timestamp < :until")
+    vector.append(" AND (timestamp < :last OR (timestamp = :last")
+    vector.append(" AND id < :last_id))")
+    vector.append(" ORDER BY timestamp DESC, id DESC LIMIT :page;")
+    query = "".join(vector)
+    return query
+
+def do_walk(connection, query, since=-1, until=-1, start=-1,
+      page=WALK_PAGE):
+
+    '''
+     Generator that yields, as dictionaries, the rows with timestamp
+     in [@since, @until) and not newer than @start, from the newest
+     to the oldest one, reading @page rows at a time.  Negative
+     values mean no limit.
+    '''
+
+    params = {
+              "since": since,
+              "until": until,
+              "last": WALK_FOREVER,
+              "last_id": WALK_FOREVER,
+              "page": page,
+             }
+    if until < 0:
+        params["until"] = WALK_FOREVER
+    if start >= 0:
+        params["last"] = start
+
+    while True:
+        rows = connection.execute(query, params).fetchall()
+        for row in rows:
+            dictobj = dict(row)
+            del dictobj["id"]
+            yield dictobj
+        if len(rows) < page:
+            break
+        params["last"] = rows[-1]["timestamp"]
+        params["last_id"] = rows[-1]["id"]
+
+def do_walk_page(connection, query, last=-1, last_id=-1, page=WALK_PAGE):
+
+    '''
+     Return, as dictionaries, the @page rows that precede the row
+     identified by @last and @last_id, i.e. its timestamp and id, from
+     the newest to the oldest one.  Each row includes its id, so that
+     the caller can ask for the next page.  Negative values mean that
+     the page starts from the newest row.
+    '''
+
+    params = {
+              "since": -1,
+              "until": WALK_FOREVER,
+              "last": last,
+              "last_id": last_id,
+              "page": page,
+             }
+    if last < 0 or last_id < 0:
+        params["last"] = WALK_FOREVER
+        params["last_id"] = WALK_FOREVER
+
+    return [dict(row) for row in connection.execute(query, params)]
+
 def rename_column_query(table1, template1, table2, template2):
 
     ''' Returns the query that copies from table1, described by
@@ -0,0 +1,348 @@
+# neubot/database/table_aggregate.py
+
+#
+# Copyright (c) 2013
+#     Nexa Center for Internet & Society, Politecnico di Torino (DAUIN),
+#     and Simone Basso <bassosimone@gmail.com>
+#
+# This file is part of Neubot <http://www.neubot.org/>.
+#
+# Neubot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Neubot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Neubot.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+'''
+ Per-day and per-server summaries of the results of each test,
+ updated each time we save a result.
+'''
+
+#
+# For each test we keep a summary of the results of each day (in
+# UTC, named as YYYY-MM-DD) and of each server (i.e. the results'
+# remote_address).  Each summary is a row of the aggregate table,
+# which contains the number of results, the first and the last
+# timestamp and, for each metric, count, sum, min, max and a
+# histogram, encoded as JSON.  Updating a summary costs the same
+# regardless of how many results we have, and so does reading it.
+#
+# The histogram bins grow geometrically by ALPHA, so percentiles
+# computed from it are within ALPHA / 2 (i.e. 0.5%) of the exact
+# ones (computed as neubot/percentile.py does), and the number of
+# bins is bounded, e.g. about 1600 between 1 Kbit/s and 10 Gbit/s.
+# Bins and percentiles are the same of neubot/quantile.py.
+# The histogram is the list of the counts of the bins between the
+# lowest and the highest nonempty ones, which is faster to decode
+# than a mapping.  Values not greater than zero are counted apart.
+#
+# Summaries are not pruned along with old results.
+#
+# The summaries of the results saved before we had summaries are
+# rebuilt in batches (see neubot/database/__init__.py).  The state
+# of each rebuild, i.e. how many results we have summarized and the
+# timestamp and id of the last one, is saved in a row of the table
+# whose kind is PENDING, so that we resume it after a restart, and
+# is removed when the rebuild is complete.  We only summarize the
+# results whose id is not greater than the largest id we had when
+# the rebuild began, because newer results update the summaries
+# when they are saved.
+#
+
+import time
+
+from neubot.compat import json
+
+from neubot import quantile
+
+# Metrics of database-based tests; for other tests we summarize
+# all the numeric fields, except the timestamp
+METRICS = {
+    "bittorrent": ("connect_time", "download_speed", "latency",
+                   "upload_speed"),
+    "raw": ("connect_time", "download_speed", "latency"),
+    "speedtest": ("connect_time", "download_speed", "latency",
+                  "upload_speed"),
+}
+
+KINDS = ("day", "server")
+PENDING = "pending"
+
+PERCENTILES = (
+    ("p5", 0.05),
+    ("p25", 0.25),
+    ("median", 0.5),
+    ("p75", 0.75),
+    ("p95", 0.95),
+)
+
+ALPHA = quantile.ALPHA
+
+CREATE_TABLE = """CREATE TABLE IF NOT EXISTS aggregate(id INTEGER PRIMARY
+  KEY, test TEXT, kind TEXT, key TEXT, summary TEXT);"""
+CREATE_INDEX = """CREATE UNIQUE INDEX IF NOT EXISTS aggregate_key_index
+  ON aggregate (test, kind, key);"""
+
+def create(connection, commit=True):
+    ''' Create the aggregate table and return True if it did not
+        exist, i.e. if the caller should rebuild the summaries '''
+    cursor = connection.execute("""SELECT COUNT(*) FROM sqlite_master
+      WHERE type='table' AND name='aggregate';""")
+    exists = cursor.fetchone()[0]
+    connection.execute(CREATE_TABLE)
+    connection.execute(CREATE_INDEX)
+    if commit:
+        connection.commit()
+    return not exists
+
+#
+# Summaries
+#
+
+def _metrics(test, result):
+    ''' Return name and value of the metrics of a result '''
+    names = METRICS.get(test)
+    if names is None:
+        names = [name for name in sorted(result.keys())
+                 if name != "timestamp"]
+    metrics = []
+    for name in names:
+        value = result.get(name)
+        if type(value) in (int, long, float):
+            metrics.append((name, value))
+    return metrics
+
+def _key(kind, result):
+    ''' Return the key of the kind-summary of result, or None '''
+    if kind == "day":
+        return time.strftime("%Y-%m-%d", time.gmtime(result.get(
+                             "timestamp", 0)))
+    address = result.get("remote_address")
+    if not address:
+        return None
+    return str(address)
+
+def _bin(value):
+    ''' Return the histogram bin of value, or None '''
+    if value <= 0:
+        return None
+    return quantile.bin_index(value)
+
+def _bin_value(index):
+    ''' Return the representative value of a histogram bin '''
+    if index is None:
+        return 0.0
+    return quantile.bin_value(index)
+
+def _new_summary():
+    ''' Return an empty summary '''
+    return {"count": 0, "first": 0, "last": 0, "metrics": {}}
+
+def _dumps(summary):
+    ''' Encode summary as compact JSON '''
+    return json.dumps(summary, separators=(",", ":"))
+
+def _loads(string):
+    ''' Decode a summary '''
+    # The JSON is ASCII, and decoding str is faster than unicode
+    return json.loads(str(string))
+
+def _add(summary, test, result):
+    ''' Account for result in summary '''
+    timestamp = result.get("timestamp", 0)
+    if summary["count"] == 0 or timestamp < summary["first"]:
+        summary["first"] = timestamp
+    if summary["count"] == 0 or timestamp > summary["last"]:
+        summary["last"] = timestamp
+    summary["count"] += 1
+    for name, value in _metrics(test, result):
+        stats = summary["metrics"].get(name)
+        if not stats:
+            stats = {"count": 0, "sum": 0, "min": value, "max": value,
+                     "zero": 0, "low": 0, "bins": []}
+            summary["metrics"][name] = stats
+        stats["count"] += 1
+        stats["sum"] += value
+        stats["min"] = min(stats["min"], value)
+        stats["max"] = max(stats["max"], value)
+        _add_bin(stats, _bin(value))
+
+def _add_bin(stats, index):
+    ''' Increment the count of a histogram bin '''
+    if index is None:
+        stats["zero"] += 1
+        return
+    bins = stats["bins"]
+    if not bins:
+        stats["low"] = index
+        bins.append(0)
+    elif index < stats["low"]:
+        bins[0:0] = [0] * (stats["low"] - index)
+        stats["low"] = index
+    elif index >= stats["low"] + len(bins):
+        bins.extend([0] * (index - stats["low"] - len(bins) + 1))
+    bins[index - stats["low"]] += 1
+
+def _sorted_bins(stats):
+    ''' Yield histogram bins and counts, sorted by value '''
+    if stats["zero"]:
+        yield None, stats["zero"]
+    for index, count in enumerate(stats["bins"]):
+        if count:
+            yield stats["low"] + index, count
+
+def _percentiles(stats):
+    ''' Compute the percentiles of a metric from its histogram '''
+    buckets = ((_bin_value(index), count) for index, count
+               in _sorted_bins(stats))
+    values = quantile.interpolate(buckets, stats["count"], [percent for
+      _, percent in PERCENTILES], stats["min"], stats["max"])
+    return dict((label, value) for (label, _), value
+                in zip(PERCENTILES, values))
+
+def export(test, kind, key, summary):
+    ''' Convert summary into the dictionary we return to clients '''
+    dictionary = {
+        "test": test,
+        "kind": kind,
+        "key": key,
+        "count": summary["count"],
+        "first": summary["first"],
+        "last": summary["last"],
+        "metrics": {},
+    }
+    for name, stats in summary["metrics"].items():
+        metric = {
+            "count": stats["count"],
+            "mean": float(stats["sum"]) / stats["count"],
+            "min": stats["min"],
+            "max": stats["max"],
+        }
+        metric.update(_percentiles(stats))
+        dictionary["metrics"][name] = metric
+    return dictionary
+
+#
+# Table operations
+#
+
+def update(connection, test, result, commit=True):
+    ''' Update the summaries of test with result '''
+    _update_many(connection, test, [result])
+    if commit:
+        connection.commit()
+
+def _update_many(connection, test, results):
+    ''' Update the summaries of test with results, reading and
+        writing each of the summaries involved once '''
+    summaries = {}
+    for result in results:
+        for kind in KINDS:
+            key = _key(kind, result)
+            if key is None:
+                continue
+            entry = summaries.get((kind, key))
+            if not entry:
+                cursor = connection.execute("""SELECT id, summary FROM
+                  aggregate WHERE test=? AND kind=? AND key=?;""",
+                  (test, kind, key))
+                row = cursor.fetchone()
+                if row:
+                    entry = (row[0], _loads(row[1]))
+                else:
+                    entry = (None, _new_summary())
+                summaries[(kind, key)] = entry
+            _add(entry[1], test, result)
+    for (kind, key), (ident, summary) in summaries.items():
+        if ident is not None:
+            connection.execute("UPDATE aggregate SET summary=? WHERE id=?;",
+                               (_dumps(summary), ident))
+        else:
+            connection.execute("INSERT INTO aggregate VALUES (null, ?, ?, "
+                               "?, ?);", (test, kind, key, _dumps(summary)))
+
+def rebuild(connection, test, results, commit=True):
+    ''' Rebuild the summaries of test from results '''
+    summaries = {}
+    for result in results:
+        for kind in KINDS:
+            key = _key(kind, result)
+            if key is None:
+                continue
+            summary = summaries.get((kind, key))
+            if not summary:
+                summary = _new_summary()
+                summaries[(kind, key)] = summary
+            _add(summary, test, result)
+    connection.execute("DELETE FROM aggregate WHERE test=?;", (test,))
+    connection.executemany("INSERT INTO aggregate VALUES (null, ?, ?, ?, ?);",
+                           ((test, kind, key, _dumps(summary))
+                            for (kind, key), summary in summaries.items()))
+    if commit:
+        connection.commit()
+
+def begin_rebuild(connection, test, count, max_id, commit=True):
+    ''' Forget the summaries of test and begin to rebuild them, in
+        batches, from its count results with id up to max_id '''
+    state = {"count": count, "done": 0, "last": -1, "last_id": -1,
+             "max_id": max_id}
+    connection.execute("DELETE FROM aggregate WHERE test=?;", (test,))
+    connection.execute("INSERT INTO aggregate VALUES (null, ?, ?, ?, ?);",
+                       (test, PENDING, "", _dumps(state)))
+    if commit:
+        connection.commit()
+
+def pending(connection):
+    ''' Return the tests whose summaries we are rebuilding, along
+        with the state of each rebuild '''
+    cursor = connection.execute("""SELECT test, summary FROM aggregate
+      WHERE kind=? ORDER BY test;""", (PENDING,))
+    return [(str(row[0]), _loads(row[1])) for row in cursor]
+
+def rebuild_page(connection, test, state, rows, last_page, commit=True):
+    ''' Summarize a page of the results of test we are rebuilding
+        from, i.e. rows, which include their id, and save the state
+        of the rebuild, which is complete if last_page is True '''
+    results = [row for row in rows if row["id"] <= state["max_id"]]
+    _update_many(connection, test, results)
+    state["done"] += len(results)
+    if rows:
+        state["last"] = rows[-1]["timestamp"]
+        state["last_id"] = rows[-1]["id"]
+    if last_page:
+        connection.execute("DELETE FROM aggregate WHERE test=? AND kind=?;",
+                           (test, PENDING))
+    else:
+        connection.execute("""UPDATE aggregate SET summary=? WHERE test=?
+          AND kind=?;""", (_dumps(state), test, PENDING))
+    if commit:
+        connection.commit()
+
+def has_test(connection, test):
+    ''' Return True if we have summaries for test '''
+    cursor = connection.execute("""SELECT COUNT(*) FROM aggregate
+      WHERE test=?;""", (test,))
+    return cursor.fetchone()[0] > 0
+
+def listify(connection, test, kind, since=-1, until=-1):
+    ''' Return the kind-summaries of test, sorted by key.  For
+        per-day summaries, since and until select the days '''
+    query = "SELECT key, summary FROM aggregate WHERE test=? AND kind=?"
+    params = [test, kind]
+    if kind == "day" and since >= 0:
+        query += " AND key >= ?"
+        params.append(_key("day", {"timestamp": since}))
+    if kind == "day" and until >= 0:
+        query += " AND key <= ?"
+        params.append(_key("day", {"timestamp": until}))
+    query += " ORDER BY key;"
+    return [export(test, kind, row[0], _loads(row[1]))
+            for row in connection.execute(query, params)]
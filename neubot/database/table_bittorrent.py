@@ -28,6 +28,7 @@
 '''
 
 from neubot.database import _table_utils
+from neubot.database import table_aggregate
 from neubot import utils
 
 TEMPLATE = {
@@ -54,17 +55,22 @@ TEMPLATE = {
 
 CREATE_TABLE = _table_utils.make_create_table("bittorrent", TEMPLATE)
 INSERT_INTO = _table_utils.make_insert_into("bittorrent", TEMPLATE)
+WALK = _table_utils.make_walk("bittorrent", TEMPLATE)
+CREATE_INDEX = _table_utils.make_create_index("bittorrent", "timestamp")
 
 def create(connection, commit=True):
     ''' Create the bittorrent table '''
     connection.execute(CREATE_TABLE)
+    connection.execute(CREATE_INDEX)
+    table_aggregate.create(connection, False)
     if commit:
         connection.commit()
 
 def insert(connection, dictobj, commit=True, override_timestamp=True):
     ''' Insert a result into bittorrent table '''
     _table_utils.do_insert_into(connection, INSERT_INTO, dictobj, TEMPLATE,
-                                commit, override_timestamp)
+                                False, override_timestamp)
+    table_aggregate.update(connection, "bittorrent", dictobj, commit)
 
 def listify(connection, since=-1, until=-1):
     ''' Converts to list the content of bittorrent table '''
@@ -78,6 +84,15 @@ def listify(connection, since=-1, until=-1):
         vector.append(dict(row))
     return vector
 
+def walk(connection, since=-1, until=-1, start=-1):
+    ''' Walk the bittorrent table, from the newest to the oldest result '''
+    return _table_utils.do_walk(connection, WALK, since, until, start)
+
+def walk_page(connection, last=-1, last_id=-1, page=_table_utils.WALK_PAGE):
+    ''' Return a page of the bittorrent table, i.e. the rows that precede
+        the one identified by last and last_id, with their id '''
+    return _table_utils.do_walk_page(connection, WALK, last, last_id, page)
+
 def prune(connection, until=None, commit=True):
     ''' Removes old results from bittorrent table '''
     if not until:
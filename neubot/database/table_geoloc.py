@@ -20,15 +20,25 @@
 # along with Neubot.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+#
+# We count the changes to the table made by this process, so that
+# who keeps a copy of the table in memory (e.g. the rendezvous
+# server) knows when it must reload it.
+#
+CHANGES = [0]
+
 def create(connection, commit=True):
     connection.execute("""CREATE TABLE IF NOT EXISTS geoloc(
       id INTEGER PRIMARY KEY, country TEXT, address TEXT);""")
+    connection.execute("""CREATE INDEX IF NOT EXISTS geoloc_country_index
+      ON geoloc (country);""")
     if commit:
         connection.commit()
 
 def insert_server(connection, country, address, commit=True):
     connection.execute("""INSERT INTO geoloc VALUES (
       null, ?, ?);""", (country, address))
+    CHANGES[0] += 1
     if commit:
         connection.commit()
 
@@ -38,3 +48,10 @@ def lookup_servers(connection, country):
     vector = map(lambda result: result[0], cursor)
     cursor.close()
     return vector
+
+def listify(connection):
+    cursor = connection.execute("SELECT country, address FROM geoloc;")
+    servers = {}
+    for country, address in cursor:
+        servers.setdefault(country, []).append(address)
+    return servers
@@ -31,9 +31,11 @@ TEMPLATE = {
 
 CREATE_TABLE = _table_utils.make_create_table("log", TEMPLATE)
 INSERT_INTO = _table_utils.make_insert_into("log", TEMPLATE)
+CREATE_INDEX = _table_utils.make_create_index("log", "timestamp")
 
 def create(connection, commit=True):
     connection.execute(CREATE_TABLE)
+    connection.execute(CREATE_INDEX)
     if commit:
         connection.commit()
 
@@ -42,6 +44,11 @@ def insert(connection, dictobj, commit=True):
     if commit:
         connection.commit()
 
+def insert_many(connection, records, commit=True):
+    connection.executemany(INSERT_INTO, records)
+    if commit:
+        connection.commit()
+
 def walk(connection, func, since=-1, until=-1):
     cursor = connection.cursor()
     SELECT = _table_utils.make_select("log", TEMPLATE,
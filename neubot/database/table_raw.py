@@ -33,6 +33,7 @@
 
 from neubot.compat import json
 from neubot.database import _table_utils
+from neubot.database import table_aggregate
 
 from neubot import utils
 
@@ -81,10 +82,14 @@ def __json_to_mapped_row(result):
 
 CREATE_TABLE = _table_utils.make_create_table('raw', TEMPLATE)
 INSERT_INTO = _table_utils.make_insert_into('raw', TEMPLATE)
+WALK = _table_utils.make_walk('raw', TEMPLATE)
+CREATE_INDEX = _table_utils.make_create_index('raw', 'timestamp')
 
 def create(connection, commit=True):
     ''' Create the RAW table '''
     connection.execute(CREATE_TABLE)
+    connection.execute(CREATE_INDEX)
+    table_aggregate.create(connection, False)
     if commit:
         connection.commit()
 
@@ -92,7 +97,8 @@ def insert(connection, dictobj, commit=True, override_timestamp=True):
     ''' Insert a result into RAW table '''
     dictobj = __json_to_mapped_row(dictobj)
     _table_utils.do_insert_into(connection, INSERT_INTO, dictobj, TEMPLATE,
-                                commit, override_timestamp)
+                                False, override_timestamp)
+    table_aggregate.update(connection, 'raw', dictobj, commit)
 
 def listify(connection, since=-1, until=-1):
     ''' Converts to list the content of RAW table '''
@@ -106,6 +112,15 @@ def listify(connection, since=-1, until=-1):
         vector.append(dict(row))
     return vector
 
+def walk(connection, since=-1, until=-1, start=-1):
+    ''' Walk the RAW table, from the newest to the oldest result '''
+    return _table_utils.do_walk(connection, WALK, since, until, start)
+
+def walk_page(connection, last=-1, last_id=-1, page=_table_utils.WALK_PAGE):
+    ''' Return a page of the RAW table, i.e. the rows that precede
+        the one identified by last and last_id, with their id '''
+    return _table_utils.do_walk_page(connection, WALK, last, last_id, page)
+
 def prune(connection, until=None, commit=True):
     ''' Removes old results from RAW table '''
     if not until:
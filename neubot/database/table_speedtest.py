@@ -27,6 +27,7 @@
 '''
 
 from neubot.database import _table_utils
+from neubot.database import table_aggregate
 from neubot import utils
 
 TEMPLATE = {
@@ -54,17 +55,22 @@ TEMPLATE = {
 
 CREATE_TABLE = _table_utils.make_create_table("speedtest", TEMPLATE)
 INSERT_INTO = _table_utils.make_insert_into("speedtest", TEMPLATE)
+WALK = _table_utils.make_walk("speedtest", TEMPLATE)
+CREATE_INDEX = _table_utils.make_create_index("speedtest", "timestamp")
 
 def create(connection, commit=True):
     ''' Create a new speedtest table '''
     connection.execute(CREATE_TABLE)
+    connection.execute(CREATE_INDEX)
+    table_aggregate.create(connection, False)
     if commit:
         connection.commit()
 
 def insert(connection, dictobj, commit=True, override_timestamp=True):
     ''' Insert a result dictionary into speedtest table '''
     _table_utils.do_insert_into(connection, INSERT_INTO, dictobj, TEMPLATE,
-                                commit, override_timestamp)
+                                False, override_timestamp)
+    table_aggregate.update(connection, "speedtest", dictobj, commit)
 
 def listify(connection, since=-1, until=-1):
     ''' Converts the content of speedtest table into a list '''
@@ -78,6 +84,15 @@ def listify(connection, since=-1, until=-1):
         vector.append(dict(row))
     return vector
 
+def walk(connection, since=-1, until=-1, start=-1):
+    ''' Walk the speedtest table, from the newest to the oldest result '''
+    return _table_utils.do_walk(connection, WALK, since, until, start)
+
+def walk_page(connection, last=-1, last_id=-1, page=_table_utils.WALK_PAGE):
+    ''' Return a page of the speedtest table, i.e. the rows that precede
+        the one identified by last and last_id, with their id '''
+    return _table_utils.do_walk_page(connection, WALK, last, last_id, page)
+
 def prune(connection, until=None, commit=True):
     ''' Removes old results from the table '''
     if not until:
@@ -115,6 +115,13 @@ class ClientHTTP(StreamHandler):
 
     ''' Manages one or more HTTP streams '''
 
+    #
+    # Clients that set recv_slices receive into pooled buffers,
+    # and the pieces passed to response.body.write() are valid
+    # only until it returns (see neubot/http/stream.py).
+    #
+    recv_slices = False
+
     def __init__(self, poller):
         ''' Initialize the HTTP client '''
         StreamHandler.__init__(self, poller)
@@ -156,6 +163,7 @@ class ClientHTTP(StreamHandler):
         if not self.host_header:
             self.host_header = utils_net.format_epnt(endpoint)
         stream = ClientStream(self.poller)
+        stream.recv_slices = self.recv_slices
         stream.attach(self, sock, self.conf)
         self.connection_ready(stream)
 
@@ -35,9 +35,12 @@ import logging
 from neubot.log import oops
 
 from neubot import compat
+from neubot import log_trace
 from neubot import utils
 from neubot import utils_net
 
+TRACE = log_trace.tracer('http')
+
 REDIRECT = '''\
 <HTML>
  <HEAD>
@@ -146,7 +149,8 @@ class Message(object):
             vector.append(" ")
             vector.append(self.reason)
 
-        logging.debug("> %s", "".join(vector))
+        if TRACE.enabled:
+            logging.debug("> %s", "".join(vector))
         vector.append("\r\n")
 
         for key, value in self.headers.items():
@@ -155,10 +159,12 @@ class Message(object):
             vector.append(": ")
             vector.append(value)
 
-            logging.debug("> %s: %s", key, value)
+            if TRACE.enabled:
+                logging.debug("> %s: %s", key, value)
             vector.append("\r\n")
 
-        logging.debug(">")
+        if TRACE.enabled:
+            logging.debug(">")
         vector.append("\r\n")
 
         string = "".join(vector)
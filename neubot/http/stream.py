@@ -26,9 +26,14 @@
 
 import logging
 
+from neubot.bufpool import Slice
 from neubot.net.stream import MAXBUF
 from neubot.net.stream import Stream
 
+from neubot import log_trace
+
+TRACE = log_trace.tracer('http')
+
 # Accepted HTTP protocols
 PROTOCOLS = [ "HTTP/1.0", "HTTP/1.1" ]
 
@@ -98,11 +103,29 @@ class StreamHTTP(Stream):
     def recv_complete(self, data):
         ''' We've received successfully some data '''
         if self.close_complete or self.close_pending:
+            if isinstance(data, Slice):
+                data.release()
             return
 
         #This one should be debug2 as well
         #logging.debug("HTTP receiver: got %d bytes", len(data))
 
+        #
+        # When the stream receives into pooled buffers (see the
+        # recv_slices attribute of neubot/net/stream.py), data is
+        # a Slice and we parse the underlying buffer in place.  So
+        # the pieces passed to got_piece() are only valid until it
+        # returns, and whoever wants to keep them must copy them.
+        #
+        rslice = None
+        if isinstance(data, Slice):
+            if self.incoming:
+                rslice, data = data, data.tobytes()
+                rslice.release()
+                rslice = None
+            else:
+                rslice, data = data, data.octets
+
         # merge with previous fragments (if any)
         if self.incoming:
             self.incoming.append(data)
@@ -112,6 +135,17 @@ class StreamHTTP(Stream):
         # consume the current fragment
         offset = 0
         length = len(data)
+        if rslice:
+            offset = rslice.start
+            length = len(rslice)
+        try:
+            self._consume(data, offset, length)
+        finally:
+            if rslice:
+                rslice.release()
+
+    def _consume(self, data, offset, length):
+        ''' Consume length bytes of data starting at offset '''
         while length > 0:
             #ostate = self.state        # needed by commented-out code below
 
@@ -126,13 +160,13 @@ class StreamHTTP(Stream):
 
             # otherwise we're looking for the next line
             elif self.left == 0:
-                index = data.find("\n", offset)
+                index = data.find("\n", offset, offset + length)
                 if index == -1:
                     if length > MAXLINE:
                         raise RuntimeError("Line too long")
                     break
                 index = index + 1
-                line = data[offset:index]
+                line = str(data[offset:index])
                 length -= (index - offset)
                 offset = index
                 self._got_line(line)
@@ -151,9 +185,10 @@ class StreamHTTP(Stream):
 
         # keep the eventual remainder for later
         if length > 0:
-            remainder = data[offset:]
+            remainder = str(data[offset:offset + length])
             self.incoming.append(remainder)
-            logging.debug("HTTP receiver: remainder %d", len(remainder))
+            if TRACE.enabled:
+                logging.debug("HTTP receiver: remainder %d", len(remainder))
 
         # get the next fragment
         self.start_recv()
@@ -162,7 +197,8 @@ class StreamHTTP(Stream):
         ''' We've got a line... what do we do? '''
         if self.state == FIRSTLINE:
             line = line.strip()
-            logging.debug("< %s", line)
+            if TRACE.enabled:
+                logging.debug("< %s", line)
             vector = line.split(None, 2)
             if len(vector) == 3:
                 if line.startswith("HTTP"):
@@ -181,7 +217,8 @@ class StreamHTTP(Stream):
                 raise RuntimeError("Invalid first line")
         elif self.state == HEADER:
             if line.strip():
-                logging.debug("< %s", line)
+                if TRACE.enabled:
+                    logging.debug("< %s", line)
                 # not handling mime folding
                 index = line.find(":")
                 if index >= 0:
@@ -190,7 +227,8 @@ class StreamHTTP(Stream):
                 else:
                     raise RuntimeError("Invalid header line")
             else:
-                logging.debug("<")
+                if TRACE.enabled:
+                    logging.debug("<")
                 self.state, self.left = self.got_end_of_headers()
                 if self.state == ERROR:
                     # allow upstream to filter out unwanted requests
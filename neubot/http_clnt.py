@@ -38,9 +38,12 @@ from neubot.handler import Handler
 from neubot.poller import POLLER
 from neubot.stream import Stream
 
+from neubot import log_trace
 from neubot import six
 from neubot import utils_version
 
+TRACE = log_trace.tracer('http')
+
 MAXLINE = 512
 MAXPIECE = 524288
 MAXREAD = 8000
@@ -110,7 +113,8 @@ class HttpClient(Handler):
     def create_stream(self, sock, connection_made, connection_lost,
           sslconfig, sslcert, extra):
         ''' Creates an HTTP stream '''
-        logging.debug('http_clnt: stream setup... in progress')
+        if TRACE.enabled:
+            logging.debug('http_clnt: stream setup... in progress')
         context = ClientContext(extra, connection_made, connection_lost)
         Stream(sock, self._handle_connection_made, self._handle_connection_lost,
           sslconfig, sslcert, context)
@@ -120,7 +124,8 @@ class HttpClient(Handler):
         context = stream.opaque
         stream.recv(MAXRECEIVE, self._handle_data)  # Kick receiver off
         context.handle_line = self._handle_firstline
-        logging.debug('http_clnt: stream setup... complete')
+        if TRACE.enabled:
+            logging.debug('http_clnt: stream setup... complete')
         context.connection_made(stream)
 
     @staticmethod
@@ -143,7 +148,8 @@ class HttpClient(Handler):
     def append_request(stream, method, uri, protocol):
         ''' Append request to output buffer '''
         context = stream.opaque
-        logging.debug('> %s %s %s', method, uri, protocol)
+        if TRACE.enabled:
+            logging.debug('> %s %s %s', method, uri, protocol)
         context.method = six.b(method)
         context.outq.append(six.b(method))
         context.outq.append(SPACE)
@@ -156,7 +162,8 @@ class HttpClient(Handler):
     def append_header(stream, name, value):
         ''' Append header to output buffer '''
         context = stream.opaque
-        logging.debug('> %s: %s', name, value)
+        if TRACE.enabled:
+            logging.debug('> %s: %s', name, value)
         context.outq.append(six.b(name))
         context.outq.append(COLON)
         context.outq.append(SPACE)
@@ -167,7 +174,8 @@ class HttpClient(Handler):
     def append_end_of_headers(stream):
         ''' Append end-of-headers (an empty line) to output buffer '''
         context = stream.opaque
-        logging.debug('>')
+        if TRACE.enabled:
+            logging.debug('>')
         context.outq.append(CRLF)
 
     @staticmethod
@@ -186,7 +194,8 @@ class HttpClient(Handler):
     def append_chunk(stream, bytez):
         ''' Append chunk to output buffer '''
         context = stream.opaque
-        logging.debug('> {chunk len=%d}', len(bytez))
+        if TRACE.enabled:
+            logging.debug('> {chunk len=%d}', len(bytez))
         context.outq.append(six.b('%x\r\n' % len(bytez)))
         context.outq.append(bytez)
         context.outq.append(CRLF)
@@ -195,21 +204,23 @@ class HttpClient(Handler):
     def append_last_chunk(stream):
         ''' Append last-chunk to output buffer '''
         context = stream.opaque
-        logging.debug('> {last-chunk}')
+        if TRACE.enabled:
+            logging.debug('> {last-chunk}')
         context.outq.append(LAST_CHUNK)
 
     @staticmethod
     def append_file(stream, filep):
         ''' Append file to output buffer '''
         context = stream.opaque
-        logging.debug('> {file}')
+        if TRACE.enabled:
+            logging.debug('> {file}')
         context.outfp = filep
 
     def send_message(self, stream):
         ''' Send output buffer content to the other end '''
         context = stream.opaque
-        string = EMPTY_STRING.join(context.outq)
-        stream.send(string, self._handle_send_complete)
+        # The stream sends the list using vectored I/O
+        stream.send(context.outq, self._handle_send_complete)
         context.outq = []
 
     def _handle_send_complete(self, stream):
@@ -264,7 +275,8 @@ class HttpClient(Handler):
         ''' Handles the FIRSTLINE event '''
         context = stream.opaque
         line = line.rstrip()
-        logging.debug('< %s', six.bytes_to_string_safe(line, 'utf-8'))
+        if TRACE.enabled:
+            logging.debug('< %s', six.bytes_to_string_safe(line, 'utf-8'))
         vector = line.split(None, 2)
         if len(vector) != 3:
             raise RuntimeError('http_clnt: invalid first line')
@@ -289,10 +301,12 @@ class HttpClient(Handler):
         context = stream.opaque
         line = line.rstrip()
         if not line:
-            logging.debug('<')
+            if TRACE.enabled:
+                logging.debug('<')
             handle_done(stream)
             return
-        logging.debug('< %s', six.bytes_to_string_safe(line, 'utf-8'))
+        if TRACE.enabled:
+            logging.debug('< %s', six.bytes_to_string_safe(line, 'utf-8'))
         # Note: must preceed header parsing to permit colons in folded line(s)
         if context.last_hdr and line[0:1] in (SPACE, TAB):
             value = context.headers[context.last_hdr]
@@ -346,12 +360,14 @@ class HttpClient(Handler):
 
         if (context.method == HEAD or context.code[0:1] == ONE or
           context.code == CODE204 or context.code == CODE304):
-            logging.debug('http_clnt: expecting no message body')
+            if TRACE.enabled:
+                logging.debug('http_clnt: expecting no message body')
             self.handle_end_of_body(stream)
             return
 
         if context.headers.get(TRANSFER_ENCODING) == CHUNKED:
-            logging.debug('http_clnt: expecting chunked message body')
+            if TRACE.enabled:
+                logging.debug('http_clnt: expecting chunked message body')
             context.handle_line = self._handle_chunklen
             return
 
@@ -359,17 +375,20 @@ class HttpClient(Handler):
         if tmp:
             length = int(tmp)
             if length > 0:
-                logging.debug('http_clnt: expecting bounded message body')
+                if TRACE.enabled:
+                    logging.debug('http_clnt: expecting bounded message body')
                 context.handle_piece = self._handle_piece_bounded
                 context.left = length
                 return
             if length == 0:
-                logging.debug('http_clnt: expecting no message body')
+                if TRACE.enabled:
+                    logging.debug('http_clnt: expecting no message body')
                 self.handle_end_of_body(stream)
                 return
             raise RuntimeError('http_clnt: invalid content length')
 
-        logging.debug('http_clnt: expecting unbounded message body')
+        if TRACE.enabled:
+            logging.debug('http_clnt: expecting unbounded message body')
         context.handle_piece = self._handle_piece_unbounded
         context.left = MAXPIECE
 
@@ -383,11 +402,13 @@ class HttpClient(Handler):
                 raise RuntimeError('http_clnt: negative chunk-length')
             elif tmp == 0:
                 context.handle_line = self._handle_trailer
-                logging.debug('< {last-chunk/}')
+                if TRACE.enabled:
+                    logging.debug('< {last-chunk/}')
             else:
                 context.left = tmp
                 context.handle_piece = self._handle_piece_chunked
-                logging.debug('< {chunk len=%d}', tmp)
+                if TRACE.enabled:
+                    logging.debug('< {chunk len=%d}', tmp)
         else:
             raise RuntimeError('http_clnt: bad chunk-length line')
 
@@ -395,7 +416,8 @@ class HttpClient(Handler):
         ''' Handles the CHUNKEND event '''
         context = stream.opaque
         if not line.strip():
-            logging.debug('< {/chunk}')
+            if TRACE.enabled:
+                logging.debug('< {/chunk}')
             context.handle_line = self._handle_chunklen
         else:
             raise RuntimeError('http_clnt: bad chunk-end line')
@@ -0,0 +1,119 @@
+# neubot/json_stream.py
+
+#
+# Copyright (c) 2013
+#     Nexa Center for Internet & Society, Politecnico di Torino (DAUIN),
+#     and Simone Basso <bassosimone@gmail.com>
+#
+# This file is part of Neubot <http://www.neubot.org/>.
+#
+# Neubot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Neubot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Neubot.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+''' Encode a sequence as a JSON list, a piece at a time '''
+
+#
+# The stream is a file-like object that we pass as the body of an
+# HTTP message.  The stream code calls read() when the socket is
+# ready to send more data, and each read() pulls from the iterator
+# just the elements needed to fill the requested amount of bytes.
+# So, the elements are read (e.g. from the database) and encoded
+# as the peer consumes them, and memory usage does not depend on
+# the number of elements.
+#
+# When chunked is true, each piece is framed as a chunk of the
+# chunked transfer encoding, and the last read() also returns the
+# last (zero-length) chunk.
+#
+# Without indent the output is the same as json.dumps(); with
+# indent the output is equivalent, i.e. json.loads() returns the
+# same list, but whitespace may differ.
+#
+
+import itertools
+import sys
+
+from neubot.compat import json
+
+# Number of elements we encode at a time without indent
+BATCH = 64
+
+class JSONStream(object):
+
+    ''' Encode a sequence as a JSON list, a piece at a time '''
+
+    def __init__(self, iterable, chunked=True, indent=None,
+                 sort_keys=False):
+        self.iterator = iter(iterable)
+        self.chunked = chunked
+        self.indent = indent
+        self.sort_keys = sort_keys
+        self.count = 0
+        self.closed = False
+
+    def _encode(self):
+        ''' Encode the next element(s), including the separator, and
+            return the empty string when there are no more elements '''
+        if self.indent is None:
+            # Faster than encoding one element at a time
+            batch = list(itertools.islice(self.iterator, BATCH))
+            if not batch:
+                return ''
+            string = json.dumps(batch, sort_keys=self.sort_keys)[1:-1]
+            self.count += len(batch)
+            if self.count == len(batch):
+                return '[' + string
+            return ', ' + string
+        try:
+            elem = next(self.iterator)
+        except StopIteration:
+            return ''
+        string = json.dumps(elem, indent=self.indent,
+                            sort_keys=self.sort_keys)
+        self.count += 1
+        prefix = ' ' * self.indent
+        string = prefix + string.replace('\n', '\n' + prefix)
+        if self.count == 1:
+            return '[\n' + string
+        return ',\n' + string
+
+    def read(self, count=sys.maxint):
+        ''' Read about count bytes '''
+        if self.closed:
+            return ''
+        vector, total = [], 0
+        while total < count:
+            string = self._encode()
+            if not string:
+                if self.count == 0:
+                    vector.append('[]')
+                elif self.indent is None:
+                    vector.append(']')
+                else:
+                    vector.append('\n]')
+                self.closed = True
+                break
+            vector.append(string)
+            total += len(string)
+        data = ''.join(vector)
+        if not self.chunked:
+            return data
+        vector = ['%x\r\n' % len(data), data, '\r\n']
+        if self.closed:
+            vector.append('0\r\n\r\n')
+        return ''.join(vector)
+
+    def close(self):
+        ''' Close '''
+        self.closed = True
@@ -25,9 +25,89 @@
 # Adapted from neubot/net/stream.py
 # Python3-ready: yes
 
+import errno
+import socket
+import sys
+
+from neubot.config import CONFIG
 from neubot.pollable import Pollable
 from neubot.poller import POLLER
 
+from neubot import utils
+
+# The accept queue is empty
+ACCEPT_AGAIN = (errno.EAGAIN, errno.EWOULDBLOCK)
+
+# The connection died while in the accept queue
+ACCEPT_SKIP = (errno.ECONNABORTED, errno.EINTR, errno.EPROTO)
+
+# Window over which we compute the accept rate, in seconds
+RATE_WINDOW = 1.0
+
+class AcceptStats(object):
+
+    ''' Accept counters of a listener '''
+
+    #
+    # An overflow is a wakeup in which we have exhausted the accept
+    # budget, so the accept queue may not be empty: clients might be
+    # arriving faster than we accept them and the kernel backlog may
+    # be growing.  If this counter keeps growing, either the budget
+    # or the listen() backlog is too small.
+    #
+
+    def __init__(self):
+        self.accepted = 0
+        self.wakeups = 0
+        self.overflows = 0
+        self.rate = 0.0
+        self.window_start = utils.ticks()
+        self.window_count = 0
+
+    def update(self, count, overflow):
+        ''' Account for a wakeup in which we accepted count
+            connections, possibly leaving some in the queue '''
+        self.wakeups += 1
+        self.accepted += count
+        if overflow:
+            self.overflows += 1
+        self.window_count += count
+        timenow = utils.ticks()
+        elapsed = timenow - self.window_start
+        if elapsed >= RATE_WINDOW:
+            self.rate = self.window_count / elapsed
+            self.window_start = timenow
+            self.window_count = 0
+
+    def snap(self):
+        ''' Take a snapshot of the counters '''
+        return {
+                'accepted': self.accepted,
+                'accept_rate': self.rate,
+                'overflows': self.overflows,
+                'wakeups': self.wakeups,
+               }
+
+def accept_batch(lsock, budget, func):
+    ''' Accept up to budget connections from lsock, invoke func(sock)
+        for each of them and return (count, overflow).  Errors other
+        than an empty queue are raised after the connections accepted
+        so far have been handled. '''
+    count = 0
+    while count < budget:
+        try:
+            sock = lsock.accept()[0]
+        except socket.error:
+            code = sys.exc_info()[1].args[0]
+            if code in ACCEPT_AGAIN:
+                return count, False
+            if code in ACCEPT_SKIP:
+                continue
+            raise
+        count += 1
+        func(sock)
+    return count, True
+
 class Listener(Pollable):
 
     ''' Pollable socket listener '''
@@ -39,6 +119,8 @@ class Listener(Pollable):
         self.endpoint = endpoint
         self.sslconfig = sslconfig
         self.sslcert = sslcert
+        self.budget = CONFIG['net.listen.accept_budget']
+        self.accept_stats = AcceptStats()
 
         # Want to listen "forever"
         self.watchdog = -1
@@ -53,9 +135,21 @@ class Listener(Pollable):
         return self.lsock.fileno()
 
     def handle_read(self):
+        # Drain the accept queue, up to the budget
+        try:
+            count, overflow = accept_batch(self.lsock, self.budget,
+                                           self._accepted)
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            self.parent.handle_accept_error(self)
+            return
+        self.accept_stats.update(count, overflow)
+
+    def _accepted(self, sock):
+        ''' Pass a new connection to the parent '''
         # Make sure we route exceptions properly
         try:
-            sock = self.lsock.accept()[0]
             sock.setblocking(False)
             self.parent.handle_accept(self, sock, self.sslconfig, self.sslcert)
         except (KeyboardInterrupt, SystemExit):
@@ -30,8 +30,10 @@ from neubot.net.poller import POLLER
 from neubot.config import CONFIG
 from neubot.database import DATABASE
 from neubot.database import table_log
+from neubot.log_writer import LogWriter
 from neubot.notify import NOTIFIER
 
+from neubot import log_trace
 from neubot import system
 from neubot import utils
 
@@ -123,12 +125,14 @@ class StreamingLogger(object):
     def start_streaming(self, stream):
         ''' Attach stream to log messages '''
         self.streams.add(stream)
+        update_tracing()
 
     def stop_streaming(self):
         ''' Close all attached streams '''
         for stream in self.streams:
             POLLER.close(stream)
         self.streams.clear()
+        update_tracing()
 
     def log(self, severity, message, args, exc_info):
         ''' Really log a message '''
@@ -191,21 +195,26 @@ class Logger(object):
 
         self._nocommit = NOCOMMIT
         self._use_database = False
-        self._queue = []
+        self.writer = LogWriter()
 
     #
     # Better not to touch the database when a test is in
     # progress, i.e. "testdone" is subscribed.
     # Maintenance consists mainly of removing old logs and
     # is mandatory because we don't want the database to grow
-    # without control.
+    # without control.  The writer performs it in its own
+    # thread (see neubot/log_writer.py).
     #
     def _maintain_database(self):
 
         POLLER.sched(INTERVAL, self._maintain_database)
 
         if (self._use_database and not NOTIFIER.is_subscribed("testdone")):
-            self.writeback()
+            now = utils.ticks()
+            vacuum = now - self.last_vacuum > INTERVAL_VACUUM
+            if vacuum:
+                self.last_vacuum = now
+            self.writer.maintain(DAYS_AGO, vacuum)
 
     #
     # We don't want to log into the database when we run
@@ -213,41 +222,17 @@ class Logger(object):
     #
     def use_database(self):
         POLLER.sched(INTERVAL, self._maintain_database)
+        connection = DATABASE.connection()
+        self.writer.start(DATABASE.path, connection)
         self._use_database = True
 
     def redirect(self):
         self.logger = system.get_background_logger()
 
-    def _writeback(self):
-        """Really commit pending log records into the database"""
-
-        connection = DATABASE.connection()
-        table_log.prune(connection, DAYS_AGO, commit=False)
-
-        for record in self._queue:
-            table_log.insert(connection, record, False)
-        connection.commit()
-
-        now = utils.ticks()
-        if now - self.last_vacuum > INTERVAL_VACUUM:
-            connection.execute("VACUUM;")
-            self.last_vacuum = now
-        connection.commit()
-
     def writeback(self):
-        """Commit pending log records into the database"""
-
-        # At least do not crash
-        try:
-            self._writeback()
-        except (KeyboardInterrupt, SystemExit):
-            raise
-        except:
-            # TODO write this exception to syslog
-            pass
-
-        # Purge the queue in any case
-        del self._queue[:]
+        """Commit pending log records into the database and
+           wait for the writer to complete (e.g. at exit)"""
+        self.writer.flush()
 
     def log(self, severity, message, args, exc_info):
         ''' Really log a message '''
@@ -320,9 +305,7 @@ class Logger(object):
                 self._nocommit = NOCOMMIT
                 commit = True
 
-            self._queue.append(record)
-            if commit:
-                self.writeback()
+            self.writer.append(record, commit)
 
         # Write to the current logger object
         self.logger(severity, message)
@@ -331,8 +314,9 @@ class Logger(object):
 
     def listify(self):
         if self._use_database:
+            pending = self.writer.pending()
             lst = table_log.listify(DATABASE.connection())
-            lst.extend(self._queue)
+            lst.extend(pending)
             return lst
         else:
             return []
@@ -378,6 +362,20 @@ ROOT_LOGGER.addHandler(LogWrapper())
 ROOT_LOGGER.addHandler(StreamingLogWrapper())
 ROOT_LOGGER.setLevel(logging.DEBUG)
 
+#
+# Debug messages have a consumer only when we are verbose or when
+# we are streaming logs, so the hot paths trace only in these cases
+# (see neubot/log_trace.py).
+#
+def update_tracing(*args):
+    ''' Sync tracers with the configuration '''
+    log_trace.configure(CONFIG['log.trace'], CONFIG['verbose'] or
+                        STREAMING_LOG.streams)
+
+CONFIG.register_watcher('verbose', update_tracing)
+CONFIG.register_watcher('log.trace', update_tracing)
+update_tracing()
+
 def set_verbose():
     ''' Make logger verbose '''
     CONFIG['verbose'] = 1
@@ -0,0 +1,88 @@
+# neubot/log_trace.py
+
+#
+# Copyright (c) 2013
+#     Nexa Center for Internet & Society, Politecnico di Torino (DAUIN),
+#     and Simone Basso <bassosimone@gmail.com>
+#
+# This file is part of Neubot <http://www.neubot.org/>.
+#
+# Neubot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Neubot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Neubot.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+''' Per-module debug tracing switches '''
+
+# Python3-ready: yes
+
+#
+# The root logger is always configured to pass DEBUG messages
+# along, because the streaming log must see them (see neubot/log.py).
+# So each logging.debug() call builds a LogRecord and walks all the
+# handlers, even when nobody is going to consume the message.  This
+# is not negligible for per-message debug calls on hot paths.
+#
+# Hot paths guard their debug calls with a tracer, i.e.:
+#
+#     TRACE = log_trace.tracer('bittorrent')
+#     ...
+#     if TRACE.enabled:
+#         logging.debug('> PIECE %d %d len=%d', index, begin, length)
+#
+# which, when tracing is disabled, costs an attribute lookup.  The
+# tracers are enabled when debug messages have a consumer (i.e. when
+# Neubot is verbose or the log is being streamed) and the module is
+# listed in the 'log.trace' setting.  neubot/log.py keeps them in
+# sync with the configuration, which is also writable through the
+# /api/config API.
+#
+
+class Tracer(object):
+
+    ''' Debug tracing switch of a module '''
+
+    __slots__ = ('name', 'enabled')
+
+    def __init__(self, name):
+        self.name = name
+        self.enabled = False
+
+TRACERS = {}
+
+# Current configuration: list of modules and whether there is a consumer
+_STATE = {'modules': 'all', 'active': False}
+
+def _is_traced(name, modules):
+    ''' Tells whether the module name is in the modules list '''
+    modules = [elem.strip() for elem in modules.split(',')]
+    return 'all' in modules or name in modules
+
+def tracer(name):
+    ''' Return the tracer of the module name '''
+    if name not in TRACERS:
+        TRACERS[name] = Tracer(name)
+        TRACERS[name].enabled = (_STATE['active'] and
+                                 _is_traced(name, _STATE['modules']))
+    return TRACERS[name]
+
+def configure(modules, active):
+    ''' Enable tracing for the comma-separated list of modules,
+        which may include 'all', if active is true '''
+    _STATE['modules'] = modules
+    _STATE['active'] = bool(active)
+    for name, elem in TRACERS.items():
+        elem.enabled = bool(active) and _is_traced(name, modules)
+
+def snap():
+    ''' Return the list of enabled tracers '''
+    return sorted([name for name, elem in TRACERS.items() if elem.enabled])
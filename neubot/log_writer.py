@@ -0,0 +1,249 @@
+# neubot/log_writer.py
+
+#
+# Copyright (c) 2013
+#     Nexa Center for Internet & Society, Politecnico di Torino (DAUIN),
+#     and Simone Basso <bassosimone@gmail.com>
+#
+# This file is part of Neubot <http://www.neubot.org/>.
+#
+# Neubot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Neubot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Neubot.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+''' Persist log records in a background thread '''
+
+#
+# Inserting log records, pruning old ones and compacting the
+# database are synchronous sqlite operations that may take long,
+# and we cannot afford to stop the poller loop in the middle of a
+# measurement.  So the logger hands records to a worker thread,
+# which owns a separate connection to the database and writes
+# them in batches, each batch being a single transaction.  Pruning
+# and VACUUM are also performed by the worker thread.
+#
+# The queue of records waiting to be written is bounded.  When it
+# is full, we drop incoming DEBUG and INFO records, while WARNING
+# and ERROR records take the place of the oldest queued record.
+# We count the dropped records (see snap()) and the worker writes
+# a WARNING record saying how many records were dropped.
+#
+# In-memory databases cannot be shared by two connections, so in
+# that case records are written synchronously, as we did before.
+#
+
+import collections
+import os
+import sqlite3
+import sys
+import threading
+
+from neubot.database import table_log
+
+from neubot import utils
+
+# Max number of records waiting to be written
+MAXQUEUE = 4096
+
+# Severities we drop first when the queue is full
+LOW_SEVERITIES = ('DEBUG', 'INFO')
+
+class LogWriter(object):
+
+    ''' Write log records into the database '''
+
+    def __init__(self, maxqueue=MAXQUEUE):
+        self.maxqueue = maxqueue
+        # Shared by the worker and flush() waiters, so use notify_all()
+        self.lock = threading.Condition()
+        self.queue = collections.deque()
+        self.inflight = []
+        self.path = None
+        self.connection = None
+        self.thread = None
+        self.pid = 0
+
+        # Pending requests
+        self.commit = False
+        self.prune = 0
+        self.vacuum = False
+
+        # Counters
+        self.batches = 0
+        self.dropped = 0
+        self.errors = 0
+        self.last_error = ''
+        self.unreported = 0
+        self.vacuums = 0
+        self.written = 0
+
+    def start(self, path, connection=None):
+        ''' Write records into the database at path, using the
+            given connection if it is an in-memory database '''
+        self.path = path
+        if not self.is_threaded():
+            self.connection = connection
+
+    def is_threaded(self):
+        ''' Returns True if we write from a separate thread '''
+        return self.path is not None and self.path != ':memory:'
+
+    def append(self, record, commit):
+        ''' Queue record and write it now if commit is true '''
+        self.lock.acquire()
+        try:
+            if len(self.queue) >= self.maxqueue:
+                self.dropped += 1
+                self.unreported += 1
+                if record['severity'] in LOW_SEVERITIES:
+                    return
+                self.queue.popleft()
+            self.queue.append(record)
+            if commit:
+                self.commit = True
+                self.lock.notify_all()
+        finally:
+            self.lock.release()
+        if commit:
+            self._kick()
+
+    def maintain(self, days_ago, vacuum):
+        ''' Prune records older than days_ago days and, if vacuum
+            is true, compact the database '''
+        self.lock.acquire()
+        self.commit = True
+        self.prune = days_ago
+        self.vacuum = self.vacuum or vacuum
+        self.lock.notify_all()
+        self.lock.release()
+        self._kick()
+
+    def flush(self, timeout=5.0):
+        ''' Write all the pending records and wait for completion,
+            at most for timeout seconds '''
+        self.lock.acquire()
+        self.commit = True
+        self.lock.notify_all()
+        self.lock.release()
+        if not self._kick():
+            return
+        deadline = utils.ticks() + timeout
+        self.lock.acquire()
+        try:
+            while self.queue or self.inflight or self.commit:
+                remaining = deadline - utils.ticks()
+                if remaining <= 0:
+                    break
+                self.lock.wait(remaining)
+        finally:
+            self.lock.release()
+
+    def pending(self):
+        ''' Return the records that are not written yet '''
+        self.lock.acquire()
+        try:
+            return self.inflight + list(self.queue)
+        finally:
+            self.lock.release()
+
+    def snap(self):
+        ''' Returns the writer counters '''
+        self.lock.acquire()
+        try:
+            return {
+                'batches': self.batches,
+                'dropped': self.dropped,
+                'errors': self.errors,
+                'last_error': self.last_error,
+                'queue': len(self.queue),
+                'threaded': self.is_threaded(),
+                'vacuums': self.vacuums,
+                'written': self.written,
+            }
+        finally:
+            self.lock.release()
+
+    def _kick(self):
+        ''' Start the thread if needed, and return False if we
+            must write synchronously instead '''
+        if not self.is_threaded():
+            if self.path is not None:
+                self._process()
+            return False
+        # Threads do not survive fork()
+        if self.pid != os.getpid() or not self.thread:
+            self.pid = os.getpid()
+            self.connection = None
+            self.thread = threading.Thread(target=self._worker)
+            self.thread.daemon = True
+            self.thread.start()
+        return True
+
+    def _worker(self):
+        ''' Write records on behalf of the poller thread '''
+        while True:
+            self.lock.acquire()
+            while not self.commit:
+                self.lock.wait()
+            self.lock.release()
+            self._process()
+
+    def _process(self):
+        ''' Process pending requests '''
+
+        self.lock.acquire()
+        batch = list(self.queue)
+        self.queue.clear()
+        self.inflight = batch
+        unreported, self.unreported = self.unreported, 0
+        prune, self.prune = self.prune, 0
+        vacuum, self.vacuum = self.vacuum, False
+        self.commit = False
+        self.lock.release()
+
+        if unreported:
+            batch = batch + [{
+                'timestamp': utils.timestamp(),
+                'severity': 'WARNING',
+                'message': 'log: dropped %d records (queue full)' % unreported,
+            }]
+
+        written, vacuumed, failed = 0, False, False
+        try:
+            if not self.connection:
+                self.connection = sqlite3.connect(self.path)
+                table_log.create(self.connection)
+            if prune:
+                table_log.prune(self.connection, prune, commit=False)
+            table_log.insert_many(self.connection, batch, commit=False)
+            self.connection.commit()
+            written = len(batch)
+            if vacuum:
+                self.connection.execute('VACUUM;')
+                self.connection.commit()
+                vacuumed = True
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            # We cannot log from here, see the error counter
+            failed = True
+            self.last_error = str(sys.exc_info()[1])
+
+        self.lock.acquire()
+        self.inflight = []
+        self.batches += 1
+        self.written += written
+        self.vacuums += vacuumed
+        self.errors += failed
+        self.lock.notify_all()
+        self.lock.release()
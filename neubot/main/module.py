@@ -33,6 +33,7 @@ MODULES = {
     "CA"                  : "neubot.net.CA",
     "agent"               : "neubot.agent",
     "api.client"          : "neubot.api.client",
+    "bench"               : "neubot.bench",
     "database"            : "neubot.database.main",
     "bittorrent"          : "neubot.bittorrent",
     "http.client"         : "neubot.http.client",
@@ -41,6 +42,7 @@ MODULES = {
     "privacy"             : "neubot.privacy",
     "raw"                 : "neubot.raw",
     "rendezvous.server"   : "neubot.rendezvous.server",
+    "segment_writer"      : "neubot.segment_writer",
     "server"              : "neubot.server",
     "speedtest"           : "neubot.speedtest.client",
     "speedtest.client"    : "neubot.speedtest.client",
@@ -61,6 +63,7 @@ if sys.platform == 'win32' and not hasattr(sys, 'frozen'):
     #import neubot.net.CA               # posix only
     import neubot.agent
     import neubot.api.client
+    #import neubot.bench                # posix only
     import neubot.database.main
     import neubot.bittorrent
     import neubot.http.client
@@ -68,6 +71,7 @@ if sys.platform == 'win32' and not hasattr(sys, 'frozen'):
     import neubot.privacy
     #import neubot.rendezvous.server    # requires PyGeoIP
     #import neubot.server               # ditto
+    import neubot.segment_writer
     import neubot.speedtest.client
     import neubot.speedtest.client
     import neubot.speedtest.server
@@ -0,0 +1,145 @@
+# neubot/negotiate/indexed_queue.py
+
+#
+# Copyright (c) 2013
+#     Nexa Center for Internet & Society, Politecnico di Torino (DAUIN),
+#     and Simone Basso <bassosimone@gmail.com>
+#
+# This file is part of Neubot <http://www.neubot.org/>.
+#
+# Neubot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Neubot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Neubot.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+''' FIFO queue with fast removal and position lookup '''
+
+#
+# Each key gets a sequence number when it joins the queue, and the
+# position of a key is the number of keys with a lower sequence
+# number still in the queue.  We count them with a Fenwick tree (also
+# known as binary indexed tree) over the sequence numbers, which has
+# a one for each key in the queue, so that appending, removing, and
+# finding the position of a key or the key at a position all take
+# O(log n) steps, wherever the key is in the queue.
+#
+# Sequence numbers are never reused, so when they are all taken we
+# renumber the keys in the queue from zero, and we make room for
+# at least as many keys as there are in the queue, so that the cost
+# of renumbering is amortized over the following appends.
+#
+
+# Initial number of sequence numbers, must be a power of two
+MIN_CAPACITY = 64
+
+# Marks the sequence numbers of the keys that left the queue
+_HOLE = object()
+
+class IndexedQueue(object):
+
+    ''' FIFO queue with fast removal and position lookup '''
+
+    def __init__(self):
+        self.nodes = {}
+        self.keys = []
+        self.tree = [0] * (MIN_CAPACITY + 1)
+        self.capacity = MIN_CAPACITY
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, key):
+        return key in self.nodes
+
+    def __iter__(self):
+        for key in self.keys:
+            if key is not _HOLE:
+                yield key
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self.nodes)
+        if index < 0 or index >= len(self.nodes):
+            raise IndexError('queue index out of range')
+        return self.keys[self._find(index)]
+
+    def _add(self, seqno, delta):
+        ''' Add delta to the count of seqno '''
+        seqno += 1
+        while seqno <= self.capacity:
+            self.tree[seqno] += delta
+            seqno += seqno & -seqno
+
+    def _count(self, seqno):
+        ''' Return how many keys have a sequence number lower
+            than seqno '''
+        count = 0
+        while seqno > 0:
+            count += self.tree[seqno]
+            seqno -= seqno & -seqno
+        return count
+
+    def _find(self, index):
+        ''' Return the sequence number of the key at index '''
+        seqno, step = 0, self.capacity
+        while step > 0:
+            if (seqno + step <= self.capacity and
+                    self.tree[seqno + step] <= index):
+                seqno += step
+                index -= self.tree[seqno]
+            step >>= 1
+        return seqno
+
+    def _renumber(self):
+        ''' Renumber the keys in the queue from zero '''
+        self.keys = [key for key in self.keys if key is not _HOLE]
+        self.capacity = MIN_CAPACITY
+        while self.capacity < 2 * len(self.keys):
+            self.capacity <<= 1
+        self.tree = [0] * (self.capacity + 1)
+        for seqno, key in enumerate(self.keys):
+            self.nodes[key] = seqno
+        # Build the tree in linear time
+        for index in xrange(1, self.capacity + 1):
+            if index <= len(self.keys):
+                self.tree[index] += 1
+            parent = index + (index & -index)
+            if parent <= self.capacity:
+                self.tree[parent] += self.tree[index]
+
+    def append(self, key):
+        ''' Append key to the queue and return its position '''
+        if key in self.nodes:
+            raise ValueError('key already in queue')
+        if len(self.keys) >= self.capacity:
+            self._renumber()
+        seqno = len(self.keys)
+        self.keys.append(key)
+        self.nodes[key] = seqno
+        self._add(seqno, 1)
+        return len(self.nodes) - 1
+
+    def position(self, key):
+        ''' Return the position of key; raises KeyError '''
+        return self._count(self.nodes[key])
+
+    def remove(self, key):
+        ''' Remove key and return the position it had; the keys
+            behind it move forward.  Raises KeyError '''
+        seqno = self.nodes.pop(key)
+        position = self._count(seqno)
+        self._add(seqno, -1)
+        self.keys[seqno] = _HOLE
+        if not self.nodes:
+            # The tree is all zeroes, so we can start over
+            del self.keys[:]
+        return position
@@ -22,15 +22,17 @@
 
 ''' Negotiate server '''
 
-import collections
 import random
 import logging
 
 from neubot.config import CONFIG
 from neubot.http.message import Message
 from neubot.http.server import ServerHTTP
+from neubot.negotiate.indexed_queue import IndexedQueue
 from neubot.compat import json
 
+from neubot import utils
+
 class NegotiateServerModule(object):
 
     ''' Each test should implement this interface '''
@@ -52,6 +54,68 @@ class NegotiateServerModule(object):
         ''' Invoked when a stream is authorized to take the test '''
         return { 'authorization': str(hash(stream)) }
 
+class QueueStats(object):
+
+    ''' Counters of a negotiate queue '''
+
+    #
+    # The wait time is the time from when a stream joins the queue
+    # to when it is unchoked.  Streams that leave the queue before
+    # they are unchoked are counted as abandoned.
+    #
+
+    def __init__(self):
+        self.joined = 0
+        self.rejected = 0
+        self.unchoked = 0
+        self.abandoned = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.since = {}
+
+    def join(self, key):
+        ''' Account for a key that joined the queue '''
+        self.joined += 1
+        self.since[key] = utils.ticks()
+
+    def reject(self, key=None):
+        ''' Account for a key that RED dropped.  In worker mode the
+            master decides after the key joined the local queue, so
+            we also forget that it joined '''
+        self.rejected += 1
+        if self.since.pop(key, None) is not None:
+            self.joined -= 1
+
+    def unchoke(self, key):
+        ''' Account for a key that has been unchoked '''
+        since = self.since.pop(key, None)
+        if since is None:
+            return  # Not the first time
+        self.unchoked += 1
+        wait = utils.ticks() - since
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+
+    def leave(self, key):
+        ''' Account for a key that left the queue '''
+        if self.since.pop(key, None) is not None:
+            self.abandoned += 1
+
+    def snap(self, queue_len):
+        ''' Take a snapshot of the counters '''
+        wait_avg = 0.0
+        if self.unchoked:
+            wait_avg = self.wait_total / self.unchoked
+        return {
+                'queue_len': queue_len,
+                'joined': self.joined,
+                'rejected': self.rejected,
+                'unchoked': self.unchoked,
+                'abandoned': self.abandoned,
+                'wait_avg': wait_avg,
+                'wait_max': self.wait_max,
+               }
+
 class NegotiateServer(ServerHTTP):
 
     ''' Common code layer for /negotiate and /collect '''
@@ -59,9 +123,12 @@ class NegotiateServer(ServerHTTP):
     def __init__(self, poller):
         ''' Initialize the negotiator '''
         ServerHTTP.__init__(self, poller)
-        self.queue = collections.deque()
+        self.queue = IndexedQueue()
         self.modules = {}
         self.known = set()
+        self.waiting = set()
+        self.coordinator = None
+        self.stats = QueueStats()
 
     def register_module(self, name, module):
         ''' Register a module '''
@@ -127,20 +194,32 @@ class NegotiateServer(ServerHTTP):
         # respond until its queue position changes.
         #
         elif request.uri.startswith('/negotiate/'):
-            if not stream in self.known:
+            if not stream in self.known and self.coordinator is not None:
+                self.known.add(stream)
+                stream.opaque = request
+                stream.atclose(self._leave_coordinator)
+                self.stats.join(stream)
+                self.coordinator.join(stream, self._coordinator_position)
+            elif not stream in self.known:
                 position = len(self.queue)
                 min_thresh = CONFIG['negotiate.min_thresh']
                 max_thresh = CONFIG['negotiate.max_thresh']
                 if random.random() < float(position - min_thresh) / (
                                        max_thresh - min_thresh):
+                    self.stats.reject()
                     stream.close()
                     return
                 self.queue.append(stream)
                 self.known.add(stream)
+                self.stats.join(stream)
                 stream.atclose(self._update_queue)
                 self._do_negotiate((stream, request, position))
             else:
                 stream.opaque = request
+                if self.coordinator is not None:
+                    self.coordinator.wait(stream)
+                elif stream in self.queue:
+                    self.waiting.add(stream)
 
         # For robustness
         else:
@@ -176,50 +255,90 @@ class NegotiateServer(ServerHTTP):
                          keepalive=True,
                          mimetype='application/json')
         stream.send_response(request, response)
+        if unchoked:
+            self.stats.unchoke(stream)
 
     #
-    # In theory this function should walk the queue and remove the
-    # lost stream.  But, actually, it seems better/faster to create
-    # and fill a new queue.
-    # In the new queue we will add streams before @lost_stream and
-    # streams after @lost_stream that (i) have no pending comet
-    # request or (ii) have a pending comet request and successfully
-    # manage to send it.
-    # Note: in case of error sending the pending comet request,
-    # unregister atclose hook to prevent recursion.
-    # TODO Libero Camillo suggests to use an ordered dictionary to
-    # implement the queue.  I like the idea and I will look into
-    # that after the pending Neubot release.
+    # When a stream leaves the queue, the streams behind it move
+    # forward by one position, and we respond to the ones to which
+    # we owe a response, i.e. the ones in self.waiting.  The queue
+    # tells us the position of each stream without walking it, so
+    # the cost depends on the number of waiting streams behind the
+    # lost one, not on the length of the queue.
+    # We respond in queue order.  In case of error sending the
+    # pending comet request, we remove the stream from the queue
+    # immediately (so the streams behind it get the right position)
+    # and we unregister the atclose hook to prevent recursion.
     #
     def _update_queue(self, lost_stream, ignored):
         ''' Invoked when a connection is lost '''
-        queue, found = collections.deque(), False
-        position = 0
-        for stream in self.queue:
-            if not found:
-                if lost_stream != stream:
-                    position += 1
-                    queue.append(stream)
-                else:
-                    found = True
-                    self.known.remove(stream)
-            elif not stream.opaque:
-                position += 1
-                queue.append(stream)
-            else:
-                request, stream.opaque = stream.opaque, None
-                try:
-                    self._do_negotiate((stream, request, position))
-                    position += 1
-                    queue.append(stream)
-                except (KeyboardInterrupt, SystemExit):
-                    raise
-                except:
-                    logging.error('Exception', exc_info=1)
-                    stream.unregister_atclose(self._update_queue)
-                    self.known.remove(stream)
-                    stream.close()
-        self.queue = queue
+        first = self.queue.remove(lost_stream)
+        self.known.remove(lost_stream)
+        self.waiting.discard(lost_stream)
+        self.stats.leave(lost_stream)
+        if not self.waiting:
+            return
+        streams = [stream for stream in self.waiting
+                   if self.queue.position(stream) >= first]
+        streams.sort(key=self.queue.position)
+        for stream in streams:
+            self.waiting.remove(stream)
+            position = self.queue.position(stream)
+            request, stream.opaque = stream.opaque, None
+            try:
+                self._do_negotiate((stream, request, position))
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except:
+                logging.error('Exception', exc_info=1)
+                stream.unregister_atclose(self._update_queue)
+                self.queue.remove(stream)
+                self.known.remove(stream)
+                self.stats.leave(stream)
+                stream.close()
+
+    #
+    # When we run as one of many server workers, the queue is
+    # global and is managed by the master process, which tells us
+    # the position of a stream when it joins and, after we tell it
+    # that we owe a response to the stream, when the position
+    # changes.  A None position means that the master decided to
+    # drop the stream.  As above, we respond only if we owe a
+    # response to the stream.
+    #
+    def _coordinator_position(self, stream, position):
+        ''' Invoked when the position of a stream changes '''
+        if position is None:
+            stream.unregister_atclose(self._leave_coordinator)
+            self.known.remove(stream)
+            self.stats.reject(stream)
+            stream.close()
+            return
+        if not stream.opaque:
+            return
+        request, stream.opaque = stream.opaque, None
+        try:
+            self._do_negotiate((stream, request, position))
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            logging.error('Exception', exc_info=1)
+            stream.unregister_atclose(self._leave_coordinator)
+            self._leave_coordinator(stream, None)
+            stream.close()
+
+    def _leave_coordinator(self, stream, ignored):
+        ''' Invoked when a connection is lost '''
+        self.known.remove(stream)
+        self.stats.leave(stream)
+        self.coordinator.leave(stream)
+
+    def snap(self, data):
+        ''' Take a snapshot of the queue counters '''
+        queue_len = len(self.queue)
+        if self.coordinator is not None:
+            queue_len = len(self.coordinator)
+        data['negotiate'] = self.stats.snap(queue_len)
 
 # No poller, so it cannot be used directly
 NEGOTIATE_SERVER = NegotiateServer(None)
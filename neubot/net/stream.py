@@ -31,7 +31,9 @@
 
 import collections
 import errno
+import os
 import socket
+import stat
 import sys
 import types
 import logging
@@ -44,10 +46,14 @@ except ImportError:
 if __name__ == "__main__":
     sys.path.insert(0, ".")
 
+from neubot.bufpool import Receiver
 from neubot.config import CONFIG
+from neubot.listener import AcceptStats
+from neubot.listener import accept_batch
 from neubot.log import oops
 from neubot.net.poller import POLLER
 from neubot.net.poller import Pollable
+from neubot.resolver import RESOLVER
 
 from neubot import utils
 from neubot import utils_net
@@ -60,11 +66,18 @@ STATES = [SUCCESS, ERROR, WANT_READ, WANT_WRITE, CONNRESET] = range(5)
 # Maximum amount of bytes we read from a socket
 MAXBUF = 1 << 18
 
+# What we can put in the send queue without copying it
+BYTES = (str, buffer)
+STRINGS = (basestring, buffer)
+
 # Soft errors on sockets, i.e. we can retry later
 SOFT_ERRORS = [ errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR ]
 
 if ssl:
     class SSLWrapper(object):
+        can_sendfile = False
+        can_sendv = False
+
         def __init__(self, sock):
             self.sock = sock
 
@@ -99,8 +112,11 @@ if ssl:
                     return ERROR, exception
 
 class SocketWrapper(object):
-    def __init__(self, sock):
+    can_sendv = True
+
+    def __init__(self, sock, sendfile=True):
         self.sock = sock
+        self.can_sendfile = sendfile and utils_net.SENDFILE is not None
 
     def soclose(self):
         try:
@@ -120,6 +136,18 @@ class SocketWrapper(object):
             else:
                 return ERROR, exception
 
+    def sorecv_into(self, receiver, maxlen):
+        try:
+            octets = receiver.recv(self.sock, maxlen)
+            return SUCCESS, octets
+        except socket.error, exception:
+            if exception[0] in SOFT_ERRORS:
+                return WANT_READ, ""
+            elif exception[0] == errno.ECONNRESET:
+                return CONNRESET, ""
+            else:
+                return ERROR, exception
+
     def sosend(self, octets):
         try:
             count = self.sock.send(octets)
@@ -132,7 +160,80 @@ class SocketWrapper(object):
             else:
                 return ERROR, exception
 
+    def sosendv(self, vector):
+        try:
+            count = utils_net.sendv(self.sock, vector)
+            return SUCCESS, count
+        except socket.error, exception:
+            if exception[0] in SOFT_ERRORS:
+                return WANT_WRITE, 0
+            elif exception[0] == errno.ECONNRESET:
+                return CONNRESET, 0
+            else:
+                return ERROR, exception
+
+    def sosendfile(self, fileslice):
+        try:
+            count = utils_net.SENDFILE(self.sock.fileno(), fileslice.fileno,
+                                       fileslice.offset, len(fileslice))
+        except (socket.error, OSError), exception:
+            if exception[0] in SOFT_ERRORS:
+                return WANT_WRITE, 0
+            elif exception[0] == errno.ECONNRESET:
+                return CONNRESET, 0
+            else:
+                return ERROR, exception
+        if count == 0:
+            # Must not be confused with EOF on the socket
+            return ERROR, RuntimeError("File shrunk while sending it")
+        return SUCCESS, count
+
+#
+# A file in the send queue that we transmit using sendfile(), i.e.
+# without copying its content into Python strings.  We can do that
+# only for regular files on non-SSL connections; in all the other
+# cases we read() the file and send() what we read.
+#
+
+class FileSlice(object):
+    def __init__(self, filep, offset, end):
+        self.filep = filep
+        self.fileno = filep.fileno()
+        self.offset = offset
+        self.end = end
+
+    def __len__(self):
+        return self.end - self.offset
+
+    def advance(self, count):
+        self.offset += count
+        return self
+
+def _make_fileslice(filep):
+    ''' Return a FileSlice for filep, or None if we cannot sendfile() it '''
+    if not isinstance(filep, file):
+        return None
+    try:
+        fileno = filep.fileno()
+        if not stat.S_ISREG(os.fstat(fileno).st_mode):
+            return None
+        offset = filep.tell()
+        end = os.fstat(fileno).st_size
+    except (IOError, OSError):
+        return None
+    # We're going to consume it, like read() would do
+    filep.seek(0, os.SEEK_END)
+    return FileSlice(filep, offset, end)
+
 class Stream(Pollable):
+
+    #
+    # Subclasses that set recv_slices receive Slices of pooled
+    # buffers (see neubot/bufpool.py) rather than strings in
+    # recv_complete(), except for SSL streams.
+    #
+    recv_slices = False
+
     def __init__(self, poller):
         Pollable.__init__(self)
         self.poller = poller
@@ -156,6 +257,7 @@ class Stream(Pollable):
         self.send_octets = None
         self.send_queue = collections.deque()
         self.send_pending = False
+        self.receiver = None
 
         self.bytes_recv_tot = 0
         self.bytes_sent_tot = 0
@@ -199,7 +301,10 @@ class Stream(Pollable):
             self.recv_ssl_needs_kickoff = not server_side
 
         else:
-            self.sock = SocketWrapper(sock)
+            self.sock = SocketWrapper(sock, conf.get("net.stream.sendfile",
+                                                     True))
+            if self.recv_slices:
+                self.receiver = Receiver()
 
         self.connection_made()
 
@@ -246,6 +351,8 @@ class Stream(Pollable):
 
         self.send_octets = None
         self.sock.soclose()
+        if self.receiver:
+            self.receiver.close()
 
     # Recv path
 
@@ -287,7 +394,10 @@ class Stream(Pollable):
             self.handle_write()
             return
 
-        status, octets = self.sock.sorecv(MAXBUF)
+        if self.receiver:
+            status, octets = self.sock.sorecv_into(self.receiver, MAXBUF)
+        else:
+            status, octets = self.sock.sorecv(MAXBUF)
 
         if status == SUCCESS and octets:
 
@@ -333,15 +443,30 @@ class Stream(Pollable):
 
         while self.send_queue:
             octets = self.send_queue[0]
-            if isinstance(octets, basestring):
+            if isinstance(octets, STRINGS):
                 # remove the piece in any case
                 self.send_queue.popleft()
                 if octets:
                     break
             else:
-                octets = octets.read(MAXBUF)
-                if octets:
-                    break
+                fileslice = None
+                if getattr(self.sock, "can_sendfile", False):
+                    fileslice = _make_fileslice(octets)
+                if fileslice:
+                    self.send_queue.popleft()
+                    return fileslice
+                # readbuf() returns buffers that we should not copy
+                if hasattr(octets, "readbuf"):
+                    vector = [elem for elem in octets.readbuf(MAXBUF) if elem]
+                    if vector:
+                        self.send_queue.extendleft(reversed(vector[1:]))
+                        octets = vector[0]
+                        break
+                    octets = ""
+                else:
+                    octets = octets.read(MAXBUF)
+                    if octets:
+                        break
                 # remove the file-like when it is empty
                 self.send_queue.popleft()
 
@@ -352,6 +477,43 @@ class Stream(Pollable):
 
         return octets
 
+    #
+    # When there are strings queued after the one we are sending, we
+    # pass all of them to a single vectored send, to save the syscalls
+    # we would otherwise make sending them one at a time.  Only plain
+    # byte strings and buffers are gathered: files and unicode strings
+    # are still handled by read_send_queue().
+    #
+
+    def _gather_send_queue(self):
+        if not getattr(self.sock, "can_sendv", False):
+            return None
+        if not self.send_queue or type(self.send_queue[0]) not in BYTES:
+            return None
+        vector = [self.send_octets]
+        total = len(self.send_octets)
+        for octets in self.send_queue:
+            if (type(octets) not in BYTES or len(vector) >= utils_net.IOV_MAX
+                    or total >= MAXBUF):
+                break
+            vector.append(octets)
+            total += len(octets)
+        return vector
+
+    def _consume_send_queue(self, vector, count):
+        # Pop what we've sent and return the count relative to the
+        # new self.send_octets, so the caller can proceed as usual
+        if count <= len(vector[0]):
+            return count
+        count -= len(vector[0])
+        for octets in vector[1:]:
+            self.send_queue.popleft()
+            self.send_octets = octets
+            if count <= len(octets):
+                return count
+            count -= len(octets)
+        raise RuntimeError("Sent more than expected")
+
     def start_send(self, octets):
         if self.close_complete or self.close_pending:
             return
@@ -380,10 +542,20 @@ class Stream(Pollable):
             self.handle_read()
             return
 
-        status, count = self.sock.sosend(self.send_octets)
+        vector = None
+        if self.send_octets.__class__ is FileSlice:
+            status, count = self.sock.sosendfile(self.send_octets)
+        else:
+            vector = self._gather_send_queue()
+            if vector:
+                status, count = self.sock.sosendv(vector)
+            else:
+                status, count = self.sock.sosend(self.send_octets)
 
         if status == SUCCESS and count > 0:
             self.bytes_sent_tot += count
+            if vector:
+                count = self._consume_send_queue(vector, count)
 
             if count == len(self.send_octets):
 
@@ -400,7 +572,10 @@ class Stream(Pollable):
                 return
 
             if count < len(self.send_octets):
-                self.send_octets = buffer(self.send_octets, count)
+                if self.send_octets.__class__ is FileSlice:
+                    self.send_octets = self.send_octets.advance(count)
+                else:
+                    self.send_octets = buffer(self.send_octets, count)
                 self.poller.set_writable(self)
                 return
 
@@ -475,7 +650,9 @@ class Connector(Pollable):
         prefer_ipv6 = CONFIG["prefer_ipv6"]
         if conf and "prefer_ipv6" in conf:
             prefer_ipv6 = conf["prefer_ipv6"]
-        sock = utils_net.connect(endpoint, prefer_ipv6)
+        RESOLVER.connect(endpoint, prefer_ipv6, self._connect_started)
+
+    def _connect_started(self, sock):
         if not sock:
             self._connection_failed()
             return
@@ -507,6 +684,8 @@ class Listener(Pollable):
         self.parent = parent
         self.lsock = sock
         self.endpoint = endpoint
+        self.budget = CONFIG['net.listen.accept_budget']
+        self.accept_stats = AcceptStats()
 
         # Want to listen "forever"
         self.watchdog = -1
@@ -528,14 +707,23 @@ class Listener(Pollable):
     #
     def handle_read(self):
         try:
-            sock = self.lsock.accept()[0]
+            count, overflow = accept_batch(self.lsock, self.budget,
+                                           self._accepted)
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except Exception, exception:
+            self.parent.accept_failed(self, exception)
+            return
+        self.accept_stats.update(count, overflow)
+
+    def _accepted(self, sock):
+        try:
             sock.setblocking(False)
             self.parent.connection_made(sock, self.endpoint, 0)
         except (KeyboardInterrupt, SystemExit):
             raise
         except Exception, exception:
             self.parent.accept_failed(self, exception)
-            return
 
     def handle_close(self):
         self.parent.bind_failed(self.endpoint)  # XXX
@@ -662,6 +850,7 @@ CONFIG.register_defaults({
     # General variables
     "net.stream.certfile": "",
     "net.stream.secure": False,
+    "net.stream.sendfile": True,
     "net.stream.server_side": False,
     # For main()
     "net.stream.address": "127.0.0.1 ::1",
@@ -679,6 +868,7 @@ def main(args):
         # General variables
         "net.stream.certfile": "Set SSL certfile path",
         "net.stream.secure": "Enable SSL",
+        "net.stream.sendfile": "Use sendfile() to send files, when possible",
         "net.stream.server_side": "Enable SSL server-side mode",
         # For main()
         "net.stream.address": "Set client or server address",
@@ -29,43 +29,78 @@
 import logging
 import errno
 import select
-import sched
 import sys
 
 from neubot.utils import ticks
 from neubot.utils import timestamp
 
+from neubot.poller_backend import READABLE
+from neubot.poller_backend import WRITABLE
+from neubot.poller_timers import TimerHeap
+
+from neubot import poller_backend
+
 #
-# Number of seconds between each check for timed-out
-# I/O operations.
+# Number of seconds after which we check again a stream
+# that does not want to be reclaimed by the watchdog, just
+# in case it changes its mind.
 #
 CHECK_TIMEOUT = 10
 
-class Poller(sched.scheduler):
+#
+# Minimum delay between two checks of the same watchdog,
+# to avoid spinning when the deadline is very near.
+#
+WATCHDOG_MINDELAY = 1
+
+class BackendError(select.error):
+
+    ''' The backend failed to wait for I/O events '''
+
+    #
+    # We wrap the error of backend.wait() into this class so that
+    # loop() can tell it apart from errors raised by the callbacks
+    # (e.g. a socket.error raised when closing a stream), which
+    # must not stop the poller.  It derives from select.error and
+    # keeps the original arguments, so args[0] is still the errno.
+    #
+
+class Poller(object):
 
     ''' Dispatch read, write, periodic and other events '''
 
     #
-    # We always keep the check_timeout() event registered
-    # so the scheduler is alive forever.
-    # We register self._poll() as the delay function and
-    # in that function we either invoke select() or we
-    # sleep for the requested amount of time.
+    # Scheduled tasks are kept into a timer heap and the loop
+    # waits for I/O events using the backend, with a timeout
+    # equal to the time until the first timer expires.
+    #
+    # The backend keeps a persistent interest set, which we
+    # update only when a stream is added to (or removed from)
+    # readset and writeset.
+    #
+    # Each stream has a watchdog timer, which is armed when the
+    # stream is registered with the poller for the first time and
+    # which fires when its watchdog deadline expires.  On activity
+    # streams just update `created`: when the timer fires, it
+    # reschedules itself if the deadline has moved forward.  Only
+    # when the deadline moves backward we need to explicitly
+    # reschedule the timer, which is done by reset_watchdog().
     #
 
-    def __init__(self, select_timeout):
+    def __init__(self, select_timeout, backend=None):
         ''' Initialize '''
-        sched.scheduler.__init__(self, ticks, self._poll)
         self.select_timeout = select_timeout
         self.again = True
         self.readset = {}
         self.writeset = {}
-        self.check_timeout()
+        self.backend = poller_backend.create_backend(backend)
+        self.timers = TimerHeap()
+        self.watchdogs = {}
 
     def sched(self, delta, func, *args):
         ''' Schedule task '''
         #logging.debug('poller: sched: %s, %s, %s', delta, func, args)
-        self.enter(delta, 0, self._run_task, (func, args))
+        self.timers.arm(ticks() + delta, self._run_task, (func, args))
         return timestamp() + delta
 
     @staticmethod
@@ -84,28 +119,44 @@ class Poller(sched.scheduler):
 
     def set_readable(self, stream):
         ''' Monitor for readability '''
-        self.readset[stream.fileno()] = stream
+        fileno = stream.fileno()
+        if fileno not in self.readset:
+            self.backend.update(fileno, True, fileno in self.writeset)
+            self._watch(stream, fileno)
+        self.readset[fileno] = stream
 
     def set_writable(self, stream):
         ''' Monitor for writability '''
-        self.writeset[stream.fileno()] = stream
+        fileno = stream.fileno()
+        if fileno not in self.writeset:
+            self.backend.update(fileno, fileno in self.readset, True)
+            self._watch(stream, fileno)
+        self.writeset[fileno] = stream
 
     def unset_readable(self, stream):
         ''' Stop monitoring for readability '''
         fileno = stream.fileno()
         if fileno in self.readset:
             del self.readset[fileno]
+            self.backend.update(fileno, False, fileno in self.writeset)
 
     def unset_writable(self, stream):
         ''' Stop monitoring for writability '''
         fileno = stream.fileno()
         if fileno in self.writeset:
             del self.writeset[fileno]
+            self.backend.update(fileno, fileno in self.readset, False)
 
     def close(self, stream):
         ''' Safely close a stream '''
-        self.unset_readable(stream)
-        self.unset_writable(stream)
+        timer = self.watchdogs.pop(stream, None)
+        if timer:
+            timer.cancel()
+        fileno = stream.fileno()
+        if fileno in self.readset or fileno in self.writeset:
+            self.readset.pop(fileno, None)
+            self.writeset.pop(fileno, None)
+            self.backend.update(fileno, False, False)
         try:
             stream.handle_close()
         except (KeyboardInterrupt, SystemExit):
@@ -158,13 +209,24 @@ class Poller(sched.scheduler):
         while True:
             try:
                 self.run()
-            except (SystemExit, select.error):
+            except (SystemExit, BackendError):
                 raise
             except KeyboardInterrupt:
                 break  # overriden semantic: break out of poller loop NOW
             except:
                 logging.error('poller: unhandled exception', exc_info=1)
 
+    def run(self):
+        ''' Run expired timers and dispatch I/O events forever '''
+        while True:
+            deadline = self.timers.next_deadline()
+            if deadline is None:
+                timeout = None
+            else:
+                timeout = max(0, deadline - ticks())
+            self._poll(timeout)
+            self.timers.run_expired(ticks())
+
     def _poll(self, timeout):
         ''' Poll for readability and writability '''
 
@@ -177,49 +239,108 @@ class Poller(sched.scheduler):
 
             # Get list of readable/writable streams
             try:
-                res = select.select(list(self.readset.keys()),
-                                    list(self.writeset.keys()),
-                                    [], timeout)
-            except select.error:
-                code = sys.exc_info()[1][0]
+                events = self.backend.wait(timeout)
+            except (select.error, IOError, OSError):
+                code = sys.exc_info()[1].args[0]
                 if code != errno.EINTR:
-                    logging.error('poller: select() failed', exc_info=1)
-                    raise
+                    logging.error('poller: %s() failed', self.backend.name,
+                                  exc_info=1)
+                    raise BackendError(*sys.exc_info()[1].args)
 
                 else:
                     # Take care of EINTR
                     return
 
             # No error?  Fire readable and writable events
-            for fileno in res[0]:
-                self._call_handle_read(fileno)
-            for fileno in res[1]:
-                self._call_handle_write(fileno)
+            for fileno, flags in events:
+                if flags & READABLE:
+                    self._call_handle_read(fileno)
+                if flags & WRITABLE:
+                    self._call_handle_write(fileno)
 
         # No I/O pending?  Break out of the loop.
         else:
             raise KeyboardInterrupt('poller: no I/O pending')
 
-    def check_timeout(self):
-        ''' Dispatch the periodic event '''
-
-        self.sched(CHECK_TIMEOUT, self.check_timeout)
-        if self.readset or self.writeset:
-
-            streams = set()
-            streams.update(list(self.readset.values()))
-            streams.update(list(self.writeset.values()))
+    #
+    # Watchdog: we pass the fileno to the timer because a stream
+    # may not have a valid fileno after it has been closed, e.g.
+    # the connector drops its socket on failure.
+    #
 
-            timenow = ticks()
-            for stream in streams:
-                if stream.handle_periodic(timenow):
-                    logging.debug('poller: watchdog timeout: %s', str(stream))
-                    self.close(stream)
+    def _watch(self, stream, fileno):
+        ''' Make sure the watchdog of a stream is armed for fileno '''
+        timer = self.watchdogs.get(stream)
+        if not timer:
+            self._arm_watchdog(stream, fileno)
+        elif timer.args[1] != fileno:
+            #
+            # Same stream, new fileno: this happens, e.g., when the
+            # connector gives up with an address and tries the next
+            # one.  Keep the deadline but check the new fileno.
+            #
+            timer.args = (stream, fileno)
+
+    def _arm_watchdog(self, stream, fileno):
+        ''' Arm the watchdog timer of a stream '''
+        timenow = ticks()
+        watchdog = getattr(stream, 'watchdog', 0)
+        if watchdog < 0:
+            delay = CHECK_TIMEOUT
+        else:
+            created = getattr(stream, 'created', timenow)
+            delay = max(WATCHDOG_MINDELAY, created + watchdog - timenow)
+        self.watchdogs[stream] = self.timers.arm(timenow + delay,
+          self._watchdog_expired, (stream, fileno))
+
+    def _watchdog_expired(self, stream, fileno):
+        ''' Invoked when the watchdog timer of a stream expires '''
+        del self.watchdogs[stream]
+
+        #
+        # The stream is not registered with the poller anymore,
+        # so there is no need to keep the timer.  It will be
+        # armed again if the stream comes back.
+        #
+        if (self.readset.get(fileno) is not stream and
+            self.writeset.get(fileno) is not stream):
+            return
+
+        if stream.handle_periodic(ticks()):
+            logging.debug('poller: watchdog timeout: %s', str(stream))
+            self.close(stream)
+            return
+
+        self._arm_watchdog(stream, fileno)
+
+    def reset_watchdog(self, stream):
+        ''' Reschedule the watchdog because the deadline changed '''
+        timer = self.watchdogs.pop(stream, None)
+        if timer:
+            fileno = timer.args[1]
+            timer.cancel()
+            self._arm_watchdog(stream, fileno)
+
+    def after_fork(self):
+        ''' Create a new backend in the child process '''
+        # Otherwise parent and child would share the epoll interest set
+        backend = self.backend
+        self.backend = poller_backend.create_backend(backend.name)
+        backend.close()
+        for fileno in set(self.readset) | set(self.writeset):
+            self.backend.update(fileno, fileno in self.readset,
+                                fileno in self.writeset)
 
     def snap(self, data):
         ''' Take a snapshot of poller state '''
-        data['poller'] = { "readset": self.readset, "writeset": self.writeset }
-        if hasattr(self, 'queue'):
-            data['poller']['queue'] = self.queue
+        listeners = {}
+        for stream in self.readset.values():
+            stats = getattr(stream, 'accept_stats', None)
+            if stats is not None:
+                listeners[repr(stream)] = stats.snap()
+        data['poller'] = { "readset": self.readset, "writeset": self.writeset,
+                           "backend": self.backend.name,
+                           "listeners": listeners,
+                           "timers": len(self.timers) }
 
 POLLER = Poller(1)
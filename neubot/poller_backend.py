@@ -0,0 +1,266 @@
+# neubot/poller_backend.py
+
+#
+# Copyright (c) 2013
+#     Nexa Center for Internet & Society, Politecnico di Torino (DAUIN),
+#     and Simone Basso <bassosimone@gmail.com>
+#
+# This file is part of Neubot <http://www.neubot.org/>.
+#
+# Neubot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Neubot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Neubot.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+''' I/O multiplexing backends for the poller '''
+
+# Python3-ready: yes
+
+#
+# The poller keeps track of readable and writable streams using two
+# dictionaries.  With select() we must rebuild the list of filenos
+# at each iteration, which is O(n) in the number of streams.  The
+# poll() and epoll() backends, instead, keep a persistent interest
+# set inside the kernel (or inside the poll object) and the poller
+# updates it only when the interest of a stream changes.
+#
+# Each backend exposes the same interface: update() changes the
+# interest of a fileno, and wait() returns a list of (fileno, flags)
+# tuples, where flags is a combination of READABLE and WRITABLE.
+#
+
+import errno
+import logging
+import os
+import select
+import sys
+
+# Flags returned by wait()
+READABLE, WRITABLE = 1, 2
+
+class SelectBackend(object):
+
+    ''' Backend using select() '''
+
+    name = 'select'
+
+    def __init__(self):
+        self.readable = set()
+        self.writable = set()
+
+    def update(self, fileno, readable, writable):
+        ''' Update the interest set for fileno '''
+        if readable:
+            self.readable.add(fileno)
+        else:
+            self.readable.discard(fileno)
+        if writable:
+            self.writable.add(fileno)
+        else:
+            self.writable.discard(fileno)
+
+    def wait(self, timeout):
+        ''' Wait for I/O events '''
+        res = select.select(self.readable, self.writable, [], timeout)
+        events = {}
+        for fileno in res[0]:
+            events[fileno] = READABLE
+        for fileno in res[1]:
+            events[fileno] = events.get(fileno, 0) | WRITABLE
+        return list(events.items())
+
+    def close(self):
+        ''' Release resources '''
+
+#
+# The poll() and epoll() backends pass the poll function of their
+# poll object to the base class, wrapped so that it accepts the
+# timeout in seconds (or None to block forever), as select() does.
+#
+
+def _poll_milliseconds(pollfunc):
+    ''' Wrap a poll function that wants the timeout in milliseconds '''
+    def wrapper(timeout):
+        ''' Poll with timeout in seconds '''
+        if timeout is None or timeout < 0:
+            return pollfunc()
+        # Round up to avoid busy looping when timeout < 1 ms
+        return pollfunc(int(timeout * 1000 + 0.999))
+    return wrapper
+
+def _poll_seconds(pollfunc):
+    ''' Wrap a poll function that wants the timeout in seconds '''
+    def wrapper(timeout):
+        ''' Poll with timeout in seconds '''
+        if timeout is None or timeout < 0:
+            timeout = -1
+        return pollfunc(timeout)
+    return wrapper
+
+class _PollBackendBase(object):
+
+    ''' Common code of poll() and epoll() backends '''
+
+    name = ''
+
+    #
+    # Note that errors and hangups are reported as both readable and
+    # writable, so the stream will notice them no matter which event
+    # it is waiting for.  This is consistent with select() behavior.
+    #
+    EV_READ = 0
+    EV_WRITE = 0
+    EV_ERROR = 0
+
+    def __init__(self, pollobj, pollfunc):
+        self.masks = {}
+        self.pollobj = pollobj
+        self._poll = pollfunc
+
+    def update(self, fileno, readable, writable):
+        ''' Update the interest set for fileno '''
+        mask = 0
+        if readable:
+            mask |= self.EV_READ
+        if writable:
+            mask |= self.EV_WRITE
+        current = self.masks.get(fileno, 0)
+        if mask == current:
+            return
+        if not mask:
+            del self.masks[fileno]
+            self._unregister(fileno)
+        elif not current:
+            self.masks[fileno] = mask
+            self._register(fileno, mask)
+        else:
+            self.masks[fileno] = mask
+            self._modify(fileno, mask)
+
+    def _register(self, fileno, mask):
+        ''' Register fileno with mask '''
+        self.pollobj.register(fileno, mask)
+
+    def _modify(self, fileno, mask):
+        ''' Modify mask of fileno '''
+        self.pollobj.modify(fileno, mask)
+
+    def _unregister(self, fileno):
+        ''' Unregister fileno '''
+        try:
+            self.pollobj.unregister(fileno)
+        except (KeyError, IOError, OSError):
+            # The file descriptor may have already been closed
+            logging.debug('poller: %s: cannot unregister %d', self.name,
+                          fileno)
+
+    def wait(self, timeout):
+        ''' Wait for I/O events '''
+        result = []
+        for fileno, mask in self._poll(timeout):
+            flags = 0
+            if mask & (self.EV_READ | self.EV_ERROR):
+                flags |= READABLE
+            if mask & (self.EV_WRITE | self.EV_ERROR):
+                flags |= WRITABLE
+            if flags:
+                result.append((fileno, flags))
+        return result
+
+    def close(self):
+        ''' Release resources '''
+        self.masks.clear()
+
+class PollBackend(_PollBackendBase):
+
+    ''' Backend using poll() '''
+
+    name = 'poll'
+
+    def __init__(self):
+        pollobj = select.poll()
+        _PollBackendBase.__init__(self, pollobj,
+                                  _poll_milliseconds(pollobj.poll))
+        self.EV_READ = select.POLLIN | select.POLLPRI
+        self.EV_WRITE = select.POLLOUT
+        self.EV_ERROR = select.POLLERR | select.POLLHUP | select.POLLNVAL
+
+class EpollBackend(_PollBackendBase):
+
+    ''' Backend using epoll() '''
+
+    name = 'epoll'
+
+    def __init__(self):
+        pollobj = select.epoll()
+        _PollBackendBase.__init__(self, pollobj,
+                                  _poll_seconds(pollobj.poll))
+        self.EV_READ = select.EPOLLIN | select.EPOLLPRI
+        self.EV_WRITE = select.EPOLLOUT
+        self.EV_ERROR = select.EPOLLERR | select.EPOLLHUP
+
+    #
+    # The kernel automatically removes a file descriptor from the
+    # epoll set when it is closed.  So, if a socket is closed before
+    # being unregistered and its fileno is reused, we may think that
+    # a fileno is registered when it is not (or the other way round).
+    # We deal with that by falling back to the other operation.
+    #
+
+    def _register(self, fileno, mask):
+        try:
+            self.pollobj.register(fileno, mask)
+        except (IOError, OSError):
+            if sys.exc_info()[1].args[0] != errno.EEXIST:
+                raise
+            self.pollobj.modify(fileno, mask)
+
+    def _modify(self, fileno, mask):
+        try:
+            self.pollobj.modify(fileno, mask)
+        except (IOError, OSError):
+            if sys.exc_info()[1].args[0] != errno.ENOENT:
+                raise
+            self.pollobj.register(fileno, mask)
+
+    def close(self):
+        _PollBackendBase.close(self)
+        self.pollobj.close()
+
+BACKENDS = {
+    'epoll': EpollBackend,
+    'poll': PollBackend,
+    'select': SelectBackend,
+}
+
+def available_backends():
+    ''' Return the list of backends available on this system,
+        from the most to the least efficient one '''
+    result = []
+    if hasattr(select, 'epoll'):
+        result.append('epoll')
+    if hasattr(select, 'poll'):
+        result.append('poll')
+    result.append('select')
+    return result
+
+def create_backend(name=None):
+    ''' Create the named backend or the most efficient one '''
+    if not name:
+        name = os.environ.get('NEUBOT_POLLER_BACKEND', '')
+    available = available_backends()
+    if name and name not in available:
+        logging.warning('poller: backend %s not available', name)
+        name = ''
+    if not name:
+        name = available[0]
+    return BACKENDS[name]()
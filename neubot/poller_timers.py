@@ -0,0 +1,153 @@
+# neubot/poller_timers.py
+
+#
+# Copyright (c) 2013
+#     Nexa Center for Internet & Society, Politecnico di Torino (DAUIN),
+#     and Simone Basso <bassosimone@gmail.com>
+#
+# This file is part of Neubot <http://www.neubot.org/>.
+#
+# Neubot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Neubot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Neubot.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+''' Timers for the poller '''
+
+# Python3-ready: yes
+
+#
+# Timers are kept into a binary heap ordered by deadline and then
+# by sequence number, so timers with the same deadline fire in the
+# order in which they were armed.  Arming a timer costs O(log n),
+# while cancelling it is O(1): we just mark the timer as cancelled
+# and we drop it when it reaches the top of the heap.  To bound the
+# memory used by cancelled timers, the heap is compacted when more
+# than half of its entries have been cancelled.
+#
+
+import heapq
+import logging
+
+# Do not bother compacting small heaps
+COMPACT_THRESHOLD = 64
+
+class Timer(object):
+
+    ''' A timer armed into a TimerHeap '''
+
+    __slots__ = ('deadline', 'seqno', 'func', 'args', 'owner')
+
+    def __init__(self, deadline, seqno, func, args, owner):
+        self.deadline = deadline
+        self.seqno = seqno
+        self.func = func
+        self.args = args
+        self.owner = owner
+
+    def __lt__(self, other):
+        return (self.deadline, self.seqno) < (other.deadline, other.seqno)
+
+    def active(self):
+        ''' Return True if this timer is still armed '''
+        return self.func is not None
+
+    def cancel(self):
+        ''' Cancel this timer '''
+        if self.func is not None:
+            self.func = None
+            self.args = None
+            self.owner.cancelled(self)
+            self.owner = None
+
+class TimerHeap(object):
+
+    ''' Heap of timers '''
+
+    def __init__(self):
+        self.heap = []
+        self.seqno = 0
+        self.ncancelled = 0
+
+    def __len__(self):
+        ''' Return the number of armed timers '''
+        return len(self.heap) - self.ncancelled
+
+    def arm(self, deadline, func, args=()):
+        ''' Arm a timer that invokes func(*args) at deadline '''
+        self.seqno += 1
+        timer = Timer(deadline, self.seqno, func, args, self)
+        heapq.heappush(self.heap, timer)
+        return timer
+
+    def cancelled(self, timer):
+        ''' Invoked when a timer is cancelled '''
+        self.ncancelled += 1
+        if (self.ncancelled > COMPACT_THRESHOLD and
+            self.ncancelled * 2 > len(self.heap)):
+            self.heap = [timer for timer in self.heap if timer.active()]
+            heapq.heapify(self.heap)
+            self.ncancelled = 0
+
+    def _discard_cancelled(self):
+        ''' Remove cancelled timers from the top of the heap '''
+        heap = self.heap
+        while heap and heap[0].func is None:
+            heapq.heappop(heap)
+            self.ncancelled -= 1
+
+    def next_deadline(self):
+        ''' Return the deadline of the next timer or None '''
+        self._discard_cancelled()
+        if self.heap:
+            return self.heap[0].deadline
+        return None
+
+    def run_expired(self, timenow):
+        ''' Run all the timers expired at timenow and return
+            the number of timers that we have run '''
+
+        #
+        # Timers armed by the functions that we invoke here are
+        # run at the next round, even if they are already expired,
+        # so that a function that rearms itself with zero delay
+        # cannot starve I/O.
+        #
+        last_seqno = self.seqno
+        heap = self.heap
+        count = 0
+
+        while heap:
+            timer = heap[0]
+            if timer.func is None:
+                heapq.heappop(heap)
+                self.ncancelled -= 1
+                continue
+            if timer.deadline > timenow or timer.seqno > last_seqno:
+                break
+            heapq.heappop(heap)
+            func, args = timer.func, timer.args
+            timer.func = None
+            timer.args = None
+            timer.owner = None
+            count += 1
+            try:
+                func(*args)
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except:
+                logging.error('poller: timer function failed', exc_info=1)
+
+            # The function may have compacted the heap
+            heap = self.heap
+
+        return count
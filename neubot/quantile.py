@@ -0,0 +1,267 @@
+# neubot/quantile.py
+
+#
+# Copyright (c) 2013
+#     Nexa Center for Internet & Society, Politecnico di Torino (DAUIN),
+#     and Simone Basso <bassosimone@gmail.com>
+#
+# This file is part of Neubot <http://www.neubot.org/>.
+#
+# Neubot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Neubot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Neubot.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+''' Streaming quantiles of a sequence of samples '''
+
+#
+# Quantiles is fed samples one at a time or in bulk, and returns
+# one or more quantiles, using the same definition and interpolation
+# of neubot/percentile.py, i.e. the p-quantile of N samples is the
+# interpolation of the samples whose ranks (in sorted order, from
+# zero) are the floor and the ceiling of (N - 1) * p.
+#
+# While we have at most EXACT_LIMIT samples (or always, when the
+# exact limit is None), we keep all of them, and we sort them (lazily)
+# only when asked for quantiles, and once for several quantiles, and
+# the quantiles are exact.
+#
+# Beyond EXACT_LIMIT we only keep a histogram whose bins grow
+# geometrically by ALPHA, as neubot/database/table_aggregate.py
+# does, plus the count, the minimum and the maximum.  Each sample
+# is represented by the geometric center of its bin, so it is off
+# by at most a relative error of sqrt(1 + ALPHA) - 1 (i.e. 0.5%),
+# and so are the quantiles: when the two interpolated samples have
+# the same sign, the relative error of the quantile is at most 0.5%;
+# otherwise, its absolute error is at most 0.5% of the largest of
+# the two samples, in absolute value.  Zero, the minimum and the
+# maximum are exact, and the results never fall outside of them.
+#
+# Memory is bounded: we keep at most MAX_BINS bins for positive and
+# MAX_BINS for negative samples, i.e. a range of about 17 orders of
+# magnitude for each sign.  If samples span a wider range we merge
+# the bins closest to zero, and the quantiles that fall into the
+# merged bins lose the error bound above.
+#
+
+import bisect
+import itertools
+import math
+import operator
+
+ALPHA = 0.01
+LOG_BASE = math.log(1 + ALPHA)
+EXACT_LIMIT = 65536
+MAX_BINS = 4096
+
+# Number of samples we process at a time
+BATCH = 65536
+
+def bin_index(value):
+    ''' Return the histogram bin of a positive value '''
+    return int(math.floor(math.log(value) / LOG_BASE))
+
+def bin_value(index):
+    ''' Return the representative value of a histogram bin '''
+    return math.exp((index + 0.5) * LOG_BASE)
+
+def _ranks(count, percents):
+    ''' Return the pivot of each percent and the sorted ranks of
+        the samples we need to interpolate '''
+    pivots = [(count - 1) * percent for percent in percents]
+    ranks = set()
+    for pivot in pivots:
+        ranks.add(int(math.floor(pivot)))
+        ranks.add(int(math.ceil(pivot)))
+    return pivots, sorted(ranks)
+
+def _interpolate(pivots, samples):
+    ''' Interpolate samples, a mapping from rank to sample, at each
+        pivot, as neubot/percentile.py does '''
+    result = []
+    for pivot in pivots:
+        floor = math.floor(pivot)
+        ceil = math.ceil(pivot)
+        if floor == ceil:
+            result.append(samples[int(pivot)])
+            continue
+        val0 = samples[int(floor)] * (ceil - pivot)
+        val1 = samples[int(ceil)] * (pivot - floor)
+        result.append(val0 + val1)
+    return result
+
+def interpolate(buckets, count, percents, low, high):
+    ''' Return the percents-quantiles of count samples, given their
+        histogram as a sorted sequence of (value, count) buckets and
+        given the minimum (low) and the maximum (high) sample '''
+    if count <= 0:
+        return [None for _ in percents]
+    pivots, ranks = _ranks(count, percents)
+    # The extremes are exact
+    samples, seen, index = {0: low, count - 1: high}, 0, 0
+    for value, number in buckets:
+        seen += number
+        value = max(low, min(high, value))
+        while index < len(ranks) and ranks[index] < seen:
+            samples.setdefault(ranks[index], value)
+            index += 1
+        if index == len(ranks):
+            break
+    return _interpolate(pivots, samples)
+
+class Quantiles(object):
+
+    ''' Streaming quantiles of a sequence of samples '''
+
+    def __init__(self, exact_limit=EXACT_LIMIT):
+        self.exact_limit = exact_limit
+        self.samples = []
+        self.dirty = False
+        self.pending = []
+        self.positive = {}
+        self.negative = {}
+        self.zero = 0
+        self.count = 0
+        self.low = None
+        self.high = None
+
+    def __len__(self):
+        if self.samples is not None:
+            return len(self.samples)
+        return self.count + len(self.pending)
+
+    def is_exact(self):
+        ''' Return True if we still keep all samples '''
+        return self.samples is not None
+
+    def add(self, value):
+        ''' Add one sample '''
+        if self.samples is not None:
+            self.samples.append(value)
+            self.dirty = True
+            if self._too_many():
+                self._to_histogram()
+            return
+        self.pending.append(value)
+        if len(self.pending) >= BATCH:
+            self._flush()
+
+    def extend(self, iterable):
+        ''' Add many samples '''
+        iterator = iter(iterable)
+        while True:
+            chunk = list(itertools.islice(iterator, BATCH))
+            if not chunk:
+                break
+            if self.samples is not None:
+                self.samples.extend(chunk)
+                self.dirty = True
+                if self._too_many():
+                    self._to_histogram()
+                continue
+            self._flush()
+            self._absorb(chunk)
+
+    def _too_many(self):
+        ''' Return True if we should stop keeping all samples '''
+        return (self.exact_limit is not None and
+                len(self.samples) > self.exact_limit)
+
+    def _to_histogram(self):
+        ''' Stop keeping all samples '''
+        samples, self.samples = self.samples, None
+        self.count = 0
+        for index in range(0, len(samples), BATCH):
+            self._absorb(samples[index:index + BATCH])
+
+    def _flush(self):
+        ''' Absorb pending samples '''
+        if self.pending:
+            chunk, self.pending = self.pending, []
+            self._absorb(chunk)
+
+    def _absorb(self, chunk):
+        ''' Add a chunk of samples to the histogram '''
+        low, high = min(chunk), max(chunk)
+        if self.count == 0 or low < self.low:
+            self.low = low
+        if self.count == 0 or high > self.high:
+            self.high = high
+        self.count += len(chunk)
+        # Filter and bin in C, then count the samples of each bin
+        positive = filter((0.0).__lt__, chunk)
+        negative = map(operator.neg, filter((0.0).__gt__, chunk))
+        self.zero += len(chunk) - len(positive) - len(negative)
+        for values, bins in ((positive, self.positive),
+                             (negative, self.negative)):
+            if not values:
+                continue
+            keys = map(math.floor, map(LOG_BASE.__rtruediv__,
+                                       map(math.log, values)))
+            keys.sort()
+            begin = 0
+            while begin < len(keys):
+                key = keys[begin]
+                # Bins are few, so we search the end of each run
+                end = bisect.bisect_right(keys, key, begin)
+                bins[int(key)] = bins.get(int(key), 0) + end - begin
+                begin = end
+            _collapse(bins)
+
+    def _buckets(self):
+        ''' Yield the histogram as sorted (value, count) buckets '''
+        for index in sorted(self.negative, reverse=True):
+            yield -bin_value(index), self.negative[index]
+        if self.zero:
+            yield 0.0, self.zero
+        for index in sorted(self.positive):
+            yield bin_value(index), self.positive[index]
+
+    def quantiles(self, percents):
+        ''' Return the percents-quantiles, or a list of None
+            if we have no samples '''
+        if self.samples is not None:
+            if not self.samples:
+                return [None for _ in percents]
+            if self.dirty:
+                self.samples.sort()
+                self.dirty = False
+            pivots, ranks = _ranks(len(self.samples), percents)
+            return _interpolate(pivots, dict((rank, self.samples[rank])
+                                             for rank in ranks))
+        self._flush()
+        return interpolate(self._buckets(), self.count, percents,
+                           self.low, self.high)
+
+    def quantile(self, percent):
+        ''' Return the percent-quantile, or None '''
+        return self.quantiles((percent,))[0]
+
+    def median(self):
+        ''' Return the median, or None '''
+        return self.quantile(0.5)
+
+def _collapse(bins):
+    ''' Merge the bins closest to zero until they are MAX_BINS '''
+    if len(bins) <= MAX_BINS:
+        return
+    indexes = sorted(bins)
+    excess = len(indexes) - MAX_BINS
+    target = indexes[excess]
+    for index in indexes[:excess]:
+        bins[target] += bins.pop(index)
+
+def quantiles(vector, percents):
+    ''' Return the percents-quantiles of a sequence of samples '''
+    estimator = Quantiles()
+    estimator.extend(vector)
+    return estimator.quantiles(percents)
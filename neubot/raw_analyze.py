@@ -23,15 +23,69 @@
 
 ''' Analyze client side results '''
 
-import collections
+#
+# The analysis works a column at a time, i.e. on the sequence of the
+# ticks, of the intervals and of the lengths of the samples, and most
+# of the per-sample work happens in C (map(), itertools and list and
+# array methods), then we loop in Python over the few samples that
+# matter, if needed.  The input is either a RawSamples store or a
+# list of (ticks, length) tuples, and the results are the same as
+# looping over the samples, as _preprocess_results() does.
+#
+
+import bisect
+import functools
+import itertools
 import logging
+import operator
+
+from neubot.raw_samples import RawSamples
+
+from neubot import quantile
+from neubot import raw_samples
 
-from neubot import percentile
+def _columns(vector):
+    ''' Return the ticks, intervals and lengths columns of vector '''
+    if isinstance(vector, RawSamples):
+        return vector.ticks, vector.intervals(), vector.lengths
+    if not vector:
+        return (), [], ()
+    ticks, lengths = zip(*vector)
+    return ticks, raw_samples.intervals(ticks), lengths
+
+def _find_zeros(column, start):
+    ''' Return the indexes of the zeros of column from start (this
+        is fast when zeros are few) '''
+    zeros = []
+    while True:
+        try:
+            index = column.index(0, start)
+        except ValueError:
+            break
+        zeros.append(index)
+        start = index + 1
+    return zeros
+
+def _join_equal_ticks(intervals, lengths):
+    ''' Return lengths where the first sample of each group of samples
+        having equal ticks has the length of the whole group, and the
+        other samples, which have zero interval, are left as is '''
+    joined = _find_zeros(intervals, 1)
+    if not joined:
+        return lengths
+    lengths = list(lengths)
+    # Walk backwards, so the first sample gets all the bytes
+    for index in reversed(joined):
+        lengths[index - 1] += lengths[index]
+    return lengths
 
 def compute_bottleneck_capacity(vector, mss):
     ''' Compute bottleneck capacity using packet pair '''
     # Note: here we group points having equal ticks
-    return _compute_bottleneck_capacity(_preprocess_results(vector, True), mss)
+    _, intervals, lengths = _columns(vector)
+    lengths = _join_equal_ticks(intervals, lengths)
+    # Zero intervals, i.e. the non-first samples of groups, are skipped
+    return _bottleneck_capacity(intervals, lengths, mss)
 
 def _preprocess_results(vector, join_if_equal_ticks):
     ''' Normalize results to ease further processing '''
@@ -52,6 +106,13 @@ def _preprocess_results(vector, join_if_equal_ticks):
         prev = ticks
 
 def _compute_bottleneck_capacity(vector, mss):
+    ''' Compute bottleneck capacity using packet pair '''
+    if not vector:
+        return None
+    _, intervals, lengths = zip(*vector)
+    return _bottleneck_capacity(list(intervals), lengths, mss)
+
+def _bottleneck_capacity(intervals, lengths, mss):
     ''' Compute bottleneck capacity using packet pair '''
     #
     # 1. We ignore samples != 1-MSS because they can be caused by rexmits or
@@ -68,20 +129,32 @@ def _compute_bottleneck_capacity(vector, mss):
     #
     # XXX I'm not sure #1 is correct.  I should investigate.
     #
-    samples = []
     half_mss = mss / 2
-    for _, interval, bytez in vector:
-        if half_mss < bytez <= mss and interval > 0:
-            samples.append(bytez / interval)
-    return percentile.median(samples)
+    # Select half_mss < bytez <= mss
+    selected = set(bytez for bytez in set(lengths)
+                   if half_mss < bytez <= mss)
+    mask = map(selected.__contains__, lengths)
+    lengths = list(itertools.compress(lengths, mask))
+    intervals = list(itertools.compress(intervals, mask))
+    # Select interval > 0, i.e. != 0 because intervals are not negative
+    zeros = _find_zeros(intervals, 0)
+    if zeros:
+        mask = [True] * len(intervals)
+        for index in zeros:
+            mask[index] = False
+        lengths = itertools.compress(lengths, mask)
+        intervals = itertools.compress(intervals, mask)
+    samples = quantile.Quantiles(exact_limit=None)
+    samples.extend(itertools.imap(operator.truediv, lengths, intervals))
+    return samples.median()
 
 def select_likely_rexmits(vector, rtt, mss):
     ''' Selects the likely-retransmission samples only '''
     # Note: here we don't group points with equal ticks
-    return list(_foreach_likely_rexmit(_preprocess_results(
-      vector, False), rtt, mss))
+    ticks, intervals, lengths = _columns(vector)
+    return list(_foreach_likely_rexmit(ticks, intervals, lengths, rtt, mss))
 
-def _foreach_likely_rexmit(vector, rtt, mss):
+def _foreach_likely_rexmit(ticks, intervals, lengths, rtt, mss):
     ''' Select likely rexmits under certain conditions '''
     #
     # TODO split this function into two generators, one for each rule, to
@@ -89,20 +162,32 @@ def _foreach_likely_rexmit(vector, rtt, mss):
     #
     # Rule 1: a likely rexmit takes > 0.7-RTT, yields > 1-MSS
     likely_rexmit = []
-    mss_smpls = 0
-    typical_mss = collections.defaultdict(int)
     min_interval = 0.7 * rtt
-    for ticks, interval, bytez in vector:
-        typical_mss[bytez] += 1
-        mss_smpls += 1
-        if interval > min_interval and bytez > mss:
-            logging.debug('raw_analyze: likely rexmit: %f %f %f', ticks,
-              interval, bytez)
-            likely_rexmit.append((ticks, interval, bytez))
+    # Long intervals are rare, so we select them first
+    mask = map(functools.partial(operator.lt, min_interval), intervals)
+    for index in itertools.compress(xrange(len(intervals)), mask):
+        if lengths[index] > mss:
+            logging.debug('raw_analyze: likely rexmit: %f %f %f',
+              ticks[index], intervals[index], lengths[index])
+            likely_rexmit.append((ticks[index], intervals[index],
+                                  lengths[index]))
+    if not likely_rexmit:
+        return
     # Rule 2: a likely rexmit has a non-frequent MSS
+    mss_smpls = len(lengths)
+    typical_mss = _count_lengths(lengths, set(bytez for _, _, bytez
+                                              in likely_rexmit))
     for ticks, interval, bytez in likely_rexmit:
         freq = typical_mss[bytez] / float(mss_smpls)
         if freq < 0.01:
             logging.debug('raw_analyze: non-frequent rexmit: %f %f %f (%f)',
               ticks, interval, bytez, freq)
             yield ticks, interval, bytez
+
+def _count_lengths(lengths, selected):
+    ''' Count how many times each selected length occurs '''
+    if len(selected) <= 16:
+        return dict((length, lengths.count(length)) for length in selected)
+    ordered = sorted(lengths)
+    return dict((length, bisect.bisect_right(ordered, length) -
+                 bisect.bisect_left(ordered, length)) for length in selected)
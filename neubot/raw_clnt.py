@@ -37,7 +37,7 @@ import sys
 if __name__ == '__main__':
     sys.path.insert(0, '.')
 
-from neubot.brigade import Brigade
+from neubot.brigade import SliceBrigade
 from neubot.defer import Deferred
 from neubot.handler import Handler
 from neubot.poller import POLLER
@@ -46,6 +46,7 @@ from neubot.raw_defs import PING
 from neubot.raw_defs import PINGBACK
 from neubot.raw_defs import PINGBACK_CODE
 from neubot.raw_defs import RAWTEST
+from neubot.raw_samples import RawSamples
 from neubot.state import STATE
 from neubot.stream import Stream
 
@@ -55,12 +56,12 @@ AUTH_LEN = 64
 LEN_MESSAGE = 32768
 MAXRECV = 262144
 
-class ClientContext(Brigade):
+class ClientContext(SliceBrigade):
 
     ''' Client context '''
 
     def __init__(self, state):
-        Brigade.__init__(self)
+        SliceBrigade.__init__(self)
         self.ticks = 0.0
         self.count = 0
         self.left = 0
@@ -84,7 +85,7 @@ class RawClient(Handler):
           sslconfig, '', ClientContext(state))
         STATE.update('test', 'raw')
         state['mss'] = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_MAXSEG)
-        state['rcvr_data'] = []
+        state['rcvr_data'] = RawSamples()
 
     def _connection_ready(self, stream):
         ''' Invoked when the connection is ready '''
@@ -161,7 +162,8 @@ class RawClient(Handler):
 
     def _rawtest_sent(self, stream):
         ''' The RAWTEST message has been sent '''
-        stream.recv(MAXRECV, self._waiting_piece)
+        # Receive the pieces into pooled buffers (see bufpool.py)
+        stream.recv_into(MAXRECV, self._waiting_piece)
 
     def _waiting_piece(self, stream, data):
         ''' Invoked when new data is available '''
@@ -169,7 +171,7 @@ class RawClient(Handler):
         # easily, as pointed out in <raw_defs.py>.
         context = stream.opaque
         context.bufferise(data)
-        context.state['rcvr_data'].append((utils.ticks(), len(data)))
+        context.state['rcvr_data'].append(utils.ticks(), len(data))
         while True:
             if context.left > 0:
                 context.left = context.skip(context.left)
@@ -210,7 +212,7 @@ class RawClient(Handler):
                     return
             else:
                 raise RuntimeError('raw_clnt: internal error')
-        stream.recv(MAXRECV, self._waiting_piece)
+        stream.recv_into(MAXRECV, self._waiting_piece)
 
     def _periodic(self, args):
         ''' Periodically snap goodput '''
@@ -252,6 +254,8 @@ class RawClient(Handler):
 
     def _connection_lost(self, stream):
         ''' Invoked when the connection is lost '''
+        if stream.opaque:
+            stream.opaque.clear()  # Give buffers back to the pool
         deferred = Deferred()
         deferred.add_callback(self._connection_lost_internal)
         deferred.add_errback(lambda error: self._connection_lost_error(stream,
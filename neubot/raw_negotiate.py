@@ -48,6 +48,7 @@ from neubot.http_clnt import HttpClient
 from neubot.notify import NOTIFIER
 from neubot.poller import POLLER
 from neubot.raw_clnt import RawClient
+from neubot.runner_discovery import DISCOVERY_CACHE
 from neubot.state import STATE
 
 from neubot import http_utils
@@ -88,6 +89,7 @@ class RawNegotiate(HttpClient):
 
     def handle_connect_error(self, connector):
         logging.warning('raw_negotiate: connect() failed')
+        DISCOVERY_CACHE.mark_stale(connector.endpoint[0])
         NOTIFIER.publish('testdone')
 
     def handle_connect(self, connector, sock, rtt, sslconfig, extra):
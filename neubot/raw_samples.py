@@ -0,0 +1,84 @@
+# neubot/raw_samples.py
+
+#
+# Copyright (c) 2013
+#     Nexa Center for Internet & Society, Politecnico di Torino (DAUIN),
+#     and Simone Basso <bassosimone@gmail.com>
+#
+# This file is part of Neubot <http://www.neubot.org/>.
+#
+# Neubot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Neubot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Neubot.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+''' Columnar store of the raw test receiver samples '''
+
+#
+# The raw test client saves the time and the length of each recv(),
+# and a long test at high speed produces millions of samples.  So
+# we store the two columns in two arrays, which take 16 bytes per
+# sample (instead of about 100 for a tuple with a float and an int)
+# and which raw_analyze.py processes a column at a time.  For the
+# rest of the code the store looks like a list of (ticks, length)
+# tuples.
+#
+# The store also computes (once) the column of the intervals between
+# each sample and the previous one, which both the analysis routines
+# need.
+#
+
+import array
+import itertools
+import operator
+
+def intervals(ticks):
+    ''' Return the interval between each sample and the previous
+        one (zero for the first sample) given the ticks column '''
+    if not ticks:
+        return []
+    result = map(operator.sub, ticks[1:], ticks[:-1])
+    if result and min(result) < 0:
+        raise RuntimeError('raw_analyze: negative time interval')
+    result.insert(0, ticks[0] - ticks[0])
+    return result
+
+class RawSamples(object):
+
+    ''' Columnar store of (ticks, length) samples '''
+
+    def __init__(self, iterable=()):
+        self.ticks = array.array('d')
+        self.lengths = array.array('l')
+        self.cached = None
+        for ticks, length in iterable:
+            self.append(ticks, length)
+
+    def append(self, ticks, length):
+        ''' Append a sample '''
+        self.ticks.append(ticks)
+        self.lengths.append(length)
+
+    def intervals(self):
+        ''' Return the intervals column '''
+        if self.cached is None or len(self.cached) != len(self.ticks):
+            self.cached = intervals(self.ticks)
+        return self.cached
+
+    def __len__(self):
+        return len(self.ticks)
+
+    def __iter__(self):
+        return itertools.izip(self.ticks, self.lengths)
+
+    def __getitem__(self, index):
+        return self.ticks[index], self.lengths[index]
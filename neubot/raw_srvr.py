@@ -127,6 +127,9 @@ class RawServer(Handler):
     def filter_auth(self, stream, tmp):
         ''' Filter client auth '''
 
+    def filter_complete(self, stream):
+        ''' Filter test complete '''
+
     def _waiting_rawtest(self, stream, data):
         ''' Waiting for RAWTEST message from client '''
         context = stream.opaque
@@ -186,6 +189,7 @@ class RawServer(Handler):
             speed = utils.speed_formatter(bytesdiff / timediff)
             logging.info('raw_srvr: goodput: %s', speed)
         self._periodic_internal(stream)
+        self.filter_complete(stream)
         stream.send(EMPTY_MESSAGE, self._empty_message_sent)
         logging.debug('> {empty-message}')
 
@@ -235,8 +239,7 @@ class RawServer(Handler):
     def _empty_message_sent(stream):
         ''' Sent the empty message to signal end of test '''
         # Tell the poller to reclaim this stream in some seconds
-        stream.created = utils.ticks()
-        stream.watchdog = 5
+        stream.set_timeout(5)
 
     def _connection_lost(self, stream):
         ''' Invoked when the connection is lost '''
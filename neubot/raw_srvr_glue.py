@@ -39,4 +39,12 @@ class RawServerEx(RawServer):
         context = stream.opaque
         context.state = NEGOTIATE_SERVER_RAW.peers[tmp]
 
+    def filter_complete(self, stream):
+        ''' Filter test complete '''
+        # Store again the state, so that it is shared with the
+        # other server workers (if any), which may serve collect
+        context = stream.opaque
+        if context.auth in NEGOTIATE_SERVER_RAW.peers:
+            NEGOTIATE_SERVER_RAW.peers[context.auth] = context.state
+
 RAW_SERVER_EX = RawServerEx()
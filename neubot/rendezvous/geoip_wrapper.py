@@ -73,7 +73,9 @@ class Geolocator(object):
                      "<http://www.maxmind.com/app/geolitecountry>.")
             sys.exit(1)
 
-        self.countries = GEOIP.open(path, GEOIP.GEOIP_STANDARD)
+        # Load the database in memory, rather than reading it from
+        # disk at each lookup
+        self.countries = GEOIP.open(path, GEOIP.GEOIP_MEMORY_CACHE)
 
     def lookup_country(self, address):
         ''' Lookup for country entry '''
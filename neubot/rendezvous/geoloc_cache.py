@@ -0,0 +1,80 @@
+# neubot/rendezvous/geoloc_cache.py
+
+#
+# Copyright (c) 2013
+#     Nexa Center for Internet & Society, Politecnico di Torino (DAUIN),
+#     and Simone Basso <bassosimone@gmail.com>
+#
+# This file is part of Neubot <http://www.neubot.org/>.
+#
+# Neubot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Neubot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Neubot.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+''' In-memory copy of the geoloc table '''
+
+#
+# The rendezvous server looks up the servers of a country for each
+# request, so we keep the geoloc table in memory, as a mapping from
+# country to the list of its servers.  We reload the table when this
+# process changes it (see table_geoloc.CHANGES) and every REFRESH
+# seconds, to notice the changes made by other processes (e.g. the
+# sqlite3 command line tool).  The generation is incremented each
+# time the content changes, so that who caches data derived from it
+# (i.e. the rendezvous responses) knows when to throw it away.
+#
+
+import logging
+
+from neubot.config import CONFIG
+from neubot.database import table_geoloc
+
+from neubot import utils
+
+class GeolocCache(object):
+
+    ''' In-memory copy of the geoloc table '''
+
+    def __init__(self):
+        self.servers = None
+        self.changes = 0
+        self.loaded = 0.0
+        self.generation = 0
+
+    def refresh(self, connection):
+        ''' Reload the table if it changed or if it is too old '''
+        interval = CONFIG['rendezvous.server.refresh']
+        if (self.servers is not None and
+                self.changes == table_geoloc.CHANGES[0] and
+                (interval <= 0 or utils.ticks() - self.loaded < interval)):
+            return
+        self.changes = table_geoloc.CHANGES[0]
+        self.loaded = utils.ticks()
+        servers = table_geoloc.listify(connection)
+        if servers != self.servers:
+            logging.debug('geoloc_cache: loaded %d countries', len(servers))
+            self.servers = servers
+            self.generation += 1
+
+    def lookup(self, connection, country, default):
+        ''' Return the servers of country.  If there are no servers
+            for it, register the default one so that we can notice
+            we have new users and can deploy nearby servers '''
+        self.refresh(connection)
+        servers = self.servers.get(country)
+        if not servers:
+            logging.info("* learning new country: %s", country)
+            table_geoloc.insert_server(connection, country, default)
+            self.refresh(connection)
+            servers = self.servers[country]
+        return servers
@@ -37,6 +37,7 @@ from neubot.http.server import HTTP_SERVER
 from neubot.http.server import ServerHTTP
 from neubot.net.poller import POLLER
 from neubot.rendezvous.geoip_wrapper import Geolocator
+from neubot.rendezvous.geoloc_cache import GeolocCache
 from neubot.rendezvous import compat
 
 from neubot.main import common
@@ -47,10 +48,31 @@ from neubot import utils_version
 
 GEOLOCATOR = Geolocator()
 
+# Maximum number of responses we keep in the cache
+MAX_RESPONSES = 4096
+
 class ServerRendezvous(ServerHTTP):
 
     ''' Rendezvous server '''
 
+    #
+    # The response depends only on the client country, version,
+    # accepted tests and privacy settings, and on the test server
+    # we choose at random among the ones of the country.  So we
+    # cache, for each combination of these parameters, the list of
+    # the marshalled responses, one per server, and we pick one at
+    # random.  The cache is flushed when the geoloc table changes
+    # (see geoloc_cache.py), when it is full (the version is chosen
+    # by the client, so there could be many combinations), and when
+    # we are configured.
+    #
+
+    def __init__(self, poller):
+        ServerHTTP.__init__(self, poller)
+        self.geoloc = GeolocCache()
+        self.generation = 0
+        self.responses = {}
+
     def configure(self, conf):
         ''' Configure rendezvous server '''
 
@@ -63,6 +85,7 @@ class ServerRendezvous(ServerHTTP):
         conf["http.server.rootdir"] = ""
 
         ServerHTTP.configure(self, conf)
+        self.responses.clear()
 
     def process_request(self, stream, request):
         ''' Process rendezvous request '''
@@ -74,41 +97,6 @@ class ServerRendezvous(ServerHTTP):
             ibody = marshal.unmarshal_object(request.body.read(),
               "application/xml", compat.RendezvousRequest)
 
-        obody = compat.RendezvousResponse()
-
-        #
-        # If we don't say anything the rendezvous server is not
-        # going to prompt for updates.  We need to specify the
-        # updated version number explicitly when we start it up.
-        # This should guarantee that we do not advertise -rc
-        # releases and other weird things.
-        #
-        version = self.conf["rendezvous.server.update_version"]
-        if version and ibody.version:
-            diff = utils_version.compare(version, ibody.version)
-            logging.debug('rendezvous: version=%s ibody.version=%s diff=%f', 
-                      version, ibody.version, diff)
-            if diff > 0:
-                obody.update["uri"] = 'http://neubot.org/'
-                obody.update["version"] = version
-
-        #
-        # Select test server address.
-        # The default test server is the master server itself.
-        # If we know the country, lookup the list of servers for
-        # that country in the database.
-        # We only redirect to other servers clients that have
-        # agreed to give us the permission to publish, in order
-        # to be compliant with M-Lab policy.
-        # If there are no servers for that country, register
-        # the master server for the country so that we can notice
-        # we have new users and can take the proper steps to
-        # deploy nearby servers.
-        #
-        server = self.conf.get("rendezvous.server.default",
-                               "master.neubot.org")
-        logging.debug("* default test server: %s", server)
-
         #
         # Backward compatibility: the variable name changed from
         # can_share to can_publish after Neubot 0.4.5
@@ -119,32 +107,112 @@ class ServerRendezvous(ServerHTTP):
               'privacy_can_share']
             del request_body['privacy_can_share']
 
-        # Redirect IFF have ALL privacy permissions
+        #
+        # We only redirect to other servers clients that have
+        # agreed to give us the permission to publish, in order
+        # to be compliant with M-Lab policy.  If we know their
+        # country, the test server is one of the servers of that
+        # country.
+        #
+        country = ""
+        agent_address = stream.peername[0]
         if privacy.count_valid(request_body, 'privacy_') == 3:
-            agent_address = stream.peername[0]
             country = GEOLOCATOR.lookup_country(agent_address)
-            if country:
+        else:
+            logging.warning('rendezvous_server: cannot redirect to M-Lab: %s',
+                        request_body)
+        collect = privacy.collect_allowed(request_body)
+
+        if self.cache_enabled():
+            self.geoloc.refresh(DATABASE.connection())
+            if self.generation != self.geoloc.generation:
+                self.generation = self.geoloc.generation
+                self.responses.clear()
+            try:
+                key = (country, ibody.version, tuple(ibody.accept), collect)
+                responses = self.responses.get(key)
+            except TypeError:  # Unhashable accept
+                key, responses = None, None
+            if responses is None:
+                responses = self._compose(ibody, country, collect)
+                if key is not None:
+                    if len(self.responses) >= MAX_RESPONSES:
+                        self.responses.clear()
+                    self.responses[key] = responses
+        else:
+            responses = self._compose(ibody, country, collect)
+
+        server, mimetype, body = random.choice(responses)
+        if country:
+            logging.info("rendezvous_server: %s[%s] -> %s", agent_address,
+                     country, server)
+
+        response = Message()
+        response.compose(code="200", reason="Ok",
+          mimetype=mimetype, body=body)
+        stream.send_response(request, response)
+
+    def cache_enabled(self):
+        ''' Whether we cache the geoloc table and the responses '''
+        return self.conf.get("rendezvous.server.cache", True)
+
+    def _compose(self, ibody, country, collect):
+        ''' Return a list of (server, mimetype, body), one for each
+            server to which we can redirect the client '''
+
+        #
+        # The default test server is the master server itself.
+        # If we know the country, lookup the list of servers for
+        # that country.
+        #
+        default = self.conf.get("rendezvous.server.default",
+                                "master.neubot.org")
+        logging.debug("* default test server: %s", default)
+        servers = [default]
+        if country:
+            if self.cache_enabled():
+                servers = self.geoloc.lookup(DATABASE.connection(),
+                                             country, default)
+            else:
                 servers = table_geoloc.lookup_servers(DATABASE.connection(),
                                                       country)
                 if not servers:
                     logging.info("* learning new country: %s", country)
                     table_geoloc.insert_server(DATABASE.connection(),
-                                               country, server)
-                    servers = [server]
-                server = random.choice(servers)
-                logging.info("rendezvous_server: %s[%s] -> %s", agent_address,
-                         country, server)
+                                               country, default)
+                    servers = [default]
 
-        else:
-            logging.warning('rendezvous_server: cannot redirect to M-Lab: %s',
-                        request_body)
+        return [(server,) + self._marshal(ibody, server, collect)
+                for server in servers]
+
+    def _marshal(self, ibody, server, collect):
+        ''' Return mimetype and body of the response that redirects
+            the client to server '''
+
+        obody = compat.RendezvousResponse()
+
+        #
+        # If we don't say anything the rendezvous server is not
+        # going to prompt for updates.  We need to specify the
+        # updated version number explicitly when we start it up.
+        # This should guarantee that we do not advertise -rc
+        # releases and other weird things.
+        #
+        version = self.conf["rendezvous.server.update_version"]
+        if version and ibody.version:
+            diff = utils_version.compare(version, ibody.version)
+            logging.debug('rendezvous: version=%s ibody.version=%s diff=%f', 
+                      version, ibody.version, diff)
+            if diff > 0:
+                obody.update["uri"] = 'http://neubot.org/'
+                obody.update["version"] = version
 
         #
         # We require at least informed and can_collect since 0.4.4
         # (released 25 October 2011), so stop clients with empty
         # privacy settings, who were still using master.
         #
-        if privacy.collect_allowed(request_body):
+        if collect:
             #
             # Note: Here we will have problems if we store unquoted
             # IPv6 addresses into the database.  Because the resulting
@@ -169,10 +237,7 @@ class ServerRendezvous(ServerHTTP):
             body = compat.adhoc_marshaller(obody)
             mimetype = "text/xml"
 
-        response = Message()
-        response.compose(code="200", reason="Ok",
-          mimetype=mimetype, body=body)
-        stream.send_response(request, response)
+        return mimetype, body
 
 CONFIG.register_defaults({
     "rendezvous.server.address": "",
@@ -181,6 +246,8 @@ CONFIG.register_defaults({
     "rendezvous.geoip_wrapper.country_database":                        \
         "/usr/local/share/GeoIP/GeoIP.dat",
     "rendezvous.server.default": "master.neubot.org",
+    "rendezvous.server.cache": True,
+    "rendezvous.server.refresh": 300,
 })
 
 def run():
@@ -192,6 +259,8 @@ def run():
 
     server = ServerRendezvous(None)
     server.configure(CONFIG)
+    if server.cache_enabled():
+        server.geoloc.refresh(DATABASE.connection())  # Preload
     HTTP_SERVER.register_child(server, "/rendezvous")
 
 def main(args):
@@ -204,6 +273,8 @@ def main(args):
         "rendezvous.geoip_wrapper.country_database":                    \
           "Path of the GeoIP country database",
         "rendezvous.server.default": "Default test server to use",
+        "rendezvous.server.cache": "Cache geoloc table and responses",
+        "rendezvous.server.refresh": "Interval between geoloc table reloads",
     })
 
     common.main("rendezvous.server", "Rendezvous server", args)
@@ -0,0 +1,245 @@
+# neubot/resolver.py
+
+#
+# Copyright (c) 2013
+#     Nexa Center for Internet & Society, Politecnico di Torino (DAUIN),
+#     and Simone Basso <bassosimone@gmail.com>
+#
+# This file is part of Neubot <http://www.neubot.org/>.
+#
+# Neubot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Neubot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Neubot.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+''' Non-blocking name resolution '''
+
+#
+# getaddrinfo() blocks and we cannot afford to stop the poller
+# loop while a name resolves, because that would stall all the
+# other measurements in progress.  So, lookups run in a small
+# pool of threads, which post results on a queue and wake up the
+# poller by writing into a socketpair.  The callbacks are always
+# invoked in the context of the poller loop.
+#
+# Results are cached: successful lookups for net.dns.positive_ttl
+# seconds and failed ones for net.dns.negative_ttl seconds (we
+# cannot see the TTL of the records through getaddrinfo()).
+# Concurrent lookups of the same name share the same query.
+#
+
+import collections
+import logging
+import os
+import socket
+import sys
+import threading
+
+from neubot.config import CONFIG
+from neubot.pollable import Pollable
+from neubot.poller import POLLER
+
+from neubot import utils
+from neubot import utils_net
+
+CONFIG.register_defaults({
+    'net.dns.negative_ttl': 30,
+    'net.dns.positive_ttl': 300,
+    'net.dns.workers': 4,
+})
+
+CONFIG.register_descriptions({
+    'net.dns.negative_ttl': 'Seconds for which failed lookups are cached',
+    'net.dns.positive_ttl': 'Seconds for which successful lookups are cached',
+    'net.dns.workers': 'Number of threads performing name resolution',
+})
+
+# Walk the cache for expired entries when it grows above this size
+CACHE_SIZE = 256
+
+def _socketpair():
+    ''' Portable socketpair() '''
+    if hasattr(socket, 'socketpair'):
+        return socket.socketpair()
+    lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    lsock.bind(('127.0.0.1', 0))
+    lsock.listen(1)
+    left = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    left.connect(utils_net.getsockname(lsock))
+    right = lsock.accept()[0]
+    lsock.close()
+    return left, right
+
+class Resolver(Pollable):
+
+    ''' Resolve names using a pool of threads '''
+
+    def __init__(self, getaddrinfo=socket.getaddrinfo):
+        Pollable.__init__(self)
+        self.getaddrinfo_func = getaddrinfo
+        self.cache = {}
+        self.pending = {}
+        self.requests = collections.deque()
+        self.results = collections.deque()
+        self.lock = threading.Condition()
+        self.threads = []
+        self.pid = 0
+        self.wakeup_recv = None
+        self.wakeup_send = None
+        self.watchdog = -1
+
+    def __repr__(self):
+        return 'resolver'
+
+    def fileno(self):
+        return self.wakeup_recv.fileno()
+
+    def getaddrinfo(self, host, port, family, socktype, proto, flags, func):
+        ''' Resolve (host, port) and invoke func(result), where result
+            is the list returned by getaddrinfo() or the exception that
+            it raised.  The callback is invoked immediately when the
+            answer is known, otherwise from the poller loop. '''
+
+        # Numeric addresses and passive lookups do not block
+        if not host or self._is_numeric(host):
+            try:
+                result = socket.getaddrinfo(host, port, family,
+                                            socktype, proto, flags)
+            except socket.error:
+                result = sys.exc_info()[1]
+            func(result)
+            return
+
+        key = (host, port, family, socktype, proto, flags)
+        entry = self.cache.get(key)
+        if entry:
+            if entry[0] > utils.ticks():
+                func(_copy_result(entry[1]))
+                return
+            del self.cache[key]
+
+        if key in self.pending:
+            self.pending[key].append(func)
+            return
+        self.pending[key] = [func]
+
+        self._start()
+        if len(self.pending) == 1:
+            POLLER.set_readable(self)
+        self.lock.acquire()
+        self.requests.append(key)
+        self.lock.notify()
+        self.lock.release()
+
+    def connect(self, epnt, prefer_ipv6, func):
+        ''' Resolve epnt, start connecting to it and pass the
+            socket (or None on failure) to func '''
+        logging.debug('resolver: about to resolve: %s', str(epnt))
+        self.getaddrinfo(epnt[0], epnt[1], socket.AF_UNSPEC,
+          socket.SOCK_STREAM, 0, 0, lambda addrinfo: func(
+          utils_net.connect_addrinfo(epnt, addrinfo, prefer_ipv6)))
+
+    @staticmethod
+    def _is_numeric(host):
+        ''' Returns True if host is a numeric address '''
+        for family in (socket.AF_INET, socket.AF_INET6):
+            try:
+                socket.inet_pton(family, host.split('%')[0])
+                return True
+            except (socket.error, ValueError, AttributeError):
+                pass
+        return False
+
+    def _start(self):
+        ''' Start the threads, if needed '''
+        # Threads do not survive fork(), e.g. server workers
+        if self.pid == os.getpid() and self.threads:
+            return
+        self.pid = os.getpid()
+        self.wakeup_recv, self.wakeup_send = _socketpair()
+        self.wakeup_recv.setblocking(False)
+        self.wakeup_send.setblocking(False)
+        self.threads = []
+        for _ in range(CONFIG['net.dns.workers']):
+            thread = threading.Thread(target=self._worker)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _worker(self):
+        ''' Perform lookups on behalf of the poller thread '''
+        while True:
+            self.lock.acquire()
+            while not self.requests:
+                self.lock.wait()
+            key = self.requests.popleft()
+            self.lock.release()
+
+            try:
+                result = self.getaddrinfo_func(*key)
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except socket.error:
+                result = sys.exc_info()[1]
+            except:
+                logging.warning('resolver: unexpected error', exc_info=1)
+                result = socket.gaierror(str(sys.exc_info()[1]))
+
+            # deque.append() is atomic, no need to lock
+            self.results.append((key, result))
+            try:
+                self.wakeup_send.send('x')
+            except socket.error:
+                pass  # The poller has many wakeups pending
+
+    def handle_read(self):
+        try:
+            self.wakeup_recv.recv(65536)
+        except socket.error:
+            pass
+
+        while self.results:
+            key, result = self.results.popleft()
+            if isinstance(result, Exception):
+                ttl = CONFIG['net.dns.negative_ttl']
+                logging.debug('resolver: %s: %s', key[0], result)
+            else:
+                ttl = CONFIG['net.dns.positive_ttl']
+            if ttl > 0:
+                self.cache[key] = (utils.ticks() + ttl, result)
+            for func in self.pending.pop(key, ()):
+                try:
+                    func(_copy_result(result))
+                except (KeyboardInterrupt, SystemExit):
+                    raise
+                except:
+                    logging.error('resolver: callback failed', exc_info=1)
+
+        if not self.pending:
+            POLLER.unset_readable(self)
+        if len(self.cache) > CACHE_SIZE:
+            self.expire()
+
+    def expire(self):
+        ''' Remove expired entries from the cache '''
+        timenow = utils.ticks()
+        for key, entry in list(self.cache.items()):
+            if entry[0] <= timenow:
+                del self.cache[key]
+
+def _copy_result(result):
+    ''' Callers may sort() the result, so give them a copy '''
+    if isinstance(result, list):
+        return list(result)
+    return result
+
+RESOLVER = Resolver()
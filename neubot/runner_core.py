@@ -45,10 +45,12 @@ from neubot.defer import Deferred
 from neubot.log import STREAMING_LOG
 from neubot.notify import NOTIFIER
 from neubot.raw_negotiate import RawNegotiate
+from neubot.runner_discovery import DISCOVERY_CACHE
 from neubot.runner_dload import RunnerDload
 from neubot.runner_hosts import RUNNER_HOSTS
 from neubot.runner_mlabns import RunnerMlabns
 from neubot.runner_tests import RUNNER_TESTS
+from neubot.runner_updates import RUNNER_UPDATES
 
 from neubot import bittorrent
 from neubot import privacy
@@ -65,6 +67,8 @@ class RunnerCore(object):
         self.dynamic_tests = {}
         self.queue = collections.deque()
         self.running = False
+        self.mlabns_endpoint = ('mlab-ns.appspot.com', 80)
+        self.rendezvous_port = '9773'
 
     def test_is_running(self):
         ''' Reports whether a test is running '''
@@ -85,31 +89,79 @@ class RunnerCore(object):
             utils_modules.modprobe("mod_" + test, "register_test",
                                    self.dynamic_tests)
 
+        refresh = None
         if auto_discover:
             logging.info('runner_core: Need to auto-discover first...')
 
             deferred2 = Deferred()
             deferred2.add_callback(lambda param: None)
 
+            discovery = None
             if test == 'raw':
-                self.queue.append(('mlab-ns', deferred2, {'policy': 'random'}))
+                discovery = ('mlab-ns', deferred2, {'policy': 'random'})
 
             elif test == "bittorrent" or test == "speedtest":
-                self.queue.append(('rendezvous', deferred2, None))
+                discovery = ('rendezvous', deferred2, None)
 
             else:
                 try:
                     test_rec = self.dynamic_tests[test]
-                    self.queue.append((test_rec["discover_method"],
-                      deferred2, {"policy": test_rec["discover_policy"]}))
+                    discovery = (test_rec["discover_method"],
+                      deferred2, {"policy": test_rec["discover_policy"]})
                 except (KeyboardInterrupt, SystemExit):
                     raise
                 except:
                     logging.warning("runner: internal error", exc_info=1)
 
+            if discovery:
+                key = self._discovery_key(discovery)
+                if not self._use_cached_discovery(key):
+                    self.queue.append(discovery)
+                elif (DISCOVERY_CACHE.needs_refresh(key) and
+                      not self._discovery_queued(key)):
+                    refresh = discovery
+
         self.queue.append((test, deferred, ctx))
+
+        # Refresh in background, i.e. after the test
+        if refresh:
+            logging.info('runner_core: will refresh %s after test', refresh[0])
+            self.queue.append(refresh)
+
         self.run_queue()
 
+    @staticmethod
+    def _discovery_key(discovery):
+        ''' Return the discovery cache key of a queued discovery '''
+        if discovery[0] == 'mlab-ns' and discovery[2]:
+            return DISCOVERY_CACHE.make_key('mlab-ns', discovery[2]['policy'])
+        return DISCOVERY_CACHE.make_key(discovery[0], '')
+
+    def _discovery_queued(self, key):
+        ''' Return True if the discovery of key is already queued '''
+        for elem in self.queue:
+            if (elem[0] in ('mlab-ns', 'rendezvous') and
+                self._discovery_key(elem) == key):
+                return True
+        return False
+
+    @staticmethod
+    def _use_cached_discovery(key):
+        ''' Apply the cached results of key and return True, or
+            return False if we have no results for key '''
+        value = DISCOVERY_CACHE.get(key)
+        if value is None:
+            return False
+        logging.info('runner_core: using cached %s results', key[0])
+        if key[0] == 'mlab-ns' and key[1] == 'random':
+            RUNNER_HOSTS.set_random_host(value)
+        elif key[0] == 'mlab-ns':
+            RUNNER_HOSTS.set_closest_host(value)
+        else:
+            RUNNER_TESTS.update(dict(value['available']))
+            RUNNER_UPDATES.update(value['update'])
+        return True
+
     def run_queue(self):
         ''' If possible run the first test in queue '''
 
@@ -155,7 +207,7 @@ class RunnerCore(object):
             raise RuntimeError('runner_core: bad privacy settings')
 
         elif first_elem[0] == 'rendezvous':
-            runner_rendezvous.run(conf['agent.master'], '9773')
+            runner_rendezvous.run(conf['agent.master'], self.rendezvous_port)
 
         elif first_elem[0] == 'speedtest':
             uri = RUNNER_TESTS.test_to_negotiate_uri('speedtest')
@@ -183,7 +235,7 @@ class RunnerCore(object):
                 extra = {'policy': ''}  # get closest server by default
             else:
                 extra = first_elem[2]
-            handler.connect(('mlab-ns.appspot.com', 80),
+            handler.connect(self.mlabns_endpoint,
               CONFIG['prefer_ipv6'], 0, extra)
 
         elif first_elem[0] in self.dynamic_tests:
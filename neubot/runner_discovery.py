@@ -0,0 +1,150 @@
+# neubot/runner_discovery.py
+
+#
+# Copyright (c) 2013
+#     Nexa Center for Internet & Society, Politecnico di Torino (DAUIN),
+#     and Simone Basso <bassosimone@gmail.com>
+#
+# This file is part of Neubot <http://www.neubot.org/>.
+#
+# Neubot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Neubot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Neubot.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+''' Caches the results of server discovery '''
+
+#
+# Before each test the runner discovers the server to use, either
+# with mlab-ns or with the rendezvous.  We keep the results of the
+# discovery, for each method, policy and address family, so that
+# the runner can skip the discovery when it has fresh results, and
+# we refresh them in the background, i.e. the runner queues the
+# discovery after the test, once they are older than half of their
+# time to live (runner.discovery_ttl).
+#
+# We keep a single result for each key, except for the random
+# policy, for which we keep up to RANDOM_POOL results and we pick
+# one at random, so the test servers are still chosen at random.
+#
+# Each result also lists the servers it refers to, and, when we
+# cannot connect to one of them, we mark the result as stale, so
+# that we don't use it anymore and the next test runs the discovery
+# again (see RUNNER_HOSTS for why insisting with a server that does
+# not work is a bad idea).
+#
+
+import logging
+import random
+import urlparse
+
+from neubot.config import CONFIG
+
+from neubot import utils
+
+# Number of results we keep for the random policy
+RANDOM_POOL = 4
+
+def _hostname(address):
+    ''' Return the hostname of a URI, or address itself '''
+    if '://' in address:
+        return urlparse.urlsplit(address).hostname or ''
+    return address
+
+class DiscoveryCache(object):
+
+    ''' Caches the results of server discovery '''
+
+    def __init__(self):
+        self.entries = {}
+
+    @staticmethod
+    def make_key(method, policy):
+        ''' Return the key of method and policy for the address
+            family we are currently using '''
+        if CONFIG['prefer_ipv6']:
+            return (method, policy, 'ipv6')
+        return (method, policy, 'ipv4')
+
+    @staticmethod
+    def _capacity(key):
+        ''' Return the number of results we keep for key '''
+        if key[1] == 'random':
+            return RANDOM_POOL
+        return 1
+
+    def _live(self, key):
+        ''' Return the results of key that are not expired '''
+        timenow = utils.ticks()
+        results = [result for result in self.entries.get(key, [])
+                   if result['expires'] > timenow]
+        if results:
+            self.entries[key] = results
+        else:
+            self.entries.pop(key, None)
+        return results
+
+    def put(self, key, value, servers):
+        ''' Save value, which refers to servers, as a result of key '''
+        ttl = CONFIG['runner.discovery_ttl']
+        if ttl <= 0:
+            return
+        results = [result for result in self._live(key)
+                   if result['value'] != value]
+        results.append({
+                        'expires': utils.ticks() + ttl,
+                        'refresh': utils.ticks() + ttl / 2.0,
+                        'servers': set(_hostname(elem) for elem in servers),
+                        'value': value,
+                       })
+        self.entries[key] = results[-self._capacity(key):]
+        logging.debug('runner_discovery: %s: %d result(s)', key,
+                      len(self.entries[key]))
+
+    def get(self, key):
+        ''' Return one fresh result of key, or None '''
+        results = self._live(key)
+        if not results:
+            return None
+        return random.choice(results)['value']
+
+    def needs_refresh(self, key):
+        ''' Return True if we should refresh the results of key '''
+        results = self._live(key)
+        if len(results) < self._capacity(key):
+            return True
+        timenow = utils.ticks()
+        for result in results:
+            if result['refresh'] <= timenow:
+                return True
+        return False
+
+    def mark_stale(self, address):
+        ''' Forget the results that refer to address, i.e. the
+            hostname or the URI of a server that does not work '''
+        hostname = _hostname(address)
+        for key in self.entries.keys():
+            results = [result for result in self.entries[key]
+                       if hostname not in result['servers']]
+            if len(results) != len(self.entries[key]):
+                logging.info('runner_discovery: %s: stale server: %s',
+                             key, hostname)
+            if results:
+                self.entries[key] = results
+            else:
+                del self.entries[key]
+
+    def clear(self):
+        ''' Forget all the results '''
+        self.entries.clear()
+
+DISCOVERY_CACHE = DiscoveryCache()
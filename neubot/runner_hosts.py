@@ -187,6 +187,11 @@ class RunnerHosts(object):
     # just a local routing problem) is more likely to be spotted.  Moreover the
     # cached closest host may be down, and insisting with it in this case is
     # worst than choosing one host at random.
+    #   Note that the runner does not always query mlab-ns before a test: it may
+    # reuse the results of a recent query (see runner_discovery.py), and in that
+    # case it sets the host again before each test.  Such results are limited
+    # in time, are dropped when we cannot connect to the host, and, for the
+    # random host, come from a pool of recent queries.
     #
 
     def get_closest_host(self):
@@ -39,6 +39,7 @@ from neubot.compat import json
 from neubot.http_clnt import HttpClient
 from neubot.notify import NOTIFIER
 from neubot.poller import POLLER
+from neubot.runner_discovery import DISCOVERY_CACHE
 from neubot.runner_hosts import RUNNER_HOSTS
 
 from neubot import http_utils
@@ -115,6 +116,8 @@ class RunnerMlabns(HttpClient):
             RUNNER_HOSTS.set_random_host(response)
         else:
             RUNNER_HOSTS.set_closest_host(response)
+        DISCOVERY_CACHE.put(DISCOVERY_CACHE.make_key('mlab-ns',
+          extra['policy']), response, [response['fqdn']])
         stream.close()
 
 USAGE = 'usage: neubot runner_mlabns [-6Sv] [-A address] [-P policy] [-p port]'
@@ -38,6 +38,7 @@ from neubot.compat import json
 from neubot.config import CONFIG
 from neubot.net.poller import POLLER
 from neubot.notify import NOTIFIER
+from neubot.runner_discovery import DISCOVERY_CACHE
 from neubot.runner_tests import RUNNER_TESTS
 from neubot.runner_updates import RUNNER_UPDATES
 from neubot.state import STATE
@@ -95,6 +96,15 @@ class RunnerRendezvous(ClientHTTP):
         RUNNER_TESTS.update(message['available'])
         RUNNER_UPDATES.update(message['update'])
 
+        servers = []
+        for uris in message['available'].values():
+            servers.extend(uris)
+        # Copy because RUNNER_TESTS clears available tests once used
+        DISCOVERY_CACHE.put(DISCOVERY_CACHE.make_key('rendezvous', ''), {
+                            'available': dict(message['available']),
+                            'update': message['update'],
+                           }, servers)
+
         logging.info('runner_rendezvous: rendezvous complete')
         stream.close()
 
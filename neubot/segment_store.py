@@ -0,0 +1,357 @@
+# neubot/segment_store.py
+
+#
+# Copyright (c) 2013
+#     Nexa Center for Internet & Society, Politecnico di Torino (DAUIN),
+#     and Simone Basso <bassosimone@gmail.com>
+#
+# This file is part of Neubot <http://www.neubot.org/>.
+#
+# Neubot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Neubot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Neubot.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+''' Append-only store for the results of generic tests '''
+
+#
+# The results of a test are saved, one JSON object per line, into
+# the current segment, i.e. <name>.jsonl.  When the current segment
+# contains SPLIT_INTERVAL results, we rotate it, as we did with the
+# old pickle files: <name>.jsonl becomes <name>.jsonl.0, which becomes
+# <name>.jsonl.1, and so on, and we keep SPLIT_NUM_FILES + 1 rotated
+# segments at most.  Saving a result is just a write() at the end
+# of the current segment, regardless of how many results we have.
+#
+# The index, i.e. <name>.jsonl.idx, contains the number of results,
+# the first and the last timestamp, and the size of each rotated
+# segment, so that range reads only parse the segments that overlap
+# with the requested range.  It is rewritten (atomically) each time
+# we rotate.  If it does not match the segments on disk, e.g. because
+# we crashed while rotating, we rebuild it by scanning the segments.
+#
+# The current segment is scanned when the store is first used.  If
+# its last line is truncated, because we crashed while writing, we
+# throw the truncated line away.
+#
+# The first time the store is used, the old <name>.pickle files (if
+# any) are converted into segments and then removed.  We remove the
+# current pickle file last, so that, if we crash while migrating, we
+# migrate again the next time.
+#
+# A readonly store does not migrate, rebuild the index on disk, or
+# create and repair segments: it reads whatever is already there.
+#
+
+import logging
+import os
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from neubot.compat import json
+
+SPLIT_INTERVAL = 1024
+SPLIT_NUM_FILES = 15
+
+INDEX_VERSION = 1
+
+def _timestamp(result):
+    ''' Return the timestamp of a result '''
+    if isinstance(result, dict):
+        return result.get('timestamp', 0)
+    return 0
+
+def _empty_stats():
+    ''' Return the stats of an empty segment '''
+    return {'count': 0, 'first': 0, 'last': 0, 'size': 0}
+
+def _update_stats(stats, result, size):
+    ''' Account for a result appended to a segment '''
+    timestamp = _timestamp(result)
+    if stats['count'] == 0:
+        stats['first'] = timestamp
+    stats['last'] = timestamp
+    stats['count'] += 1
+    stats['size'] += size
+
+def select_range(results, since, until):
+    ''' Filter results, sorted from the newest to the oldest one,
+        and stop at the first result older than since '''
+    for result in results:
+        timestamp = _timestamp(result)
+        if until >= 0 and timestamp > until:
+            continue
+        if since >= 0 and timestamp < since:
+            break
+        yield result
+
+class SegmentStore(object):
+
+    ''' Append-only store for the results of a generic test '''
+
+    def __init__(self, datadir, name, touch=None,
+                 split_interval=SPLIT_INTERVAL,
+                 split_num_files=SPLIT_NUM_FILES, readonly=False):
+        self.datadir = datadir
+        self.name = name
+        self.readonly = readonly
+        if not touch:
+            touch = self._touch
+        self.touch = touch
+        self.split_interval = split_interval
+        self.split_num_files = split_num_files
+        self.filep = None
+        self.current = None
+        self.segments = None
+
+    def _filename(self, index):
+        ''' Return the file name of the index-th segment '''
+        filename = '%s.jsonl' % self.name
+        if index is not None:
+            filename += '.%d' % index
+        return filename
+
+    def _path(self, index):
+        ''' Return the path of the index-th segment '''
+        return os.path.join(self.datadir, self._filename(index))
+
+    def _touch(self, filename):
+        ''' Create filename below datadir '''
+        path = os.path.join(self.datadir, filename)
+        open(path, 'ab').close()
+        return path
+
+    def append(self, result):
+        ''' Append result to the current segment '''
+        if self.readonly:
+            raise RuntimeError('segment_store: readonly store')
+        self._load()
+        if self.current['count'] >= self.split_interval:
+            self._rotate()
+        if not self.filep:
+            self.filep = open(self._path(None), 'ab')
+        line = json.dumps(result, separators=(',', ':')) + '\n'
+        self.filep.write(line)
+        self.filep.flush()
+        _update_stats(self.current, result, len(line))
+
+    def read(self, index):
+        ''' Return the results in the index-th segment, from the
+            oldest to the newest one; None is the current segment '''
+        self._load()
+        if index is not None and (index < 0 or index >= len(self.segments)):
+            return []
+        return list(self._iter_segment(self._path(index)))
+
+    def walk(self, since=-1, until=-1):
+        ''' Yield the results saved between since and until, from
+            the newest to the oldest one, a segment at a time '''
+        self._load()
+        segments = [(None, self.current)]
+        segments.extend(enumerate(self.segments))
+        for index, stats in segments:
+            if stats['count'] == 0:
+                continue
+            if until >= 0 and stats['first'] > until:
+                continue
+            if since >= 0 and stats['last'] < since:
+                return
+            results = self._iter_reversed(self._path(index))
+            for result in select_range(results, since, until):
+                yield result
+            if since >= 0 and stats['first'] < since:
+                return
+
+    def count(self):
+        ''' Return the number of saved results '''
+        self._load()
+        return self.current['count'] + sum([stats['count']
+                                            for stats in self.segments])
+
+    def close(self):
+        ''' Close the current segment '''
+        if self.filep:
+            self.filep.close()
+            self.filep = None
+
+    #
+    # Load, rotate, index
+    #
+
+    def _load(self):
+        ''' Load the index and scan the current segment '''
+        if self.segments is not None:
+            return
+        if not self.readonly:
+            self._migrate()
+        self.segments = self._read_index()
+        if self.segments is None:
+            self.segments = []
+            for index in range(self.split_num_files + 1):
+                stats = self._scan(self._path(index), False)
+                if stats is None:
+                    break
+                self.segments.append(stats)
+            if self.segments and not self.readonly:
+                logging.debug('segment_store: rebuilt index of %s', self.name)
+                self._write_index()
+        if self.readonly:
+            self.current = self._scan(self._path(None), False)
+            if self.current is None:
+                self.current = _empty_stats()
+            return
+        self.touch(self._filename(None))
+        self.current = self._scan(self._path(None), True)
+
+    def _rotate(self):
+        ''' Rotate the current segment '''
+        self.close()
+        tmppath = self._path(self.split_num_files)
+        if os.path.isfile(tmppath):
+            os.unlink(tmppath)
+        for index in range(self.split_num_files, 0, -1):
+            srcpath = self._path(index - 1)
+            if not os.path.isfile(srcpath):
+                continue
+            os.rename(srcpath, self._path(index))
+        os.rename(self._path(None), self._path(0))
+        self.segments.insert(0, self.current)
+        del self.segments[self.split_num_files + 1:]
+        self.current = _empty_stats()
+        self.touch(self._filename(None))
+        self._write_index()
+
+    def _read_index(self):
+        ''' Read the index and return None if it is stale '''
+        path = self._path(None) + '.idx'
+        if not os.path.isfile(path):
+            return None
+        try:
+            filep = open(path, 'rb')
+            content = json.load(filep)
+            filep.close()
+            if content['version'] != INDEX_VERSION:
+                return None
+            segments = content['segments']
+            for index, stats in enumerate(segments):
+                if os.path.getsize(self._path(index)) != stats['size']:
+                    return None
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            return None
+        if (len(segments) <= self.split_num_files and
+              os.path.isfile(self._path(len(segments)))):
+            return None
+        return segments
+
+    def _write_index(self):
+        ''' Atomically write the index '''
+        filename = self._filename(None) + '.idx'
+        tmppath = self.touch(filename + '.tmp')
+        filep = open(tmppath, 'wb')
+        json.dump({'version': INDEX_VERSION, 'segments': self.segments},
+                  filep)
+        filep.close()
+        os.rename(tmppath, os.path.join(self.datadir, filename))
+
+    @staticmethod
+    def _iter_segment(path):
+        ''' Yield the results in the segment at path '''
+        if not os.path.isfile(path):
+            return
+        filep = open(path, 'rb')
+        for line in filep:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                logging.warning('segment_store: invalid line in %s', path)
+        filep.close()
+
+    @staticmethod
+    def _iter_reversed(path):
+        ''' Yield the results in the segment at path, from the newest
+            to the oldest one, parsing only the lines we consume '''
+        if not os.path.isfile(path):
+            return
+        filep = open(path, 'rb')
+        lines = filep.read().splitlines()
+        filep.close()
+        for line in reversed(lines):
+            try:
+                yield json.loads(line)
+            except ValueError:
+                logging.warning('segment_store: invalid line in %s', path)
+
+    def _scan(self, path, recover):
+        ''' Return the stats of the segment at path, and, if recover
+            is true, throw away its truncated last line (if any) '''
+        if not os.path.isfile(path):
+            return None
+        stats = _empty_stats()
+        filep = open(path, 'rb')
+        for line in filep:
+            if not line.endswith('\n'):
+                if recover:
+                    logging.warning('segment_store: truncated line in %s',
+                                    path)
+                    filep.close()
+                    filep = open(path, 'r+b')
+                    filep.truncate(stats['size'])
+                break
+            try:
+                result = json.loads(line)
+            except ValueError:
+                stats['size'] += len(line)
+                continue
+            _update_stats(stats, result, len(line))
+        filep.close()
+        return stats
+
+    def _migrate(self):
+        ''' Convert the old pickle files into segments '''
+        legacy = os.path.join(self.datadir, '%s.pickle' % self.name)
+        if not os.path.isfile(legacy):
+            return
+        logging.info('segment_store: migrating %s', legacy)
+        indexes = [None]
+        indexes.extend(range(self.split_num_files + 1))
+        for index in indexes:
+            srcpath = legacy
+            if index is not None:
+                srcpath += '.%d' % index
+            if not os.path.isfile(srcpath):
+                if os.path.isfile(self._path(index)):
+                    os.unlink(self._path(index))
+                continue
+            filep = open(srcpath, 'rb')
+            content = filep.read()
+            filep.close()
+            results = []
+            if content:
+                results = pickle.loads(content)
+            filep = open(self.touch(self._filename(index)), 'wb')
+            for result in results:
+                filep.write(json.dumps(result, separators=(',', ':')) + '\n')
+            filep.close()
+        index_path = self._path(None) + '.idx'
+        if os.path.isfile(index_path):
+            os.unlink(index_path)
+        for index in reversed(indexes):
+            srcpath = legacy
+            if index is not None:
+                srcpath += '.%d' % index
+            if os.path.isfile(srcpath):
+                os.unlink(srcpath)
@@ -0,0 +1,347 @@
+# neubot/segment_writer.py
+
+#
+# Copyright (c) 2013
+#     Nexa Center for Internet & Society, Politecnico di Torino (DAUIN),
+#     and Simone Basso <bassosimone@gmail.com>
+#
+# This file is part of Neubot <http://www.neubot.org/>.
+#
+# Neubot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Neubot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Neubot.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+''' Rolling compressed segments for the M-Lab backend '''
+
+#
+# The M-Lab backend used to save each result into its own gzip file,
+# named after the time of the test, below a year/month/day tree.  On
+# a busy server that means lots of tiny files, and creating them (and
+# fixing their ownership and permissions) costs more than writing the
+# results.  So we append the results of a test to a segment, i.e.:
+#
+#     YYYY/MM/DD/YYYYmmddTHH:MM:SS.nnnnnnnnnZ_<test>.jsonl.gz
+#
+# named after the time of its first result.  Each result is saved as
+# a separate gzip member, which is what the old per-result file would
+# have contained, including the original file name in the header.  A
+# segment is a valid gzip file, which decompresses to one JSON object
+# per line.
+#
+# Next to each segment there is an index, i.e. <segment>.idx, with a
+# line for each result, containing the offset and the length of its
+# member and the name of the file that the old code would have used
+# to save it.  So existing consumers can still locate (and extract)
+# individual results.
+#
+# Results are buffered and written when the buffer is larger than
+# 'mlab.segment.flush_size' bytes, or when the oldest buffered result
+# is older than 'mlab.segment.flush_interval' seconds.  The data is
+# written before the index, so the index never refers to data that
+# is not on disk.  We rotate the segment when it is larger than
+# 'mlab.segment.rotate_size' bytes, when it is older than
+# 'mlab.segment.rotate_interval' seconds and when the day changes.
+#
+# If we crash, the last member of a segment may be truncated and the
+# index may miss the last results.  The reader stops at the first
+# truncated member, and repair() truncates the segment after the
+# last complete member and rebuilds the index from the members.
+#
+
+import getopt
+import logging
+import os
+import struct
+import sys
+import time
+import zlib
+
+if __name__ == '__main__':
+    sys.path.insert(0, '.')
+
+from neubot.compat import json
+from neubot.config import CONFIG
+from neubot.poller import POLLER
+
+CONFIG.register_defaults({
+    'mlab.segment.flush_interval': 1,
+    'mlab.segment.flush_size': 65536,
+    'mlab.segment.rotate_interval': 600,
+    'mlab.segment.rotate_size': 67108864,
+})
+
+CONFIG.register_descriptions({
+    'mlab.segment.flush_interval': 'Max seconds results stay buffered before we write them',
+    'mlab.segment.flush_size': 'Max bytes of results we buffer before we write them',
+    'mlab.segment.rotate_interval': 'Seconds after which we start a new M-Lab segment',
+    'mlab.segment.rotate_size': 'Bytes after which we start a new M-Lab segment',
+})
+
+# Gzip header flags and size of the fixed part of the header
+FNAME = 0x08
+HEADER_SIZE = 10
+
+# Amount of compressed data we decompress at a time when reading
+CHUNK_SIZE = 65536
+
+def result_name(thetime, test):
+    ''' Return the name of the file that the old code would
+        have used to save a result of test at thetime '''
+    #
+    # The time format is ISO8601, except that we use nanosecond
+    # and not microsecond precision.
+    #
+    gmt = time.gmtime(thetime)
+    nanosec = int((thetime % 1.0) * 1000000000)
+    return '%s.%09dZ_%s.gz' % (time.strftime('%Y%m%dT%H:%M:%S', gmt),
+                               nanosec, test)
+
+def gzip_member(data, name, mtime):
+    ''' Compress data into a gzip member '''
+    if name.endswith('.gz'):
+        name = name[:-3]
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return ''.join([
+        struct.pack('<BBBBIBB', 0x1f, 0x8b, 8, FNAME, int(mtime), 0, 255),
+        name, '\0',
+        compressor.compress(data),
+        compressor.flush(),
+        struct.pack('<II', zlib.crc32(data) & 0xffffffff,
+                    len(data) & 0xffffffff),
+    ])
+
+def _parse_member(content, offset):
+    ''' Parse the gzip member at offset and return its length,
+        its name and its data, or None if it is truncated '''
+    if len(content) - offset < HEADER_SIZE:
+        return None
+    if content[offset:offset + 3] != '\x1f\x8b\x08':
+        return None
+    flags = ord(content[offset + 3])
+    position = offset + HEADER_SIZE
+    name = ''
+    if flags & 0x04:
+        if len(content) - position < 2:
+            return None
+        position += 2 + struct.unpack('<H', content[position:position + 2])[0]
+    for flag in (FNAME, 0x10):
+        if flags & flag:
+            end = content.find('\0', position)
+            if end < 0:
+                return None
+            if flag == FNAME:
+                name = content[position:end] + '.gz'
+            position = end + 1
+    if flags & 0x02:
+        position += 2
+    # Feed the decompressor a chunk at a time, so that we don't copy
+    # the rest of the segment into unused_data for each member
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    data = []
+    while len(decompressor.unused_data) < 8:
+        chunk = content[position:position + CHUNK_SIZE]
+        if not chunk:
+            return None
+        try:
+            data.append(decompressor.decompress(chunk))
+        except zlib.error:
+            return None
+        position += len(chunk)
+    data = ''.join(data)
+    trailer = decompressor.unused_data
+    crc, size = struct.unpack('<II', trailer[:8])
+    if crc != zlib.crc32(data) & 0xffffffff or size != len(data) & 0xffffffff:
+        return None
+    return position - len(trailer) + 8 - offset, name, data
+
+def iter_members(path):
+    ''' Yield offset, length, name and data of the complete members
+        of the segment at path, and stop at the first truncated one '''
+    filep = open(path, 'rb')
+    content = filep.read()
+    filep.close()
+    offset = 0
+    while offset < len(content):
+        member = _parse_member(content, offset)
+        if not member:
+            logging.warning('segment_writer: %s: truncated at %d', path, offset)
+            break
+        length, name, data = member
+        yield offset, length, name, data
+        offset += length
+
+def read_index(path):
+    ''' Return the offset, length and name of the results saved
+        in the segment at path, according to the index '''
+    entries = []
+    if not os.path.isfile(path + '.idx'):
+        return entries
+    size = os.path.getsize(path)
+    filep = open(path + '.idx', 'rb')
+    for line in filep:
+        vector = line.split()
+        if not line.endswith('\n') or len(vector) != 3:
+            break
+        offset, length = int(vector[0]), int(vector[1])
+        if offset + length > size:
+            break
+        entries.append((offset, length, vector[2]))
+    filep.close()
+    return entries
+
+def read_result(path, offset, length):
+    ''' Read the result saved at offset in the segment at path '''
+    filep = open(path, 'rb')
+    filep.seek(offset)
+    content = filep.read(length)
+    filep.close()
+    member = _parse_member(content, 0)
+    if not member:
+        raise RuntimeError('segment_writer: %s: bad member at %d' %
+                           (path, offset))
+    return json.loads(member[2])
+
+def repair(path):
+    ''' Truncate the segment at path after its last complete member,
+        rebuild its index, and return the number of results '''
+    lines, end = [], 0
+    for offset, length, name, _ in iter_members(path):
+        lines.append('%d %d %s\n' % (offset, length, name))
+        end = offset + length
+    if os.path.getsize(path) != end:
+        logging.warning('segment_writer: %s: truncating at %d', path, end)
+        filep = open(path, 'r+b')
+        filep.truncate(end)
+        filep.close()
+    filep = open(path + '.idx', 'wb')
+    filep.write(''.join(lines))
+    filep.close()
+    return len(lines)
+
+class SegmentWriter(object):
+
+    ''' Append the results of a test to rolling gzip segments '''
+
+    def __init__(self, test, touch, poller=POLLER):
+        self.test = test
+        self.touch = touch
+        self.poller = poller
+        self.flush_interval = CONFIG['mlab.segment.flush_interval']
+        self.flush_size = CONFIG['mlab.segment.flush_size']
+        self.rotate_interval = CONFIG['mlab.segment.rotate_interval']
+        self.rotate_size = CONFIG['mlab.segment.rotate_size']
+        self.path = None
+        self.filep = None
+        self.indexp = None
+        self.begin = 0
+        self.day = None
+        self.offset = 0
+        self.buffer = []
+        self.index = []
+        self.buffered = 0
+        self.oldest = 0
+        self.scheduled = False
+
+    def append(self, message, thetime):
+        ''' Append message, i.e. the result of a test run at thetime '''
+        day = time.gmtime(thetime)[:3]
+        if self.path and (day != self.day or self.offset >= self.rotate_size
+          or thetime - self.begin >= self.rotate_interval):
+            self.close()
+        if not self.path:
+            self._open(thetime, day)
+
+        name = result_name(thetime, self.test)
+        member = gzip_member(json.dumps(message) + '\n', name, thetime)
+        self.index.append('%d %d %s\n' % (self.offset, len(member), name))
+        self.buffer.append(member)
+        self.offset += len(member)
+        self.buffered += len(member)
+        if len(self.buffer) == 1:
+            self.oldest = time.time()
+
+        if (self.buffered >= self.flush_size or
+              time.time() - self.oldest >= self.flush_interval):
+            self.flush()
+        elif not self.scheduled:
+            self.scheduled = True
+            self.poller.sched(self.flush_interval, self._periodic)
+
+    def flush(self):
+        ''' Write the buffered results '''
+        if not self.buffer:
+            return
+        self.filep.write(''.join(self.buffer))
+        self.filep.flush()
+        self.indexp.write(''.join(self.index))
+        self.indexp.flush()
+        self.buffer, self.index, self.buffered = [], [], 0
+
+    def close(self):
+        ''' Flush and close the current segment '''
+        if not self.path:
+            return
+        self.flush()
+        self.filep.close()
+        self.indexp.close()
+        self.path = self.filep = self.indexp = None
+
+    def _periodic(self):
+        ''' Periodically flush the buffer '''
+        self.scheduled = False
+        if not self.buffer:
+            return
+        if time.time() - self.oldest >= self.flush_interval:
+            self.flush()
+            return
+        self.scheduled = True
+        self.poller.sched(self.flush_interval, self._periodic)
+
+    def _open(self, thetime, day):
+        ''' Open a new segment '''
+        gmt = time.gmtime(thetime)
+        leaf = result_name(thetime, self.test).replace('.gz', '.jsonl.gz')
+        components = [time.strftime('%Y', gmt), time.strftime('%m', gmt),
+                      time.strftime('%d', gmt), leaf]
+        self.path = self.touch(components)
+        components[-1] += '.idx'
+        self.touch(components)
+        logging.debug('segment_writer: new segment: %s', self.path)
+        self.filep = open(self.path, 'ab')
+        self.indexp = open(self.path + '.idx', 'ab')
+        self.offset = self.filep.tell()
+        self.begin = thetime
+        self.day = day
+
+USAGE = 'usage: neubot segment_writer [-r] segment...'
+
+def main(args):
+    ''' List (or repair, with -r) the results in segments '''
+    try:
+        options, arguments = getopt.getopt(args[1:], 'r')
+    except getopt.error:
+        sys.exit(USAGE)
+    if not arguments:
+        sys.exit(USAGE)
+    fix = False
+    for name, _ in options:
+        if name == '-r':
+            fix = True
+    for path in arguments:
+        if fix:
+            repair(path)
+        for offset, length, name in read_index(path):
+            sys.stdout.write('%s %d %d %s\n' % (path, offset, length, name))
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -52,11 +52,14 @@ from neubot.config import CONFIG
 from neubot.backend import BACKEND
 from neubot.log import LOG
 from neubot.raw_srvr_glue import RAW_SERVER_EX
+from neubot.utils_random import PAYLOAD
 
 from neubot import bittorrent
 from neubot import negotiate
+from neubot import server_workers
 from neubot import system
 from neubot import utils_modules
+from neubot import utils_net
 from neubot import utils_posix
 
 #from neubot import rendezvous          # Not yet
@@ -88,13 +91,15 @@ class DebugAPI(ServerHTTP):
                     # Add the length of the most relevant globals
                     'NEGOTIATE_SERVER.queue': len(NEGOTIATE_SERVER.queue),
                     'NEGOTIATE_SERVER.known': len(NEGOTIATE_SERVER.known),
+                    'NEGOTIATE_SERVER.waiting': len(NEGOTIATE_SERVER.waiting),
                     'NEGOTIATE_SERVER_BITTORRENT.peers': \
                         len(NEGOTIATE_SERVER_BITTORRENT.peers),
                     'NEGOTIATE_SERVER_SPEEDTEST.clients': \
                         len(NEGOTIATE_SERVER_SPEEDTEST.clients),
                     'POLLER.readset': len(POLLER.readset),
                     'POLLER.writeset': len(POLLER.writeset),
-                    'LOG._queue': len(LOG._queue),
+                    'LOG.writer.queue': len(LOG.writer.queue),
+                    'LOG.writer.dropped': LOG.writer.dropped,
                     'CONFIG.conf': len(CONFIG.conf),
                     'NOTIFIER._timestamps': len(NOTIFIER._timestamps),
                     'NOTIFIER._subscribers': len(NOTIFIER._subscribers),
@@ -150,7 +155,9 @@ class ServerSideAPI(ServerHTTP):
             response.compose(code="200", reason="Ok", body=body,
                              mimetype="application/json")
         elif request.uri == "/sapi/state":
-            body = '{"queue_len_cur": %d}' % len(NEGOTIATE_SERVER.queue)
+            state = {"queue_len_cur": len(NEGOTIATE_SERVER.queue)}
+            NEGOTIATE_SERVER.snap(state)
+            body = json.dumps(state)
             response.compose(code="200", reason="Ok", body=body,
                              mimetype="application/json")
         else:
@@ -168,6 +175,7 @@ SETTINGS = {
     "server.rendezvous": False,         # Not needed on the random server
     "server.sapi": True,
     "server.speedtest": True,
+    "server.workers": 1,
 }
 
 USAGE = '''\
@@ -187,11 +195,13 @@ valid defines:
   server.raw        Set to nonzero to enable RAW server (default: 1)
   server.rendezvous Set to nonzero to enable rendezvous server (default: 0)
   server.sapi       Set to nonzero to enable nagios API (default: 1)
-  server.speedtest  Set to nonzero to enable speedtest server (default: 1)'''
+  server.speedtest  Set to nonzero to enable speedtest server (default: 1)
+  server.workers    Set number of worker processes (default: 1)'''
 
 VALID_MACROS = ('server.bittorrent', 'server.daemonize', 'server.datadir',
                 'server.debug', 'server.negotiate', 'server.raw',
-                'server.rendezvous', 'server.sapi', 'server.speedtest')
+                'server.rendezvous', 'server.sapi', 'server.speedtest',
+                'server.workers')
 
 def main(args):
     """ Starts the server module """
@@ -243,6 +253,33 @@ def main(args):
 
     conf = CONFIG.copy()
 
+    #
+    # Prefork mode: fork the workers before we start listening, so
+    # that each worker binds the same ports using SO_REUSEPORT and
+    # runs its own poller.  The master does not serve clients, it
+    # just coordinates the state shared by the workers.
+    #
+    if conf['server.workers'] > 1:
+        if conf["server.daemonize"]:
+            LOG.redirect()
+            system.go_background()
+            conf["server.daemonize"] = False
+        utils_net.set_listen_reuseport(True)
+        # Create the payload now, so the workers share it
+        PAYLOAD.create()
+        master, worker = server_workers.prefork(conf['server.workers'])
+        if master:
+            signal.signal(signal.SIGTERM, lambda signo, frame:
+                          master.terminate())
+            logging.info('Neubot server -- master starting up')
+            system.drop_privileges()
+            POLLER.loop()
+            logging.info('Neubot server -- master shutting down')
+            BACKEND.flush()
+            utils_posix.remove_pidfile('/var/run/neubot.pid')
+            return
+        server_workers.worker_setup(worker)
+
     #
     # Configure our global HTTP server and make
     # sure that we don't provide filesystem access
@@ -342,7 +379,9 @@ def main(args):
     POLLER.loop()
 
     logging.info('Neubot server -- shutting down')
-    utils_posix.remove_pidfile('/var/run/neubot.pid')
+    BACKEND.flush()
+    if conf['server.workers'] <= 1:
+        utils_posix.remove_pidfile('/var/run/neubot.pid')
 
 if __name__ == "__main__":
     main(sys.argv)
@@ -0,0 +1,517 @@
+# neubot/server_workers.py
+
+#
+# Copyright (c) 2013
+#     Nexa Center for Internet & Society, Politecnico di Torino (DAUIN),
+#     and Simone Basso <bassosimone@gmail.com>
+#
+# This file is part of Neubot <http://www.neubot.org/>.
+#
+# Neubot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Neubot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Neubot.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+''' Prefork worker model for neubot server '''
+
+#
+# The master process forks N workers before the server starts
+# listening.  Each worker runs its own poller and binds the same
+# ports using SO_REUSEPORT, so the kernel spreads connections among
+# workers.  The master does not serve clients: it coordinates the
+# state that must be shared among workers, using a socketpair per
+# worker over which we exchange length-prefixed pickled tuples:
+#
+# - the negotiate queue, which must be global so that RED admission
+#   and the maximum number of parallel tests still make sense;
+#
+# - the tables of authorized sessions (e.g. NEGOTIATE_SERVER_RAW.peers),
+#   which are replicated to every worker because the test connection
+#   may land on a worker that is not the one that negotiated;
+#
+# - the results, which are saved by the master only, so there is a
+#   single writer for the backend.
+#
+# Pickle is safe here because both ends of the channel are forks of
+# the same process.
+#
+
+import collections
+import errno
+import logging
+import os
+import random
+import signal
+import socket
+import struct
+import sys
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from neubot.backend import BACKEND
+from neubot.config import CONFIG
+from neubot.database import DATABASE
+from neubot.negotiate.indexed_queue import IndexedQueue
+from neubot.negotiate.server import QueueStats
+from neubot.pollable import Pollable
+from neubot.poller import POLLER
+
+from neubot import six
+
+# Maximum amount of bytes we read from the channel at once
+MAXRECV = 262144
+
+# Messages exchanged between master and workers
+(TABLE_SET, TABLE_DEL, QUEUE_JOIN, QUEUE_LEAVE, QUEUE_POSITION,
+ STORE, QUEUE_WAIT) = range(7)
+
+class IPCChannel(Pollable):
+
+    ''' Channel between the master and a worker '''
+
+    def __init__(self, sock, handle_message, handle_eof):
+        Pollable.__init__(self)
+        self.sock = sock
+        self.sock.setblocking(False)
+        self.filenum = sock.fileno()
+        self.handle_message = handle_message
+        self.handle_eof = handle_eof
+        self.incoming = six.b('')
+        self.outgoing = collections.deque()
+        self.isclosed = False
+        self.watchdog = -1
+        POLLER.set_readable(self)
+
+    def __repr__(self):
+        return 'ipc channel %d' % self.filenum
+
+    def fileno(self):
+        return self.filenum
+
+    def send(self, message):
+        ''' Send a message to the other end '''
+        if self.isclosed:
+            return
+        octets = pickle.dumps(message, 2)
+        self.outgoing.append(struct.pack('!I', len(octets)) + octets)
+        POLLER.set_writable(self)
+
+    def handle_read(self):
+        try:
+            octets = self.sock.recv(MAXRECV)
+        except socket.error:
+            if sys.exc_info()[1].args[0] in (errno.EAGAIN, errno.EINTR):
+                return
+            raise
+        if not octets:
+            POLLER.close(self)
+            return
+        self.incoming += octets
+        while len(self.incoming) >= 4:
+            length = struct.unpack('!I', self.incoming[:4])[0]
+            if len(self.incoming) < 4 + length:
+                break
+            message = pickle.loads(self.incoming[4:4 + length])
+            self.incoming = self.incoming[4 + length:]
+            self.handle_message(self, message)
+
+    def handle_write(self):
+        octets = self.outgoing[0]
+        try:
+            count = self.sock.send(octets)
+        except socket.error:
+            if sys.exc_info()[1].args[0] in (errno.EAGAIN, errno.EINTR):
+                return
+            raise
+        if count < len(octets):
+            self.outgoing[0] = octets[count:]
+            return
+        self.outgoing.popleft()
+        if not self.outgoing:
+            POLLER.unset_writable(self)
+
+    def handle_close(self):
+        if self.isclosed:
+            return
+        self.isclosed = True
+        self.sock.close()
+        self.outgoing.clear()
+        self.handle_eof(self)
+
+class SharedTable(dict):
+
+    ''' A dictionary replicated among all the workers '''
+
+    #
+    # Lookups are local and fast, while each change is sent to the
+    # master, which forwards it to the other workers.  The set-like
+    # methods allow to use this class in place of a set().
+    #
+
+    def __init__(self, name, channel):
+        dict.__init__(self)
+        self.name = name
+        self.channel = channel
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self.channel.send((TABLE_SET, self.name, key, value))
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self.channel.send((TABLE_DEL, self.name, key))
+
+    def add(self, key):
+        ''' Set-like add() '''
+        self[key] = True
+
+    def remove(self, key):
+        ''' Set-like remove() '''
+        del self[key]
+
+    def apply_remote(self, message):
+        ''' Apply a change made by another worker '''
+        if message[0] == TABLE_SET:
+            dict.__setitem__(self, message[2], message[3])
+        elif message[2] in self:
+            dict.__delitem__(self, message[2])
+
+class BackendWorker(object):
+
+    ''' Backend that forwards results to the master '''
+
+    def __init__(self, proxy, channel):
+        self.proxy = proxy
+        self.channel = channel
+
+    def bittorrent_store(self, message):
+        ''' Save result of BitTorrent test '''
+        self.channel.send((STORE, 'bittorrent_store', (message,)))
+
+    def store_raw(self, message):
+        ''' Save result of RAW test '''
+        self.channel.send((STORE, 'store_raw', (message,)))
+
+    def speedtest_store(self, message):
+        ''' Save result of speedtest test '''
+        self.channel.send((STORE, 'speedtest_store', (message,)))
+
+    def store_generic(self, test, results):
+        ''' Store the results of a generic test '''
+        self.channel.send((STORE, 'store_generic', (test, results)))
+
+    def walk_generic(self, test, index):
+        ''' Walk over the results of a generic test '''
+        return []
+
+    def walk_generic_range(self, test, since, until):
+        ''' Walk over the results of a generic test saved between
+            since and until '''
+        return []
+
+    def flush(self):
+        ''' Write the buffered results (if any) '''
+
+    def datadir_init(self, uname=None, datadir=None):
+        ''' Initialize datadir (if needed) '''
+
+class QueueCoordinator(object):
+
+    ''' Worker-side view of the global negotiate queue '''
+
+    #
+    # The negotiate server invokes join() the first time it sees
+    # a stream and leave() when the stream is closed.  The master
+    # answers with the position of the stream in the global queue,
+    # or with None if RED decided to drop it.  After that, the
+    # negotiate server invokes wait() each time it owes a response
+    # to the stream, and the master sends the position when it
+    # changes, or at once if it changed since the last time.
+    #
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.tickets = {}
+
+    def __len__(self):
+        return len(self.tickets)
+
+    def join(self, stream, func):
+        ''' Join the global queue; func(stream, position) is invoked
+            each time the position of stream changes '''
+        ticket = id(stream)
+        self.tickets[ticket] = (stream, func)
+        self.channel.send((QUEUE_JOIN, ticket))
+
+    def wait(self, stream):
+        ''' Ask for the position of stream when it changes '''
+        ticket = id(stream)
+        if ticket in self.tickets:
+            self.channel.send((QUEUE_WAIT, ticket))
+
+    def leave(self, stream):
+        ''' Leave the global queue '''
+        ticket = id(stream)
+        if ticket in self.tickets:
+            del self.tickets[ticket]
+            self.channel.send((QUEUE_LEAVE, ticket))
+
+    def position_changed(self, ticket, position):
+        ''' Invoked when the master sends us a new position '''
+        if ticket not in self.tickets:
+            return  # Already left
+        stream, func = self.tickets[ticket]
+        if position is None:
+            del self.tickets[ticket]
+        func(stream, position)
+
+class Worker(object):
+
+    ''' Worker side of the prefork model '''
+
+    def __init__(self, sock):
+        self.channel = IPCChannel(sock, self._handle_message,
+                                  self._handle_eof)
+        self.tables = {}
+        self.coordinator = QueueCoordinator(self.channel)
+
+    def share_table(self, name, table):
+        ''' Create a shared table initialized from table '''
+        shared = SharedTable(name, self.channel)
+        dict.update(shared, table)
+        self.tables[name] = shared
+        return shared
+
+    def _handle_message(self, channel, message):
+        ''' Handle a message from the master '''
+        if message[0] in (TABLE_SET, TABLE_DEL):
+            self.tables[message[1]].apply_remote(message)
+        elif message[0] == QUEUE_POSITION:
+            self.coordinator.position_changed(message[1], message[2])
+        else:
+            logging.warning('server_workers: unexpected message: %s',
+                            message[0])
+
+    @staticmethod
+    def _handle_eof(channel):
+        ''' The master died, so we must die too '''
+        logging.warning('server_workers: lost master, exiting')
+        POLLER.break_loop()
+
+class Master(object):
+
+    ''' Master side of the prefork model '''
+
+    def __init__(self):
+        self.workers = {}
+        self.queue = IndexedQueue()
+        self.waiting = set()
+        self.told = {}
+        self.stats = QueueStats()
+
+    def add_worker(self, pid, sock):
+        ''' Register a worker '''
+        channel = IPCChannel(sock, self._handle_message, self._handle_eof)
+        self.workers[channel] = pid
+        return channel
+
+    def _handle_message(self, channel, message):
+        ''' Handle a message from a worker '''
+        if message[0] in (TABLE_SET, TABLE_DEL):
+            for other in self.workers:
+                if other is not channel:
+                    other.send(message)
+        elif message[0] == QUEUE_JOIN:
+            self.queue_join(channel, message[1])
+        elif message[0] == QUEUE_LEAVE:
+            self.queue_leave(channel, message[1])
+        elif message[0] == QUEUE_WAIT:
+            self.queue_wait(channel, message[1])
+        elif message[0] == STORE:
+            self._store(message[1], message[2])
+        else:
+            logging.warning('server_workers: unexpected message: %s',
+                            message[0])
+
+    @staticmethod
+    def _store(method, args):
+        ''' Save a result on behalf of a worker '''
+        try:
+            getattr(BACKEND, method)(*args)
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            logging.error('server_workers: cannot save result', exc_info=1)
+
+    #
+    # Same RED admission algorithm of NegotiateServer, applied to
+    # the global queue length.
+    #
+    # As NegotiateServer does, when an entry leaves the queue we
+    # send the new position only to the entries behind it that are
+    # waiting for a response, i.e. the ones in self.waiting, and we
+    # account for the entries that cross the parallelism threshold,
+    # so the cost does not depend on the length of the queue.  We
+    # remember the position we told to each entry, because a wait
+    # request may arrive after its position has changed, and in
+    # that case we must respond at once.
+    #
+
+    def queue_join(self, channel, ticket):
+        ''' A worker wants to add a stream to the queue '''
+        position = len(self.queue)
+        min_thresh = CONFIG['negotiate.min_thresh']
+        max_thresh = CONFIG['negotiate.max_thresh']
+        if random.random() < float(position - min_thresh) / (
+                               max_thresh - min_thresh):
+            self.stats.reject()
+            channel.send((QUEUE_POSITION, ticket, None))
+            return
+        self.queue.append((channel, ticket))
+        self.stats.join((channel, ticket))
+        self._send_position((channel, ticket), position)
+
+    def queue_wait(self, channel, ticket):
+        ''' A worker owes a response to a stream '''
+        entry = (channel, ticket)
+        if entry not in self.queue:
+            return
+        position = self.queue.position(entry)
+        if position != self.told.get(entry):
+            self._send_position(entry, position)
+        else:
+            self.waiting.add(entry)
+
+    def queue_leave(self, channel, ticket):
+        ''' A worker removes a stream from the queue '''
+        if (channel, ticket) not in self.queue:
+            return
+        index = self._remove((channel, ticket))
+        self._queue_moved(index)
+
+    def _remove(self, entry):
+        ''' Remove entry from the queue and return its position '''
+        index = self.queue.remove(entry)
+        self.waiting.discard(entry)
+        del self.told[entry]
+        self.stats.leave(entry)
+        return index
+
+    def _queue_moved(self, index):
+        ''' Notify streams whose position changed '''
+        parallelism = CONFIG['negotiate.parallelism']
+        for position in range(index, min(parallelism, len(self.queue))):
+            self.stats.unchoke(self.queue[position])
+        if not self.waiting:
+            return
+        entries = [entry for entry in self.waiting
+                   if self.queue.position(entry) >= index]
+        entries.sort(key=self.queue.position)
+        for entry in entries:
+            self.waiting.remove(entry)
+            self._send_position(entry, self.queue.position(entry))
+
+    def _send_position(self, entry, position):
+        ''' Tell a worker the position of a stream '''
+        entry[0].send((QUEUE_POSITION, entry[1], position))
+        self.told[entry] = position
+        if position < CONFIG['negotiate.parallelism']:
+            self.stats.unchoke(entry)
+
+    def _handle_eof(self, channel):
+        ''' A worker died '''
+        pid = self.workers.pop(channel)
+        logging.warning('server_workers: worker %d exited', pid)
+        entries = [entry for entry in self.queue if entry[0] is channel]
+        if entries:
+            index = min([self._remove(entry) for entry in entries])
+            self._queue_moved(index)
+        #
+        # The worker closes the channel when it exits, so we may see
+        # EOF before it has exited, and waitpid() with WNOHANG would
+        # leave a zombie.  Wait for it instead: it is already exiting.
+        #
+        while True:
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                if sys.exc_info()[1].args[0] == errno.EINTR:
+                    continue
+            break
+        if not self.workers:
+            POLLER.break_loop()
+
+    def terminate(self):
+        ''' Ask all workers to terminate '''
+        for pid in self.workers.values():
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def snap(self, data):
+        ''' Take a snapshot of master state '''
+        data['server_workers'] = {
+            'workers': list(self.workers.values()),
+            'queue_len': len(self.queue),
+            'negotiate': self.stats.snap(len(self.queue)),
+        }
+
+def prefork(count):
+    ''' Fork count workers.  Returns (None, worker) in the worker
+        processes and (master, None) in the master process '''
+
+    if POLLER.readset or POLLER.writeset:
+        raise RuntimeError('server_workers: must fork before listening')
+
+    children = []
+    for _ in range(count):
+        master_sock, worker_sock = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            master_sock.close()
+            for _, sock in children:
+                sock.close()
+            POLLER.after_fork()
+            DATABASE.after_fork()
+            return None, Worker(worker_sock)
+        worker_sock.close()
+        children.append((pid, master_sock))
+
+    master = Master()
+    for pid, sock in children:
+        master.add_worker(pid, sock)
+    logging.info('server_workers: forked %d workers', count)
+    return master, None
+
+def worker_setup(worker):
+    ''' Share negotiate state and results with the master '''
+
+    # Lazy import to avoid an import loop
+    from neubot.negotiate.server import NEGOTIATE_SERVER
+    from neubot.negotiate.server_bittorrent import NEGOTIATE_SERVER_BITTORRENT
+    from neubot.negotiate.server_raw import NEGOTIATE_SERVER_RAW
+    from neubot.negotiate.server_speedtest import NEGOTIATE_SERVER_SPEEDTEST
+
+    NEGOTIATE_SERVER.coordinator = worker.coordinator
+    NEGOTIATE_SERVER_BITTORRENT.peers = worker.share_table(
+      'bittorrent.peers', NEGOTIATE_SERVER_BITTORRENT.peers)
+    NEGOTIATE_SERVER_RAW.peers = worker.share_table('raw.peers',
+      NEGOTIATE_SERVER_RAW.peers)
+    NEGOTIATE_SERVER_SPEEDTEST.clients = worker.share_table(
+      'speedtest.clients', dict.fromkeys(NEGOTIATE_SERVER_SPEEDTEST.clients,
+      True))
+
+    BACKEND.backend = BackendWorker(BACKEND, worker.channel)
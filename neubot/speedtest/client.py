@@ -35,6 +35,7 @@ from neubot.http.client import ClientHTTP
 from neubot.http.message import Message
 from neubot.net.poller import POLLER
 from neubot.notify import NOTIFIER
+from neubot.runner_discovery import DISCOVERY_CACHE
 from neubot.state import STATE
 from neubot.speedtest.wrapper import SpeedtestCollect
 from neubot.speedtest.wrapper import SpeedtestNegotiate_Response
@@ -81,6 +82,10 @@ class ClientLatency(ClientHTTP):
           []).append(ticks)
 
 class ClientDownload(ClientHTTP):
+
+    # We throw the body away, so we can receive it in place
+    recv_slices = True
+
     def __init__(self, poller):
         ClientHTTP.__init__(self, poller)
         self.ticks = {}
@@ -312,6 +317,7 @@ class ClientSpeedtest(ClientHTTP):
     # So we don't need to do gymnastics here.
     #
     def connection_failed(self, connector, exception):
+        DISCOVERY_CACHE.mark_stale(self.conf.get("speedtest.client.uri", ""))
         self.cleanup(message="connection failed")
 
     def connection_lost(self, stream):
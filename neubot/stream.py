@@ -30,6 +30,7 @@ import os
 import socket
 import sys
 
+from neubot.bufpool import Receiver
 from neubot.defer import Deferred
 from neubot.pollable import Pollable
 from neubot.poller import POLLER
@@ -83,6 +84,19 @@ class StreamWrapper(object):
             else:
                 raise
 
+    def sorecv_into(self, receiver, maxlen):
+        ''' Wrapper for socket recv_into() '''
+        try:
+            return SUCCESS, receiver.recv(self.sock, maxlen)
+        except socket.error:
+            exception = sys.exc_info()[1]
+            if exception.args[0] in SOFT_ERRORS:
+                return WANT_READ, EMPTY_STRING
+            elif exception.args[0] == errno.ECONNRESET:
+                return CONNRST, EMPTY_STRING
+            else:
+                raise
+
     def sosend(self, octets):
         ''' Wrapper for socket send() '''
         try:
@@ -96,6 +110,19 @@ class StreamWrapper(object):
             else:
                 raise
 
+    def sosendv(self, vector):
+        ''' Wrapper for vectored socket send() '''
+        try:
+            return SUCCESS, utils_net.sendv(self.sock, vector)
+        except socket.error:
+            exception = sys.exc_info()[1]
+            if exception.args[0] in SOFT_ERRORS:
+                return WANT_WRITE, 0
+            elif exception.args[0] == errno.ECONNRESET:
+                return CONNRST, 0
+            else:
+                raise
+
 class StreamWrapperDebug(StreamWrapper):
     ''' Debug stream wrapper '''
 
@@ -103,6 +130,10 @@ class StreamWrapperDebug(StreamWrapper):
         maxlen = 1
         return StreamWrapper.sorecv(self, maxlen)
 
+    def sorecv_into(self, receiver, maxlen):
+        maxlen = 1
+        return StreamWrapper.sorecv_into(self, receiver, maxlen)
+
 def _stream_wrapper(sock):
     ''' Create the right stream wrapper '''
     if not os.environ.get('NEUBOT_STREAM_DEBUG'):
@@ -137,6 +168,7 @@ class Stream(Pollable):
         self.atclose = Deferred()
         self.atconnect = Deferred()
         self.opaque = opaque
+        self.receiver = None
         self.recv_complete = None
         self.send_complete = None
         self.send_octets = EMPTY_STRING
@@ -150,6 +182,7 @@ class Stream(Pollable):
         self.isclosed = False
         self.recv_bytes = 0
         self.recv_blocked = False
+        self.recv_slices = False
         self.send_blocked = False
 
         self.atclose.add_callback(connection_lost)
@@ -205,10 +238,13 @@ class Stream(Pollable):
 
         self.atclose.callback_each_np(self)
         self.sock.close()
+        if self.receiver:
+            self.receiver.close()
 
         self.atclose = None
         self.atconnect = None
         self.opaque = None
+        self.receiver = None
         self.recv_complete = None
         self.send_complete = None
         self.send_octets = None
@@ -236,6 +272,7 @@ class Stream(Pollable):
 
         self.recv_bytes = recv_bytes
         self.recv_complete = recv_complete
+        self.recv_slices = False
 
         if self.recv_blocked:
             logging.debug('stream: recv() is blocked')
@@ -243,6 +280,17 @@ class Stream(Pollable):
 
         POLLER.set_readable(self)
 
+    def recv_into(self, recv_bytes, recv_complete):
+        ''' Like recv(), but passes recv_complete() Slices of pooled
+            buffers (see neubot/bufpool.py) rather than strings.  The
+            protocol should release() slices when done, e.g. using a
+            SliceBrigade.  SSL streams still pass strings. '''
+        self.recv(recv_bytes, recv_complete)
+        if hasattr(self.sock, 'sorecv_into'):
+            if not self.receiver:
+                self.receiver = Receiver()
+            self.recv_slices = True
+
     def handle_read(self):
 
         #
@@ -259,7 +307,11 @@ class Stream(Pollable):
             self.handle_write()
             return
 
-        status, octets = self.sock.sorecv(self.recv_bytes)
+        if self.recv_slices:
+            status, octets = self.sock.sorecv_into(self.receiver,
+                                                   self.recv_bytes)
+        else:
+            status, octets = self.sock.sorecv(self.recv_bytes)
 
         #
         # Optimisation: reorder if branches such that the ones more relevant
@@ -307,13 +359,19 @@ class Stream(Pollable):
     #
 
     def send(self, send_octets, send_complete):
-        ''' Async send() '''
+        ''' Async send(); send_octets may also be a list of strings,
+            which are sent with as few system calls as possible '''
 
         if self.isclosed:
             raise RuntimeError('stream: send() on a closed stream')
         if self.send_octets:
             raise RuntimeError('stream: already send()ing')
 
+        if isinstance(send_octets, list):
+            send_octets = utils_net.coalesce_vector(send_octets)
+            if not hasattr(self.sock, 'sosendv') or len(send_octets) <= 1:
+                send_octets = EMPTY_STRING.join(send_octets)
+
         self.send_octets = send_octets
         self.send_complete = send_complete
 
@@ -339,7 +397,10 @@ class Stream(Pollable):
             self.handle_read()
             return
 
-        status, count = self.sock.sosend(self.send_octets)
+        if self.send_octets.__class__ is list:
+            status, count = self.sock.sosendv(self.send_octets)
+        else:
+            status, count = self.sock.sosend(self.send_octets)
 
         #
         # Optimisation: reorder if branches such that the ones more relevant
@@ -351,6 +412,15 @@ class Stream(Pollable):
         if status == SUCCESS and count > 0:
             self.bytes_out += count
 
+            if self.send_octets.__class__ is list:
+                self.send_octets = utils_net.consume_vector(self.send_octets,
+                                                            count)
+                if not self.send_octets:
+                    POLLER.unset_writable(self)
+                    self.send_octets = EMPTY_STRING
+                    self.send_complete(self)
+                return
+
             if count == len(self.send_octets):
                 POLLER.unset_writable(self)
                 self.send_octets = EMPTY_STRING
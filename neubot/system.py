@@ -62,3 +62,13 @@ def check_database_path(pathname):
     _want_rwx_dir(os.path.dirname(pathname))
     _want_rw_file(pathname)
     return pathname
+
+def check_database_journal(pathname):
+    ''' Make sure the database WAL journal files are OK '''
+
+    if not has_enough_privs():
+        return
+
+    for suffix in ('-wal', '-shm'):
+        if os.path.isfile(pathname + suffix):
+            _want_rw_file(pathname + suffix)
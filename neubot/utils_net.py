@@ -28,9 +28,165 @@ import os
 import socket
 import sys
 
+from neubot import six
+
 # Winsock returns EWOULDBLOCK
 INPROGRESS = [ 0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN ]
 
+# Python < 3.4 does not export SO_REUSEPORT
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', None)
+if SO_REUSEPORT is None and sys.platform.startswith('linux'):
+    SO_REUSEPORT = 15
+
+#
+# When set, listen() sets SO_REUSEPORT so that many processes can
+# bind the same port and the kernel spreads connections among them.
+#
+LISTEN_REUSEPORT = False
+
+def set_listen_reuseport(enable):
+    ''' Enable or disable SO_REUSEPORT for listening sockets '''
+    global LISTEN_REUSEPORT
+    if enable and SO_REUSEPORT is None:
+        raise RuntimeError('utils_net: SO_REUSEPORT not available')
+    LISTEN_REUSEPORT = enable
+
+#
+# Zero-copy transmission of a file.  Python 3.3+ exports sendfile()
+# in the os module, with older Pythons we use the C library on Linux
+# and, elsewhere, callers must fall back to read() and send().
+#
+
+def _libc_sendfile():
+    ''' Return sendfile() from the C library, or None '''
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        func = getattr(libc, 'sendfile64', None)
+        if func is None:
+            func = libc.sendfile
+    except (ImportError, OSError, AttributeError):
+        return None
+    func.argtypes = [ctypes.c_int, ctypes.c_int,
+                     ctypes.POINTER(ctypes.c_longlong), ctypes.c_size_t]
+    func.restype = ctypes.c_ssize_t
+
+    def libc_sendfile(out_fd, in_fd, offset, count):
+        ''' Send count bytes of in_fd starting at offset '''
+        position = ctypes.c_longlong(offset)
+        result = func(out_fd, in_fd, ctypes.byref(position), count)
+        if result < 0:
+            code = ctypes.get_errno()
+            raise OSError(code, os.strerror(code))
+        return result
+
+    return libc_sendfile
+
+SENDFILE = getattr(os, 'sendfile', None)
+if SENDFILE is None:
+    SENDFILE = _libc_sendfile()
+
+#
+# Vectored send.  Python 3.3+ sockets have sendmsg(), with older
+# Pythons we use writev() from the C library and, if that is not
+# available, we join a bounded number of bytes and send() them.
+#
+
+# Max number of buffers passed to a single vectored send
+IOV_MAX = 64
+
+# Max number of bytes we join when there is no vectored send
+SENDV_JOIN_MAX = 262144
+
+# Buffers smaller than this are cheaper to copy than to pass by reference
+SENDV_COPY_MAX = 1024
+
+def _libc_writev():
+    ''' Return a writev()-based sendv() function, or None '''
+    if os.name != 'posix':
+        return None
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        writev = libc.writev
+        as_read_buffer = ctypes.pythonapi.PyObject_AsReadBuffer
+    except (ImportError, OSError, AttributeError):
+        return None
+
+    class IOVec(ctypes.Structure):
+        ''' The C struct iovec '''
+        _fields_ = [('iov_base', ctypes.c_void_p),
+                    ('iov_len', ctypes.c_size_t)]
+
+    writev.argtypes = [ctypes.c_int, ctypes.POINTER(IOVec), ctypes.c_int]
+    writev.restype = ctypes.c_ssize_t
+    as_read_buffer.argtypes = [ctypes.py_object,
+                               ctypes.POINTER(ctypes.c_void_p),
+                               ctypes.POINTER(ctypes.c_ssize_t)]
+    as_read_buffer.restype = ctypes.c_int
+
+    def libc_sendv(sock, vector):
+        ''' Send the buffers in vector using writev() '''
+        # Note: vector keeps the buffers alive during writev()
+        iov = (IOVec * len(vector))()
+        base, length = ctypes.c_void_p(), ctypes.c_ssize_t()
+        for index, octets in enumerate(vector):
+            as_read_buffer(octets, ctypes.byref(base), ctypes.byref(length))
+            iov[index].iov_base = base.value
+            iov[index].iov_len = length.value
+        result = writev(sock.fileno(), iov, len(vector))
+        if result < 0:
+            code = ctypes.get_errno()
+            raise socket.error(code, os.strerror(code))
+        return result
+
+    return libc_sendv
+
+if hasattr(socket.socket, 'sendmsg'):
+    SENDV = lambda sock, vector: sock.sendmsg(vector)
+else:
+    SENDV = _libc_writev()
+
+def sendv(sock, vector):
+    ''' Send as many of the buffers in vector as possible using a
+        single system call and return the number of bytes sent '''
+    if SENDV is not None:
+        return SENDV(sock, vector[:IOV_MAX])
+    total, index = 0, 0
+    while index < len(vector) and index < IOV_MAX and total < SENDV_JOIN_MAX:
+        total += len(vector[index])
+        index += 1
+    return sock.send(six.b('').join([bytes(octets)
+                                     for octets in vector[:index]]))
+
+def coalesce_vector(vector):
+    ''' Join runs of small buffers in vector, so that the vectored
+        send does not waste slots on, e.g., single header tokens '''
+    result, pending = [], []
+    for octets in vector:
+        if len(octets) < SENDV_COPY_MAX:
+            pending.append(octets)
+            continue
+        if pending:
+            result.append(six.b('').join(pending))
+            pending = []
+        result.append(octets)
+    if pending:
+        result.append(six.b('').join(pending))
+    return result
+
+def consume_vector(vector, count):
+    ''' Return what is left of vector after count bytes were sent '''
+    index = 0
+    while index < len(vector) and count >= len(vector[index]):
+        count -= len(vector[index])
+        index += 1
+    if index < len(vector) and count > 0:
+        return [six.buff(vector[index], count)] + vector[index + 1:]
+    return vector[index:]
+
 def format_epnt(epnt):
     ''' Format endpoint for printing '''
     address, port = epnt[:2]
@@ -133,6 +289,8 @@ def listen(epnt, prefer_ipv6):
 
             sock = socket.socket(ainfo[0], socket.SOCK_STREAM)
             sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if LISTEN_REUSEPORT:
+                sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
             sock.setblocking(False)
             sock.bind(ainfo[4])
             # Probably the backlog here is too big
@@ -163,8 +321,17 @@ def connect(epnt, prefer_ipv6):
         addrinfo = socket.getaddrinfo(epnt[0], epnt[1], socket.AF_UNSPEC,
                                       socket.SOCK_STREAM)
     except socket.error:
-        logging.error('connect(): cannot connect to %s',
-                      format_epnt(epnt), exc_info=1)
+        addrinfo = sys.exc_info()[1]
+
+    return connect_addrinfo(epnt, addrinfo, prefer_ipv6)
+
+def connect_addrinfo(epnt, addrinfo, prefer_ipv6):
+    ''' Connect to epnt given the result of getaddrinfo(), which
+        may also be the exception raised by getaddrinfo() '''
+
+    if isinstance(addrinfo, Exception):
+        logging.error('connect(): cannot connect to %s: %s',
+                      format_epnt(epnt), addrinfo)
         return None
 
     message = ['connect(): getaddrinfo() returned: [']
@@ -23,131 +23,122 @@
 ''' Generate random data blocks for the tests '''
 
 #
-# This code is inspired by code published on the blog
-# of Jesse Noller <http://bit.ly/irj8je>.
+# All the tests draw their payload from a single region of random
+# bytes, which is generated once and then handed out in slices at
+# rotating offsets, so we don't spend CPU generating filler bytes
+# and we don't allocate memory for each block we send.  The region
+# is an anonymous shared mmap: server workers forked after it has
+# been created share the same physical pages.
 #
-
-import collections
-import os.path
-import random
-
+# The first MAXSLICE bytes of the region are mirrored at its end,
+# so that any slice up to MAXSLICE bytes is contiguous no matter
+# where it starts.
 #
-# Must use WWWDIR because Python modules are not
-# reachable with Windows.  They are stored into
-# library.zip.
-#
-from neubot import utils_hier
-
-# Maximum depth
-MAXDEPTH = 16
-
-# Size of a block
-BLOCKSIZE = 262144
-
-def listdir(curdir, vector, depth):
-
-    ''' Make a list of all the files in a given directory
-        up to a certain depth '''
-
-    if depth > MAXDEPTH:
-        return
-
-    for entry in os.listdir(curdir):
-        entry = os.path.join(curdir, entry)
-        if os.path.isdir(entry):
-            listdir(entry, vector, depth + 1)
-        elif os.path.isfile(entry):
-            vector.append(entry)
-
-def create_base_block(length):
-
-    ''' Create a base block of length @length '''
-
-    base_block = collections.deque()
 
-    files = []
-    listdir(utils_hier.WWWDIR, files, 0)
-    random.shuffle(files)
+import mmap
+import os
 
-    for fpath in files:
-        fileptr = open(fpath, 'rb')
-        content = fileptr.read()
-        words = content.split()
+from neubot import six
 
-        for word in words:
-            amount = min(len(word), length)
-            word = word[:amount]
-            wordlist = list(word)
-            random.shuffle(wordlist)
+# Size of the random region
+REGION_SIZE = 8388608
 
-            base_block.append(''.join(wordlist))
-            length -= amount
-            if length <= 0:
-                break
+# Max size of a single slice
+MAXSLICE = 1048576
 
-        if length <= 0:
-            break
+# How much we skip between two slices
+STRIDE = 4099
 
-    return base_block
-
-def block_generator(size):
-
-    ''' Generator that returns blocks '''
+# Size of a block
+BLOCKSIZE = 262144
 
-    block = create_base_block(size)
-    while True:
-        block.rotate(random.randrange(4, 16))
-        yield ''.join(block)
+class Payload(object):
+
+    ''' Shared region of pregenerated random bytes '''
+
+    def __init__(self, size=REGION_SIZE, maxslice=MAXSLICE):
+        self.size = size
+        self.maxslice = maxslice
+        self.offset = 0
+        self.region = None
+
+    def create(self):
+        ''' Create the region, if needed '''
+        if self.region is not None:
+            return
+        region = mmap.mmap(-1, self.size + self.maxslice)
+        offset = 0
+        while offset < self.size:
+            amount = min(self.maxslice, self.size - offset)
+            region[offset:offset + amount] = os.urandom(amount)
+            offset += amount
+        region[self.size:] = region[:self.maxslice]
+        self.region = region
+
+    def get(self, length):
+        ''' Return a read-only slice of up to MAXSLICE bytes (a
+            buffer or a memoryview, not a copy) '''
+        self.create()
+        length = min(length, self.maxslice)
+        offset = self.offset
+        self.offset = (offset + length + STRIDE) % self.size
+        if six.PY3:
+            return memoryview(self.region)[offset:offset + length]
+        return buffer(self.region, offset, length)
+
+    def read(self, length):
+        ''' Like get(), but return a string '''
+        return bytes(self.get(length))
+
+PAYLOAD = Payload()
 
 class RandomBlocks(object):
 
-    ''' Generate blocks randomly shuffling a base block '''
+    ''' Generate blocks drawing from the shared payload '''
 
     def __init__(self, size=BLOCKSIZE):
         ''' Initialize random blocks generator '''
-        self._generator = block_generator(size)
         self.blocksiz = size
 
     def reinit(self):
         ''' Reinitialize the generator '''
-        self._generator = block_generator(self.blocksiz)
 
     def get_block(self):
         ''' Return a block of data '''
-        return self._generator.next()
+        return PAYLOAD.read(self.blocksiz)
 
-RANDOMBLOCKS = RandomBlocks()
+    def get_buffer(self):
+        ''' Return a block of data without copying it '''
+        return PAYLOAD.get(self.blocksiz)
 
-#
-# XXX Create and discard the first block at the very
-# beginning, so we are sure that we can fetch all the
-# needed files in the common case, i.e. when we
-# startup as root.
-#
-RANDOMBLOCKS.get_block()
+RANDOMBLOCKS = RandomBlocks()
 
 class RandomBody(object):
 
     '''
      This class implements a minimal file-like interface and
-     employs the random number generator to create the content
-     returned by its read() method.
+     returns random content drawn from the shared payload.
     '''
 
     def __init__(self, total):
         ''' Initialize random body object '''
         self.total = int(total)
 
-    def read(self, want=None):
-        ''' Read up to @want bytes '''
+    def readbuf(self, want=None):
+        ''' Like read() but returns a list of buffers '''
         if not want:
             want = self.total
         amt = min(self.total, min(want, RANDOMBLOCKS.blocksiz))
         if amt:
             self.total -= amt
-            return RANDOMBLOCKS.get_block()[:amt]
+            return [PAYLOAD.get(amt)]
         else:
-            return ''
+            return []
+
+    def read(self, want=None):
+        ''' Read up to @want bytes '''
+        return six.b('').join([bytes(elem) for elem in
+                               self.readbuf(want)])
 
     def seek(self, offset=0, whence=0):
         ''' Seek stub '''
@@ -97,6 +97,26 @@ CONVERT = {
            UNSIGNED32: lambda raw: struct.unpack('=I', raw)[0],
           }
 
+# Struct format of each type, to compile a whole group at once
+FORMATS = {
+           COUNTER32: 'I',
+           COUNTER64: 'Q',
+           GAUGE32: 'I',
+           INET_ADDRESS: '17s',
+           INET_ADDRESS_IPV4: 'I',
+           INET_ADDRESS_IPV6: '17s',
+           INET_PORT_NUMBER: 'H',
+           INTEGER32: 'I',
+           INTEGER: 'I',
+           OCTET: 'B',
+           STR32: '32s',
+           TIME_TICKS: 'I',
+           UNSIGNED32: 'I',
+          }
+
+# Where the kernel exports web100 variables
+PROCDIR = '/proc/web100'
+
 ADDRTYPES = (
              ADDRTYPE_UNKNOWN,
              ADDRTYPE_IPV4,
@@ -107,7 +127,7 @@ ADDRTYPES = (
 def _web100_init():
     ''' Read web100 header at /proc/web100/header '''
     hdr, group = {}, ''
-    filep = open('/proc/web100/header', 'r')
+    filep = open(os.sep.join([PROCDIR, 'header']), 'r')
     for line in filep:
         line = line.strip()
         if not line:
@@ -130,19 +150,42 @@ def _web100_init():
 
 def web100_init():
     ''' Read web100 hdr at /proc/web100/header '''
+    _COMPILED.clear()
     try:
         return _web100_init()
     except IOError:
         logging.warning('web100: no information available', exc_info=1)
         return {}
 
-def web100_find_dirname(hdr, spec):
-    ''' Find /proc/web100/<dirname> with the given spec '''
-    result = ''
-    if hdr:
-        matching = []
-        for name in os.listdir('/proc/web100'):
-            dirname = os.sep.join(['/proc/web100', name])
+#
+# Each connection has a /proc/web100/<cid> directory, where <cid>
+# is an increasing connection identifier, and spec-ascii contains
+# the connection's 4-tuple, i.e. the spec.  We index directories
+# by spec, and we read the spec of each directory just once, so,
+# when a new connection does not match any indexed directory, we
+# list /proc/web100 and read the spec of the new directories only.
+# Directories disappear when connections are closed and, in the
+# meantime, the spec of a directory does not change.
+#
+
+class Web100Index(object):
+
+    ''' Maps the spec of each connection to its directory '''
+
+    def __init__(self):
+        self.specs = {}
+        self.dirnames = {}
+
+    def _scan(self):
+        ''' Index new directories and forget vanished ones '''
+        names = set(os.listdir(PROCDIR))
+        for name in list(self.specs):
+            if name not in names:
+                self._forget(name)
+        for name in names:
+            if name in self.specs:
+                continue
+            dirname = os.sep.join([PROCDIR, name])
             if not os.path.isdir(dirname):
                 continue
             tmp = os.sep.join([dirname, 'spec-ascii'])
@@ -155,8 +198,48 @@ def web100_find_dirname(hdr, spec):
             # Work-around web100 kernel bug
             if ':::' in data:
                 data = data.replace(':::', '::')
-            if data == spec:
+            self.specs[name] = data
+            self.dirnames.setdefault(data, set()).add(name)
+
+    def _forget(self, name):
+        ''' Forget the directory called name '''
+        spec = self.specs.pop(name)
+        names = self.dirnames[spec]
+        names.discard(name)
+        if not names:
+            del self.dirnames[spec]
+
+    def _lookup(self, spec):
+        ''' Return the existing directories matching spec '''
+        matching = []
+        for name in list(self.dirnames.get(spec, ())):
+            dirname = os.sep.join([PROCDIR, name])
+            if os.path.isdir(dirname):
                 matching.append(dirname)
+            else:
+                self._forget(name)
+        return matching
+
+    def find(self, spec):
+        ''' Return the directories matching spec '''
+        matching = self._lookup(spec)
+        if len(matching) != 1:
+            self._scan()
+            matching = self._lookup(spec)
+        return sorted(matching)
+
+    def clear(self):
+        ''' Forget all directories '''
+        self.specs.clear()
+        self.dirnames.clear()
+
+WEB100_INDEX = Web100Index()
+
+def web100_find_dirname(hdr, spec):
+    ''' Find /proc/web100/<dirname> with the given spec '''
+    result = ''
+    if hdr:
+        matching = WEB100_INDEX.find(spec)
         if len(matching) == 1:
             result = matching[0]
         elif len(matching) > 1:
@@ -165,6 +248,38 @@ def web100_find_dirname(hdr, spec):
         logging.warning('web100: no information available')
     return result
 
+#
+# We compile the variables of a group into a single struct, whose
+# format skips the unused bytes between variables (e.g. variables
+# whose name starts with X_), so that we can unpack a snapshot with
+# a single call.  We compile each group once (a group is a dict of
+# the header read by web100_init()).  Variables that overlap with
+# the previous one (if any) are converted one at a time.
+#
+
+_COMPILED = {}
+
+def _web100_compile(group):
+    ''' Return the struct and the names of the variables of group,
+        and the variables we must convert one at a time '''
+    entry = _COMPILED.get(id(group))
+    if entry and entry[0] is group:
+        return entry[1:]
+    fmt, names, others, position = ['='], [], [], 0
+    for off, kind, size, name in sorted((value + (name,)) for name,
+                                        value in group.items()):
+        if off < position:
+            others.append((name, off, kind, size))
+            continue
+        if off > position:
+            fmt.append('%dx' % (off - position))
+        fmt.append(FORMATS[kind])
+        names.append(name)
+        position = off + size
+    entry = (group, struct.Struct(''.join(fmt)), tuple(names), others)
+    _COMPILED[id(group)] = entry
+    return entry[1:]
+
 def web100_snap(hdr, dirname):
     ''' Take a snapshot of standard web100 variables '''
     if not hdr:
@@ -174,11 +289,10 @@ def web100_snap(hdr, dirname):
     path = os.sep.join([dirname, 'read'])
     data = _web100_readfile(path)
     if data:
-        for name, value in hdr['/read'].items():
-            off, kind, size = value
-            tmp = data[off:off + size]
-            value = CONVERT[kind](tmp)
-            result[name] = value
+        compiled, names, others = _web100_compile(hdr['/read'])
+        result = dict(zip(names, compiled.unpack_from(data)))
+        for name, off, kind, size in others:
+            result[name] = CONVERT[kind](data[off:off + size])
         _web100_normalise_addr(result, 'LocalAddress', 'LocalAddressType')
         _web100_normalise_addr(result, 'RemAddress', 'LocalAddressType')
     return result
@@ -218,8 +332,8 @@ def _web100_normalise_addr(result, value_name, addrtype_name):
 
 def __autocheck(hdr):
     ''' Autocheck this implementation '''
-    for dirname in os.listdir('/proc/web100'):
-        dirpath = os.sep.join(['/proc/web100', dirname])
+    for dirname in os.listdir(PROCDIR):
+        dirpath = os.sep.join([PROCDIR, dirname])
         if not os.path.isdir(dirpath):
             continue
         filepath = os.sep.join([dirpath, 'spec-ascii'])
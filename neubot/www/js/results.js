@@ -392,82 +392,78 @@ var results = (function () {
         return self;
     }
 
-    function build_vector(result, recipe) {
-        var dataset, k, timestamp, value;
+    //
+    // /api/aggregate returns, for each day or server, the number of
+    // results and the percentiles of each metric.  To reuse the recipes
+    // in WWWDIR/test, we build a result whose metrics are the medians
+    // of the summary, and evaluate the recipes on it.
+    //
+    function median_result(summary) {
+        var result = {
+            timestamp: summary.first
+        };
+
+        jQuery.each(summary.metrics, function (name, metric) {
+            result[name] = metric.median;
+        });
+
+        return result;
+    }
+
+    // The key of per-day summaries is the UTC day, i.e. YYYY-MM-DD, and
+    // we put the point in the middle of the day.
+    function day_to_millisecond(key) {
+        var fields = key.split("-");
+
+        return Date.UTC(Number(fields[0]), Number(fields[1]) - 1,
+                        Number(fields[2]), 12);
+    }
+
+    function build_vector(summaries, recipe) {
+        var dataset, k, value;
 
+        // /api/aggregate returns the days from the oldest one
         dataset = [];
-        for (k = 0; k < result.length; k += 1) {
-            timestamp = result[k].timestamp * 1000;  // To millisec
-            value = eval_recipe(recipe, result[k]);
+        for (k = 0; k < summaries.length; k += 1) {
+            value = eval_recipe(recipe, median_result(summaries[k]));
             if (value !== undefined) {
-                dataset.push([timestamp, value]);
+                dataset.push([day_to_millisecond(summaries[k].key), value]);
             }
         }
 
         return dataset;
     }
 
-    function build_per_serie_options(label, address, marker) {
-        var dictionary;
+    function build_per_serie_options(label, marker) {
+        var median = i18n.get("median");
 
-        if (address !== "") {
-            label += " (" + address + ")";
-        }
-        dictionary = {
-            label: label,
+        return {
+            label: label + " (" + median + ")",
             markerOptions: {
                 style: marker
             },
             neighborThreshold: -1
         };
-
-        return dictionary;
     }
 
-    function mkplot(info, dataset, result, plotter) {
-        var address, data_by_ip, i, label, marker, recipe;
+    function mkplot(dataset, summaries, plotter) {
+        var vector;
 
-        recipe = dataset.recipe;
-        label = dataset.label;
-        marker = dataset.marker;
-
-        data_by_ip = {};
-        if (!info.www_no_split_by_ip) {
-            for (i = 0; i < result.length; i += 1) {
-                address = result[i].real_address;
-                if (data_by_ip[address] === undefined) {
-                    data_by_ip[address] = [];
-                }
-                data_by_ip[address].push(result[i]);
-            }
-        } else {
-            data_by_ip[""] = result;
+        vector = build_vector(summaries, dataset.recipe);
+        if (vector.length > 0) {
+            plotter.push_data(vector);
+            plotter.push_options(build_per_serie_options(dataset.label,
+                                 dataset.marker));
         }
-
-        jQuery.each(data_by_ip, function (address, vector) {
-            if (vector.length > 0) {
-                vector = build_vector(vector, recipe);
-                if (vector.length > 0) {
-                    plotter.push_data(vector);
-                    plotter.push_options(build_per_serie_options(label,
-                                         address, marker));
-                }
-            }
-        });
     }
 
     // We added this function in 2012, to workaround a jqplot bug. It makes
     // sense to check whether this is still needed with newer jqplots.
-    function compute_xmin(result, since) {
-        var k, list, timestamp, xmin;
+    function compute_xmin(summaries, since) {
+        var xmin;
 
-        list = [];
-        for (k = 0; k < result.length; k += 1) {                /* XXX */
-            timestamp = result[k].timestamp * 1000;
-            list.push(timestamp);
-        }
-        if (list.length > 0) {
-            xmin = Math.min.apply(null, list) - 300000;
+        if (summaries.length > 0) {
+            xmin = day_to_millisecond(summaries[0].key) - self.one_day_in_ms;
         } else {
             xmin = since;
         }
@@ -491,7 +487,7 @@ var results = (function () {
         return xfmt;
     }
 
-    function formatter_plot(info, result, since, until) {
+    function formatter_plot(info, summaries, since, until) {
         var i, j, plotter;
 
         for (i = 0; i < info.plots.length; i += 1) {
@@ -500,17 +496,63 @@ var results = (function () {
             plotter.set_title(info.plots[i].title);
             plotter.set_xlabel(info.plots[i].xlabel);
             plotter.set_ylabel(info.plots[i].ylabel);
-            plotter.set_xmin(compute_xmin(result, since));
+            plotter.set_xmin(compute_xmin(summaries, since));
             plotter.set_xfmt(compute_xfmt(since));
-            options = [];
             for (j = 0; j < info.plots[i].datasets.length; j += 1) {
-                mkplot(info, info.plots[i].datasets[j], result, plotter);
+                mkplot(info.plots[i].datasets[j], summaries, plotter);
             }
             plotter.show_hide_legend(!info.www_no_legend);
             plotter.plot("#charts");
         }
     }
 
+    //
+    // One row for each server, with the number of results and the
+    // median of each of the plotted datasets.
+    //
+    function formatter_summary(info, summaries) {
+        var datasets = [], html = "", i, j, median, result, value;
+
+        median = i18n.get("median");
+
+        for (i = 0; i < info.plots.length; i += 1) {
+            for (j = 0; j < info.plots[i].datasets.length; j += 1) {
+                datasets.push(info.plots[i].datasets[j]);
+            }
+        }
+
+        html += '<center><table id="summary_table">';
+        html += "<thead><tr>";
+        html += "<th>" + i18n.get("Server") + "</th>";
+        html += "<th>" + i18n.get("Tests") + "</th>";
+        for (j = 0; j < datasets.length; j += 1) {
+            html += "<th>" + datasets[j].label + " (" + median + ")</th>";
+        }
+        html += "</tr></thead>";
+        html += "<tbody>";
+
+        for (i = 0; i < summaries.length; i += 1) {
+            result = median_result(summaries[i]);
+            html += "<tr>";
+            html += "<td>" + summaries[i].key + "</td>";
+            html += "<td>" + summaries[i].count + "</td>";
+            for (j = 0; j < datasets.length; j += 1) {
+                value = eval_recipe(datasets[j].recipe, result);
+                if (jQuery.type(value) === "number") {
+                    value = utils.toFixed(value);
+                }
+                if (value === undefined) {
+                    value = "-";
+                }
+                html += "<td>" + value + "</td>";
+            }
+            html += "</tr>";
+        }
+
+        html += "</tbody></table></center>";
+        jQuery("#summary").html(html);
+    }
+
     function formatter_table(info, data, since, until) {
         var html = "", i, j, recipe, value;
 
@@ -550,21 +592,47 @@ var results = (function () {
         if (until !== undefined) {
             data.until = Math.ceil(until / 1000);
         }
-        jQuery.ajax({
-            url: '/api/data',
-            data: data,
-            success: function (data) {
-                jQuery("#charts").html("");
-                jQuery("#results").html("");
-                if (!info.www_no_plot) {
-                    formatter_plot(info, data, since, until);
-                }
-                if (!info.www_no_table) {
-                    formatter_table(info, data, since, until);
-                }
-            },
-            dataType: "json"
-        });
+
+        jQuery("#charts").html("");
+        jQuery("#summary").html("");
+        jQuery("#results").html("");
+
+        //
+        // Plots and per-server summaries come from the summaries that
+        // we keep updated when we save results, so their cost does not
+        // depend on how many results we have.  Only the table of the
+        // results needs to fetch the results themselves.
+        //
+        if (!info.www_no_plot) {
+            jQuery.ajax({
+                url: '/api/aggregate',
+                data: jQuery.extend({by: "day"}, data),
+                success: function (summaries) {
+                    formatter_plot(info, summaries, since, until);
+                },
+                dataType: "json"
+            });
+        }
+        if (!info.www_no_split_by_ip) {
+            jQuery.ajax({
+                url: '/api/aggregate',
+                data: {test: info.selected_test, by: "server"},
+                success: function (summaries) {
+                    formatter_summary(info, summaries);
+                },
+                dataType: "json"
+            });
+        }
+        if (!info.www_no_table) {
+            jQuery.ajax({
+                url: '/api/data',
+                data: data,
+                success: function (result) {
+                    formatter_table(info, result, since, until);
+                },
+                dataType: "json"
+            });
+        }
     }
 
     /*
@@ -37,8 +37,12 @@ var LANG = {
 
     'Please insert a valid number': 'Please insert a valid number',
 
+    'Server': 'Server',
+
     'Test running': 'Test running',
 
+    'Tests': 'Tests',
+
     'disabled': 'disabled',
 
     'enabled': 'enabled',
@@ -292,6 +296,8 @@ degli Abruzzi 24, 10129 Turin, ITALY.&quot;\r\n\
  a general overview of the status of the neubot daemon. Above there\
  are a number of tabs, one for each available transmission test.\
  Each tab provides more information on the test and allows you to\
- review your recent results.'
+ review your recent results.',
+
+    'median': 'median'
 
 };
@@ -38,6 +38,9 @@ LANG = {
     'Enable': "Attiva",
     'Disable': "Disattiva",
     'Test running': "Test in corso",
+    'Server': "Server",
+    'Tests': "Test",
+    'median': "mediana",
 
     'Your bittorrent connect time': 'Tempo per connettersi del test bittorrent',
     'Your bittorrent download and upload speed': 'Velocità di download e upload del test bittorrent',
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+
+#
+# Copyright (c) 2013
+#     Nexa Center for Internet & Society, Politecnico di Torino (DAUIN),
+#     and Simone Basso <bassosimone@gmail.com>
+#
+# This file is part of Neubot <http://www.neubot.org/>.
+#
+# Neubot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Neubot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Neubot.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+''' Regression test and memory benchmark for mod_dash/server_smpl.py '''
+
+import os
+import resource
+import select
+import signal
+import socket
+import sys
+import unittest
+
+if __name__ == '__main__':
+    sys.path.insert(0, '.')
+
+from mod_dash.server_smpl import DASHServerSmpl
+from mod_dash.server_smpl import DASH_MAXIMUM_BODY_SIZE
+from neubot.config import CONFIG
+from neubot.net.poller import POLLER
+
+from neubot import utils
+
+# Number of concurrent clients in the memory test
+CLIENTS = 16
+
+# Max growth of the server RSS when serving CLIENTS clients
+MAXGROWTH = 32 << 20
+
+class Server(DASHServerSmpl):
+    ''' Report the port we are listening at '''
+
+    def __init__(self, poller, wfile):
+        DASHServerSmpl.__init__(self, poller)
+        self.wfile = wfile
+
+    def started_listening(self, listener):
+        os.write(self.wfile, '%d %d\n' % (listener.lsock.getsockname()[1],
+                                          _maxrss()))
+
+def _maxrss():
+    ''' Return the peak RSS of this process in bytes '''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def _run_server(wfile):
+    ''' Serve DASH requests until we receive SIGTERM '''
+
+    def report_usage(signo, frame):
+        ''' Write the peak RSS and exit '''
+        os.write(wfile, '%d\n' % _maxrss())
+        os._exit(0)
+
+    signal.signal(signal.SIGTERM, report_usage)
+    server = Server(POLLER, wfile)
+    server.configure(CONFIG.copy())
+    server.listen(('127.0.0.1', 0))
+    POLLER.loop()
+
+class ServerProcess(object):
+    ''' Run the DASH server in a separate process '''
+
+    def __init__(self):
+        rfile, wfile = os.pipe()
+        self.pid = os.fork()
+        if self.pid == 0:
+            try:
+                os.close(rfile)
+                _run_server(wfile)
+            finally:
+                os._exit(1)
+        os.close(wfile)
+        self.rfile = os.fdopen(rfile)
+        port, base = self.rfile.readline().split()
+        self.port, self.base = int(port), int(base)
+
+    def stop(self):
+        ''' Stop the server and return its peak RSS '''
+        os.kill(self.pid, signal.SIGTERM)
+        maxrss = int(self.rfile.readline())
+        os.waitpid(self.pid, 0)
+        return maxrss
+
+class Client(object):
+    ''' Download a DASH body as fast as possible '''
+
+    def __init__(self, port, size):
+        self.sock = socket.create_connection(('127.0.0.1', port))
+        self.sock.sendall('GET /dash/download/%d HTTP/1.1\r\n'
+                          'Host: 127.0.0.1\r\n\r\n' % size)
+        self.sock.setblocking(False)
+        self.headers = ''
+        self.length = -1
+        self.received = 0
+        self.distinct = set()
+
+    def fileno(self):
+        ''' Return the socket file number '''
+        return self.sock.fileno()
+
+    def handle_read(self):
+        ''' Receive data and return True when done '''
+        data = self.sock.recv(1 << 20)
+        if not data:
+            raise RuntimeError('unexpected EOF')
+        if self.length < 0:
+            self.headers += data
+            if '\r\n\r\n' not in self.headers:
+                return False
+            self.headers, data = self.headers.split('\r\n\r\n', 1)
+            for line in self.headers.split('\r\n'):
+                if line.lower().startswith('content-length:'):
+                    self.length = int(line.split(':', 1)[1])
+        if len(self.distinct) < 256:
+            self.distinct.update(data[:4096])
+        self.received += len(data)
+        if self.received >= self.length:
+            self.sock.close()
+            return True
+        return False
+
+def _download(port, clients, size):
+    ''' Run clients concurrent downloads and return them '''
+    pending = [Client(port, size) for _ in range(clients)]
+    done = []
+    while pending:
+        for client in select.select(pending, [], [])[0]:
+            if client.handle_read():
+                pending.remove(client)
+                done.append(client)
+    return done
+
+class TestDASHServer(unittest.TestCase):
+    ''' Make sure the DASH server streams its body '''
+
+    def test_body(self):
+        ''' Make sure we receive the requested amount of random data '''
+        server = ServerProcess()
+        for size in (0, 1000, 1 << 20):
+            client = _download(server.port, 1, size)[0]
+            self.assertTrue(client.headers.startswith('HTTP/1.1 200 Ok'))
+            self.assertEqual(client.length, size)
+            self.assertEqual(client.received, size)
+            if size >= 4096:
+                self.assertTrue(len(client.distinct) > 200)
+        server.stop()
+
+    def test_maximum_size(self):
+        ''' Make sure we clamp the body size '''
+        server = ServerProcess()
+        client = Client(server.port, DASH_MAXIMUM_BODY_SIZE + 1)
+        client.sock.setblocking(True)
+        while client.length < 0:
+            client.handle_read()
+        client.sock.close()
+        self.assertEqual(client.length, DASH_MAXIMUM_BODY_SIZE)
+        server.stop()
+
+    def test_memory(self):
+        ''' Make sure peak RSS stays flat with many concurrent clients '''
+        server = ServerProcess()
+        _download(server.port, 1, DASH_MAXIMUM_BODY_SIZE)
+        _download(server.port, CLIENTS, DASH_MAXIMUM_BODY_SIZE)
+        maxrss = server.stop()
+        self.assertTrue(maxrss - server.base < MAXGROWTH)
+
+def benchmark():
+    ''' Measure the server peak RSS with an increasing number of clients '''
+    sys.stdout.write('Serving %s DASH bodies over loopback:\n' %
+      utils.unit_formatter(DASH_MAXIMUM_BODY_SIZE, unit='B'))
+    for clients in (1, 4, CLIENTS):
+        server = ServerProcess()
+        begin = utils.ticks()
+        _download(server.port, clients, DASH_MAXIMUM_BODY_SIZE)
+        elapsed = utils.ticks() - begin
+        maxrss = server.stop()
+        sys.stdout.write('  %2d clients: max RSS %s (+%s), %s\n' % (clients,
+          utils.unit_formatter(maxrss, unit='B'),
+          utils.unit_formatter(maxrss - server.base, unit='B'),
+          utils.speed_formatter(clients * DASH_MAXIMUM_BODY_SIZE / elapsed)))
+
+if __name__ == '__main__':
+    benchmark()
+    unittest.main()
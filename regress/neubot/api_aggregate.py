@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+
+#
+# Copyright (c) 2013
+#     Nexa Center for Internet & Society, Politecnico di Torino (DAUIN),
+#     and Simone Basso <bassosimone@gmail.com>
+#
+# This file is part of Neubot <http://www.neubot.org/>.
+#
+# Neubot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Neubot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Neubot.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+''' Regression test and benchmark for neubot/api_aggregate.py '''
+
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import unittest
+
+if __name__ == '__main__':
+    sys.path.insert(0, '.')
+
+from neubot.compat import json
+from neubot.database import DATABASE
+from neubot.database import table_aggregate
+from neubot.database import table_speedtest
+from neubot.http.message import Message
+from neubot.utils_api import NotImplementedTest
+
+from neubot import api_aggregate
+from neubot import api_data
+from neubot import api_results
+from neubot import percentile
+from neubot import utils
+
+#
+# We're accessing private methods and we don't maintain
+# unittest, so we don't care about the number of methods.
+#
+# pylint: disable=W0212,R0904
+#
+
+# Results are one every PERIOD seconds, starting at BEGIN
+BEGIN = 1356998400
+PERIOD = 600
+DAY = 86400
+SERVERS = ('194.116.85.211', '194.116.85.224', '130.192.91.231')
+
+def _result(index, rng):
+    ''' Create a speedtest result '''
+    return {
+        'timestamp': BEGIN + index * PERIOD,
+        'uuid': '0964312e-f451-4579-9984-3954dcfdeb42',
+        'internal_address': '192.168.1.2',
+        'real_address': '130.192.91.211',
+        'remote_address': SERVERS[index % len(SERVERS)],
+        'privacy_informed': 1,
+        'privacy_can_collect': 1,
+        'privacy_can_publish': 1,
+        'connect_time': rng.lognormvariate(-4, 0.5),
+        'download_speed': rng.lognormvariate(14, 1),
+        'upload_speed': rng.lognormvariate(12, 1),
+        'latency': rng.lognormvariate(-4, 0.5),
+        'platform': 'linux2',
+        'neubot_version': '0.004016007',
+        'test_version': 1,
+    }
+
+def _prefill(path, count):
+    ''' Create a speedtest table with count results '''
+    rng = random.Random(17)
+    connection = sqlite3.connect(path)
+    connection.execute(table_speedtest.CREATE_TABLE)
+    connection.executemany(table_speedtest.INSERT_INTO,
+                           (_result(index, rng) for index in xrange(count)))
+    connection.commit()
+    connection.close()
+
+class FakeStream(object):
+    ''' Fake HTTP stream '''
+
+    def __init__(self):
+        self.body = None
+
+    def send_response(self, request, response):
+        ''' Read the whole response '''
+        if isinstance(response.body, basestring):
+            self.body = response.body
+            return
+        vector = []
+        while True:
+            octets = response.body.read(262144)
+            if not octets:
+                break
+            vector.append(octets)
+        self.body = ''.join(vector)
+
+def _get(function, query):
+    ''' Invoke an API and return the body '''
+    stream = FakeStream()
+    # With HTTP/1.0 /api/data does not use chunked
+    function(stream, Message(protocol='HTTP/1.0'), query)
+    return stream.body
+
+def load_page(count):
+    ''' Load the results page as it would be with count results, i.e.
+        its description, the per-day summaries of the last month, the
+        per-server summaries and the results of the last week '''
+    last = BEGIN + (count - 1) * PERIOD
+    vector = [
+        _get(api_results.api_results, 'test=speedtest'),
+        _get(api_aggregate.api_aggregate, 'test=speedtest&by=day&since=%d'
+             % (last - 30 * DAY)),
+        _get(api_aggregate.api_aggregate, 'test=speedtest&by=server'),
+        _get(api_data.api_data, 'test=speedtest&since=%d' % (last - 7 * DAY)),
+    ]
+    return vector
+
+def load_page_legacy():
+    ''' Load the results page as before, i.e. reading the description
+        of the test and all the results, and computing the per-day
+        and per-server medians from the results '''
+    api_results.CACHE.clear()
+    _get(api_results.api_results, 'test=speedtest')
+    results = json.loads(_get(api_data.api_data, 'test=speedtest'))
+    for kind in table_aggregate.KINDS:
+        groups = {}
+        for result in results:
+            key = table_aggregate._key(kind, result)
+            groups.setdefault(key, []).append(result['download_speed'])
+        for values in groups.values():
+            percentile.median(values)
+
+class TestAPIAggregate(unittest.TestCase):
+    ''' Regression test for /api/aggregate '''
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        DATABASE.set_path(os.path.join(self.tempdir, 'database.sqlite3'))
+        self.connection = DATABASE.connection()
+        rng = random.Random(17)
+        for index in range(300):
+            table_speedtest.insert(self.connection, _result(index, rng),
+                                   override_timestamp=False)
+
+    def tearDown(self):
+        DATABASE.close()
+        shutil.rmtree(self.tempdir)
+
+    def test_api(self):
+        ''' Make sure the API returns the summaries '''
+        body = json.loads(_get(api_aggregate.api_aggregate,
+                               'test=speedtest&by=server'))
+        self.assertEqual(body, json.loads(json.dumps(table_aggregate.listify(
+                         self.connection, 'speedtest', 'server'))))
+        self.assertEqual(sum([elem['count'] for elem in body]), 300)
+        body = json.loads(_get(api_aggregate.api_aggregate,
+          'test=speedtest&since=%d&until=%d' % (BEGIN + DAY, BEGIN + DAY)))
+        self.assertEqual([elem['key'] for elem in body], ['2013-01-02'])
+        self.assertEqual(body[0]['count'], DAY / PERIOD)
+        self.assertEqual(json.loads(_get(api_aggregate.api_aggregate,
+                         'test=nonexistent')), [])
+        self.assertRaises(NotImplementedTest, _get,
+                          api_aggregate.api_aggregate, 'test=speedtest&by=x')
+
+    def test_cache(self):
+        ''' Make sure we read again changed descriptions '''
+        api_results.CACHE.clear()
+        path = os.path.join(self.tempdir, 'description')
+        for content in ('{}', '{"x": 1}', '{"y": 2}'):
+            filep = open(path, 'wb')
+            filep.write(content)
+            filep.close()
+            os.utime(path, (0, time.time() + len(content)))
+            self.assertEqual(api_results._read_cached(path), content)
+        self.assertEqual(len(api_results.CACHE), 1)
+
+class TestPageLoad(unittest.TestCase):
+    ''' Make sure the results page loads quickly '''
+
+    def test_page_load(self):
+        ''' Make sure we load the page in less than one second with
+            100000 results '''
+        tempdir = tempfile.mkdtemp()
+        _prefill(os.path.join(tempdir, 'database.sqlite3'), 100000)
+        DATABASE.set_path(os.path.join(tempdir, 'database.sqlite3'))
+        DATABASE.connection()
+        while DATABASE.summarize():
+            pass
+        try:
+            load_page(100000)
+            begin = utils.ticks()
+            vector = load_page(100000)
+            elapsed = utils.ticks() - begin
+            self.assertTrue(elapsed < 1.0, elapsed)
+            self.assertEqual(len(json.loads(vector[2])), len(SERVERS))
+            self.assertEqual(len(json.loads(vector[3])), 7 * DAY / PERIOD + 1)
+        finally:
+            DATABASE.close()
+            shutil.rmtree(tempdir)
+
+def benchmark():
+    ''' Compare the results page load time before and after '''
+    sys.stdout.write('Results page load time:\n')
+    for count in (10000, 100000):
+        tempdir = tempfile.mkdtemp()
+        _prefill(os.path.join(tempdir, 'database.sqlite3'), count)
+        DATABASE.set_path(os.path.join(tempdir, 'database.sqlite3'))
+        begin = utils.ticks()
+        DATABASE.connection()
+        while DATABASE.summarize():
+            pass
+        summarize = utils.ticks() - begin
+        begin = utils.ticks()
+        load_page_legacy()
+        legacy = utils.ticks() - begin
+        load_page(count)
+        begin = utils.ticks()
+        load_page(count)
+        elapsed = utils.ticks() - begin
+        DATABASE.close()
+        shutil.rmtree(tempdir)
+        sys.stdout.write('  %6d results: before %s, after %s (one-time '
+          'summary of existing results %s)\n' % (count,
+          utils.time_formatter(legacy), utils.time_formatter(elapsed),
+          utils.time_formatter(summarize)))
+
+if __name__ == '__main__':
+    benchmark()
+    unittest.main()
@@ -0,0 +1,377 @@
+#!/usr/bin/env python
+
+#
+# Copyright (c) 2013
+#     Nexa Center for Internet & Society, Politecnico di Torino (DAUIN),
+#     and Simone Basso <bassosimone@gmail.com>
+#
+# This file is part of Neubot <http://www.neubot.org/>.
+#
+# Neubot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Neubot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Neubot.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+''' Regression test and benchmark for neubot/api_data.py '''
+
+import os
+import resource
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+import urlparse
+
+if __name__ == '__main__':
+    sys.path.insert(0, '.')
+
+from neubot.backend import BACKEND
+from neubot.compat import json
+from neubot.database import DATABASE
+from neubot.database import table_speedtest
+from neubot.http.message import Message
+from neubot.json_stream import JSONStream
+
+from neubot import api_data
+from neubot import utils
+
+#
+# We're accessing private methods and we don't maintain
+# unittest, so we don't care about the number of methods.
+#
+# pylint: disable=W0212,R0904
+#
+
+# Results are one every PERIOD seconds, starting at BEGIN
+BEGIN = 1356998400
+PERIOD = 31
+
+# What the stream code reads at a time
+MAXBUF = 262144
+
+def _result(index, timestamp=None):
+    ''' Create a speedtest result '''
+    if timestamp is None:
+        timestamp = BEGIN + index * PERIOD
+    return {
+        'timestamp': timestamp,
+        'uuid': '0964312e-f451-4579-9984-3954dcfdeb42',
+        'internal_address': '192.168.1.2',
+        'real_address': '130.192.91.211',
+        'remote_address': '194.116.85.211',
+        'privacy_informed': 1,
+        'privacy_can_collect': 1,
+        'privacy_can_publish': 1,
+        'connect_time': 0.0123,
+        'download_speed': 1187400.0 + index,
+        'upload_speed': 456000.0,
+        'latency': 0.0241,
+        'platform': 'linux2',
+        'neubot_version': '0.004016007',
+        'test_version': 1,
+    }
+
+def _prefill(path, results):
+    ''' Create a speedtest table containing results '''
+    connection = sqlite3.connect(path)
+    connection.execute(table_speedtest.CREATE_TABLE)
+    connection.execute(table_speedtest.CREATE_INDEX)
+    connection.executemany(table_speedtest.INSERT_INTO, results)
+    connection.commit()
+    connection.close()
+
+def _dechunk(data):
+    ''' Decode chunked data '''
+    vector = []
+    while True:
+        index = data.index('\r\n')
+        length = int(data[:index], 16)
+        if length == 0:
+            if data[index:] != '\r\n\r\n':
+                raise RuntimeError('Invalid last chunk')
+            return ''.join(vector)
+        vector.append(data[index + 2:index + 2 + length])
+        if data[index + 2 + length:index + 4 + length] != '\r\n':
+            raise RuntimeError('Invalid chunk end')
+        data = data[index + 4 + length:]
+
+class FakeStream(object):
+    ''' Fake HTTP stream '''
+
+    def __init__(self, keep=True):
+        self.keep = keep
+        self.response = None
+        self.body = []
+        self.total = 0
+
+    def send_response(self, request, response):
+        ''' Consume the response as the stream would '''
+        self.response = response
+        if isinstance(response.body, basestring):
+            self.total = len(response.body)
+            return
+        while True:
+            octets = response.body.read(MAXBUF)
+            if not octets:
+                break
+            self.total += len(octets)
+            if self.keep:
+                self.body.append(octets)
+
+def _get(query, protocol='HTTP/1.1', keep=True):
+    ''' Invoke /api/data and return the stream '''
+    request = Message(protocol=protocol)
+    stream = FakeStream(keep)
+    api_data.api_data(stream, request, query)
+    return stream
+
+def _get_json(query):
+    ''' Invoke /api/data and return the list and the next query '''
+    stream = _get(query)
+    body = _dechunk(''.join(stream.body))
+    link = stream.response['link']
+    if link:
+        link = urlparse.urlsplit(link[1:link.index('>')])[3]
+    return json.loads(body), link
+
+def _get_all(query):
+    ''' Read all the pages, and return results and pages '''
+    results, pages = [], 0
+    while query:
+        page, query = _get_json(query)
+        results.extend(page)
+        pages += 1
+    return results, pages
+
+class TestJSONStream(unittest.TestCase):
+    ''' Regression test for JSONStream '''
+
+    def test_compact(self):
+        ''' Make sure the compact output is the same of json.dumps() '''
+        for count in (0, 1, 2, 1000):
+            lst = [_result(index) for index in range(count)]
+            for size in (1, 100, MAXBUF):
+                stream = JSONStream(iter(lst), chunked=False)
+                vector = []
+                while True:
+                    octets = stream.read(size)
+                    if not octets:
+                        break
+                    vector.append(octets)
+                self.assertEqual(''.join(vector), json.dumps(lst))
+
+    def test_indent(self):
+        ''' Make sure the indented output is equivalent '''
+        for count in (0, 1, 5):
+            lst = [_result(index) for index in range(count)]
+            stream = JSONStream(lst, chunked=False, indent=4, sort_keys=True)
+            string = stream.read()
+            self.assertEqual(stream.read(), '')
+            self.assertEqual(json.loads(string), lst)
+            self.assertEqual(string.splitlines()[1:3], json.dumps(lst,
+                             indent=4, sort_keys=True).splitlines()[1:3])
+
+    def test_chunked(self):
+        ''' Make sure we frame chunks correctly '''
+        lst = [_result(index) for index in range(100)]
+        stream = JSONStream(lst)
+        vector = []
+        while True:
+            octets = stream.read(1024)
+            if not octets:
+                break
+            vector.append(octets)
+        self.assertTrue(len(vector) > 1)
+        self.assertEqual(_dechunk(''.join(vector)), json.dumps(lst))
+
+class TestAPIData(unittest.TestCase):
+    ''' Regression test for /api/data '''
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        results = [_result(index) for index in range(1000)]
+        # Lots of results with the same timestamp
+        results.extend([_result(index, BEGIN + 500 * PERIOD)
+                        for index in range(1000, 1100)])
+        _prefill(os.path.join(self.tempdir, 'database.sqlite3'), results)
+        DATABASE.set_path(os.path.join(self.tempdir, 'database.sqlite3'))
+        self.connection = DATABASE.connection()
+
+    def tearDown(self):
+        DATABASE.close()
+        shutil.rmtree(self.tempdir)
+
+    def test_unchanged(self):
+        ''' Make sure the whole table is what we returned before '''
+        for query in ('test=speedtest',
+                      'test=speedtest&since=%d' % (BEGIN + 700 * PERIOD),
+                      'test=speedtest&since=%d&until=%d' % (BEGIN,
+                                                      BEGIN + 501 * PERIOD)):
+            expect = dict(urlparse.parse_qsl(query))
+            expect = table_speedtest.listify(self.connection,
+                                             int(expect.get('since', -1)),
+                                             int(expect.get('until', -1)))
+            stream = _get(query)
+            self.assertEqual(stream.response['transfer-encoding'], 'chunked')
+            self.assertEqual(stream.response['link'], '')
+            result = json.loads(_dechunk(''.join(stream.body)))
+            self.assertEqual(sorted(result), sorted(expect))
+            self.assertEqual([elem['timestamp'] for elem in result],
+                             [elem['timestamp'] for elem in expect])
+            # As before, from the newest to the oldest one
+            timestamps = [elem['timestamp'] for elem in result]
+            self.assertEqual(timestamps, sorted(timestamps, reverse=True))
+
+    def test_pagination(self):
+        ''' Make sure pages don't overlap and don't miss results '''
+        expect = table_speedtest.listify(self.connection)
+        for limit in (1, 7, 64, 1099, 1100, 5000):
+            results, pages = _get_all('test=speedtest&limit=%d' % limit)
+            self.assertEqual(pages, max(1, (1100 + limit - 1) // limit))
+            self.assertEqual(sorted(results), sorted(expect))
+            self.assertEqual([elem['timestamp'] for elem in results],
+                             [elem['timestamp'] for elem in expect])
+
+        expect = table_speedtest.listify(self.connection, BEGIN + 400 * PERIOD,
+                                         BEGIN + 600 * PERIOD)
+        results, _ = _get_all('test=speedtest&limit=9&since=%d&until=%d' % (
+                              BEGIN + 400 * PERIOD, BEGIN + 600 * PERIOD))
+        self.assertEqual(sorted(results), sorted(expect))
+
+    def test_stable(self):
+        ''' Make sure new results don't shift the pages '''
+        page, query = _get_json('test=speedtest&limit=50')
+        for index in range(2000, 2100):
+            table_speedtest.insert(self.connection, _result(index),
+                                   override_timestamp=False)
+        results = page + _get_all(query)[0]
+        self.assertEqual(len(results), 1100)
+
+    def test_generic(self):
+        ''' Make sure we paginate generic tests '''
+        BACKEND.use_backend('volatile')
+        try:
+            for index in range(100):
+                BACKEND.store_generic('dash', {'timestamp': index // 3,
+                                               'index': index})
+            expect = list(BACKEND.walk_generic_range('dash', -1, -1))
+            self.assertEqual(_get_all('test=dash')[0], expect)
+            for limit in (1, 2, 3, 10):
+                results, pages = _get_all('test=dash&limit=%d' % limit)
+                self.assertEqual(results, expect)
+                self.assertEqual(pages, (100 + limit - 1) // limit)
+            results = _get_all('test=dash&limit=4&since=10&until=20')[0]
+            self.assertEqual(results, list(BACKEND.walk_generic_range('dash',
+                                                                 10, 20)))
+        finally:
+            BACKEND.use_backend('neubot')
+
+    def test_http10(self):
+        ''' Make sure we don't use chunked with HTTP/1.0 clients '''
+        stream = _get('test=speedtest', 'HTTP/1.0')
+        self.assertEqual(stream.response['transfer-encoding'], '')
+        self.assertEqual(stream.response['connection'], 'close')
+        self.assertEqual(len(json.loads(''.join(stream.body))), 1100)
+
+    def test_invalid(self):
+        ''' Make sure we reject invalid parameters '''
+        for query in ('test=speedtest&limit=x', 'test=speedtest&cursor=1',
+                      'test=speedtest&cursor=1:-1'):
+            self.assertRaises(ValueError, _get, query)
+
+#
+# Memory benchmark: in a child process, we read the whole speedtest
+# table through /api/data, and we measure how much the peak memory
+# grows, as a function of the number of results, first as the old code
+# did (i.e. building the whole list and serializing it) and then with
+# the streaming code.  Note that a forked child inherits the peak of
+# its parent, so the parent creates the databases without loading
+# results into memory.
+#
+
+def _maxrss():
+    ''' Return the peak memory usage in bytes '''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def _legacy(stream, request, query):
+    ''' The old /api/data '''
+    lst = table_speedtest.listify(DATABASE.connection())
+    response = Message()
+    response.compose(code='200', reason='Ok', body=json.dumps(lst),
+                     mimetype='application/json')
+    stream.send_response(request, response)
+
+def measure_memory(path, legacy):
+    ''' Return peak memory growth, elapsed time and bytes '''
+    rfile, wfile = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(rfile)
+            DATABASE.set_path(path)
+            DATABASE.connection()
+            base = _maxrss()
+            begin = utils.ticks()
+            stream = FakeStream(False)
+            if legacy:
+                _legacy(stream, Message(), 'test=speedtest')
+            else:
+                api_data.api_data(stream, Message(), 'test=speedtest')
+            elapsed = utils.ticks() - begin
+            os.write(wfile, '%d %f %d\n' % (_maxrss() - base, elapsed,
+                                             stream.total))
+        finally:
+            os._exit(0)
+    os.close(wfile)
+    rfilep = os.fdopen(rfile)
+    growth, elapsed, total = rfilep.read().split()
+    rfilep.close()
+    os.waitpid(pid, 0)
+    return int(growth), float(elapsed), int(total)
+
+def _create(count):
+    ''' Create a database with count results '''
+    tempdir = tempfile.mkdtemp()
+    path = os.path.join(tempdir, 'database.sqlite3')
+    _prefill(path, (_result(index) for index in xrange(count)))
+    return tempdir, path
+
+class TestMemory(unittest.TestCase):
+    ''' Make sure memory does not depend on the number of results '''
+
+    def test_memory(self):
+        ''' Make sure memory does not grow with the number of results '''
+        growth = []
+        for count in (10000, 100000):
+            tempdir, path = _create(count)
+            growth.append(measure_memory(path, False)[0])
+            shutil.rmtree(tempdir)
+        # The difference is smaller than the response for 100000 results
+        self.assertTrue(growth[1] - growth[0] < 4 * 1024 * 1024)
+
+def benchmark():
+    ''' Compare the old and the new /api/data '''
+    sys.stdout.write('Peak memory growth and time to read a whole table:\n')
+    for count in (10000, 100000, 300000):
+        tempdir, path = _create(count)
+        for name, legacy in (('before', True), ('streaming', False)):
+            growth, elapsed, total = measure_memory(path, legacy)
+            sys.stdout.write('  %6d results, %-9s: %s in %s (response %s)\n'
+              % (count, name, utils.unit_formatter(growth, unit='B'),
+                 utils.time_formatter(elapsed),
+                 utils.unit_formatter(total, unit='B')))
+        shutil.rmtree(tempdir)
+
+if __name__ == '__main__':
+    benchmark()
+    unittest.main()
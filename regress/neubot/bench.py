@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+
+#
+# Copyright (c) 2013
+#     Nexa Center for Internet & Society, Politecnico di Torino (DAUIN),
+#     and Simone Basso <bassosimone@gmail.com>
+#
+# This file is part of Neubot <http://www.neubot.org/>.
+#
+# Neubot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Neubot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Neubot.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+''' Regression test for neubot/bench.py '''
+
+import socket
+import struct
+import sys
+import unittest
+
+if __name__ == '__main__':
+    sys.path.insert(0, '.')
+
+from neubot import bench
+from neubot import utils
+
+#
+# We're accessing private methods and we don't maintain
+# unittest, so we don't care about the number of methods.
+#
+# pylint: disable=W0212,R0904
+#
+
+class Recorder(bench.Client):
+    ''' Record the frames we receive '''
+
+    def __init__(self):
+        bench.Client.__init__(self, {})
+        self.frames = []
+
+    def got_frame(self, connection, length, code):
+        self.frames.append((length, code))
+
+class TestFramedConnection(unittest.TestCase):
+    ''' Make sure we split frames correctly '''
+
+    def setUp(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(1)
+        self.client = Recorder()
+        self.connection = bench.FramedConnection(self.client,
+          self.listener.getsockname()[1], 3)
+
+    def tearDown(self):
+        self.connection.close()
+        self.listener.close()
+
+    def test_frames(self):
+        ''' Make sure we get the same frames with any fragmentation '''
+        data = ''.join(('xyz', struct.pack('!I', 3), 'abc',
+                        struct.pack('!I', 0), struct.pack('!I', 1), 'q',
+                        struct.pack('!I', 1000), 'P' * 1000,
+                        struct.pack('!I', 0)))
+        expected = [(3, 'a'), (0, ''), (1, 'q'), (1000, 'P'), (0, '')]
+        for size in (1, 2, 3, 5, 7, len(data)):
+            self.setUp()
+            for index in range(0, len(data), size):
+                self.connection.received(data[index:index + size])
+            self.assertEqual(self.client.frames, expected, size)
+            self.tearDown()
+
+#
+# We run each test for a short time, and we check that the clients
+# transfer data, complete sessions (except for the raw test, whose
+# sessions take ten seconds) and don't see errors.
+#
+
+RUNS = {}
+
+def run(test, clients, duration):
+    ''' Run a test (only once) '''
+    if (test, clients, duration) not in RUNS:
+        RUNS[(test, clients, duration)] = bench.run(test, clients, duration)
+    return RUNS[(test, clients, duration)]
+
+class TestBench(unittest.TestCase):
+    ''' Make sure each test works against the servers '''
+
+    def _check(self, test, sessions=True):
+        ''' Run test and check the results '''
+        result = run(test, 2, 1.0)
+        self.assertEqual(result['test'], test)
+        self.assertEqual(result['clients'], 2)
+        self.assertEqual(result['errors'], 0)
+        self.assertTrue(result['bytes'] > 0)
+        self.assertEqual(result['sessions'] > 0, sessions)
+        self.assertTrue(result['cpu'] > 0)
+        self.assertTrue(result['cpu_per_byte'] > 0)
+        self.assertTrue(result['max_rss'] > 0)
+        self.assertTrue(0 <= result['loop_latency_median'] <=
+                        result['loop_latency_p99'] <=
+                        result['loop_latency_max'])
+
+    def test_negotiate(self):
+        ''' Make sure the negotiate clients work '''
+        self._check('negotiate')
+
+    def test_speedtest(self):
+        ''' Make sure the speedtest clients work '''
+        self._check('speedtest')
+
+    def test_bittorrent(self):
+        ''' Make sure the BitTorrent clients work '''
+        self._check('bittorrent', False)
+
+    def test_raw(self):
+        ''' Make sure the raw test clients work '''
+        self._check('raw', False)
+
+    def test_dash(self):
+        ''' Make sure the DASH clients work '''
+        self._check('dash')
+
+def benchmark():
+    ''' Run each test with 2 clients for one second '''
+    sys.stdout.write('Loopback benchmark (2 clients, 1 s):\n')
+    for test in bench.TESTS:
+        result = run(test, 2, 1.0)
+        sys.stdout.write('  %-10s: %s, %.2f ns/byte, %d sessions, loop '
+          'p99 %s, max RSS %s\n' % (test,
+          utils.speed_formatter(result['throughput']),
+          result['cpu_per_byte'] * 1e09, result['sessions'],
+          utils.time_formatter(result['loop_latency_p99']),
+          utils.unit_formatter(result['max_rss'], unit='B')))
+
+if __name__ == '__main__':
+    benchmark()
+    unittest.main()
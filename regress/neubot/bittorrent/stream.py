@@ -22,6 +22,7 @@
 
 import StringIO
 import random
+import resource
 import struct
 import sys
 import unittest
@@ -30,6 +31,10 @@ if __name__ == "__main__":
     sys.path.insert(0, ".")
 
 from neubot.bittorrent import stream
+from neubot.bittorrent.config import PIECE_LEN
+from neubot.utils_random import PAYLOAD
+
+from neubot import utils
 
 #
 #   ____                     _       _
@@ -326,5 +331,197 @@ class TestOtherMessagesProcessing(unittest.TestCase):
     def got_piece(self, s, i, a, b):
         pass
 
+#
+#  ____                          _   _        _
+# |  _ \  ___   _   _  _ __    __| | | |_  _ __ (_) _ __
+# | |_) |/ _ \ | | | || '_ \  / _` | | __|| '__|| || '_ \
+# |  _ <| (_) || |_| || | | || (_| | | |_ | |   | || |_) |
+# |_| \_\\___/  \__,_||_| |_| \__,_|  \__||_|   |_|| .__/
+#                                                  |_|
+#
+# This section makes sure that what we send is what we receive,
+# for all the messages we can send, including big messages, that
+# are passed upstream without being reassembled.
+#
+
+class RoundTripPeer(object):
+    """Records the messages received by the stream"""
+
+    def __init__(self):
+        # So that the bitfield is a big message
+        self.numpieces = 16 * stream.SMALLMESSAGE
+        self.infohash = chr(0) * 20
+        self.my_id = chr(0) * 20
+        self.received = []
+
+    def connection_ready(self, s):
+        pass
+    def got_choke(self, s):
+        self.received.append(("choke",))
+    def got_unchoke(self, s):
+        self.received.append(("unchoke",))
+    def got_interested(self, s):
+        self.received.append(("interested",))
+    def got_not_interested(self, s):
+        self.received.append(("not_interested",))
+    def got_have(self, i):
+        self.received.append(("have", i))
+    def got_bitfield(self, b):
+        self.received.append(("bitfield", b))
+    def got_request(self, s, i, a, b):
+        self.received.append(("request", i, a, b))
+    def got_piece(self, s, i, a, b):
+        self.received.append(("piece", i, a,
+                              "".join([str(elem) for elem in b])))
+
+def _sender(parent):
+    """Return a stream that records what it sends"""
+    s = stream.StreamBitTorrent(None)
+    s.parent = parent
+    s.sent = []
+    s.start_send = s.sent.append
+    return s
+
+class TestRoundTrip(unittest.TestCase):
+
+    def setUp(self):
+        self.peer = RoundTripPeer()
+        self.sender = _sender(self.peer)
+        self.expected = []
+
+        self.sender._send_handshake()
+        small = PAYLOAD.read(1000)
+        large = PAYLOAD.get(PIECE_LEN)
+        bitfield = "\x0f" * (self.peer.numpieces // 8)
+        last = self.peer.numpieces - 1
+
+        self.sender.send_bitfield(bitfield)
+        self.expected.append(("bitfield", bitfield))
+        self.sender.send_interested()
+        self.expected.append(("interested",))
+        self.sender.send_unchoke()
+        self.expected.append(("unchoke",))
+        self.sender.send_keepalive()
+        self.sender.send_request(7, 0, PIECE_LEN)
+        self.expected.append(("request", 7, 0, PIECE_LEN))
+        self.sender.send_piece(7, 0, large)
+        self.expected.append(("piece", 7, 0, str(large)))
+        self.sender.send_have(3)
+        self.expected.append(("have", 3))
+        self.sender.send_piece(9, 17, small)
+        self.expected.append(("piece", 9, 17, small))
+        self.sender.send_cancel(7, 0, PIECE_LEN)
+        self.sender.send_piece(last, PIECE_LEN, large)
+        self.expected.append(("piece", last, PIECE_LEN, str(large)))
+        self.sender.send_choke()
+        self.expected.append(("choke",))
+        self.sender.send_not_interested()
+        self.expected.append(("not_interested",))
+
+        self.data = "".join([str(elem) for elem in self.sender.sent])
+
+    def _receive(self, chunks):
+        receiver = stream.StreamBitTorrent(None)
+        receiver.parent = self.peer
+        receiver.start_recv = lambda: None
+        for chunk in chunks:
+            receiver.recv_complete(chunk)
+        self.assertEqual(self.peer.received, self.expected)
+        self.assertEqual(receiver.left, 0)
+        self.assertEqual(receiver.count, 0)
+        self.assertEqual(receiver.piece, None)
+
+    def test_single_buffer(self):
+        """Make sure we receive what we send in a single buffer"""
+        self._receive([self.data])
+
+    def test_random_chunks(self):
+        """Make sure we receive what we send in random-sized chunks"""
+        for _ in range(8):
+            chunks, offset = [], 0
+            while offset < len(self.data):
+                amt = random.choice((1, 3, 9, 13, 1460, 65536))
+                chunks.append(buffer(self.data, offset, amt))
+                offset += amt
+            del self.peer.received[:]
+            self._receive(chunks)
+
+    def test_piece_is_not_copied(self):
+        """Make sure send_piece() does not copy the block"""
+        block = PAYLOAD.get(PIECE_LEN)
+        self.sender.sent = []
+        self.sender.start_send = self.sender.sent.append
+        self.sender.send_piece(5, 0, block)
+        self.assertEqual(len(self.sender.sent), 2)
+        self.assertEqual(len(self.sender.sent[0]), 4 + stream.PIECE_HEADER)
+        self.assertTrue(self.sender.sent[1] is block)
+
+    def test_bad_piece_index(self):
+        """Make sure we reject big PIECE with invalid index"""
+        sender = _sender(self.peer)
+        sender.send_piece(self.peer.numpieces, 0, PAYLOAD.get(PIECE_LEN))
+        receiver = stream.StreamBitTorrent(None)
+        receiver.parent = self.peer
+        receiver.complete = True
+        self.assertRaises(RuntimeError, receiver.recv_complete,
+                          "".join([str(elem) for elem in sender.sent]))
+
+#
+#  ____                     _                            _
+# | __ )   ___  _ __    ___ | |__   _ __ ___    __ _  _ __| | __
+# |  _ \  / _ \| '_ \  / __|| '_ \ | '_ ` _ \  / _` || '__| |/ /
+# | |_) ||  __/| | | || (__ | | | || | | | | || (_| || |  |   <
+# |____/  \___||_| |_| \___||_| |_||_| |_| |_| \__,_||_|  |_|\_\
+#
+# This section measures the CPU cost of framing PIECE messages, i.e.
+# of sending them and of parsing them, in MByte per CPU second.
+#
+
+BENCH_BYTES = 256 << 20
+RECV_SIZE = 1 << 18
+
+class BenchmarkPeer(object):
+    numpieces = 1 << 20
+    def got_piece(self, s, i, a, b):
+        pass
+
+def _cputime():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+def benchmark():
+    """Measure the CPU cost of framing PIECE messages"""
+
+    count = BENCH_BYTES // PIECE_LEN
+    block = PAYLOAD.read(PIECE_LEN)
+    sender = _sender(BenchmarkPeer())
+    begin = _cputime()
+    for index in range(count):
+        sender.send_piece(index, 0, block)
+    send_time = _cputime() - begin
+
+    data = "".join([str(elem) for elem in sender.sent[:64]])
+    chunks = [data[offset:offset + RECV_SIZE]
+              for offset in range(0, len(data), RECV_SIZE)]
+    receiver = stream.StreamBitTorrent(None)
+    receiver.parent = BenchmarkPeer()
+    receiver.complete = True
+    receiver.left = 0
+    receiver.start_recv = lambda: None
+    begin = _cputime()
+    for _ in range(count // 64):
+        for chunk in chunks:
+            receiver.recv_complete(chunk)
+    recv_time = _cputime() - begin
+
+    megabytes = BENCH_BYTES / float(1 << 20)
+    sys.stdout.write("Framing %s in %s PIECE messages:\n" % (
+      utils.unit_formatter(BENCH_BYTES, unit="B"),
+      utils.unit_formatter(PIECE_LEN, unit="B")))
+    for name, elapsed in (("send", send_time), ("recv", recv_time)):
+        sys.stdout.write("  %s: %.0f MByte per CPU second\n" % (name,
+                         megabytes / max(elapsed, 0.001)))
+
 if __name__ == "__main__":
+    benchmark()
     unittest.main()
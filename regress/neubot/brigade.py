@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+
+#
+# Copyright (c) 2013
+#     Nexa Center for Internet & Society, Politecnico di Torino (DAUIN),
+#     and Simone Basso <bassosimone@gmail.com>
+#
+# This file is part of Neubot <http://www.neubot.org/>.
+#
+# Neubot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Neubot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Neubot.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+''' Regression test for neubot/brigade.py '''
+
+import random
+import sys
+import unittest
+
+if __name__ == '__main__':
+    sys.path.insert(0, '.')
+
+from neubot.brigade import Brigade
+from neubot.brigade import SliceBrigade
+from neubot.bufpool import BufferPool
+from neubot.bufpool import Slice
+
+#
+# We're accessing private methods and we don't maintain
+# unittest, so we don't care about the number of methods.
+#
+# pylint: disable=W0212,R0904
+#
+
+MAXLINE = 64
+
+def _split(data, pool):
+    ''' Split data in randomly-sized slices of pooled buffers '''
+    pieces = []
+    offset = 0
+    while offset < len(data):
+        chunk = data[offset:offset + random.randrange(1, 17)]
+        rbuf = pool.get()
+        rbuf.octets[:len(chunk)] = chunk
+        rbuf.refs += 1
+        rbuf.retired = True
+        pieces.append(Slice(rbuf.octets, 0, len(chunk), rbuf))
+        offset += len(chunk)
+    return pieces
+
+def _parse(brigade, pieces, script):
+    ''' Parse pieces according to script, where each entry is a
+        line (None), a record to pullup (its length) or a record to
+        skip (minus its length) '''
+    result, script = [], list(script)
+    for piece in pieces:
+        brigade.bufferise(piece)
+        while script:
+            if script[0] is None:
+                tmp = brigade.getline(MAXLINE)
+            elif script[0] < 0:
+                tmp = brigade.skip(-script[0])
+                if tmp == 0:
+                    tmp = 'skipped'
+                else:
+                    script[0] = -tmp
+                    tmp = ''
+            else:
+                tmp = brigade.pullup(script[0])
+            if not tmp:
+                break
+            result.append(tmp)
+            script.pop(0)
+    return result
+
+class TestSliceBrigade(unittest.TestCase):
+    ''' Make sure SliceBrigade works like Brigade '''
+
+    def setUp(self):
+        self.pool = BufferPool(bufsize=16, maxfree=4)
+
+    def _build(self):
+        ''' Build a random message and its parsing script '''
+        data, script = [], []
+        for _ in range(256):
+            if random.random() < 0.4:
+                line = 'x' * random.randrange(0, MAXLINE - 1) + '\n'
+                data.append(line)
+                script.append(None)
+            elif random.random() < 0.5:
+                count = random.randrange(1, 100)
+                data.append(chr(random.randrange(256)) * count)
+                script.append(count)
+            else:
+                count = random.randrange(1, 100)
+                data.append('s' * count)
+                script.append(-count)
+        return ''.join(data), script
+
+    def test_equivalence(self):
+        ''' Parse lines and records across buffer boundaries '''
+        for _ in range(16):
+            data, script = self._build()
+            pieces = _split(data, self.pool)
+            expected = _parse(Brigade(), [piece.tobytes()
+                                          for piece in pieces], script)
+            brigade = SliceBrigade()
+            self.assertEqual(_parse(brigade, pieces, script), expected)
+            self.assertEqual(len(expected), len(script))
+            self.assertEqual(brigade.total, 0)
+            self.assertFalse([piece for piece in pieces if piece.rbuf])
+
+    def test_line_too_long(self):
+        ''' Make sure we reject too long lines across buffers '''
+        brigade = SliceBrigade()
+        for piece in _split('y' * MAXLINE, self.pool):
+            brigade.bufferise(piece)
+        self.assertRaises(RuntimeError, brigade.getline, MAXLINE)
+
+    def test_line_incomplete(self):
+        ''' Make sure we wait for the rest of the line '''
+        brigade = SliceBrigade()
+        brigade.bufferise('GET / HTTP/1.1\r')
+        self.assertEqual(brigade.getline(MAXLINE), '')
+        brigade.bufferise('\nHost')
+        self.assertEqual(brigade.getline(MAXLINE), 'GET / HTTP/1.1\r\n')
+        self.assertEqual(brigade.getline(MAXLINE), '')
+        self.assertEqual(brigade.total, 4)
+
+    def test_release(self):
+        ''' Make sure buffers go back to the pool when consumed '''
+        brigade = SliceBrigade()
+        pieces = _split('z' * 40, self.pool)
+        for piece in pieces:
+            brigade.bufferise(piece)
+        free = len(self.pool.free)
+        self.assertEqual(brigade.skip(20), 0)
+        self.assertTrue(len(self.pool.free) > free)
+        brigade.clear()
+        self.assertEqual(brigade.total, 0)
+        self.assertFalse([piece for piece in pieces if piece.rbuf])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+
+#
+# Copyright (c) 2013
+#     Nexa Center for Internet & Society, Politecnico di Torino (DAUIN),
+#     and Simone Basso <bassosimone@gmail.com>
+#
+# This file is part of Neubot <http://www.neubot.org/>.
+#
+# Neubot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Neubot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Neubot.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+''' Regression test and receive benchmark for neubot/bufpool.py '''
+
+import os
+import resource
+import socket
+import struct
+import sys
+import unittest
+
+if __name__ == '__main__':
+    sys.path.insert(0, '.')
+
+from neubot.brigade import Brigade
+from neubot.brigade import SliceBrigade
+from neubot.bufpool import BufferPool
+from neubot.bufpool import Receiver
+from neubot.bufpool import Slice
+from neubot.config import CONFIG
+from neubot.http.client import ClientHTTP
+from neubot.http.message import Message
+from neubot.net import stream as net_stream
+from neubot.stream import Stream
+
+from neubot import bufpool
+from neubot import utils
+
+#
+# We're accessing private methods and we don't maintain
+# unittest, so we don't care about the number of methods.
+#
+# pylint: disable=W0212,R0904
+#
+
+def _loopback_pair():
+    ''' Return a connected pair of TCP sockets '''
+    lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    lsock.bind(('127.0.0.1', 0))
+    lsock.listen(1)
+    left = socket.create_connection(lsock.getsockname())
+    right = lsock.accept()[0]
+    lsock.close()
+    return left, right
+
+class TestReceiver(unittest.TestCase):
+    ''' Regression test for Receiver '''
+
+    def setUp(self):
+        self.left, self.right = _loopback_pair()
+        self.pool = BufferPool(bufsize=bufpool.MINRECV * 2, maxfree=2)
+        self.receiver = Receiver(self.pool)
+
+    def tearDown(self):
+        self.left.close()
+        self.right.close()
+
+    def _recv(self, data):
+        ''' Send data and receive it into a slice '''
+        self.left.sendall(data)
+        piece = self.receiver.recv(self.right, len(data))
+        self.assertEqual(piece.tobytes(), data)
+        return piece
+
+    def test_rewind(self):
+        ''' Make sure we reuse the buffer when slices are released '''
+        first = self._recv('abc')
+        first.release()
+        second = self._recv('def')
+        self.assertEqual(second.start, 0)
+        self.assertEqual(self.pool.allocated, 1)
+
+    def test_retire(self):
+        ''' Make sure full buffers are retired and then reused '''
+        first = self._recv('x' * (bufpool.MINRECV + 1))
+        second = self._recv('y' * bufpool.MINRECV)
+        self.assertTrue(first.rbuf is not second.rbuf)
+        self.assertTrue(first.rbuf.retired)
+        self.assertEqual(self.pool.allocated, 2)
+        first.release()
+        self.assertEqual(len(self.pool.free), 1)
+        self.assertEqual(second.tobytes(), 'y' * bufpool.MINRECV)
+        second.release()
+        self.receiver.close()
+        self.assertEqual(len(self.pool.free), 2)
+
+    def test_eof(self):
+        ''' Make sure we return an empty string on EOF '''
+        self.left.close()
+        self.assertEqual(self.receiver.recv(self.right, 1024), '')
+
+    def test_close_pending(self):
+        ''' Make sure close() does not recycle referenced buffers '''
+        piece = self._recv('abc')
+        self.receiver.close()
+        self.assertEqual(self.pool.free, [])
+        self.assertEqual(piece.tobytes(), 'abc')
+        piece.release()
+        self.assertEqual(len(self.pool.free), 1)
+
+class NetStreamSlices(net_stream.Stream):
+    ''' Old-style stream that receives slices '''
+
+    recv_slices = True
+
+    def __init__(self, poller):
+        net_stream.Stream.__init__(self, poller)
+        self.received = []
+
+    def recv_complete(self, octets):
+        self.received.append(octets)
+
+class TestStreams(unittest.TestCase):
+    ''' Make sure the streams receive slices when asked '''
+
+    def setUp(self):
+        self.left, self.right = _loopback_pair()
+        self.received = []
+
+    def tearDown(self):
+        self.left.close()
+        self.right.close()
+
+    def _connection_made(self, stream):
+        ''' Invoked when the stream is ready '''
+
+    def _connection_lost(self, stream):
+        ''' Invoked when the stream is closed '''
+
+    def _recv_complete(self, stream, octets):
+        ''' Invoked when recv() is complete '''
+        self.received.append(octets)
+
+    def test_stream(self):
+        ''' Make sure neubot/stream.py recv_into() passes slices '''
+        stream = Stream(self.right, self._connection_made,
+                        self._connection_lost, None, None, None)
+        self.left.sendall('abc')
+        stream.recv_into(1024, self._recv_complete)
+        stream.handle_read()
+        self.left.sendall('def')
+        stream.recv(1024, self._recv_complete)
+        stream.handle_read()
+        self.assertTrue(isinstance(self.received[0], Slice))
+        self.assertEqual(self.received[0].tobytes(), 'abc')
+        self.assertEqual(self.received[1], 'def')
+        self.assertEqual(stream.bytes_in, 6)
+        stream.handle_close()
+
+    def test_net_stream(self):
+        ''' Make sure neubot/net/stream.py passes slices '''
+        stream = NetStreamSlices(self)
+        stream.attach(self, self.right, CONFIG.copy())
+        self.left.sendall('abc')
+        stream.handle_read()
+        self.assertTrue(isinstance(stream.received[0], Slice))
+        self.assertEqual(stream.received[0].tobytes(), 'abc')
+
+    # Invoked by the old-style stream
+    def connection_lost(self, stream):
+        ''' Nothing to do '''
+    def unset_readable(self, stream):
+        ''' Nothing to do '''
+
+class FakePoller(object):
+    ''' Poller that does nothing '''
+
+    def set_readable(self, stream):
+        ''' Nothing to do '''
+    def set_writable(self, stream):
+        ''' Nothing to do '''
+    def unset_readable(self, stream):
+        ''' Nothing to do '''
+    def unset_writable(self, stream):
+        ''' Nothing to do '''
+
+class ClientSlices(ClientHTTP):
+    ''' HTTP client that receives slices '''
+
+    recv_slices = True
+
+    def __init__(self, poller):
+        ClientHTTP.__init__(self, poller)
+        self.body = []
+        self.responses = []
+        self.stream = None
+
+    def connection_ready(self, stream):
+        request = Message()
+        request.compose(method='GET', pathquery='/', host='127.0.0.1')
+        response = Message()
+        response.body.write = lambda piece: self.body.append(str(piece))
+        stream.send_request(request, response)
+        self.stream = stream
+
+    def got_response(self, stream, request, response):
+        self.responses.append(response.code)
+
+class TestHTTPSlices(unittest.TestCase):
+    ''' Make sure the HTTP stream parses slices '''
+
+    def test_chunked(self):
+        ''' Make sure we parse a chunked response across slices '''
+        left, right = _loopback_pair()
+        client = ClientSlices(FakePoller())
+        client.configure(CONFIG.copy())
+        client.connection_made(right, ('127.0.0.1', 80), 0)
+        stream = client.stream
+        self.assertTrue(stream.receiver)
+        fragments = ['HTTP/1.1 200 Ok\r\nTransfer-Enc',
+                     'oding: chunked\r\n\r\n5\r\nabc',
+                     'de\r\n3\r\nfgh\r\n0\r\n', '\r\n']
+        for fragment in fragments:
+            left.sendall(fragment)
+            stream.handle_read()
+        self.assertEqual(client.responses, ['200'])
+        self.assertEqual(''.join(client.body), 'abcdefgh')
+        self.assertEqual(stream.receiver.rbuf.refs, 0)
+        left.close()
+        right.close()
+
+#
+# Memory/CPU benchmark: receive a stream of length-prefixed pieces
+# (like the raw test does) using recv() and Brigade, and recv_into()
+# and SliceBrigade.  Each run is in a separate process, so that we
+# can measure its peak RSS.
+#
+
+BENCH_BYTES = 256 << 20
+PIECE_SIZE = 32768
+MAXRECV = 262144
+
+def _receive(sock, use_pool):
+    ''' Receive and parse the stream '''
+    receiver = Receiver()
+    if use_pool:
+        brigade = SliceBrigade()
+    else:
+        brigade = Brigade()
+    left, total, calls = 0, 0, 0
+    while True:
+        if use_pool:
+            data = receiver.recv(sock, MAXRECV)
+        else:
+            data = sock.recv(MAXRECV)
+        if not data:
+            break
+        calls += 1
+        total += len(data)
+        brigade.bufferise(data)
+        while True:
+            if left > 0:
+                left = brigade.skip(left)
+                if left > 0:
+                    break
+            else:
+                tmp = brigade.pullup(4)
+                if not tmp:
+                    break
+                left = struct.unpack('!I', tmp)[0]
+    return total, calls
+
+def _send(sock):
+    ''' Send the stream '''
+    piece = struct.pack('!I', PIECE_SIZE) + 'x' * PIECE_SIZE
+    data = piece * (1048576 // len(piece))
+    count = 0
+    while count < BENCH_BYTES:
+        sock.sendall(data)
+        count += len(data)
+    sock.close()
+
+def _run(use_pool):
+    ''' Run the benchmark in a child process '''
+    rfile, wfile = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(rfile)
+            left, right = _loopback_pair()
+            if os.fork() == 0:
+                try:
+                    right.close()
+                    _send(left)
+                finally:
+                    os._exit(0)
+            left.close()
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            begin = utils.ticks()
+            total, calls = _receive(right, use_pool)
+            elapsed = utils.ticks() - begin
+            after = resource.getrusage(resource.RUSAGE_SELF)
+            os.write(wfile, '%d %d %f %f %d %d\n' % (total, calls, elapsed,
+              after.ru_utime + after.ru_stime - usage.ru_utime -
+              usage.ru_stime, after.ru_maxrss,
+              bufpool.POOL.allocated))
+            os.wait()
+        finally:
+            os._exit(0)
+    os.close(wfile)
+    result = os.fdopen(rfile).read().split()
+    os.waitpid(pid, 0)
+    return result
+
+def benchmark():
+    ''' Compare recv() and recv_into() '''
+    sys.stdout.write('Receiving %s in %d-byte pieces:\n' % (
+      utils.unit_formatter(BENCH_BYTES, unit='B'), PIECE_SIZE))
+    cputimes = {}
+    for name, use_pool in (('recv', False), ('recv_into', True)):
+        total, calls, elapsed, cputime, maxrss, buffers = _run(use_pool)
+        megabytes = int(total) / 1048576.0
+        allocations = int(calls)
+        if use_pool:
+            allocations = int(buffers)
+        cputimes[name] = float(cputime) / megabytes
+        sys.stdout.write('  %-9s: %s CPU per MByte, %s, %d buffers'
+          ' allocated, max RSS %s\n' % (name,
+          utils.time_formatter(cputimes[name]),
+          utils.speed_formatter(int(total) / float(elapsed)),
+          allocations, utils.unit_formatter(int(maxrss) * 1024, unit='B')))
+
+if __name__ == '__main__':
+    benchmark()
+    unittest.main()
@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+
+#
+# Copyright (c) 2013
+#     Nexa Center for Internet & Society, Politecnico di Torino (DAUIN),
+#     and Simone Basso <bassosimone@gmail.com>
+#
+# This file is part of Neubot <http://www.neubot.org/>.
+#
+# Neubot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Neubot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Neubot.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+''' Regression test and benchmark for neubot/database/__init__.py '''
+
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+if __name__ == '__main__':
+    sys.path.insert(0, '.')
+
+from neubot.config import CONFIG
+from neubot.database import DatabaseManager
+from neubot.database import table_speedtest
+
+from neubot import utils
+
+#
+# We're accessing private methods and we don't maintain
+# unittest, so we don't care about the number of methods.
+#
+# pylint: disable=W0212,R0904
+#
+
+# Results are one every PERIOD seconds, starting at BEGIN
+BEGIN = 1356998400
+PERIOD = 31
+DAY = 86400
+
+def _result(index):
+    ''' Create a speedtest result '''
+    return {
+        'timestamp': BEGIN + index * PERIOD,
+        'uuid': '0964312e-f451-4579-9984-3954dcfdeb42',
+        'internal_address': '192.168.1.2',
+        'real_address': '130.192.91.211',
+        'remote_address': '194.116.85.211',
+        'privacy_informed': 1,
+        'privacy_can_collect': 1,
+        'privacy_can_publish': 1,
+        'connect_time': 0.0123,
+        'download_speed': 1187400.0,
+        'upload_speed': 456000.0,
+        'latency': 0.0241,
+        'platform': 'linux2',
+        'neubot_version': '0.004016007',
+        'test_version': 1,
+    }
+
+def _prefill(path, rows):
+    ''' Create a speedtest table, without indexes, with rows results '''
+    connection = sqlite3.connect(path)
+    connection.execute(table_speedtest.CREATE_TABLE)
+    connection.executemany(table_speedtest.INSERT_INTO,
+                           (_result(index) for index in xrange(rows)))
+    connection.commit()
+    connection.close()
+
+def _indexes(connection):
+    ''' Return the names of the indexes we created '''
+    cursor = connection.execute('SELECT name FROM sqlite_master WHERE '
+                                'type="index" AND sql IS NOT NULL;')
+    return sorted([row[0] for row in cursor])
+
+class TestDatabaseManager(unittest.TestCase):
+    ''' Regression test for DatabaseManager '''
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'database.sqlite3')
+        self.saved = (CONFIG['database.journal_mode'],
+                      CONFIG['database.synchronous'])
+        self.manager = DatabaseManager()
+        self.manager.set_path(self.path)
+
+    def tearDown(self):
+        self.manager.close()
+        CONFIG['database.journal_mode'] = self.saved[0]
+        CONFIG['database.synchronous'] = self.saved[1]
+        shutil.rmtree(self.tempdir)
+
+    def _pragma(self, name):
+        ''' Return the value of a pragma '''
+        return self.manager.connection().execute('PRAGMA %s;' %
+                                                 name).fetchone()[0]
+
+    def test_tuning(self):
+        ''' Make sure we apply the tuning settings '''
+        self.assertEqual(self._pragma('journal_mode'), 'delete')
+        self.assertEqual(self._pragma('synchronous'), 1)
+        CONFIG['database.synchronous'] = 'full'
+        self.assertEqual(self._pragma('synchronous'), 2)
+        CONFIG['database.journal_mode'] = 'wal'
+        self.assertEqual(self._pragma('journal_mode'), 'wal')
+        CONFIG['database.journal_mode'] = 'nonexistent'
+        self.assertEqual(self._pragma('journal_mode'), 'wal')
+
+    def test_readable(self):
+        ''' Make sure readers need no journal files by default, even
+            if the database was left in WAL mode '''
+        connection = sqlite3.connect(self.path)
+        connection.execute('PRAGMA journal_mode=wal;')
+        connection.close()
+        self.manager.connection()
+        self.manager.close()
+        self.assertFalse(os.path.exists(self.path + '-wal'))
+        self.assertFalse(os.path.exists(self.path + '-shm'))
+        connection = sqlite3.connect(self.path)
+        self.assertEqual(connection.execute('PRAGMA journal_mode;'
+                                            ).fetchone()[0], 'delete')
+        connection.close()
+
+    def test_indexes(self):
+        ''' Make sure we create indexes and use them '''
+        connection = self.manager.connection()
+        self.assertEqual(_indexes(connection), [
+                         'aggregate_key_index',
+                         'bittorrent_timestamp_index',
+                         'geoloc_country_index',
+                         'log_timestamp_index',
+                         'raw_timestamp_index',
+                         'speedtest_timestamp_index'])
+        query = table_speedtest._table_utils.make_select('speedtest',
+          table_speedtest.TEMPLATE, since=0, until=0, desc=True)
+        plan = ' '.join([str(row[-1]) for row in connection.execute(
+          'EXPLAIN QUERY PLAN ' + query, {'since': 0, 'until': 0})])
+        self.assertTrue('speedtest_timestamp_index' in plan)
+
+    def test_migration(self):
+        ''' Make sure we add indexes to existing databases '''
+        _prefill(self.path, 100)
+        connection = self.manager.connection()
+        self.assertTrue('speedtest_timestamp_index' in _indexes(connection))
+        self.assertEqual(len(table_speedtest.listify(connection)), 100)
+
+    def test_group(self):
+        ''' Make sure grouped transactions commit once '''
+        connection = self.manager.connection()
+        self.assertEqual(connection.group_depth, 0)
+        reader = sqlite3.connect(self.path)
+        count = lambda: reader.execute('SELECT COUNT(*) FROM '
+                                       'speedtest;').fetchone()[0]
+        self.manager.begin_group()
+        self.manager.begin_group()
+        table_speedtest.insert(connection, _result(0))
+        self.manager.end_group()
+        table_speedtest.insert(connection, _result(1))
+        self.assertEqual(count(), 0)
+        self.manager.end_group()
+        self.assertEqual(count(), 2)
+        table_speedtest.insert(connection, _result(2))
+        self.assertEqual(count(), 3)
+        self.assertRaises(RuntimeError, self.manager.end_group)
+        reader.close()
+
+#
+# Benchmark: we create a speedtest table with ROWS results, one
+# every PERIOD seconds, and we measure the average latency of
+# INSERTS inserts and of QUERIES one-day range queries, first as
+# before (rollback journal, FULL synchronous level, no indexes and
+# a commit per insert), then with DatabaseManager (which also
+# creates the indexes, and we measure how long it takes), and then
+# grouping the inserts into a single transaction.  To compare just
+# the tuning, inserts do not update the summaries (see the aggregate
+# table).  We also measure how long it takes to summarize the existing
+# results, which DatabaseManager does in background after connecting.
+#
+# With 1M rows the benchmark takes more than one minute, so we run
+# it only when NEUBOT_DATABASE_BENCHMARK is set, e.g.:
+#
+#   NEUBOT_DATABASE_BENCHMARK=1 ./regress/neubot/database/manager.py
+#
+
+ROWS = 1000000
+INSERTS = 200
+QUERIES = 20
+
+def _measure(connection, manager=None):
+    ''' Return insert and query latency '''
+    if manager:
+        manager.begin_group()
+    begin = utils.ticks()
+    for index in range(ROWS, ROWS + INSERTS):
+        connection.execute(table_speedtest.INSERT_INTO, _result(index))
+        connection.commit()
+    if manager:
+        manager.end_group()
+    insert = (utils.ticks() - begin) / INSERTS
+
+    begin = utils.ticks()
+    for index in range(QUERIES):
+        since = BEGIN + index * 17 * DAY
+        table_speedtest.listify(connection, since, since + DAY)
+    query = (utils.ticks() - begin) / QUERIES
+    return insert, query
+
+def benchmark():
+    ''' Compare the old and the new database setup '''
+    tempdir = tempfile.mkdtemp()
+    path = os.path.join(tempdir, 'database.sqlite3')
+    sys.stdout.write('Speedtest table with %d rows:\n' % ROWS)
+    _prefill(path, ROWS)
+    shutil.copy(path, path + '.orig')
+
+    connection = sqlite3.connect(path)
+    connection.row_factory = sqlite3.Row
+    insert, query = _measure(connection)
+    connection.close()
+    sys.stdout.write('  before         : insert %s, range query %s\n' % (
+      utils.time_formatter(insert), utils.time_formatter(query)))
+
+    for grouped in (False, True):
+        shutil.copy(path + '.orig', path)
+        manager = DatabaseManager()
+        manager.set_path(path)
+        begin = utils.ticks()
+        connection = manager.connection()
+        migration = utils.ticks() - begin
+        begin = utils.ticks()
+        while manager.summarize():
+            pass
+        summarize = utils.ticks() - begin
+        if grouped:
+            insert, query = _measure(connection, manager)
+            sys.stdout.write('  after (grouped): insert %s, range query %s'
+              '\n' % (utils.time_formatter(insert),
+                      utils.time_formatter(query)))
+        else:
+            insert, query = _measure(connection)
+            sys.stdout.write('  after          : insert %s, range query %s'
+              ' (migrated in %s, summarized in %s)\n' % (
+              utils.time_formatter(insert), utils.time_formatter(query),
+              utils.time_formatter(migration),
+              utils.time_formatter(summarize)))
+        manager.close()
+
+    shutil.rmtree(tempdir)
+
+if __name__ == '__main__':
+    if os.environ.get('NEUBOT_DATABASE_BENCHMARK'):
+        benchmark()
+    unittest.main()
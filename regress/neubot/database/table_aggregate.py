@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+
+#
+# Copyright (c) 2013
+#     Nexa Center for Internet & Society, Politecnico di Torino (DAUIN),
+#     and Simone Basso <bassosimone@gmail.com>
+#
+# This file is part of Neubot <http://www.neubot.org/>.
+#
+# Neubot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Neubot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Neubot.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+''' Regression test for neubot/database/table_aggregate.py '''
+
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+if __name__ == '__main__':
+    sys.path.insert(0, '.')
+
+from neubot.backend_neubot import BackendNeubot
+from neubot.database import DATABASE
+from neubot.database import table_aggregate
+from neubot.database import table_speedtest
+
+from neubot import percentile
+
+#
+# We're accessing private methods and we don't maintain
+# unittest, so we don't care about the number of methods.
+#
+# pylint: disable=W0212,R0904
+#
+
+# 2013-01-01T00:00:00Z, one result every PERIOD seconds
+BEGIN = 1356998400
+PERIOD = 3600
+SERVERS = ('194.116.85.211', '194.116.85.224', '130.192.91.231')
+
+def _result(index, rng):
+    ''' Create a speedtest result '''
+    return {
+        'timestamp': BEGIN + index * PERIOD,
+        'uuid': '0964312e-f451-4579-9984-3954dcfdeb42',
+        'internal_address': '192.168.1.2',
+        'real_address': '130.192.91.211',
+        'remote_address': SERVERS[index % len(SERVERS)],
+        'privacy_informed': 1,
+        'privacy_can_collect': 1,
+        'privacy_can_publish': 1,
+        'connect_time': rng.lognormvariate(-4, 0.5),
+        'download_speed': rng.lognormvariate(14, 1),
+        'upload_speed': rng.choice((0.0, rng.lognormvariate(12, 1))),
+        'latency': rng.lognormvariate(-4, 0.5),
+        'platform': 'linux2',
+        'neubot_version': '0.004016007',
+        'test_version': 1,
+    }
+
+def _connect():
+    ''' Connect to an in-memory database '''
+    connection = sqlite3.connect(':memory:')
+    connection.row_factory = sqlite3.Row
+    table_speedtest.create(connection)
+    return connection
+
+class TestTableAggregate(unittest.TestCase):
+    ''' Regression test for table_aggregate '''
+
+    def setUp(self):
+        rng = random.Random(17)
+        self.results = [_result(index, rng) for index in range(500)]
+        self.connection = _connect()
+        for result in self.results:
+            table_speedtest.insert(self.connection, dict(result),
+                                   override_timestamp=False)
+
+    def _expect(self, function):
+        ''' Compute the exact summaries of the results for which
+            function returns the same key, using percentile.py '''
+        groups = {}
+        for result in self.results:
+            groups.setdefault(function(result), []).append(result)
+        return groups
+
+    def _check(self, summary, results):
+        ''' Check summary against the exact values '''
+        self.assertEqual(summary['count'], len(results))
+        for name in table_aggregate.METRICS['speedtest']:
+            values = [result[name] for result in results]
+            metric = summary['metrics'][name]
+            self.assertEqual(metric['count'], len(values))
+            self.assertEqual(metric['min'], min(values))
+            self.assertEqual(metric['max'], max(values))
+            self.assertAlmostEqual(metric['mean'], sum(values) / len(values))
+            for label, percent in table_aggregate.PERCENTILES:
+                exact = percentile.percentile(values, percent)
+                self.assertTrue(abs(metric[label] - exact) <=
+                                exact * table_aggregate.ALPHA / 2 + 1e-12,
+                                (name, label, metric[label], exact))
+
+    def test_day(self):
+        ''' Make sure per-day summaries are correct '''
+        groups = self._expect(lambda result: table_aggregate._key('day',
+                                                                  result))
+        summaries = table_aggregate.listify(self.connection, 'speedtest',
+                                            'day')
+        self.assertEqual([summary['key'] for summary in summaries],
+                         sorted(groups.keys()))
+        self.assertEqual(summaries[0]['key'], '2013-01-01')
+        for summary in summaries:
+            self._check(summary, groups[summary['key']])
+
+        summaries = table_aggregate.listify(self.connection, 'speedtest',
+          'day', BEGIN + 86400 + 7, BEGIN + 3 * 86400 + 7)
+        self.assertEqual([summary['key'] for summary in summaries],
+                         ['2013-01-02', '2013-01-03', '2013-01-04'])
+
+    def test_server(self):
+        ''' Make sure per-server summaries are correct '''
+        groups = self._expect(lambda result: result['remote_address'])
+        summaries = table_aggregate.listify(self.connection, 'speedtest',
+                                            'server')
+        self.assertEqual([summary['key'] for summary in summaries],
+                         sorted(SERVERS))
+        for summary in summaries:
+            self._check(summary, groups[summary['key']])
+            self.assertEqual(summary['first'], min([result['timestamp']
+              for result in groups[summary['key']]]))
+
+    def test_rebuild(self):
+        ''' Make sure rebuild() is equivalent to update() '''
+        for kind in table_aggregate.KINDS:
+            expect = table_aggregate.listify(self.connection, 'speedtest',
+                                             kind)
+            connection = _connect()
+            table_aggregate.rebuild(connection, 'speedtest',
+                                    iter(self.results))
+            self.assertEqual(table_aggregate.listify(connection,
+                             'speedtest', kind), expect)
+
+    def test_small(self):
+        ''' Make sure we are exact with identical values '''
+        connection = _connect()
+        table_aggregate.update(connection, 'x', {'timestamp': BEGIN,
+                               'value': 3, 'remote_address': 'a'})
+        summary = table_aggregate.listify(connection, 'x', 'server')[0]
+        for label, _ in table_aggregate.PERCENTILES:
+            self.assertEqual(summary['metrics']['value'][label], 3)
+        self.assertEqual(table_aggregate.listify(connection, 'x', 'day')[0][
+                         'metrics'].keys(), ['value'])
+
+class TestSummarize(unittest.TestCase):
+    ''' Make sure we summarize existing results '''
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'database.sqlite3')
+        DATABASE.set_path(self.path)
+        DATABASE.summarizing = False
+
+    def tearDown(self):
+        DATABASE.close()
+        shutil.rmtree(self.tempdir)
+
+    def test_database(self):
+        ''' Make sure we summarize results of older databases '''
+        rng = random.Random(17)
+        connection = sqlite3.connect(self.path)
+        connection.execute(table_speedtest.CREATE_TABLE)
+        connection.executemany(table_speedtest.INSERT_INTO,
+                               [_result(index, rng) for index in range(100)])
+        connection.commit()
+        connection.close()
+        connection = DATABASE.connection()
+        self.assertEqual(table_aggregate.listify(connection, 'speedtest',
+                                                 'server'), [])
+        self.assertTrue(DATABASE.summarizing)
+        while DATABASE.summarizing:
+            DATABASE._summarize_task()
+        self.assertEqual(table_aggregate.pending(connection), [])
+        summaries = table_aggregate.listify(connection, 'speedtest',
+                                            'server')
+        self.assertEqual(sum([summary['count'] for summary in summaries]),
+                         100)
+
+    def test_batches(self):
+        ''' Make sure we summarize in batches, count once the results
+            saved meanwhile, and resume after a restart '''
+        rng = random.Random(17)
+        results = [_result(index, rng) for index in range(110)]
+        connection = sqlite3.connect(self.path)
+        connection.execute(table_speedtest.CREATE_TABLE)
+        connection.executemany(table_speedtest.INSERT_INTO, results[:100])
+        connection.commit()
+        connection.close()
+
+        connection = DATABASE.connection()
+        self.assertTrue(DATABASE.summarize(30))
+        state = table_aggregate.pending(connection)[0][1]
+        self.assertEqual(state['done'], 30)
+        for result in results[100:105]:
+            table_speedtest.insert(connection, dict(result),
+                                   override_timestamp=False)
+        DATABASE.close()
+
+        connection = DATABASE.connection()
+        for result in results[105:]:
+            table_speedtest.insert(connection, dict(result),
+                                   override_timestamp=False)
+        self.assertTrue(DATABASE.summarize(30))
+        self.assertTrue(DATABASE.summarize(30))
+        self.assertFalse(DATABASE.summarize(30))
+        self.assertFalse(DATABASE.summarize(30))
+
+        # Sums depend on the order of the results, so means may differ
+        expect = _connect()
+        table_aggregate.rebuild(expect, 'speedtest', iter(results))
+        for kind in table_aggregate.KINDS:
+            summaries = table_aggregate.listify(connection, 'speedtest', kind)
+            expected = table_aggregate.listify(expect, 'speedtest', kind)
+            self.assertEqual(len(summaries), len(expected))
+            for summary, other in zip(summaries, expected):
+                for metric in summary['metrics'].values():
+                    metric['mean'] = round(metric['mean'], 6)
+                for metric in other['metrics'].values():
+                    metric['mean'] = round(metric['mean'], 6)
+                self.assertEqual(summary, other)
+
+    def test_generic(self):
+        ''' Make sure we summarize results of generic tests '''
+        proxy = FakeProxy(self.tempdir)
+        backend = BackendNeubot(proxy)
+        for index in range(10):
+            backend.store_generic('dash', {'timestamp': BEGIN + index,
+              'elapsed': 1.0 + index, 'remote_address': 'a'})
+        connection = DATABASE.connection()
+        summaries = table_aggregate.listify(connection, 'dash', 'server')
+        self.assertEqual(summaries[0]['count'], 10)
+        self.assertEqual(summaries[0]['metrics'].keys(), ['elapsed'])
+        connection.execute('DELETE FROM aggregate;')
+        backend = BackendNeubot(proxy)
+        backend.store_generic('dash', {'timestamp': BEGIN + 10,
+          'elapsed': 11.0, 'remote_address': 'a'})
+        summaries = table_aggregate.listify(connection, 'dash', 'server')
+        self.assertEqual(summaries[0]['count'], 11)
+
+class FakeProxy(object):
+    ''' Fake backend proxy '''
+
+    def __init__(self, datadir):
+        self.datadir = datadir
+
+    def datadir_touch(self, components):
+        ''' Touch a file below datadir '''
+        path = os.path.join(self.datadir, components[0])
+        open(path, 'ab').close()
+        return path
+
+if __name__ == '__main__':
+    unittest.main()
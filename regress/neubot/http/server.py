@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+
+#
+# Copyright (c) 2013
+#     Nexa Center for Internet & Society, Politecnico di Torino (DAUIN),
+#     and Simone Basso <bassosimone@gmail.com>
+#
+# This file is part of Neubot <http://www.neubot.org/>.
+#
+# Neubot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Neubot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Neubot.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+''' Regression test and static files benchmark for neubot/http/server.py '''
+
+import os
+import resource
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import unittest
+
+if __name__ == '__main__':
+    sys.path.insert(0, '.')
+
+from neubot.config import CONFIG
+from neubot.http.server import ServerHTTP
+from neubot.net.poller import POLLER
+
+from neubot import utils
+from neubot import utils_net
+
+# Size of the static file we serve
+FILESIZE = 8 << 20
+
+# Number of times we fetch it in the benchmark
+REQUESTS = 32
+
+class StaticServer(ServerHTTP):
+    ''' Report the port we are listening at '''
+
+    def __init__(self, poller, wfile):
+        ServerHTTP.__init__(self, poller)
+        self.wfile = wfile
+
+    def started_listening(self, listener):
+        os.write(self.wfile, '%d %f\n' % (listener.lsock.getsockname()[1],
+                                          _cputime()))
+
+def _cputime():
+    ''' Return the CPU time used by this process '''
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+def _run_server(rootdir, sendfile, wfile):
+    ''' Serve rootdir until we receive SIGTERM '''
+
+    def report_usage(signo, frame):
+        ''' Write the CPU time we've used and exit '''
+        os.write(wfile, '%f\n' % _cputime())
+        os._exit(0)
+
+    signal.signal(signal.SIGTERM, report_usage)
+    conf = CONFIG.copy()
+    conf['http.server.rootdir'] = rootdir
+    conf['net.stream.sendfile'] = sendfile
+    server = StaticServer(POLLER, wfile)
+    server.configure(conf)
+    server.listen(('127.0.0.1', 0))
+    POLLER.loop()
+
+class Server(object):
+    ''' Run the static server in a separate process '''
+
+    def __init__(self, rootdir, sendfile):
+        rfile, wfile = os.pipe()
+        self.pid = os.fork()
+        if self.pid == 0:
+            try:
+                os.close(rfile)
+                _run_server(rootdir, sendfile, wfile)
+            finally:
+                os._exit(1)
+        os.close(wfile)
+        self.rfile = os.fdopen(rfile)
+        port, base = self.rfile.readline().split()
+        self.port, self.base = int(port), float(base)
+
+    def stop(self):
+        ''' Stop the server and return the CPU time it has used '''
+        os.kill(self.pid, signal.SIGTERM)
+        cputime = float(self.rfile.readline())
+        os.waitpid(self.pid, 0)
+        return cputime - self.base
+
+def _fetch(sock, path, method='GET'):
+    ''' Fetch path over sock and return (headers, body) '''
+    sock.sendall('%s %s HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n' % (method, path))
+    data = ''
+    while '\r\n\r\n' not in data:
+        data += sock.recv(65536)
+    headers, body = data.split('\r\n\r\n', 1)
+    length = 0
+    for line in headers.split('\r\n'):
+        if line.lower().startswith('content-length:'):
+            length = int(line.split(':', 1)[1])
+    if method == 'HEAD':
+        return headers, body
+    chunks = [body]
+    count = len(body)
+    while count < length:
+        chunk = sock.recv(1 << 20)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        count += len(chunk)
+    return headers, ''.join(chunks)
+
+class TestStaticFiles(unittest.TestCase):
+    ''' Make sure we serve static files correctly '''
+
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp()
+        self.content = os.urandom(1 << 20)
+        filep = open(os.path.join(self.rootdir, 'file.bin'), 'wb')
+        filep.write(self.content)
+        filep.close()
+        filep = open(os.path.join(self.rootdir, 'small.txt'), 'wb')
+        filep.write('Hello, world\n')
+        filep.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.rootdir)
+
+    def _test(self, sendfile):
+        ''' Fetch files, possibly using sendfile() '''
+        server = Server(self.rootdir, sendfile)
+        sock = socket.create_connection(('127.0.0.1', server.port))
+        self.assertTrue(_fetch(sock, '/file.bin')[1] == self.content)
+        headers, body = _fetch(sock, '/file.bin', 'HEAD')
+        self.assertTrue('Content-Length: %d' % len(self.content) in headers)
+        self.assertEqual(body, '')
+        self.assertEqual(_fetch(sock, '/small.txt')[1], 'Hello, world\n')
+        self.assertTrue(_fetch(sock, '/file.bin')[1] == self.content)
+        sock.close()
+        server.stop()
+
+    def test_sendfile(self):
+        ''' Make sure we serve the right content using sendfile() '''
+        self._test(True)
+
+    def test_buffered(self):
+        ''' Make sure we serve the right content without sendfile() '''
+        self._test(False)
+
+def benchmark():
+    ''' Measure server CPU time per MByte served '''
+    rootdir = tempfile.mkdtemp()
+    filep = open(os.path.join(rootdir, 'file.bin'), 'wb')
+    filep.write(os.urandom(FILESIZE))
+    filep.close()
+
+    sys.stdout.write('Serving %d x %s over loopback:\n' % (REQUESTS,
+                     utils.unit_formatter(FILESIZE, unit='B')))
+    modes = [('buffered', False)]
+    if utils_net.SENDFILE is not None:
+        modes.append(('sendfile', True))
+    for name, sendfile in modes:
+        server = Server(rootdir, sendfile)
+        sock = socket.create_connection(('127.0.0.1', server.port))
+        begin = utils.ticks()
+        for _ in range(REQUESTS):
+            assert len(_fetch(sock, '/file.bin')[1]) == FILESIZE
+        elapsed = utils.ticks() - begin
+        sock.close()
+        cputime = server.stop()
+        megabytes = REQUESTS * FILESIZE / float(1 << 20)
+        sys.stdout.write('  %-8s: %s CPU per MByte, %s\n' % (name,
+          utils.time_formatter(cputime / megabytes),
+          utils.speed_formatter(REQUESTS * FILESIZE / elapsed)))
+
+    shutil.rmtree(rootdir)
+
+if __name__ == '__main__':
+    benchmark()
+    unittest.main()
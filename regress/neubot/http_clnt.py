@@ -52,6 +52,8 @@ class FakeStream(object):
 
     def send(self, data, func):
         ''' Emulates stream send() '''
+        if isinstance(data, list):
+            data = http_clnt.EMPTY_STRING.join(data)
         self.outs = data
         # func is ignored
 
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+
+#
+# Copyright (c) 2013
+#     Nexa Center for Internet & Society, Politecnico di Torino (DAUIN),
+#     and Simone Basso <bassosimone@gmail.com>
+#
+# This file is part of Neubot <http://www.neubot.org/>.
+#
+# Neubot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Neubot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Neubot.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+''' Regression test and connection-storm benchmark for neubot/listener.py '''
+
+import errno
+import os
+import socket
+import sys
+import unittest
+
+if __name__ == '__main__':
+    sys.path.insert(0, '.')
+
+from neubot.config import CONFIG
+from neubot.handler import Handler
+from neubot.listener import AcceptStats
+from neubot.listener import accept_batch
+from neubot.poller import POLLER
+
+from neubot import listener
+from neubot import utils
+
+#
+# We're accessing private methods and we don't maintain
+# unittest, so we don't care about the number of methods.
+#
+# pylint: disable=W0212,R0904
+#
+
+class FakeListenSocket(object):
+    ''' Fake listening socket that replays a script '''
+
+    def __init__(self, script):
+        self.script = list(script)
+
+    def accept(self):
+        ''' Replay the next entry of the script '''
+        entry = self.script.pop(0)
+        if isinstance(entry, int):
+            raise socket.error(entry, os.strerror(entry))
+        return entry, ('127.0.0.1', 0)
+
+class TestAcceptBatch(unittest.TestCase):
+    ''' Regression test for accept_batch() '''
+
+    def test_drain(self):
+        ''' Make sure we stop when the queue is empty '''
+        accepted = []
+        lsock = FakeListenSocket(['a', 'b', errno.EAGAIN])
+        self.assertEqual(accept_batch(lsock, 64, accepted.append), (2, False))
+        self.assertEqual(accepted, ['a', 'b'])
+
+    def test_budget(self):
+        ''' Make sure we stop when the budget is exhausted '''
+        accepted = []
+        lsock = FakeListenSocket(['a', 'b', 'c', errno.EAGAIN])
+        self.assertEqual(accept_batch(lsock, 2, accepted.append), (2, True))
+        self.assertEqual(lsock.script, ['c', errno.EAGAIN])
+
+    def test_skip(self):
+        ''' Make sure aborted connections are skipped '''
+        accepted = []
+        lsock = FakeListenSocket([errno.ECONNABORTED, 'a', errno.EAGAIN])
+        self.assertEqual(accept_batch(lsock, 64, accepted.append), (1, False))
+
+    def test_error(self):
+        ''' Make sure hard errors are raised after dispatching '''
+        accepted = []
+        lsock = FakeListenSocket(['a', errno.EMFILE])
+        self.assertRaises(socket.error, accept_batch, lsock, 64,
+                          accepted.append)
+        self.assertEqual(accepted, ['a'])
+
+class TestAcceptStats(unittest.TestCase):
+    ''' Regression test for AcceptStats '''
+
+    def test_counters(self):
+        ''' Make sure counters and rate are updated '''
+        stats = AcceptStats()
+        stats.update(3, False)
+        stats.update(64, True)
+        self.assertEqual(stats.accepted, 67)
+        self.assertEqual(stats.wakeups, 2)
+        self.assertEqual(stats.overflows, 1)
+        stats.window_start -= listener.RATE_WINDOW
+        stats.update(1, False)
+        self.assertTrue(stats.rate > 0)
+        self.assertEqual(stats.window_count, 0)
+        self.assertEqual(sorted(stats.snap().keys()), ['accept_rate',
+                         'accepted', 'overflows', 'wakeups'])
+
+#
+# Connection-storm benchmark: a child process opens many connections
+# as fast as it can while we accept them.  With a budget of one we go
+# back to the poller after each accept, as we used to.
+#
+
+STORM_CONNECTIONS = 2000
+
+class StormServer(Handler):
+    ''' Accept and close connections '''
+
+    def __init__(self, expected):
+        self.expected = expected
+        self.count = 0
+        self.listener = None
+
+    def handle_listen(self, listener):
+        self.listener = listener
+
+    def handle_accept(self, listener, sock, sslconfig, sslcert):
+        sock.close()
+        self.count += 1
+        if self.count == self.expected:
+            POLLER.break_loop()
+
+def _listen_overflows():
+    ''' Read the system-wide ListenOverflows counter (Linux only) '''
+    try:
+        lines = open('/proc/net/netstat').readlines()
+    except (IOError, OSError):
+        return 0
+    for index in range(0, len(lines) - 1, 2):
+        names, values = lines[index].split(), lines[index + 1].split()
+        if names[0] == 'TcpExt:' and 'ListenOverflows' in names:
+            return int(values[names.index('ListenOverflows')])
+    return 0
+
+def _storm_server(budget, count, wfile):
+    ''' Accept count connections and report the counters '''
+    CONFIG['net.listen.accept_budget'] = budget
+    server = StormServer(count)
+    server.listen(('127.0.0.1', 0), False, False, '')
+    os.write(wfile, '%d\n' % server.listener.lsock.getsockname()[1])
+    POLLER.loop()
+    stats = server.listener.accept_stats
+    os.write(wfile, '%d %d %d\n' % (stats.accepted, stats.wakeups,
+                                   stats.overflows))
+
+def storm(budget, count=STORM_CONNECTIONS):
+    ''' Run the connection-storm benchmark with the given budget '''
+
+    # The poller loop runs only once, so we need a new process
+    rfile, wfile = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(rfile)
+            _storm_server(budget, count, wfile)
+        finally:
+            os._exit(0)
+    os.close(wfile)
+    rfile = os.fdopen(rfile)
+    endpoint = ('127.0.0.1', int(rfile.readline()))
+
+    overflows = _listen_overflows()
+    begin = utils.ticks()
+    socks = []
+    for _ in range(count):
+        socks.append(socket.create_connection(endpoint))
+        if len(socks) >= 256:
+            for sock in socks:
+                sock.close()
+            del socks[:]
+    accepted, wakeups, budget_overflows = map(int, rfile.readline().split())
+    elapsed = utils.ticks() - begin
+    os.waitpid(pid, 0)
+    for sock in socks:
+        sock.close()
+
+    sys.stdout.write('  budget %3d: %s, %d wakeups, %d budget overflows,'
+                     ' %d kernel overflows\n' % (budget,
+                     utils.time_formatter(elapsed), wakeups,
+                     budget_overflows, _listen_overflows() - overflows))
+    assert accepted == count
+    return wakeups
+
+def main():
+    ''' Run the benchmark, then the unit tests '''
+    sys.stdout.write('Accepting %d connections:\n' % STORM_CONNECTIONS)
+    one_by_one = storm(1)
+    batched = storm(CONFIG['net.listen.accept_budget'])
+    assert batched < one_by_one
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
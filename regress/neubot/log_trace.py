@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+
+#
+# Copyright (c) 2013
+#     Nexa Center for Internet & Society, Politecnico di Torino (DAUIN),
+#     and Simone Basso <bassosimone@gmail.com>
+#
+# This file is part of Neubot <http://www.neubot.org/>.
+#
+# Neubot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Neubot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Neubot.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+''' Regression test and tracing benchmark for neubot/log_trace.py '''
+
+import struct
+import sys
+import unittest
+
+if __name__ == '__main__':
+    sys.path.insert(0, '.')
+
+from neubot.bittorrent import stream as bt_stream
+from neubot.config import CONFIG
+from neubot.http.message import Message
+from neubot.log import STREAMING_LOG
+
+from neubot import log_trace
+from neubot import utils
+
+#
+# We're accessing private methods and we don't maintain
+# unittest, so we don't care about the number of methods.
+#
+# pylint: disable=W0212,R0904
+#
+
+class FakeStream(object):
+    ''' Fake stream for the streaming log '''
+
+    def __init__(self):
+        self.lines = []
+
+    def start_send(self, octets):
+        ''' Save a log line '''
+        self.lines.append(octets)
+
+class TestTracers(unittest.TestCase):
+    ''' Make sure tracers follow the configuration '''
+
+    def setUp(self):
+        self.saved = CONFIG['verbose'], CONFIG['log.trace']
+
+    def tearDown(self):
+        STREAMING_LOG.streams.clear()
+        CONFIG['log.trace'] = self.saved[1]
+        CONFIG['verbose'] = self.saved[0]
+
+    def test_default(self):
+        ''' Make sure tracing is off when nobody consumes it '''
+        CONFIG['verbose'] = 0
+        self.assertFalse(bt_stream.TRACE.enabled)
+        self.assertEqual(log_trace.snap(), [])
+
+    def test_verbose(self):
+        ''' Make sure verbose enables tracing '''
+        CONFIG['verbose'] = 1
+        self.assertTrue(bt_stream.TRACE.enabled)
+        self.assertTrue(log_trace.tracer('http').enabled)
+        self.assertTrue(log_trace.tracer('new-module').enabled)
+
+    def test_per_module(self):
+        ''' Make sure we can enable tracing for some modules only '''
+        CONFIG['verbose'] = 1
+        CONFIG['log.trace'] = 'config, bittorrent'
+        self.assertEqual(log_trace.snap(), ['bittorrent', 'config'])
+        CONFIG['log.trace'] = 'none'
+        self.assertEqual(log_trace.snap(), [])
+
+    def test_api(self):
+        ''' Make sure tracing is controllable through /api/config '''
+        CONFIG.merge_api({'verbose': '1', 'log.trace': 'http'})
+        self.assertEqual(log_trace.snap(), ['http'])
+        CONFIG.merge_api({'verbose': '0'})
+        self.assertEqual(log_trace.snap(), [])
+
+    def test_streaming(self):
+        ''' Make sure streaming the log enables tracing '''
+        CONFIG['verbose'] = 0
+        stream = FakeStream()
+        STREAMING_LOG.start_streaming(stream)
+        self.assertTrue(bt_stream.TRACE.enabled)
+        sender = bt_stream.StreamBitTorrent(None)
+        sender.start_send = lambda octets: None
+        sender.send_interested()
+        self.assertEqual(stream.lines, ['DEBUG > INTERESTED\r\n'])
+        STREAMING_LOG.streams.clear()
+        STREAMING_LOG.stop_streaming()
+        self.assertFalse(bt_stream.TRACE.enabled)
+
+#
+# Per-message overhead benchmark: we process messages on the
+# BitTorrent and HTTP paths with tracing enabled, which is what
+# happened for all messages before tracers were introduced, and
+# with tracing disabled.  Neubot is not verbose and no one is
+# streaming the log, so debug messages are always discarded.
+#
+
+MESSAGES = 100000
+
+class BenchmarkPeer(object):
+    ''' Minimal peer for the benchmark '''
+    numpieces = 1024
+    def got_have(self, index):
+        ''' Nothing to do '''
+
+def _bittorrent():
+    ''' Parse HAVE messages '''
+    receiver = bt_stream.StreamBitTorrent(None)
+    receiver.parent = BenchmarkPeer()
+    receiver.complete = True
+    receiver.left = 0
+    receiver.start_recv = lambda: None
+    message = struct.pack('!IcI', 5, bt_stream.HAVE, 7)
+    data = message * 1000
+    for _ in range(MESSAGES // 1000):
+        receiver.recv_complete(data)
+    return MESSAGES
+
+def _http():
+    ''' Serialize response headers '''
+    message = Message()
+    message.compose(code='200', reason='Ok', body='', keepalive=True,
+                    mimetype='text/plain')
+    for _ in range(MESSAGES // 10):
+        message.serialize_headers()
+    return MESSAGES // 10
+
+def benchmark():
+    ''' Measure per-message tracing overhead '''
+    saved = CONFIG['verbose']
+    CONFIG['verbose'] = 0
+    sys.stdout.write('Per-message cost with tracing on and off:\n')
+    for name, func in (('bittorrent', _bittorrent), ('http', _http)):
+        results = []
+        for enabled in (True, False):
+            log_trace.tracer(name).enabled = enabled
+            begin = utils.ticks()
+            count = func()
+            results.append((utils.ticks() - begin) / count)
+        log_trace.configure(CONFIG['log.trace'], False)
+        sys.stdout.write('  %-10s: %s -> %s per message\n' % (name,
+          utils.time_formatter(results[0]),
+          utils.time_formatter(results[1])))
+    CONFIG['verbose'] = saved
+
+if __name__ == '__main__':
+    benchmark()
+    unittest.main()
@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+
+#
+# Copyright (c) 2013
+#     Nexa Center for Internet & Society, Politecnico di Torino (DAUIN),
+#     and Simone Basso <bassosimone@gmail.com>
+#
+# This file is part of Neubot <http://www.neubot.org/>.
+#
+# Neubot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Neubot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Neubot.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+''' Regression test and loop pause benchmark for neubot/log_writer.py '''
+
+import os
+import shutil
+import socket
+import sqlite3
+import sys
+import tempfile
+import threading
+import unittest
+
+if __name__ == '__main__':
+    sys.path.insert(0, '.')
+
+from neubot.database import table_log
+from neubot.log_writer import LogWriter
+from neubot.pollable import Pollable
+from neubot.poller import POLLER
+
+from neubot import utils
+
+#
+# We're accessing private methods and we don't maintain
+# unittest, so we don't care about the number of methods.
+#
+# pylint: disable=W0212,R0904
+#
+
+def _record(severity='INFO', message='message', timestamp=None):
+    ''' Create a log record '''
+    if timestamp is None:
+        timestamp = utils.timestamp()
+    return {'timestamp': timestamp, 'severity': severity, 'message': message}
+
+def _listify(path):
+    ''' Return the records saved at path '''
+    connection = sqlite3.connect(path)
+    connection.row_factory = sqlite3.Row
+    result = table_log.listify(connection)
+    connection.close()
+    return result
+
+class TestLogWriter(unittest.TestCase):
+    ''' Regression test for LogWriter '''
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'database.sqlite3')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_batches(self):
+        ''' Make sure we write records in a background thread '''
+        writer = LogWriter()
+        writer.start(self.path)
+        for index in range(100):
+            writer.append(_record(message=str(index)), index == 99)
+        writer.flush()
+        self.assertTrue(writer.thread.isAlive())
+        self.assertTrue(writer.thread is not threading.currentThread())
+        self.assertEqual([row['message'] for row in _listify(self.path)],
+                         [str(index) for index in range(100)])
+        snap = writer.snap()
+        self.assertEqual(snap['written'], 100)
+        self.assertEqual(snap['queue'], 0)
+        self.assertEqual(snap['errors'], 0)
+        self.assertTrue(snap['threaded'])
+
+    def test_no_commit(self):
+        ''' Make sure we don't write unless asked to do so '''
+        writer = LogWriter()
+        writer.start(self.path)
+        writer.append(_record(), False)
+        self.assertEqual(writer.thread, None)
+        self.assertEqual(len(writer.pending()), 1)
+        writer.flush()
+        self.assertEqual(writer.pending(), [])
+        self.assertEqual(len(_listify(self.path)), 1)
+
+    def test_drop_policy(self):
+        ''' Make sure we drop records when the queue is full '''
+        writer = LogWriter(maxqueue=4)
+        for index in range(4):
+            writer.append(_record(message=str(index)), False)
+        writer.append(_record('DEBUG', 'dropped'), False)
+        writer.append(_record('INFO', 'dropped'), False)
+        writer.append(_record('ERROR', 'kept'), False)
+        self.assertEqual([record['message'] for record in writer.pending()],
+                         ['1', '2', '3', 'kept'])
+        self.assertEqual(writer.snap()['dropped'], 3)
+
+        writer.start(self.path)
+        writer.flush()
+        rows = _listify(self.path)
+        self.assertEqual([row['message'] for row in rows[:4]],
+                         ['1', '2', '3', 'kept'])
+        self.assertEqual(rows[4]['severity'], 'WARNING')
+        self.assertEqual(rows[4]['message'],
+                         'log: dropped 3 records (queue full)')
+
+    def test_concurrent_flush(self):
+        ''' Make sure flush() waiters do not steal the worker wakeup '''
+        writer = LogWriter()
+        writer.start(self.path)
+        writer.append(_record(), True)
+        writer.flush()
+
+        def flusher(index):
+            ''' Append a record and wait for it to be written '''
+            for count in range(10):
+                writer.append(_record(message='%d.%d' % (index, count)),
+                              False)
+                writer.flush(timeout=30.0)
+
+        begin = utils.ticks()
+        threads = [threading.Thread(target=flusher, args=(index,))
+                   for index in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(utils.ticks() - begin < 30.0)
+        self.assertEqual(writer.pending(), [])
+        self.assertEqual(len(_listify(self.path)), 41)
+
+    def test_maintain(self):
+        ''' Make sure we prune old records and vacuum '''
+        writer = LogWriter()
+        writer.start(self.path)
+        writer.append(_record(message='old', timestamp=1), False)
+        writer.append(_record(message='new'), True)
+        writer.flush()
+        self.assertEqual(len(_listify(self.path)), 2)
+        writer.maintain(7, True)
+        writer.flush()
+        self.assertEqual([row['message'] for row in _listify(self.path)],
+                         ['new'])
+        self.assertEqual(writer.snap()['vacuums'], 1)
+
+    def test_memory(self):
+        ''' Make sure we write synchronously into in-memory databases '''
+        connection = sqlite3.connect(':memory:')
+        connection.row_factory = sqlite3.Row
+        table_log.create(connection)
+        writer = LogWriter()
+        writer.start(':memory:', connection)
+        writer.append(_record(), True)
+        self.assertEqual(writer.thread, None)
+        self.assertEqual(len(table_log.listify(connection)), 1)
+        self.assertFalse(writer.snap()['threaded'])
+
+#
+# Loop pause benchmark: while the poller loop logs heavily, the
+# writer persists the records and periodically prunes and vacuums
+# the database.  A probe scheduled every PROBE_INTERVAL seconds
+# measures by how much the loop is late.  We run the writer in its
+# thread and synchronously in the poller thread, i.e. as we did
+# before the writer was introduced.
+#
+
+DURATION = 2.0
+PROBE_INTERVAL = 0.01
+RECORDS_PER_TICK = 256
+NOCOMMIT = 32
+
+# Max loop pause we tolerate when writing in the background
+MAXPAUSE = 0.25
+
+class SyncLogWriter(LogWriter):
+    ''' Write records in the poller thread '''
+
+    def is_threaded(self):
+        return False
+
+class IdleSocket(Pollable):
+    ''' Keep the poller loop running '''
+
+    def __init__(self):
+        Pollable.__init__(self)
+        self.sockets = socket.socketpair()
+
+    def fileno(self):
+        return self.sockets[0].fileno()
+
+def _run_loop(writer, path, wfile):
+    ''' Log heavily and measure the loop pauses '''
+    state = {'maxpause': 0.0, 'expected': 0.0, 'count': 0}
+    writer.start(path)
+
+    def probe():
+        ''' Measure how late we are '''
+        now = utils.ticks()
+        state['maxpause'] = max(state['maxpause'], now - state['expected'])
+        state['expected'] = now + PROBE_INTERVAL
+        POLLER.sched(PROBE_INTERVAL, probe)
+
+    def produce():
+        ''' Log many records '''
+        for _ in range(RECORDS_PER_TICK):
+            state['count'] += 1
+            writer.append(_record(message='x' * 80),
+                          state['count'] % NOCOMMIT == 0)
+        POLLER.sched(PROBE_INTERVAL, produce)
+
+    def maintain():
+        ''' Prune and vacuum '''
+        writer.maintain(7, True)
+        POLLER.sched(DURATION / 4, maintain)
+
+    def finish():
+        ''' Report the results '''
+        os.write(wfile, '%f %d %d\n' % (state['maxpause'], state['count'],
+                                        writer.snap()['dropped']))
+        POLLER.break_loop()
+
+    POLLER.set_readable(IdleSocket())
+    state['expected'] = utils.ticks()
+    probe()
+    produce()
+    POLLER.sched(DURATION / 4, maintain)
+    POLLER.sched(DURATION, finish)
+    POLLER.loop()
+
+def measure_pause(threaded):
+    ''' Return max loop pause, records logged and records dropped '''
+    tempdir = tempfile.mkdtemp()
+    rfile, wfile = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(rfile)
+            if threaded:
+                writer = LogWriter()
+            else:
+                writer = SyncLogWriter()
+            _run_loop(writer, os.path.join(tempdir,
+                      'database.sqlite3'), wfile)
+        finally:
+            os._exit(0)
+    os.close(wfile)
+    result = os.fdopen(rfile).read().split()
+    os.waitpid(pid, 0)
+    shutil.rmtree(tempdir)
+    return float(result[0]), int(result[1]), int(result[2])
+
+class TestLoopPause(unittest.TestCase):
+    ''' Make sure the loop does not stall while we persist logs '''
+
+    def test_pause(self):
+        ''' Make sure the max loop pause stays bounded '''
+        maxpause, count, dropped = measure_pause(True)
+        self.assertTrue(maxpause < MAXPAUSE)
+        self.assertTrue(count > 0)
+        self.assertTrue(dropped < count)
+
+def benchmark():
+    ''' Compare synchronous and background writeback '''
+    sys.stdout.write('Max poller loop pause while logging heavily:\n')
+    for name, threaded in (('poller', False), ('thread', True)):
+        maxpause, count, dropped = measure_pause(threaded)
+        sys.stdout.write('  %-6s: %s (%d records, %d dropped)\n' % (name,
+          utils.time_formatter(maxpause), count, dropped))
+
+if __name__ == '__main__':
+    benchmark()
+    unittest.main()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+
+#
+# Copyright (c) 2013
+#     Nexa Center for Internet & Society, Politecnico di Torino (DAUIN),
+#     and Simone Basso <bassosimone@gmail.com>
+#
+# This file is part of Neubot <http://www.neubot.org/>.
+#
+# Neubot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Neubot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Neubot.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+''' Regression test and benchmark for neubot/negotiate/indexed_queue.py '''
+
+import collections
+import random
+import sys
+import unittest
+
+if __name__ == '__main__':
+    sys.path.insert(0, '.')
+
+from neubot.negotiate.indexed_queue import IndexedQueue
+
+from neubot import utils
+
+#
+# We don't maintain unittest, so we don't care about the number
+# of methods.
+#
+# pylint: disable=R0904
+#
+
+class TestIndexedQueue(unittest.TestCase):
+    ''' Regression test for IndexedQueue '''
+
+    def test_basics(self):
+        ''' Make sure append, remove and position work '''
+        queue = IndexedQueue()
+        for key in 'abcde':
+            self.assertEqual(queue.append(key), len(queue) - 1)
+        self.assertRaises(ValueError, queue.append, 'a')
+        self.assertEqual(queue.remove('b'), 1)
+        self.assertEqual(queue.remove('d'), 2)
+        self.assertRaises(KeyError, queue.remove, 'd')
+        self.assertRaises(KeyError, queue.position, 'd')
+        self.assertEqual(list(queue), ['a', 'c', 'e'])
+        self.assertEqual([queue.position(key) for key in 'ace'], [0, 1, 2])
+        self.assertEqual((queue[0], queue[-1], queue[1]), ('a', 'e', 'c'))
+        self.assertRaises(IndexError, queue.__getitem__, 3)
+        self.assertTrue('c' in queue)
+        self.assertFalse('b' in queue)
+
+    def test_random(self):
+        ''' Compare with a list under random appends and removals '''
+        queue, reference = IndexedQueue(), []
+        for key in xrange(20000):
+            if reference and random.random() < 0.5:
+                victim = random.choice(reference)
+                self.assertEqual(queue.remove(victim),
+                                 reference.index(victim))
+                reference.remove(victim)
+            else:
+                self.assertEqual(queue.append(key), len(reference))
+                reference.append(key)
+            if key % 1000 == 0:
+                self.assertEqual(list(queue), reference)
+                for position, elem in enumerate(reference):
+                    self.assertEqual(queue.position(elem), position)
+                    self.assertEqual(queue[position], elem)
+        self.assertEqual(list(queue), reference)
+        self.assertEqual(len(queue), len(reference))
+
+    def test_renumber(self):
+        ''' Make sure we renumber keys when we run out of sequence
+            numbers, and we start over when the queue is empty '''
+        queue, reference = IndexedQueue(), []
+        for key in xrange(1000):
+            queue.append(key)
+            reference.append(key)
+            if key % 3:
+                queue.remove(key - 1)
+                reference.remove(key - 1)
+        self.assertEqual(list(queue), reference)
+        self.assertEqual([queue.position(key) for key in reference],
+                         range(len(reference)))
+        self.assertTrue(queue.capacity < 4 * len(reference))
+        for key in reference:
+            queue.remove(key)
+        self.assertEqual((len(queue), queue.keys), (0, []))
+        self.assertEqual(queue.append('x'), 0)
+        self.assertEqual(queue[0], 'x')
+
+#
+# Benchmark: we fill a queue with QUEUE_LEN keys, then we remove
+# them all, from the head, from the tail and at random, and we
+# compare with a list, which the master process used before, and
+# with a deque, which the negotiate server used before.  With the
+# list we also find the position of the key, as the master did.
+#
+
+QUEUE_LEN = 10000
+
+def _remove_list(queue, key):
+    ''' Remove key from a list and return its position '''
+    position = queue.index(key)
+    del queue[position]
+    return position
+
+def benchmark():
+    ''' Compare IndexedQueue with a list and a deque '''
+    sys.stdout.write('Remove %d keys:\n' % QUEUE_LEN)
+    for name in ('head', 'tail', 'random'):
+        keys = range(QUEUE_LEN)
+        if name == 'tail':
+            keys.reverse()
+        elif name == 'random':
+            random.shuffle(keys)
+        results = []
+        for factory, remove in ((list, _remove_list),
+                                (collections.deque, collections.deque.remove),
+                                (IndexedQueue, IndexedQueue.remove)):
+            queue = factory()
+            for key in xrange(QUEUE_LEN):
+                queue.append(key)
+            begin = utils.ticks()
+            for key in keys:
+                remove(queue, key)
+            results.append(utils.time_formatter((utils.ticks() - begin)
+                                                / QUEUE_LEN))
+        sys.stdout.write('  from the %-6s: list %s, deque %s, IndexedQueue '
+                         '%s\n' % (name, results[0], results[1], results[2]))
+
+if __name__ == '__main__':
+    benchmark()
+    unittest.main()
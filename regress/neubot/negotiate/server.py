@@ -21,6 +21,8 @@
 #
 
 import StringIO
+import collections
+import os
 import sys
 import unittest
 
@@ -29,12 +31,16 @@ if __name__ == "__main__":
 
 from neubot.config import CONFIG
 from neubot.http.message import Message
+from neubot.http_clnt import HttpClient
 from neubot.negotiate.server import NEGOTIATE_SERVER
 from neubot.negotiate.server import NegotiateServerModule
 from neubot.negotiate.server import NegotiateServer
+from neubot.poller import POLLER
 
 from neubot.compat import json
 
+from neubot import utils
+
 class MinimalHttpStream:
     ''' Minimal HTTP stream '''
 
@@ -330,6 +336,7 @@ class UpdateQueue(unittest.TestCase):
             stream = MinimalHttpStream()
             server.queue.append(stream)
             server.known.add(stream)
+            server.waiting.add(stream)
             stream.opaque = position
 
         lost_stream = server.queue[2]
@@ -348,6 +355,7 @@ class UpdateQueue(unittest.TestCase):
             stream = MinimalHttpStream()
             server.queue.append(stream)
             server.known.add(stream)
+            server.waiting.add(stream)
             stream.opaque = position
 
         lost_stream = server.queue[2]
@@ -358,5 +366,325 @@ class UpdateQueue(unittest.TestCase):
                                              (server.queue[2], 4, 2),
                                             ])
 
+class QueueCounters(unittest.TestCase):
+
+    ''' Verifies the queue counters of NEGOTIATE_SERVER '''
+
+    def test_counters(self):
+        ''' Make sure we count joins, rejects, unchokes and waits '''
+
+        server = NegotiateServer(None)
+        server.register_module('abc', NegotiateServerModule())
+        parallelism = CONFIG['negotiate.parallelism']
+
+        streams = []
+        for _ in range(parallelism + 2):
+            stream = MinimalHttpStream()
+            request = Message(uri='/negotiate/abc')
+            request.body = StringIO.StringIO('{}')
+            server.process_request(stream, request)
+            streams.append(stream)
+
+        # The last stream in queue gives up, then the first is done
+        server._update_queue(streams[-1], None)
+        request = Message(uri='/negotiate/abc')
+        request.body = StringIO.StringIO('{}')
+        server.process_request(streams[-2], request)
+        server._update_queue(streams[0], None)
+        self.assertEqual(json.loads(streams[-2].response.body)['unchoked'], 1)
+
+        # Make the queue so long that RED always rejects
+        saved = (CONFIG['negotiate.min_thresh'],
+                 CONFIG['negotiate.max_thresh'])
+        CONFIG['negotiate.min_thresh'] = 0
+        CONFIG['negotiate.max_thresh'] = 1
+        try:
+            server.process_request(MinimalHttpStream(),
+                                   Message(uri='/negotiate/abc'))
+        finally:
+            CONFIG['negotiate.min_thresh'] = saved[0]
+            CONFIG['negotiate.max_thresh'] = saved[1]
+
+        data = {}
+        server.snap(data)
+        self.assertEqual(data['negotiate']['queue_len'], parallelism)
+        self.assertEqual(data['negotiate']['joined'], parallelism + 2)
+        self.assertEqual(data['negotiate']['rejected'], 1)
+        self.assertEqual(data['negotiate']['unchoked'], parallelism + 1)
+        self.assertEqual(data['negotiate']['abandoned'], 1)
+        self.assertTrue(data['negotiate']['wait_max'] >=
+                        data['negotiate']['wait_avg'] >= 0)
+
+#
+# Simulation: SIM_CLIENTS synthetic clients negotiate and collect
+# with a real NegotiateServer over loopback, at most SIM_CONCURRENCY
+# at a time (more than negotiate.max_thresh, so RED drops some of
+# them).  Like the real clients, they negotiate again each time they
+# get a response and they are choked, and they collect as soon as
+# they are unchoked.
+#
+
+SIM_CLIENTS = 10000
+SIM_CONCURRENCY = 48
+
+class SimModule(NegotiateServerModule):
+
+    ''' Negotiate module that checks parallelism '''
+
+    def __init__(self):
+        self.active = set()
+        self.max_active = 0
+
+    def unchoke(self, stream, request_body):
+        self.active.add(stream)
+        self.max_active = max(self.max_active, len(self.active))
+        return NegotiateServerModule.unchoke(self, stream, request_body)
+
+    def collect(self, stream, request_body):
+        self.active.remove(stream)
+        return request_body
+
+class SimServer(NegotiateServer):
+
+    ''' Negotiate server that tells us its port '''
+
+    def __init__(self, poller):
+        NegotiateServer.__init__(self, poller)
+        self.port = 0
+
+    def started_listening(self, listener):
+        self.port = listener.lsock.getsockname()[1]
+
+class SimClient(HttpClient):
+
+    ''' Synthetic negotiate client '''
+
+    def __init__(self, port, count, concurrency):
+        HttpClient.__init__(self)
+        self.port = port
+        self.left = count
+        self.running = 0
+        self.results = collections.defaultdict(int)
+        self.positions_ok = True
+        for _ in range(concurrency):
+            self._start()
+
+    def _start(self):
+        ''' Start a new client, if any '''
+        if self.left <= 0:
+            if self.running == 0:
+                POLLER.break_loop()
+            return
+        self.left -= 1
+        self.running += 1
+        self.connect(('127.0.0.1', self.port), False, 0, {
+                     'phase': 'negotiate', 'position': None})
+
+    def handle_connect_error(self, connector):
+        self.results['connect_error'] += 1
+        self.running -= 1
+        self._start()
+
+    def handle_connect(self, connector, sock, rtt, sslconfig, extra):
+        self.create_stream(sock, self._send_request, self._connection_lost,
+                           sslconfig, None, extra)
+
+    def _send_request(self, stream):
+        ''' Send a negotiate or collect request '''
+        context = stream.opaque
+        uri = '/%s/sim' % context.extra['phase']
+        self.append_request(stream, 'POST', uri, 'HTTP/1.1')
+        self.append_header(stream, 'Host', '127.0.0.1:%d' % self.port)
+        self.append_header(stream, 'Content-Type', 'application/json')
+        self.append_header(stream, 'Content-Length', '2')
+        self.append_end_of_headers(stream)
+        self.append_bytes(stream, '{}')
+        self.send_message(stream)
+        context.body = StringIO.StringIO()
+
+    def handle_end_of_body(self, stream):
+        HttpClient.handle_end_of_body(self, stream)
+        context = stream.opaque
+        extra = context.extra
+        response = json.loads(context.body.getvalue())
+        if extra['phase'] == 'collect':
+            extra['phase'] = 'done'
+            stream.close()
+            return
+        # The position never grows while we are in the queue
+        if (extra['position'] is not None and
+                response['queue_pos'] >= extra['position']):
+            self.positions_ok = False
+        extra['position'] = response['queue_pos']
+        if response['unchoked']:
+            extra['phase'] = 'collect'
+        self._send_request(stream)
+
+    def _connection_lost(self, stream):
+        ''' Account for a finished client '''
+        extra = stream.opaque.extra
+        if extra['phase'] == 'done':
+            self.results['done'] += 1
+        elif extra['position'] is None:
+            self.results['rejected'] += 1
+        else:
+            self.results['failed'] += 1
+        self.running -= 1
+        self._start()
+
+def _simulate(count, concurrency):
+    ''' Run the simulation and return a summary '''
+    server = SimServer(POLLER)
+    module = SimModule()
+    server.register_module('sim', module)
+    server.configure(CONFIG.copy())
+    server.listen(('127.0.0.1', 0))
+    begin = utils.ticks()
+    client = SimClient(server.port, count, concurrency)
+    POLLER.loop()
+    summary = {
+               'elapsed': utils.ticks() - begin,
+               'results': dict(client.results),
+               'positions_ok': client.positions_ok,
+               'max_active': module.max_active,
+               'queue': len(server.queue),
+               'known': len(server.known),
+               'waiting': len(server.waiting),
+              }
+    server.snap(summary)
+    return summary
+
+# The benchmark and the test share the same run
+SIMULATIONS = {}
+
+def simulate(count, concurrency):
+    ''' Run the simulation in a child process (so the access log
+        does not clobber our output) and return a summary '''
+    if (count, concurrency) in SIMULATIONS:
+        return SIMULATIONS[(count, concurrency)]
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(rfd)
+            devnull = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(devnull, 2)
+            os.write(wfd, json.dumps(_simulate(count, concurrency)))
+        finally:
+            os._exit(0)
+    os.close(wfd)
+    vector = []
+    while True:
+        data = os.read(rfd, 65536)
+        if not data:
+            break
+        vector.append(data)
+    os.close(rfd)
+    os.waitpid(pid, 0)
+    summary = json.loads(''.join(vector))
+    SIMULATIONS[(count, concurrency)] = summary
+    return summary
+
+class Simulation(unittest.TestCase):
+
+    ''' Drives synthetic clients through negotiate and collect '''
+
+    def test_simulation(self):
+        ''' Make sure the queue behaves under churn '''
+        summary = simulate(SIM_CLIENTS, SIM_CONCURRENCY)
+        results = summary['results']
+        self.assertEqual(results.get('done', 0) + results.get('rejected', 0),
+                         SIM_CLIENTS)
+        self.assertTrue(results.get('rejected', 0) > 0)
+        self.assertTrue(summary['positions_ok'])
+        self.assertEqual(summary['max_active'],
+                         CONFIG['negotiate.parallelism'])
+        self.assertEqual(summary['queue'], 0)
+        self.assertEqual(summary['known'], 0)
+        self.assertEqual(summary['waiting'], 0)
+        self.assertEqual(summary['negotiate']['joined'], results['done'])
+        self.assertEqual(summary['negotiate']['rejected'],
+                         results['rejected'])
+        self.assertEqual(summary['negotiate']['unchoked'], results['done'])
+
+#
+# Benchmark: QUEUE_LEN streams are in queue and PENDING of them owe
+# a response, and we remove the stream at the head of the queue
+# until the queue is empty, as happens when the streams run their
+# test one after the other.  We compare the old _update_queue(),
+# which rebuilt the whole queue each time, with the current one.
+#
+
+QUEUE_LEN = 10000
+PENDING = 100
+
+class LegacyServer(NegotiateServerForUpdateQueue):
+
+    ''' Negotiate server with the old _update_queue() '''
+
+    def __init__(self, poller):
+        NegotiateServerForUpdateQueue.__init__(self, poller)
+        self.queue = collections.deque()
+
+    def _update_queue(self, lost_stream, ignored):
+        queue, found = collections.deque(), False
+        position = 0
+        for stream in self.queue:
+            if not found:
+                if lost_stream != stream:
+                    position += 1
+                    queue.append(stream)
+                else:
+                    found = True
+                    self.known.remove(stream)
+            elif not stream.opaque:
+                position += 1
+                queue.append(stream)
+            else:
+                request, stream.opaque = stream.opaque, None
+                self._do_negotiate((stream, request, position))
+                position += 1
+                queue.append(stream)
+        self.queue = queue
+
+def _drain(server):
+    ''' Fill the queue, then drain it from the head '''
+    streams = []
+    for index in range(QUEUE_LEN):
+        stream = MinimalHttpStream()
+        server.queue.append(stream)
+        server.known.add(stream)
+        streams.append(stream)
+    begin = utils.ticks()
+    for index, stream in enumerate(streams):
+        # Keep PENDING streams waiting at the tail of the queue
+        if index % (QUEUE_LEN / PENDING) == 0:
+            waiter = streams[-1 - index / (QUEUE_LEN / PENDING)]
+            if waiter in server.known:
+                waiter.opaque = 'request'
+                if hasattr(server, 'waiting'):
+                    server.waiting.add(waiter)
+        server._update_queue(stream, None)
+    return utils.ticks() - begin
+
+def benchmark():
+    ''' Compare old and new queue management '''
+    sys.stdout.write('Drain a queue of %d streams, %d of them waiting:\n'
+                     % (QUEUE_LEN, PENDING))
+    for name, server in (('before', LegacyServer(None)),
+                         ('after', NegotiateServerForUpdateQueue(None))):
+        elapsed = _drain(server)
+        sys.stdout.write('  %-6s: %s per removal (%d responses)\n' % (name,
+          utils.time_formatter(elapsed / QUEUE_LEN), len(server.negotiated)))
+
+    summary = simulate(SIM_CLIENTS, SIM_CONCURRENCY)
+    sys.stdout.write('Simulation: %d clients (%d at a time) in %.1f s: '
+      '%d done, %d rejected, wait avg %s max %s\n' % (SIM_CLIENTS,
+      SIM_CONCURRENCY, summary['elapsed'], summary['results']['done'],
+      summary['results']['rejected'],
+      utils.time_formatter(summary['negotiate']['wait_avg']),
+      utils.time_formatter(summary['negotiate']['wait_max'])))
+
 if __name__ == "__main__":
+    benchmark()
     unittest.main()
@@ -21,17 +21,98 @@
 #
 
 import StringIO
+import os
 import random
+import socket
 import struct
 import sys
+import tempfile
 import unittest
 
+#
+# Make sure that strings queued after the one we are sending are
+# gathered into a single vectored send, and that we correctly
+# resume after a short write.
+#
+class ShortWriteWrapper(object):
+    can_sendv = True
+
+    def __init__(self, maxcount):
+        self.maxcount = maxcount
+        self.data = []
+        self.calls = 0
+
+    def sosend(self, octets):
+        self.calls += 1
+        octets = str(octets)[:self.maxcount]
+        self.data.append(octets)
+        return stream.SUCCESS, len(octets)
+
+    def sosendv(self, vector):
+        self.calls += 1
+        octets = "".join(str(elem) for elem in vector)[:self.maxcount]
+        self.data.append(octets)
+        return stream.SUCCESS, len(octets)
+
+class TestStreamSend_Vectored(unittest.TestCase):
+
+    def _send(self, maxcount, messages):
+        s = stream.Stream(self)
+        s.sock = ShortWriteWrapper(maxcount)
+        self.complete = False
+        s.send_complete = lambda: setattr(self, "complete", True)
+        for message in messages:
+            s.start_send(message)
+        while not self.complete:
+            s.handle_write()
+        expected = "".join(m if isinstance(m, basestring) else m.getvalue()
+                           for m in messages)
+        self.assertEqual("".join(s.sock.data), expected)
+        self.assertEqual(s.bytes_sent_tot, len(expected))
+        self.assertEqual(len(s.send_queue), 0)
+        return s.sock.calls
+
+    def test_gather(self):
+        """Make sure we send queued strings with a single call"""
+        self.assertEqual(self._send(65536, ["A" * 10, "B" * 1400,
+                                            "", "\r\n"]), 1)
+
+    def test_short_writes(self):
+        """Make sure we handle short writes across the buffers"""
+        messages = []
+        for index in range(64):
+            messages.append("%x\r\n" % index)
+            messages.append(chr(65 + index % 26) * random.randrange(1, 300))
+            messages.append("\r\n")
+        for maxcount in (1, 3, 7, 64, 1000):
+            self._send(maxcount, messages)
+
+    def test_not_strings(self):
+        """Make sure we don't gather files in the queue"""
+        self._send(5, ["HEAD", StringIO.StringIO("BODY"), "TAIL", "!"])
+
+    def test_disabled(self):
+        """Make sure we send one buffer at a time without sendv"""
+        ShortWriteWrapper.can_sendv = False
+        try:
+            self.assertEqual(self._send(65536, ["A", "B", "C"]), 3)
+        finally:
+            ShortWriteWrapper.can_sendv = True
+
+    # Invoked by the stream
+    def set_writable(self, stream):
+        pass
+    def unset_writable(self, stream):
+        pass
+
 if __name__ == "__main__":
     sys.path.insert(0, ".")
 
 from neubot.config import CONFIG
 from neubot.net import stream
 
+from neubot import utils_net
+
 #
 # Provide the bare minimum needed to look
 # like a socket.  Raise on close(), send()
@@ -469,5 +550,192 @@ class TestStreamSend_ReandSendQueue_NotEmpty(unittest.TestCase):
     def set_writable(self, stream):
         pass
 
+#
+# Make sure that files in the send queue are transmitted with
+# sendfile(), when possible, and that the result is the same we
+# would have got by reading the file.
+#
+def _loopback_pair():
+    lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    lsock.bind(("127.0.0.1", 0))
+    lsock.listen(1)
+    left = socket.create_connection(lsock.getsockname())
+    right = lsock.accept()[0]
+    lsock.close()
+    return left, right
+
+class TestStreamSend_Sendfile(unittest.TestCase):
+
+    def setUp(self):
+        self.left, self.right = _loopback_pair()
+        self.left.setblocking(False)
+        self.filep = tempfile.TemporaryFile()
+        self.content = os.urandom(1 << 20)
+        self.filep.write(self.content)
+        self.filep.seek(0)
+        self.writable = False
+        self.complete = False
+
+    def tearDown(self):
+        self.left.close()
+        self.right.close()
+        self.filep.close()
+
+    def _send(self, sendfile):
+        conf = CONFIG.copy()
+        conf["net.stream.sendfile"] = sendfile
+        s = stream.Stream(self)
+        s.attach(self, self.left, conf)
+        s.send_complete = lambda: setattr(self, "complete", True)
+        s.start_send("HEAD")
+        s.start_send(self.filep)
+        s.start_send("TAIL")
+
+        expected = "HEAD" + self.content + "TAIL"
+        data, total = [], 0
+        while total < len(expected):
+            if not self.complete:
+                s.handle_write()
+            data.append(self.right.recv(1 << 20))
+            total += len(data[-1])
+        self.assertTrue(self.complete)
+        self.assertTrue("".join(data) == expected)
+        self.assertEqual(s.bytes_sent_tot, len(self.content) + 8)
+        return s
+
+    def test_sendfile(self):
+        """Make sure we use sendfile() when it's available"""
+        if utils_net.SENDFILE is None:
+            return
+        calls = []
+        saved = utils_net.SENDFILE
+        def counting(*args):
+            calls.append(args)
+            return saved(*args)
+        utils_net.SENDFILE = counting
+        try:
+            self._send(True)
+        finally:
+            utils_net.SENDFILE = saved
+        self.assertTrue(calls)
+
+    def test_offset(self):
+        """Make sure we start from the current file position"""
+        if utils_net.SENDFILE is None:
+            return
+        self.filep.seek(1000)
+        self.content = self.content[1000:]
+        self._send(True)
+
+    def test_fallback(self):
+        """Make sure we read() the file when sendfile() is disabled"""
+        saved = utils_net.SENDFILE
+        utils_net.SENDFILE = None
+        try:
+            self._send(True)
+        finally:
+            utils_net.SENDFILE = saved
+
+    def test_disabled(self):
+        """Make sure we honor net.stream.sendfile"""
+        s = stream.Stream(self)
+        conf = CONFIG.copy()
+        conf["net.stream.sendfile"] = False
+        s.attach(self, self.left, conf)
+        self.assertFalse(s.sock.can_sendfile)
+
+    def test_not_regular(self):
+        """Make sure we don't sendfile() non regular files"""
+        self.assertEqual(stream._make_fileslice(StringIO.StringIO("x")), None)
+        rfd, wfd = os.pipe()
+        pipe = os.fdopen(rfd, "rb")
+        self.assertEqual(stream._make_fileslice(pipe), None)
+        pipe.close()
+        os.close(wfd)
+
+    # Invoked by the stream
+    def set_writable(self, stream):
+        self.writable = True
+    def unset_writable(self, stream):
+        self.writable = False
+    def connection_lost(self, stream):
+        pass
+
+#
+# Make sure that strings queued after the one we are sending are
+# gathered into a single vectored send, and that we correctly
+# resume after a short write.
+#
+class ShortWriteWrapper(object):
+    can_sendv = True
+
+    def __init__(self, maxcount):
+        self.maxcount = maxcount
+        self.data = []
+        self.calls = 0
+
+    def sosend(self, octets):
+        self.calls += 1
+        octets = str(octets)[:self.maxcount]
+        self.data.append(octets)
+        return stream.SUCCESS, len(octets)
+
+    def sosendv(self, vector):
+        self.calls += 1
+        octets = "".join(str(elem) for elem in vector)[:self.maxcount]
+        self.data.append(octets)
+        return stream.SUCCESS, len(octets)
+
+class TestStreamSend_Vectored(unittest.TestCase):
+
+    def _send(self, maxcount, messages):
+        s = stream.Stream(self)
+        s.sock = ShortWriteWrapper(maxcount)
+        self.complete = False
+        s.send_complete = lambda: setattr(self, "complete", True)
+        for message in messages:
+            s.start_send(message)
+        while not self.complete:
+            s.handle_write()
+        expected = "".join(m if isinstance(m, basestring) else m.getvalue()
+                           for m in messages)
+        self.assertEqual("".join(s.sock.data), expected)
+        self.assertEqual(s.bytes_sent_tot, len(expected))
+        self.assertEqual(len(s.send_queue), 0)
+        return s.sock.calls
+
+    def test_gather(self):
+        """Make sure we send queued strings with a single call"""
+        self.assertEqual(self._send(65536, ["A" * 10, "B" * 1400,
+                                            "", "\r\n"]), 1)
+
+    def test_short_writes(self):
+        """Make sure we handle short writes across the buffers"""
+        messages = []
+        for index in range(64):
+            messages.append("%x\r\n" % index)
+            messages.append(chr(65 + index % 26) * random.randrange(1, 300))
+            messages.append("\r\n")
+        for maxcount in (1, 3, 7, 64, 1000):
+            self._send(maxcount, messages)
+
+    def test_not_strings(self):
+        """Make sure we don't gather files in the queue"""
+        self._send(5, ["HEAD", StringIO.StringIO("BODY"), "TAIL", "!"])
+
+    def test_disabled(self):
+        """Make sure we send one buffer at a time without sendv"""
+        ShortWriteWrapper.can_sendv = False
+        try:
+            self.assertEqual(self._send(65536, ["A", "B", "C"]), 3)
+        finally:
+            ShortWriteWrapper.can_sendv = True
+
+    # Invoked by the stream
+    def set_writable(self, stream):
+        pass
+    def unset_writable(self, stream):
+        pass
+
 if __name__ == "__main__":
     unittest.main()
@@ -22,16 +22,22 @@
 
 ''' Regression test for neubot/poller.py '''
 
+import errno
 import sys
 import unittest
 
 if __name__ == '__main__':
     sys.path.insert(0, '.')
 
+from neubot.pollable import Pollable
+from neubot.poller_backend import READABLE
+from neubot.poller import BackendError
+from neubot.poller import CHECK_TIMEOUT
 from neubot.poller import Poller
+from neubot.utils import ticks
 
-class TestCheckTimeoutStream(object):
-    ''' Fake stream for TestCheckTimeout '''
+class TestWatchdogStream(object):
+    ''' Fake stream for TestWatchdog '''
 
     def __init__(self, result, fileno):
         '''Initialize fake stream '''
@@ -60,30 +66,70 @@ class TestCheckTimeoutStream(object):
         ''' String representation of this stream '''
         return "stream %d" % self._fileno
 
-class TestCheckTimeout(unittest.TestCase):
-    ''' Regression test for poller.check_timeout() '''
+#
+# Use the select() backend because the fake streams do not
+# have valid file descriptors, and select() is the only backend
+# that does not check them until wait() is invoked.
+#
+
+class TestWatchdog(unittest.TestCase):
+    ''' Regression test for the poller watchdog timers '''
 
     def test_readable(self):
         ''' Make sure it runs when there's only readable stuff '''
-        poller = Poller(1)
+        poller = Poller(1, 'select')
         result = []
-        stream = TestCheckTimeoutStream(result, 1)
-        poller.readset[1] = stream
-        poller.check_timeout()
+        stream = TestWatchdogStream(result, 1)
+        poller.set_readable(stream)
+        poller.timers.run_expired(ticks() + CHECK_TIMEOUT)
         self.assertEqual(result, [1])
+        self.assertEqual(poller.watchdogs, {})
 
     def test_writable(self):
         ''' Make sure it runs when there's only writable stuff '''
-        poller = Poller(1)
+        poller = Poller(1, 'select')
+        result = []
+        stream = TestWatchdogStream(result, 1)
+        poller.set_writable(stream)
+        poller.timers.run_expired(ticks() + CHECK_TIMEOUT)
+        self.assertEqual(result, [1])
+
+    def test_dormant(self):
+        ''' Make sure the watchdog ignores unregistered streams '''
+        poller = Poller(1, 'select')
         result = []
-        stream = TestCheckTimeoutStream(result, 1)
-        poller.writeset[1] = stream
-        poller.check_timeout()
+        stream = TestWatchdogStream(result, 1)
+        poller.set_readable(stream)
+        poller.unset_readable(stream)
+        poller.timers.run_expired(ticks() + CHECK_TIMEOUT)
+        self.assertEqual(result, [])
+        self.assertEqual(poller.watchdogs, {})
+        self.assertEqual(len(poller.timers), 0)
+
+    def test_rearm(self):
+        ''' Make sure the timer is rearmed if the stream is alive '''
+        poller = Poller(1, 'select')
+        result = []
+        stream = TestWatchdogStream(result, 2)
+        poller.set_readable(stream)
+        poller.timers.run_expired(ticks() + CHECK_TIMEOUT)
+        self.assertEqual(result, [])
+        self.assertTrue(stream in poller.watchdogs)
+        self.assertEqual(len(poller.timers), 1)
+
+    def test_close(self):
+        ''' Make sure close() cancels the watchdog timer '''
+        poller = Poller(1, 'select')
+        result = []
+        stream = TestWatchdogStream(result, 1)
+        poller.set_readable(stream)
+        poller.close(stream)
         self.assertEqual(result, [1])
+        self.assertEqual(len(poller.timers), 0)
 
     def test_complete(self):
         ''' Make sure it works with both readable and writable streams '''
-        poller = Poller(1)
+        poller = Poller(1, 'select')
         result = []
 
         #
@@ -93,13 +139,13 @@ class TestCheckTimeout(unittest.TestCase):
         # streams are all processed correctly.
         #
         for i in range(256):
-            stream = TestCheckTimeoutStream(result, i)
-            poller.readset[i] = stream
+            stream = TestWatchdogStream(result, i)
+            poller.set_readable(stream)
             if i > 14 and i < 128:
-                poller.writeset[i] = stream
+                poller.set_writable(stream)
 
         # This should close odd streams only
-        poller.check_timeout()
+        poller.timers.run_expired(ticks() + CHECK_TIMEOUT)
 
         # Check we have closed the right streams
         self.assertEqual(sorted(result), range(1, 256, 2))
@@ -110,5 +156,102 @@ class TestCheckTimeout(unittest.TestCase):
         # Make sure the writable set is consistent
         self.assertEqual(sorted(poller.writeset), range(16, 128, 2))
 
+        # Make sure we have one timer for each live stream
+        self.assertEqual(len(poller.timers), 128)
+
+    def test_new_fileno(self):
+        ''' Make sure the watchdog follows a stream to a new fileno '''
+        poller = Poller(1, 'select')
+        result = []
+        stream = TestWatchdogStream(result, 2)
+        poller.set_writable(stream)
+        poller.unset_writable(stream)
+        stream._fileno = 3
+        poller.set_writable(stream)
+        poller.timers.run_expired(ticks() + CHECK_TIMEOUT)
+        self.assertEqual(result, [3])
+        self.assertEqual(poller.watchdogs, {})
+
+class TestWatchdogDeadline(unittest.TestCase):
+    ''' Make sure the watchdog honours the stream deadline '''
+
+    def test_deadline(self):
+        ''' Make sure the timer is armed at the stream deadline '''
+        poller = Poller(1, 'select')
+        stream = Pollable()
+        stream.fileno = lambda: 7
+        stream.watchdog = 30
+        poller.set_readable(stream)
+        timer = poller.watchdogs[stream]
+        self.assertTrue(abs(timer.deadline - (stream.created + 30)) < 0.1)
+
+    def test_reset(self):
+        ''' Make sure reset_watchdog() moves the deadline backward '''
+        poller = Poller(1, 'select')
+        stream = Pollable()
+        stream.fileno = lambda: 7
+        poller.set_readable(stream)
+        stream.watchdog = 5
+        poller.reset_watchdog(stream)
+        timer = poller.watchdogs[stream]
+        self.assertTrue(timer.deadline - ticks() < 5.1)
+        self.assertEqual(len(poller.timers), 1)
+
+class TestLoopBackend(object):
+    ''' Fake backend for TestLoop '''
+
+    name = 'fake'
+
+    def __init__(self, poller, errors):
+        ''' Initialize fake backend '''
+        self.poller = poller
+        self.errors = errors
+        self.waits = 0
+
+    def update(self, fileno, readable, writable):
+        ''' Fail like epoll does with a stale fileno '''
+        raise OSError(errno.EBADF, 'Bad file descriptor')
+
+    def wait(self, timeout):
+        ''' Return one event, then the configured errors '''
+        self.waits += 1
+        if self.waits == 1:
+            return [(1, READABLE)]
+        if self.errors:
+            raise self.errors.pop(0)
+        self.poller.break_loop()
+        return []
+
+class TestLoop(unittest.TestCase):
+    ''' Make sure loop() stops only when the backend fails '''
+
+    def _loop(self, errors):
+        ''' Run the loop with a stream that fails on read and whose
+            close() fails as well, plus an idle stream '''
+        poller = Poller(1, 'select')
+        stream = Pollable()
+        stream.fileno = lambda: 1
+        stream.handle_read = lambda: poller.set_writable(stream)
+        poller.readset[1] = stream
+        poller.readset[2] = Pollable()
+        poller.backend = TestLoopBackend(poller, errors)
+        poller.loop()
+        return poller
+
+    def test_callback_error(self):
+        ''' Make sure an OSError outside wait() does not stop loop() '''
+        poller = self._loop([])
+        self.assertEqual(poller.backend.waits, 2)
+
+    def test_eintr(self):
+        ''' Make sure loop() survives EINTR '''
+        poller = self._loop([OSError(errno.EINTR, 'Interrupted')])
+        self.assertEqual(poller.backend.waits, 3)
+
+    def test_wait_error(self):
+        ''' Make sure loop() raises if wait() fails '''
+        self.assertRaises(BackendError, self._loop,
+                          [OSError(errno.EBADF, 'Bad file descriptor')])
+
 if __name__ == '__main__':
     unittest.main()
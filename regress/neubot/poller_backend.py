@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+
+#
+# Copyright (c) 2013
+#     Nexa Center for Internet & Society, Politecnico di Torino (DAUIN),
+#     and Simone Basso <bassosimone@gmail.com>
+#
+# This file is part of Neubot <http://www.neubot.org/>.
+#
+# Neubot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Neubot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Neubot.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+''' Regression test and benchmark for neubot/poller_backend.py '''
+
+import socket
+import sys
+import unittest
+
+if __name__ == '__main__':
+    sys.path.insert(0, '.')
+
+from neubot.poller import Poller
+from neubot.poller_backend import READABLE
+from neubot.poller_backend import WRITABLE
+
+from neubot import poller_backend
+from neubot import utils
+
+#
+# We're accessing private methods and we don't maintain
+# unittest, so we don't care about the number of methods.
+#
+# pylint: disable=W0212,R0904
+#
+
+class FakeStream(object):
+    ''' Fake stream wrapping a socket '''
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.reads = 0
+        self.writes = 0
+
+    def fileno(self):
+        ''' Return file number '''
+        return self.sock.fileno()
+
+    def handle_read(self):
+        ''' Handle the READ event '''
+        self.reads += 1
+        self.sock.recv(65536)
+
+    def handle_write(self):
+        ''' Handle the WRITE event '''
+        self.writes += 1
+
+    def handle_close(self):
+        ''' Handle the CLOSE event '''
+
+    def handle_periodic(self, timenow):
+        ''' Handle the PERIODIC event '''
+        return False
+
+class BackendTestMixin(object):
+    ''' Tests that every backend must pass '''
+
+    name = ''
+
+    def setUp(self):
+        self.backend = poller_backend.create_backend(self.name)
+        self.left, self.right = socket.socketpair()
+
+    def tearDown(self):
+        self.backend.close()
+        self.left.close()
+        self.right.close()
+
+    def test_name(self):
+        ''' Make sure we've created the requested backend '''
+        self.assertEqual(self.backend.name, self.name)
+
+    def test_writable(self):
+        ''' Make sure an idle socket is writable and not readable '''
+        self.backend.update(self.left.fileno(), True, True)
+        self.assertEqual(self.backend.wait(0),
+                         [(self.left.fileno(), WRITABLE)])
+
+    def test_readable(self):
+        ''' Make sure a socket with pending data is readable '''
+        self.backend.update(self.left.fileno(), True, False)
+        self.assertEqual(self.backend.wait(0), [])
+        self.right.send('x')
+        self.assertEqual(self.backend.wait(1),
+                         [(self.left.fileno(), READABLE)])
+
+    def test_modify(self):
+        ''' Make sure we can change the interest of a fileno '''
+        self.right.send('x')
+        self.backend.update(self.left.fileno(), False, True)
+        self.assertEqual(self.backend.wait(0),
+                         [(self.left.fileno(), WRITABLE)])
+        self.backend.update(self.left.fileno(), True, False)
+        self.assertEqual(self.backend.wait(0),
+                         [(self.left.fileno(), READABLE)])
+        self.backend.update(self.left.fileno(), True, True)
+        self.assertEqual(self.backend.wait(0),
+                         [(self.left.fileno(), READABLE|WRITABLE)])
+
+    def test_unregister(self):
+        ''' Make sure unregistered filenos are not reported '''
+        self.backend.update(self.left.fileno(), True, True)
+        self.backend.update(self.left.fileno(), False, False)
+        self.assertEqual(self.backend.wait(0), [])
+
+    def test_hangup(self):
+        ''' Make sure hangup is reported as readable '''
+        self.backend.update(self.left.fileno(), True, False)
+        self.right.close()
+        result = self.backend.wait(1)
+        self.assertEqual(len(result), 1)
+        self.assertTrue(result[0][1] & READABLE)
+
+    def test_closed_before_unregister(self):
+        ''' Make sure we survive fileno reuse after close '''
+        fileno = self.left.fileno()
+        self.backend.update(fileno, True, False)
+        self.left.close()
+        self.backend.update(fileno, False, False)
+        self.left, other = socket.socketpair()
+        other.close()
+        self.backend.update(self.left.fileno(), True, False)
+        self.assertEqual(self.backend.wait(1)[0][0], self.left.fileno())
+
+class TestSelectBackend(BackendTestMixin, unittest.TestCase):
+    ''' Regression test for SelectBackend '''
+    name = 'select'
+
+if 'poll' in poller_backend.available_backends():
+    class TestPollBackend(BackendTestMixin, unittest.TestCase):
+        ''' Regression test for PollBackend '''
+        name = 'poll'
+
+if 'epoll' in poller_backend.available_backends():
+    class TestEpollBackend(BackendTestMixin, unittest.TestCase):
+        ''' Regression test for EpollBackend '''
+        name = 'epoll'
+
+class TestPollerInterest(unittest.TestCase):
+    ''' Make sure the poller keeps the backend in sync '''
+
+    def test_sync(self):
+        ''' Make sure set/unset update the backend interest set '''
+        poller = Poller(1, 'select')
+        left, right = socket.socketpair()
+        stream = FakeStream(left)
+
+        poller.set_readable(stream)
+        poller.set_writable(stream)
+        self.assertEqual(poller.backend.readable, set([left.fileno()]))
+        self.assertEqual(poller.backend.writable, set([left.fileno()]))
+
+        poller.unset_writable(stream)
+        self.assertEqual(poller.backend.writable, set())
+
+        poller.close(stream)
+        self.assertEqual(poller.backend.readable, set())
+
+        left.close()
+        right.close()
+
+    def test_dispatch(self):
+        ''' Make sure the poller dispatches events '''
+        for name in poller_backend.available_backends():
+            poller = Poller(1, name)
+            left, right = socket.socketpair()
+            stream = FakeStream(left)
+            poller.set_readable(stream)
+            poller.set_writable(stream)
+            right.send('x')
+            poller._poll(1)
+            self.assertEqual(stream.reads, 1)
+            self.assertEqual(stream.writes, 1)
+            poller.close(stream)
+            poller.backend.close()
+            left.close()
+            right.close()
+
+def _loopback_connections(count):
+    ''' Create count idle loopback connections '''
+    lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    lsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    lsock.bind(('127.0.0.1', 0))
+    lsock.listen(128)
+    clients, servers = [], []
+    for _ in range(count):
+        client = socket.create_connection(lsock.getsockname())
+        servers.append(lsock.accept()[0])
+        clients.append(client)
+    lsock.close()
+    return clients, servers
+
+def benchmark(count=2000, iterations=500):
+    ''' Measure per-iteration cost with many idle connections '''
+
+    try:
+        import resource
+        limit = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+        count = min(count, (limit - 64) // 2)
+    except ImportError:
+        pass
+
+    clients, servers = _loopback_connections(count)
+    active_left, active_right = socket.socketpair()
+
+    sys.stdout.write('Benchmark with %d idle connections\n' % count)
+    for name in poller_backend.available_backends():
+        poller = Poller(1, name)
+        for sock in servers:
+            poller.set_readable(FakeStream(sock))
+        active = FakeStream(active_left)
+        poller.set_writable(active)
+
+        begin = utils.ticks()
+        try:
+            for _ in range(iterations):
+                poller._poll(0)
+        except ValueError:
+            # select() cannot handle filenos above FD_SETSIZE
+            sys.stdout.write('  %-6s: %s\n' % (name, sys.exc_info()[1]))
+            poller.backend.close()
+            continue
+        elapsed = utils.ticks() - begin
+
+        assert active.writes == iterations
+        sys.stdout.write('  %-6s: %s per iteration\n' % (name,
+                         utils.time_formatter(elapsed / iterations)))
+        poller.backend.close()
+
+    for sock in clients + servers + [active_left, active_right]:
+        sock.close()
+
+if __name__ == '__main__':
+    benchmark()
+    unittest.main()
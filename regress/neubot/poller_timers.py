@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+
+#
+# Copyright (c) 2013
+#     Nexa Center for Internet & Society, Politecnico di Torino (DAUIN),
+#     and Simone Basso <bassosimone@gmail.com>
+#
+# This file is part of Neubot <http://www.neubot.org/>.
+#
+# Neubot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Neubot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Neubot.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+''' Regression test for neubot/poller_timers.py '''
+
+import random
+import socket
+import sys
+import unittest
+
+if __name__ == '__main__':
+    sys.path.insert(0, '.')
+
+from neubot.poller import Poller
+from neubot.poller_timers import TimerHeap
+from neubot.utils import ticks
+
+from neubot import poller_timers
+
+#
+# We don't maintain unittest, so we don't care about
+# the number of methods.
+#
+# pylint: disable=R0904
+#
+
+# Number of timers for the stress tests
+MANY = 10000
+
+class TestTimerHeap(unittest.TestCase):
+    ''' Regression test for TimerHeap '''
+
+    def test_order(self):
+        ''' Make sure timers fire in deadline and arm order '''
+        heap, result = TimerHeap(), []
+        heap.arm(3, result.append, (3,))
+        heap.arm(1, result.append, (1,))
+        heap.arm(2, result.append, ('2a',))
+        heap.arm(2, result.append, ('2b',))
+        self.assertEqual(heap.run_expired(2), 3)
+        self.assertEqual(result, [1, '2a', '2b'])
+        self.assertEqual(heap.next_deadline(), 3)
+
+    def test_cancel(self):
+        ''' Make sure cancelled timers do not fire '''
+        heap, result = TimerHeap(), []
+        timer = heap.arm(1, result.append, (1,))
+        heap.arm(2, result.append, (2,))
+        timer.cancel()
+        timer.cancel()  # Must be idempotent
+        self.assertEqual(len(heap), 1)
+        self.assertEqual(heap.next_deadline(), 2)
+        heap.run_expired(10)
+        self.assertEqual(result, [2])
+        self.assertEqual(heap.next_deadline(), None)
+
+    def test_rearm_zero(self):
+        ''' Make sure a timer rearming itself does not starve I/O '''
+        heap, result = TimerHeap(), []
+        def rearm():
+            ''' Rearm with zero delay '''
+            result.append(1)
+            heap.arm(0, rearm)
+        heap.arm(0, rearm)
+        self.assertEqual(heap.run_expired(0), 1)
+        self.assertEqual(heap.run_expired(0), 1)
+        self.assertEqual(result, [1, 1])
+
+    def test_exception(self):
+        ''' Make sure an exception does not stop other timers '''
+        heap, result = TimerHeap(), []
+        heap.arm(1, lambda: 1 / 0)
+        heap.arm(1, result.append, (1,))
+        heap.run_expired(1)
+        self.assertEqual(result, [1])
+
+    def test_many_cancel(self):
+        ''' Make sure cancellation works with many timers '''
+        heap, result = TimerHeap(), []
+        timers = []
+        for index in range(MANY):
+            timers.append(heap.arm(random.random(), result.append, (index,)))
+        random.shuffle(timers)
+        cancelled = timers[:MANY // 2 + 1]
+        for timer in cancelled:
+            timer.cancel()
+
+        # Compaction must keep the heap bounded
+        self.assertTrue(len(heap.heap) <= MANY // 2 +
+                        poller_timers.COMPACT_THRESHOLD)
+        self.assertEqual(len(heap), MANY // 2 - 1)
+
+        heap.run_expired(1)
+        expected = sorted(timer.seqno - 1 for timer in timers[MANY // 2 + 1:])
+        self.assertEqual(sorted(result), expected)
+        self.assertEqual(len(heap), 0)
+
+    def test_many_order(self):
+        ''' Make sure many timers fire in deadline order '''
+        heap, result = TimerHeap(), []
+        for _ in range(MANY):
+            deadline = random.random()
+            heap.arm(deadline, result.append, (deadline,))
+        heap.run_expired(1)
+        self.assertEqual(len(result), MANY)
+        self.assertEqual(result, sorted(result))
+
+class TestPollerAccuracy(unittest.TestCase):
+    ''' Make sure the poller fires timers on time '''
+
+    def test_accuracy(self):
+        ''' Make sure that 10k timers fire on time '''
+
+        poller = Poller(1)
+        lateness = []
+
+        def expired(args):
+            ''' Record how late the timer was '''
+            lateness.append(ticks() - args[0])
+            if len(lateness) == MANY:
+                poller.break_loop()
+
+        # Keep the loop alive with a socket that never becomes readable
+        left, right = socket.socketpair()
+        class Dummy(object):
+            ''' Dummy stream '''
+            watchdog = -1
+            def fileno(self):
+                ''' Return file number '''
+                return left.fileno()
+        poller.set_readable(Dummy())
+
+        cancelled = []
+        for index in range(2 * MANY):
+            delay = random.random() * 0.5
+            if index % 2:
+                poller.sched(delay, expired, ticks() + delay)
+            else:
+                cancelled.append(poller.timers.arm(ticks() + delay,
+                                 lateness.append, (None,)))
+        for timer in cancelled:
+            timer.cancel()
+
+        poller.loop()
+        left.close()
+        right.close()
+
+        self.assertEqual(len(lateness), MANY)
+        self.assertTrue(None not in lateness)
+        self.assertTrue(min(lateness) >= 0)
+        lateness.sort()
+        sys.stdout.write('\nTimer lateness: median %.1f ms, max %.1f ms\n' % (
+                         lateness[MANY // 2] * 1000, lateness[-1] * 1000))
+        self.assertTrue(lateness[MANY // 2] < 0.05)
+
+if __name__ == '__main__':
+    unittest.main()
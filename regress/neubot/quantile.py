@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+
+#
+# Copyright (c) 2013
+#     Nexa Center for Internet & Society, Politecnico di Torino (DAUIN),
+#     and Simone Basso <bassosimone@gmail.com>
+#
+# This file is part of Neubot <http://www.neubot.org/>.
+#
+# Neubot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Neubot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Neubot.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+''' Regression test and benchmark for neubot/quantile.py '''
+
+import math
+import random
+import sys
+import unittest
+
+if __name__ == '__main__':
+    sys.path.insert(0, '.')
+
+from neubot import percentile
+from neubot import quantile
+from neubot import utils
+
+#
+# We're accessing private methods and we don't maintain
+# unittest, so we don't care about the number of methods.
+#
+# pylint: disable=W0212,R0904
+#
+
+PERCENTS = (0.0, 0.001, 0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99, 0.999,
+            1.0, 1.0 / 3)
+
+# The documented error bound, plus some slack for rounding
+BOUND = math.sqrt(1 + quantile.ALPHA) - 1 + 1e-9
+
+def _datasets():
+    ''' Return random and adversarial datasets '''
+    rng = random.Random(4)
+    base = 1 + quantile.ALPHA
+    return {
+        'uniform': [rng.random() * 1e6 for _ in range(20000)],
+        'lognormal': [rng.lognormvariate(12, 3) for _ in range(20000)],
+        'pareto': [rng.paretovariate(0.5) for _ in range(20000)],
+        'ascending': [float(index) for index in range(1, 20001)],
+        'descending': [float(index) for index in range(20000, 0, -1)],
+        'constant': [1187400.0] * 20000,
+        'bimodal': [rng.choice((1e-3, 1e9)) * (1 + rng.random() / 100)
+                    for _ in range(20000)],
+        'alternating': [(1e-6, 1e12)[index % 2] for index in range(20000)],
+        'boundaries': [base ** rng.randint(-500, 500) for _ in range(20000)],
+        'signs': [rng.choice((-1, 0, 1)) * rng.expovariate(1e-3)
+                  for _ in range(20000)],
+        'integers': [rng.randint(0, 10 ** 15) for _ in range(20000)],
+    }
+
+class TestQuantiles(unittest.TestCase):
+    ''' Regression test for Quantiles '''
+
+    def _check(self, name, values, estimate, percent):
+        ''' Check estimate against the exact percentile '''
+        exact = percentile.percentile(values, percent)
+        vector = sorted(values)
+        pivot = (len(vector) - 1) * percent
+        val0 = vector[int(math.floor(pivot))]
+        val1 = vector[int(math.ceil(pivot))]
+        if val0 * val1 >= 0:
+            limit = BOUND * abs(exact)
+        else:
+            limit = BOUND * max(abs(val0), abs(val1))
+        self.assertTrue(abs(estimate - exact) <= limit + 1e-300,
+                        (name, percent, estimate, exact))
+
+    def test_empty(self):
+        ''' Make sure we return None without samples '''
+        estimator = quantile.Quantiles()
+        self.assertEqual(len(estimator), 0)
+        self.assertEqual(estimator.median(), None)
+        self.assertEqual(estimator.quantiles((0.1, 0.9)), [None, None])
+        self.assertEqual(quantile.interpolate([], 0, (0.5,), 0, 0), [None])
+
+    def test_exact(self):
+        ''' Make sure small inputs give exact percentiles '''
+        for name, values in _datasets().items():
+            estimator = quantile.Quantiles(exact_limit=len(values))
+            estimator.extend(values)
+            self.assertTrue(estimator.is_exact())
+            self.assertEqual(len(estimator), len(values))
+            self.assertEqual(estimator.quantiles(PERCENTS), [
+                             percentile.percentile(values, percent)
+                             for percent in PERCENTS], name)
+
+    def test_exact_incremental(self):
+        ''' Make sure we can add samples after a query '''
+        rng = random.Random(7)
+        estimator = quantile.Quantiles()
+        values = []
+        for _ in range(100):
+            value = rng.random()
+            values.append(value)
+            estimator.add(value)
+            self.assertEqual(estimator.median(), percentile.median(values))
+        self.assertEqual(quantile.Quantiles().median(), None)
+
+    def test_histogram(self):
+        ''' Make sure large inputs are within the error bound '''
+        for name, values in _datasets().items():
+            estimator = quantile.Quantiles(exact_limit=1000)
+            estimator.extend(values)
+            self.assertFalse(estimator.is_exact())
+            self.assertEqual(len(estimator), len(values))
+            estimates = estimator.quantiles(PERCENTS)
+            for percent, estimate in zip(PERCENTS, estimates):
+                self._check(name, values, estimate, percent)
+            self.assertEqual(estimates[0], min(values))
+            self.assertEqual(estimates[PERCENTS.index(1.0)], max(values))
+
+    def test_add(self):
+        ''' Make sure add() and extend() give the same results '''
+        values = _datasets()['signs']
+        estimator1 = quantile.Quantiles(exact_limit=1000)
+        estimator2 = quantile.Quantiles(exact_limit=1000)
+        for value in values:
+            estimator1.add(value)
+        estimator2.extend(values[:500])
+        estimator2.extend(iter(values[500:]))
+        self.assertEqual(len(estimator1), len(estimator2))
+        self.assertEqual(estimator1.quantiles(PERCENTS),
+                         estimator2.quantiles(PERCENTS))
+        self.assertEqual(estimator1.zero, values.count(0))
+
+    def test_bins_bounded(self):
+        ''' Make sure we merge the bins closest to zero '''
+        saved = quantile.MAX_BINS
+        quantile.MAX_BINS = 100
+        try:
+            values = [10.0 ** (index / 10.0) for index in range(-3000, 3000)]
+            estimator = quantile.Quantiles(exact_limit=0)
+            estimator.extend(values)
+            self.assertEqual(len(estimator.positive), 100)
+            # High percentiles keep the error bound
+            for percent in (0.99, 0.999, 1.0):
+                self._check('wide', values, estimator.quantile(percent),
+                            percent)
+            self.assertEqual(estimator.quantile(0.0), min(values))
+        finally:
+            quantile.MAX_BINS = saved
+
+    def test_same_bins(self):
+        ''' Make sure the batch binning is the same as bin_index() '''
+        values = _datasets()['boundaries'] + _datasets()['lognormal']
+        estimator = quantile.Quantiles(exact_limit=0)
+        estimator.extend(values)
+        expected = {}
+        for value in values:
+            index = quantile.bin_index(value)
+            expected[index] = expected.get(index, 0) + 1
+        self.assertEqual(estimator.positive, expected)
+
+#
+# Benchmark: several percentiles of SAMPLES samples, with percentile.py,
+# which sorts the samples at each call, and with Quantiles, which only
+# keeps a histogram.  We also compare exact quantiles, for which
+# Quantiles sorts just once.
+#
+
+SAMPLES = 10000000
+
+def benchmark():
+    ''' Compare percentile.py and Quantiles '''
+    rng = random.Random(11)
+    percents = [percent for _, percent in (('p5', 0.05), ('p25', 0.25),
+                ('median', 0.5), ('p75', 0.75), ('p95', 0.95))]
+
+    sys.stdout.write('Quantiles of %d samples (%d percentiles):\n' % (
+                     quantile.EXACT_LIMIT, len(percents)))
+    values = [rng.expovariate(1e-6) for _ in xrange(quantile.EXACT_LIMIT)]
+    begin = utils.ticks()
+    for percent in percents:
+        percentile.percentile(values, percent)
+    sys.stdout.write('  percentile.py: %s\n' % utils.time_formatter(
+                     utils.ticks() - begin))
+    begin = utils.ticks()
+    estimator = quantile.Quantiles()
+    estimator.extend(values)
+    estimator.quantiles(percents)
+    sys.stdout.write('  Quantiles    : %s (exact)\n' % utils.time_formatter(
+                     utils.ticks() - begin))
+
+    sys.stdout.write('Quantiles of %d samples:\n' % SAMPLES)
+    values = [rng.expovariate(1e-6) for _ in xrange(SAMPLES)]
+    begin = utils.ticks()
+    exact = percentile.percentile(values, 0.5)
+    elapsed = utils.ticks() - begin
+    sys.stdout.write('  percentile.py: %s per percentile, keeps %d '
+      'samples\n' % (utils.time_formatter(elapsed), len(values)))
+    begin = utils.ticks()
+    estimator = quantile.Quantiles()
+    estimator.extend(values)
+    feed = utils.ticks() - begin
+    begin = utils.ticks()
+    estimates = estimator.quantiles(percents)
+    query = utils.ticks() - begin
+    sys.stdout.write('  Quantiles    : feed %s, %d percentiles %s, keeps '
+      '%d bins, median error %.3f%%\n' % (utils.time_formatter(feed),
+      len(percents), utils.time_formatter(query), len(estimator.positive) +
+      len(estimator.negative), 100 * abs(estimates[2] - exact) / exact))
+
+if __name__ == '__main__':
+    benchmark()
+    unittest.main()
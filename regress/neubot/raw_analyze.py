@@ -23,13 +23,19 @@
 
 ''' Regression test for raw_analyze.py '''
 
+import collections
+import random
 import unittest
 import sys
 
 if __name__ == '__main__':
     sys.path.insert(0, '.')
 
+from neubot.raw_samples import RawSamples
+
+from neubot import percentile
 from neubot import raw_analyze
+from neubot import utils
 
 #
 # We're accessing private methods of `raw_analyze` for testing and we don't
@@ -177,5 +183,132 @@ class TestComputeBottleneckCapacity(unittest.TestCase):
         capacity = raw_analyze._compute_bottleneck_capacity(samples, 1440)
         self.assertEqual(capacity, 602006.68896321068)
 
+#
+# The implementation that loops over the samples, which we use as a
+# reference and in the benchmark.
+#
+
+def reference_bottleneck_capacity(vector, mss):
+    ''' Compute bottleneck capacity using packet pair '''
+    samples = []
+    half_mss = mss / 2
+    for _, interval, bytez in raw_analyze._preprocess_results(vector, True):
+        if half_mss < bytez <= mss and interval > 0:
+            samples.append(bytez / interval)
+    return percentile.median(samples)
+
+def reference_likely_rexmits(vector, rtt, mss):
+    ''' Selects the likely-retransmission samples only '''
+    likely_rexmit = []
+    mss_smpls = 0
+    typical_mss = collections.defaultdict(int)
+    min_interval = 0.7 * rtt
+    for ticks, interval, bytez in raw_analyze._preprocess_results(vector,
+                                                                  False):
+        typical_mss[bytez] += 1
+        mss_smpls += 1
+        if interval > min_interval and bytez > mss:
+            likely_rexmit.append((ticks, interval, bytez))
+    result = []
+    for ticks, interval, bytez in likely_rexmit:
+        if typical_mss[bytez] / float(mss_smpls) < 0.01:
+            result.append((ticks, interval, bytez))
+    return result
+
+def _make_samples(count, seed, coarse=False):
+    ''' Make synthetic receiver samples, including equal ticks (with
+        coarse clock), small and large recv()s and rare long pauses '''
+    rng = random.Random(seed)
+    vector, ticks = [], 1386000000.0
+    for _ in range(count):
+        if rng.random() < 0.001:
+            ticks += rng.uniform(0.02, 0.2)
+            length = rng.choice((2880, 4320, 1440 * rng.randint(4, 64)))
+        else:
+            ticks += rng.expovariate(1e5)
+            length = rng.choice((1440, 1440, 1440, 1440, 1380, 600, 2880))
+        if coarse:
+            ticks = round(ticks, 3)
+        vector.append((ticks, length))
+    return vector
+
+class TestColumnar(unittest.TestCase):
+    ''' Make sure the columnar analysis matches the reference '''
+
+    def _check(self, vector):
+        ''' Compare the results on vector '''
+        samples = RawSamples(vector)
+        self.assertEqual(list(samples), vector)
+        expected = reference_bottleneck_capacity(vector, 1440)
+        self.assertEqual(raw_analyze.compute_bottleneck_capacity(vector,
+                         1440), expected)
+        self.assertEqual(raw_analyze.compute_bottleneck_capacity(samples,
+                         1440), expected)
+        expected = reference_likely_rexmits(vector, 0.01, 1440)
+        self.assertEqual(raw_analyze.select_likely_rexmits(vector, 0.01,
+                         1440), expected)
+        self.assertEqual(raw_analyze.select_likely_rexmits(samples, 0.01,
+                         1440), expected)
+        return expected
+
+    def test_empty(self):
+        ''' Make sure it works for empty input '''
+        self._check([])
+        self.assertEqual(raw_analyze.compute_bottleneck_capacity(
+                         RawSamples(), 1440), None)
+
+    def test_random(self):
+        ''' Make sure results are identical on random input '''
+        self.assertTrue(self._check(_make_samples(20000, 1)))
+
+    def test_equal_ticks(self):
+        ''' Make sure results are identical with a coarse clock '''
+        self.assertTrue(self._check(_make_samples(20000, 2, True)))
+
+    def test_many_lengths(self):
+        ''' Make sure we count many distinct rexmit lengths right '''
+        vector = [(float(index), 1440) for index in range(10000)]
+        vector.extend((10000.0 + index, 1441 + index) for index in range(50))
+        self.assertEqual(len(self._check(vector)), 50)
+
+    def test_negative_interval(self):
+        ''' Make sure we raise RuntimeError on negative interval '''
+        samples = RawSamples([(1234567890, 1440), (1234567889, 1440)])
+        self.assertRaises(RuntimeError, raw_analyze.compute_bottleneck_capacity,
+                          samples, 1440)
+        self.assertRaises(RuntimeError, raw_analyze.select_likely_rexmits,
+                          samples, 0.01, 1440)
+
+#
+# Benchmark: the analysis of a long raw test at high speed, with
+# SAMPLES samples, before (looping over a list of tuples) and after
+# (columnar, on the RawSamples store).
+#
+
+SAMPLES = 2000000
+
+def benchmark():
+    ''' Compare the old and the new analysis '''
+    vector = _make_samples(SAMPLES, 3)
+    samples = RawSamples()
+    begin = utils.ticks()
+    for ticks, length in vector:
+        samples.append(ticks, length)
+    store = utils.ticks() - begin
+    sys.stdout.write('Raw test analysis of %d samples:\n' % SAMPLES)
+    begin = utils.ticks()
+    reference_bottleneck_capacity(vector, 1440)
+    reference_likely_rexmits(vector, 0.01, 1440)
+    sys.stdout.write('  before: %s\n' % utils.time_formatter(
+                     utils.ticks() - begin))
+    begin = utils.ticks()
+    raw_analyze.compute_bottleneck_capacity(samples, 1440)
+    raw_analyze.select_likely_rexmits(samples, 0.01, 1440)
+    sys.stdout.write('  after : %s (append %s per sample, store %d bytes '
+      'per sample)\n' % (utils.time_formatter(utils.ticks() - begin),
+      utils.time_formatter(store / SAMPLES), samples.ticks.itemsize +
+      samples.lengths.itemsize))
+
 if __name__ == '__main__':
+    benchmark()
     unittest.main()
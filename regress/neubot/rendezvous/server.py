@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+
+#
+# Copyright (c) 2013
+#     Nexa Center for Internet & Society, Politecnico di Torino (DAUIN),
+#     and Simone Basso <bassosimone@gmail.com>
+#
+# This file is part of Neubot <http://www.neubot.org/>.
+#
+# Neubot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Neubot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Neubot.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+''' Regression test and benchmark for neubot/rendezvous/server.py '''
+
+import StringIO
+import logging
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+if __name__ == '__main__':
+    sys.path.insert(0, '.')
+
+from neubot.config import CONFIG
+from neubot.database import DATABASE
+from neubot.database import table_geoloc
+from neubot.http.message import Message
+from neubot.rendezvous.server import GEOLOCATOR
+from neubot.rendezvous.server import ServerRendezvous
+
+from neubot.compat import json
+
+from neubot import utils
+
+#
+# We're accessing private methods and we don't maintain
+# unittest, so we don't care about the number of methods.
+#
+# pylint: disable=W0212,R0904
+#
+
+# Synthetic geoloc table: SERVERS servers for each of COUNTRIES
+COUNTRIES = 250
+SERVERS = 4
+
+class StubCountries(object):
+    ''' Stub GeoIP database: 10.0.X.Y is in the X-th country, and
+        other addresses are not found '''
+
+    @staticmethod
+    def country_code_by_addr(address):
+        ''' Return the country code of address '''
+        if not address.startswith('10.0.'):
+            return None
+        return 'C%d' % int(address.split('.')[2])
+
+class MinimalHttpStream(object):
+    ''' Minimal HTTP stream '''
+
+    def __init__(self, address):
+        self.peername = (address, 54321)
+        self.response = None
+
+    def send_response(self, request, response):
+        ''' Record the response '''
+        self.response = response
+
+def _fill(connection):
+    ''' Fill the geoloc table '''
+    for country in range(COUNTRIES):
+        for server in range(SERVERS):
+            table_geoloc.insert_server(connection, 'C%d' % country,
+              'mlab%d.c%d.measurement-lab.org' % (server, country), False)
+    connection.commit()
+
+def _request(version='0.4.15.3', privacy=1, accept=('speedtest',
+             'bittorrent')):
+    ''' Create a rendezvous request '''
+    request = Message()
+    request['content-type'] = 'application/json'
+    request.body = StringIO.StringIO(json.dumps({
+        'accept': list(accept),
+        'version': version,
+        'privacy_informed': privacy,
+        'privacy_can_collect': privacy,
+        'privacy_can_share': privacy,
+    }))
+    return request
+
+def _rendezvous(server, address, request=None):
+    ''' Perform a rendezvous and return the response '''
+    if request is None:
+        request = _request()
+    stream = MinimalHttpStream(address)
+    server.process_request(stream, request)
+    return stream.response
+
+def _server(cache):
+    ''' Create a rendezvous server '''
+    server = ServerRendezvous(None)
+    conf = CONFIG.copy()
+    conf['rendezvous.server.cache'] = cache
+    server.configure(conf)
+    return server
+
+class TestRendezvous(unittest.TestCase):
+    ''' Regression test for ServerRendezvous '''
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'database.sqlite3')
+        DATABASE.set_path(self.path)
+        _fill(DATABASE.connection())
+        self.saved = (GEOLOCATOR.countries, CONFIG['rendezvous.server.refresh'])
+        GEOLOCATOR.countries = StubCountries()
+
+    def tearDown(self):
+        GEOLOCATOR.countries = self.saved[0]
+        CONFIG['rendezvous.server.refresh'] = self.saved[1]
+        DATABASE.close()
+        shutil.rmtree(self.tempdir)
+
+    def test_same_responses(self):
+        ''' Make sure the cache does not change the responses '''
+        cases = [('10.0.7.1', _request()),
+                 ('10.0.7.2', _request(version='0.3.6')),
+                 ('10.0.8.1', _request(version='0.4.16.0')),
+                 ('10.0.9.1', _request(privacy=0)),
+                 ('10.0.9.1', _request(accept=('speedtest',))),
+                 ('192.168.1.1', _request())]
+        for cache in (False, True):
+            server = _server(cache)
+            random.seed(0)
+            responses = []
+            for address, request in cases * 3:
+                request.body.seek(0)
+                response = _rendezvous(server, address, request)
+                responses.append((response['content-type'],
+                                  response.body))
+            if not cache:
+                expected = responses
+        self.assertEqual(responses, expected)
+        self.assertTrue(responses[1][0].startswith('text/xml'))
+        self.assertEqual(json.loads(responses[0][1])['available'][
+                         'speedtest'][0].split('.')[1], 'c7')
+        self.assertEqual(json.loads(responses[3][1])['available'], {})
+
+    def test_spread(self):
+        ''' Make sure we still spread the clients among servers '''
+        server = _server(True)
+        servers = set()
+        for _ in range(100):
+            body = json.loads(_rendezvous(server, '10.0.3.1').body)
+            servers.add(body['available']['bittorrent'][0])
+        self.assertEqual(len(servers), SERVERS)
+
+    def test_learn_country(self):
+        ''' Make sure we learn new countries '''
+        server = _server(True)
+        body = json.loads(_rendezvous(server, '10.0.999.1').body)
+        self.assertEqual(body['available']['speedtest'],
+                         ['http://master.neubot.org/speedtest'])
+        self.assertEqual(table_geoloc.lookup_servers(DATABASE.connection(),
+                         'C999'), ['master.neubot.org'])
+
+    def test_invalidation(self):
+        ''' Make sure we notice when the geoloc table changes '''
+        server = _server(True)
+        _rendezvous(server, '10.0.1.1')
+        self.assertEqual(len(server.responses), 1)
+
+        # Changes made by this process are noticed immediately
+        table_geoloc.insert_server(DATABASE.connection(), 'C1', 'new.org')
+        servers = set()
+        for _ in range(200):
+            body = json.loads(_rendezvous(server, '10.0.1.1').body)
+            servers.add(body['available']['bittorrent'][0])
+        self.assertTrue('http://new.org/' in servers)
+
+        # Changes made by others are noticed after the refresh interval
+        connection = sqlite3.connect(self.path)
+        connection.execute('DELETE FROM geoloc WHERE country="C1";')
+        connection.execute('INSERT INTO geoloc VALUES (null, "C1", '
+                           '"other.org");')
+        connection.commit()
+        connection.close()
+        body = json.loads(_rendezvous(server, '10.0.1.1').body)
+        self.assertNotEqual(body['available']['bittorrent'],
+                            ['http://other.org/'])
+        CONFIG['rendezvous.server.refresh'] = 1
+        server.geoloc.loaded -= 2
+        body = json.loads(_rendezvous(server, '10.0.1.1').body)
+        self.assertEqual(body['available']['bittorrent'],
+                         ['http://other.org/'])
+
+#
+# Benchmark: we measure how many requests per second the rendezvous
+# server processes, with and without the cache, when REQUESTS clients
+# from random countries rendezvous.  We call process_request()
+# directly, so we don't measure the HTTP layer.
+#
+
+REQUESTS = 10000
+
+def benchmark():
+    ''' Measure requests per second with and without the cache '''
+    tempdir = tempfile.mkdtemp()
+    DATABASE.set_path(os.path.join(tempdir, 'database.sqlite3'))
+    _fill(DATABASE.connection())
+    GEOLOCATOR.countries = StubCountries()
+    logging.getLogger().setLevel(logging.WARNING)
+    addresses = ['10.0.%d.1' % random.randrange(COUNTRIES)
+                 for _ in range(REQUESTS)]
+    requests = [_request() for _ in range(REQUESTS)]
+    sys.stdout.write('Rendezvous with %d countries, %d servers each:\n' % (
+                     COUNTRIES, SERVERS))
+    for cache in (False, True):
+        server = _server(cache)
+        begin = utils.ticks()
+        for address, request in zip(addresses, requests):
+            _rendezvous(server, address, request)
+            request.body.seek(0)
+        elapsed = utils.ticks() - begin
+        sys.stdout.write('  %-8s: %.0f requests/s\n' % (
+          cache and 'cache' or 'no cache', REQUESTS / elapsed))
+    logging.getLogger().setLevel(logging.DEBUG)
+    GEOLOCATOR.countries = None
+    DATABASE.close()
+    shutil.rmtree(tempdir)
+
+if __name__ == '__main__':
+    benchmark()
+    unittest.main()
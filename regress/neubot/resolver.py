@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+
+#
+# Copyright (c) 2013
+#     Nexa Center for Internet & Society, Politecnico di Torino (DAUIN),
+#     and Simone Basso <bassosimone@gmail.com>
+#
+# This file is part of Neubot <http://www.neubot.org/>.
+#
+# Neubot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Neubot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Neubot.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+''' Regression test for neubot/resolver.py '''
+
+import socket
+import sys
+import threading
+import time
+import unittest
+
+if __name__ == '__main__':
+    sys.path.insert(0, '.')
+
+from neubot.config import CONFIG
+from neubot.handler import Handler
+from neubot.poller import POLLER
+from neubot.resolver import RESOLVER
+from neubot.resolver import Resolver
+from neubot.utils import ticks
+
+#
+# We're accessing private methods and we don't maintain
+# unittest, so we don't care about the number of methods.
+#
+# pylint: disable=W0212,R0904
+#
+
+# Artificial latency of the stub resolver
+LATENCY = 0.3
+
+class StubResolver(object):
+    ''' Stub getaddrinfo() that resolves *.test names to loopback
+        after LATENCY seconds and fails for other names '''
+
+    def __init__(self):
+        self.queries = []
+        self.lock = threading.Lock()
+
+    def __call__(self, host, port, family, socktype, proto, flags):
+        self.lock.acquire()
+        self.queries.append(host)
+        self.lock.release()
+        time.sleep(LATENCY)
+        if not host.endswith('.test'):
+            raise socket.gaierror(socket.EAI_NONAME, 'Name not known')
+        return [(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP,
+                 '', ('127.0.0.1', port))]
+
+def _run_poller(condition, timeout=5):
+    ''' Run the poller until condition() is true '''
+    deadline = ticks() + timeout
+    while not condition() and ticks() < deadline:
+        POLLER._poll(0.01)
+        POLLER.timers.run_expired(ticks())
+
+class TestResolver(unittest.TestCase):
+    ''' Regression test for Resolver '''
+
+    def setUp(self):
+        self.stub = StubResolver()
+        self.resolver = Resolver(self.stub)
+        self.results = []
+
+    def _lookup(self, host):
+        ''' Start a lookup of host '''
+        self.resolver.getaddrinfo(host, 80, socket.AF_UNSPEC,
+          socket.SOCK_STREAM, 0, 0, self.results.append)
+
+    def test_not_blocking(self):
+        ''' Make sure the poller runs while a name resolves '''
+        ticked = []
+        def tick():
+            ''' Periodic timer '''
+            ticked.append(ticks())
+            if not self.results:
+                POLLER.sched(0.01, tick)
+        POLLER.sched(0.01, tick)
+
+        begin = ticks()
+        self._lookup('www.example.test')
+        self.assertTrue(ticks() - begin < LATENCY / 10)
+        self.assertEqual(self.results, [])
+
+        _run_poller(lambda: self.results)
+        self.assertEqual(self.results[0][0][4], ('127.0.0.1', 80))
+        self.assertTrue(len(ticked) > 5)
+        self.assertTrue(self.resolver.fileno() not in POLLER.readset)
+
+    def test_coalesce(self):
+        ''' Make sure concurrent lookups share the same query '''
+        for _ in range(3):
+            self._lookup('www.example.test')
+        _run_poller(lambda: len(self.results) == 3)
+        self.assertEqual(len(self.results), 3)
+        self.assertEqual(self.stub.queries, ['www.example.test'])
+
+    def test_positive_cache(self):
+        ''' Make sure successful lookups are cached '''
+        self._lookup('www.example.test')
+        _run_poller(lambda: self.results)
+        self._lookup('www.example.test')
+        self.assertEqual(len(self.results), 2)
+        self.assertEqual(self.results[0], self.results[1])
+        self.assertFalse(self.results[0] is self.results[1])
+        self.assertEqual(len(self.stub.queries), 1)
+
+    def test_negative_cache(self):
+        ''' Make sure failed lookups are cached '''
+        self._lookup('www.example.invalid')
+        _run_poller(lambda: self.results)
+        self._lookup('www.example.invalid')
+        self.assertEqual(len(self.results), 2)
+        self.assertTrue(isinstance(self.results[1], socket.gaierror))
+        self.assertEqual(len(self.stub.queries), 1)
+
+    def test_expire(self):
+        ''' Make sure we query again after the TTL '''
+        self._lookup('www.example.test')
+        _run_poller(lambda: self.results)
+        for key, entry in self.resolver.cache.items():
+            self.resolver.cache[key] = (ticks() - 1, entry[1])
+        self._lookup('www.example.test')
+        _run_poller(lambda: len(self.results) == 2)
+        self.assertEqual(len(self.stub.queries), 2)
+        self.resolver.expire()
+        self.assertEqual(len(self.resolver.cache), 1)
+
+    def test_numeric(self):
+        ''' Make sure numeric addresses do not use the threads '''
+        for address in ('127.0.0.1', '::1'):
+            self._lookup(address)
+        self._lookup(None)
+        self.assertEqual(len(self.results), 3)
+        self.assertEqual(self.stub.queries, [])
+        self.assertEqual(self.resolver.threads, [])
+
+class ConnectHandler(Handler):
+    ''' Record connect results '''
+
+    def __init__(self):
+        self.result = None
+
+    def handle_connect(self, connector, sock, rtt, sslconfig, extra):
+        self.result = sock
+        sock.close()
+
+    def handle_connect_error(self, connector):
+        self.result = False
+
+class TestConnector(unittest.TestCase):
+    ''' Make sure the connector uses the resolver '''
+
+    def setUp(self):
+        self.saved = RESOLVER.getaddrinfo_func
+        self.stub = StubResolver()
+        RESOLVER.getaddrinfo_func = self.stub
+        RESOLVER.cache.clear()
+
+    def tearDown(self):
+        RESOLVER.getaddrinfo_func = self.saved
+
+    def test_connect(self):
+        ''' Make sure we connect to a resolved name '''
+        lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        lsock.bind(('127.0.0.1', 0))
+        lsock.listen(1)
+        handler = ConnectHandler()
+        handler.connect(('www.example.test', lsock.getsockname()[1]),
+                        CONFIG['prefer_ipv6'], 0, {})
+        self.assertEqual(handler.result, None)
+        _run_poller(lambda: handler.result is not None)
+        self.assertTrue(handler.result)
+        lsock.close()
+
+    def test_fallback(self):
+        ''' Make sure we try the next name when one fails '''
+        lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        lsock.bind(('127.0.0.1', 0))
+        lsock.listen(1)
+        handler = ConnectHandler()
+        handler.connect(('www.example.invalid www.example.test',
+                        lsock.getsockname()[1]), CONFIG['prefer_ipv6'],
+                        0, {})
+        _run_poller(lambda: handler.result is not None)
+        self.assertTrue(handler.result)
+        self.assertEqual(self.stub.queries, ['www.example.invalid',
+                                             'www.example.test'])
+        lsock.close()
+
+    def test_failure(self):
+        ''' Make sure we report the error when no name resolves '''
+        handler = ConnectHandler()
+        handler.connect(('www.example.invalid', 80), CONFIG['prefer_ipv6'],
+                        0, {})
+        _run_poller(lambda: handler.result is not None)
+        self.assertEqual(handler.result, False)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+
+#
+# Copyright (c) 2013
+#     Nexa Center for Internet & Society, Politecnico di Torino (DAUIN),
+#     and Simone Basso <bassosimone@gmail.com>
+#
+# This file is part of Neubot <http://www.neubot.org/>.
+#
+# Neubot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Neubot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Neubot.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+''' Regression test and benchmark for neubot/runner_discovery.py '''
+
+import collections
+import os
+import sys
+import unittest
+
+if __name__ == '__main__':
+    sys.path.insert(0, '.')
+
+from neubot.compat import json
+from neubot.config import CONFIG
+from neubot.defer import Deferred
+from neubot.http.message import Message
+from neubot.http.server import ServerHTTP
+from neubot.net.poller import POLLER
+from neubot.notify import NOTIFIER
+from neubot.runner_core import RunnerCore
+from neubot.runner_discovery import DISCOVERY_CACHE
+from neubot.runner_discovery import RANDOM_POOL
+from neubot.runner_hosts import RUNNER_HOSTS
+from neubot.runner_tests import RUNNER_TESTS
+
+from neubot import runner_discovery
+from neubot import utils
+
+#
+# We're accessing private methods and we don't maintain
+# unittest, so we don't care about the number of methods.
+#
+# pylint: disable=W0212,R0904
+#
+
+class TestDiscoveryCache(unittest.TestCase):
+    ''' Regression test for DiscoveryCache '''
+
+    def setUp(self):
+        self.saved = (CONFIG['runner.discovery_ttl'], CONFIG['prefer_ipv6'],
+                      runner_discovery.utils.ticks)
+        self.now = [1000.0]
+        runner_discovery.utils.ticks = lambda: self.now[0]
+        CONFIG['runner.discovery_ttl'] = 100
+        CONFIG['prefer_ipv6'] = 0
+        self.cache = runner_discovery.DiscoveryCache()
+
+    def tearDown(self):
+        CONFIG['runner.discovery_ttl'] = self.saved[0]
+        CONFIG['prefer_ipv6'] = self.saved[1]
+        runner_discovery.utils.ticks = self.saved[2]
+
+    def test_key(self):
+        ''' Make sure the key depends on the address family '''
+        self.assertEqual(self.cache.make_key('mlab-ns', 'random'),
+                         ('mlab-ns', 'random', 'ipv4'))
+        CONFIG['prefer_ipv6'] = 1
+        self.assertEqual(self.cache.make_key('mlab-ns', 'random'),
+                         ('mlab-ns', 'random', 'ipv6'))
+
+    def test_ttl(self):
+        ''' Make sure results expire and need refresh at half TTL '''
+        key = self.cache.make_key('mlab-ns', '')
+        self.assertEqual(self.cache.get(key), None)
+        self.assertTrue(self.cache.needs_refresh(key))
+        self.cache.put(key, {'fqdn': 'a.example'}, ['a.example'])
+        self.assertEqual(self.cache.get(key), {'fqdn': 'a.example'})
+        self.assertFalse(self.cache.needs_refresh(key))
+        self.now[0] += 50
+        self.assertTrue(self.cache.needs_refresh(key))
+        self.assertEqual(self.cache.get(key), {'fqdn': 'a.example'})
+        self.cache.put(key, {'fqdn': 'b.example'}, ['b.example'])
+        self.assertEqual(self.cache.get(key), {'fqdn': 'b.example'})
+        self.now[0] += 100
+        self.assertEqual(self.cache.get(key), None)
+        self.assertEqual(self.cache.entries, {})
+
+    def test_disabled(self):
+        ''' Make sure a zero TTL disables the cache '''
+        CONFIG['runner.discovery_ttl'] = 0
+        key = self.cache.make_key('mlab-ns', '')
+        self.cache.put(key, {'fqdn': 'a.example'}, ['a.example'])
+        self.assertEqual(self.cache.get(key), None)
+
+    def test_pool(self):
+        ''' Make sure the random policy keeps a pool of results '''
+        key = self.cache.make_key('mlab-ns', 'random')
+        for index in range(RANDOM_POOL + 2):
+            self.assertEqual(self.cache.needs_refresh(key),
+                             index < RANDOM_POOL)
+            host = 'host%d.example' % index
+            self.cache.put(key, {'fqdn': host}, [host])
+        self.assertFalse(self.cache.needs_refresh(key))
+        seen = set(self.cache.get(key)['fqdn'] for _ in range(200))
+        self.assertEqual(seen, set('host%d.example' % index for index
+                         in range(2, RANDOM_POOL + 2)))
+
+    def test_mark_stale(self):
+        ''' Make sure we drop the results of servers that fail '''
+        key1 = self.cache.make_key('mlab-ns', '')
+        key2 = self.cache.make_key('rendezvous', '')
+        self.cache.put(key1, {'fqdn': 'a.example'}, ['a.example'])
+        self.cache.put(key2, {'available': {}}, ['http://a.example:8080/',
+                       'http://b.example/'])
+        self.cache.mark_stale('c.example')
+        self.assertNotEqual(self.cache.get(key1), None)
+        self.assertNotEqual(self.cache.get(key2), None)
+        self.cache.mark_stale('http://b.example/speedtest')
+        self.assertNotEqual(self.cache.get(key1), None)
+        self.assertEqual(self.cache.get(key2), None)
+        self.cache.mark_stale('a.example')
+        self.assertEqual(self.cache.get(key1), None)
+        self.assertEqual(self.cache.entries, {})
+
+#
+# We run the runner against a local stub discovery server, which
+# counts the requests it receives and serves both the mlab-ns and
+# the rendezvous API.  The test is a fake dynamic test that records
+# the address it should use and is done immediately.
+#
+
+class StubDiscovery(ServerHTTP):
+
+    ''' Stub mlab-ns and rendezvous server '''
+
+    def __init__(self, poller):
+        ServerHTTP.__init__(self, poller)
+        self.requests = collections.defaultdict(int)
+        self.port = 0
+
+    def started_listening(self, listener):
+        self.port = listener.lsock.getsockname()[1]
+
+    def process_request(self, stream, request):
+        path = request.uri.split('?')[0]
+        self.requests[path] += 1
+        if path == '/neubot':
+            body = {'fqdn': 'host%d.example' % self.requests[path]}
+        else:
+            body = {'available': {'fake': ['http://127.0.0.1:%d/' %
+                    self.port]}, 'update': {}}
+        response = Message()
+        response.compose(code='200', reason='Ok', body=json.dumps(body),
+                         mimetype='application/json')
+        stream.send_response(request, response)
+
+def _run_tests(method, policy, count):
+    ''' Run count tests, and return the stub requests, the hosts
+        we used and the average time per test '''
+    server = StubDiscovery(POLLER)
+    server.configure(CONFIG.copy())
+    server.listen(('127.0.0.1', 0))
+    CONFIG['agent.master'] = '127.0.0.1'
+    for name in ('privacy.informed', 'privacy.can_collect',
+                 'privacy.can_publish'):
+        CONFIG[name] = 1
+    DISCOVERY_CACHE.clear()
+
+    core = RunnerCore()
+    core.mlabns_endpoint = ('127.0.0.1', server.port)
+    core.rendezvous_port = str(server.port)
+    hosts = []
+
+    def test_func(ctx):
+        ''' Fake test '''
+        if method == 'rendezvous':
+            hosts.append(RUNNER_TESTS.test_to_negotiate_uri('fake'))
+        else:
+            hosts.append(ctx['address'])
+        POLLER.sched(0, lambda: NOTIFIER.publish('testdone'))
+
+    core.dynamic_tests['fake'] = {
+                                  'discover_method': method,
+                                  'discover_policy': policy,
+                                  'test_func': test_func,
+                                 }
+
+    def run_next(*args):
+        ''' Run the next test, or stop '''
+        if len(hosts) >= count:
+            POLLER.break_loop()
+            return
+        deferred = Deferred()
+        deferred.add_callback(run_next)
+        core.run('fake', deferred)
+
+    begin = utils.ticks()
+    POLLER.sched(0, run_next)
+    POLLER.loop()
+    elapsed = utils.ticks() - begin
+    return {
+            'requests': sum(server.requests.values()),
+            'hosts': hosts,
+            'per_test': elapsed / count,
+           }
+
+# The benchmark and the tests share the same runs
+RUNS = {}
+
+def run_tests(method, policy, count, ttl=3600):
+    ''' Run the tests in a child process (so that the access log
+        does not clobber our output) and return a summary '''
+    if (method, policy, count, ttl) in RUNS:
+        return RUNS[(method, policy, count, ttl)]
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(rfd)
+            devnull = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(devnull, 2)
+            CONFIG['runner.discovery_ttl'] = ttl
+            os.write(wfd, json.dumps(_run_tests(method, policy, count)))
+        finally:
+            os._exit(0)
+    os.close(wfd)
+    vector = []
+    while True:
+        data = os.read(rfd, 65536)
+        if not data:
+            break
+        vector.append(data)
+    os.close(rfd)
+    os.waitpid(pid, 0)
+    summary = json.loads(''.join(vector))
+    RUNS[(method, policy, count, ttl)] = summary
+    return summary
+
+class TestRunnerDiscovery(unittest.TestCase):
+    ''' Make sure the runner reuses discovery results '''
+
+    def test_closest(self):
+        ''' Make sure we query mlab-ns once for the closest host '''
+        summary = run_tests('mlab-ns', '', 5)
+        self.assertEqual(len(summary['hosts']), 5)
+        self.assertEqual(summary['requests'], 1)
+
+    def test_random(self):
+        ''' Make sure we refresh the random hosts pool in background '''
+        summary = run_tests('mlab-ns', 'random', 20)
+        self.assertEqual(len(summary['hosts']), 20)
+        self.assertEqual(summary['requests'], RANDOM_POOL)
+        # Hosts come from the stub, never from the static table
+        self.assertTrue(set(summary['hosts']) <= set('host%d.example' %
+                        index for index in range(1, RANDOM_POOL + 1)))
+
+    def test_rendezvous(self):
+        ''' Make sure we rendezvous once '''
+        summary = run_tests('rendezvous', '', 5)
+        self.assertEqual(len(summary['hosts']), 5)
+        self.assertEqual(summary['requests'], 1)
+        self.assertTrue(summary['hosts'][-1].startswith('http://127.0.0.1'))
+
+    def test_no_cache(self):
+        ''' Make sure we discover before each test with zero TTL '''
+        summary = run_tests('mlab-ns', 'random', 20, 0)
+        self.assertEqual(summary['requests'], 20)
+        self.assertEqual(summary['hosts'], ['host%d.example' % index
+                         for index in range(1, 21)])
+
+    def test_runner_hosts(self):
+        ''' Make sure a cached result is applied before each test '''
+        DISCOVERY_CACHE.clear()
+        key = DISCOVERY_CACHE.make_key('mlab-ns', 'random')
+        DISCOVERY_CACHE.put(key, {'fqdn': 'a.example'}, ['a.example'])
+        self.assertTrue(RunnerCore._use_cached_discovery(key))
+        self.assertEqual(RUNNER_HOSTS.get_random_host(), 'a.example')
+        DISCOVERY_CACHE.mark_stale('a.example')
+        self.assertFalse(RunnerCore._use_cached_discovery(key))
+
+#
+# Benchmark: number of discovery requests and time per test, with
+# and without the cache, using the stub server on the loopback (so
+# that a real discovery costs more, because of the network RTT).
+#
+
+def benchmark():
+    ''' Benchmark the runner with and without the cache '''
+    sys.stdout.write('Runner discovery (%d tests, loopback stub):\n' % 20)
+    for label, method, policy in (('mlab-ns (closest)', 'mlab-ns', ''),
+                                  ('mlab-ns (random)', 'mlab-ns', 'random'),
+                                  ('rendezvous', 'rendezvous', '')):
+        for ttl in (0, 3600):
+            summary = run_tests(method, policy, 20, ttl)
+            sys.stdout.write('  %-17s %-8s: %2d requests, %s per test\n'
+              % (label, ttl and 'cache' or 'no cache', summary['requests'],
+                 utils.time_formatter(summary['per_test'])))
+
+if __name__ == '__main__':
+    benchmark()
+    unittest.main()
@@ -0,0 +1,373 @@
+#!/usr/bin/env python
+
+#
+# Copyright (c) 2013
+#     Nexa Center for Internet & Society, Politecnico di Torino (DAUIN),
+#     and Simone Basso <bassosimone@gmail.com>
+#
+# This file is part of Neubot <http://www.neubot.org/>.
+#
+# Neubot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Neubot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Neubot.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+''' Regression test and benchmark for neubot/segment_store.py '''
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+if __name__ == '__main__':
+    sys.path.insert(0, '.')
+
+from neubot.backend_neubot import BackendNeubot
+from neubot.database import DATABASE
+from neubot.database import table_aggregate
+from neubot.segment_store import SegmentStore
+from neubot.segment_store import SPLIT_INTERVAL
+from neubot.segment_store import SPLIT_NUM_FILES
+
+from neubot import utils
+
+#
+# We're accessing private methods and we don't maintain
+# unittest, so we don't care about the number of methods.
+#
+# pylint: disable=W0212,R0904
+#
+
+def _result(timestamp):
+    ''' Create a result '''
+    return {
+        'timestamp': timestamp,
+        'uuid': '0964312e-f451-4579-9984-3954dcfdeb42',
+        'real_address': '130.192.91.211',
+        'remote_address': '194.116.85.211',
+        'elapsed': 0.9861450195,
+        'received': 1187400,
+        'rate': 3000,
+        'iteration': timestamp % 15,
+        'platform': 'linux2',
+        'version': '0.004016007',
+    }
+
+def _timestamps(results):
+    ''' Return the timestamps of results '''
+    return [result['timestamp'] for result in results]
+
+def _write_pickles(datadir, name, count):
+    ''' Save count results as the old pickle files would '''
+    path = os.path.join(datadir, '%s.pickle' % name)
+    current = count % SPLIT_INTERVAL or SPLIT_INTERVAL
+    segments = [range(count - current, count)]
+    end = count - current
+    while end > 0 and len(segments) <= SPLIT_NUM_FILES + 1:
+        segments.append(range(max(0, end - SPLIT_INTERVAL), end))
+        end -= SPLIT_INTERVAL
+    for index, timestamps in enumerate(segments):
+        filename = path
+        if index > 0:
+            filename += '.%d' % (index - 1)
+        filep = open(filename, 'wb')
+        pickle.dump([_result(timestamp) for timestamp in timestamps], filep)
+        filep.close()
+
+class TestSegmentStore(unittest.TestCase):
+    ''' Regression test for SegmentStore '''
+
+    def setUp(self):
+        self.datadir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.datadir)
+
+    def _store(self, **kwargs):
+        ''' Create a store '''
+        return SegmentStore(self.datadir, 'test', **kwargs)
+
+    def test_append(self):
+        ''' Make sure we append and read results '''
+        store = self._store()
+        for timestamp in range(10):
+            store.append(_result(timestamp))
+        self.assertEqual(_timestamps(store.read(None)), range(10))
+        self.assertEqual(store.read(0), [])
+        self.assertEqual(store.count(), 10)
+        store.close()
+        self.assertEqual(_timestamps(self._store().read(None)), range(10))
+
+    def test_rotate(self):
+        ''' Make sure we rotate and keep a bounded number of segments '''
+        store = self._store(split_interval=4, split_num_files=2)
+        for timestamp in range(22):
+            store.append(_result(timestamp))
+        self.assertEqual(_timestamps(store.read(None)), [20, 21])
+        self.assertEqual(_timestamps(store.read(0)), range(16, 20))
+        self.assertEqual(_timestamps(store.read(2)), range(8, 12))
+        self.assertEqual(store.read(3), [])
+        self.assertFalse(os.path.exists(store._path(3)))
+        self.assertEqual(store.count(), 14)
+
+    def test_walk(self):
+        ''' Make sure range reads follow the old /api/data semantics '''
+        store = self._store(split_interval=4, split_num_files=2)
+        for timestamp in range(22):
+            store.append(_result(timestamp))
+        self.assertEqual(_timestamps(store.walk()), range(21, 7, -1))
+        self.assertEqual(_timestamps(store.walk(10, 17)), range(17, 9, -1))
+        self.assertEqual(_timestamps(store.walk(21)), [21])
+        self.assertEqual(_timestamps(store.walk(until=9)), [9, 8])
+        self.assertEqual(_timestamps(store.walk(30)), [])
+
+    def test_index(self):
+        ''' Make sure a stale index is rebuilt '''
+        store = self._store(split_interval=4, split_num_files=2)
+        for timestamp in range(10):
+            store.append(_result(timestamp))
+        store.close()
+        segments = store.segments
+        self.assertEqual(self._store()._read_index(), segments)
+        os.unlink(store._path(None) + '.idx')
+        store = self._store(split_interval=4, split_num_files=2)
+        self.assertEqual(_timestamps(store.walk(2, 6)), range(6, 1, -1))
+        self.assertEqual(store.segments, segments)
+        filep = open(store._path(0), 'ab')
+        filep.write('{"timestamp":8}\n')
+        filep.close()
+        self.assertEqual(self._store()._read_index(), None)
+
+    def test_truncated(self):
+        ''' Make sure we recover from a truncated last line '''
+        store = self._store()
+        for timestamp in range(3):
+            store.append(_result(timestamp))
+        store.close()
+        filep = open(store._path(None), 'ab')
+        filep.write('{"timestamp": 3, "uu')
+        filep.close()
+        store = self._store()
+        self.assertEqual(_timestamps(store.read(None)), range(3))
+        store.append(_result(4))
+        self.assertEqual(_timestamps(store.read(None)), [0, 1, 2, 4])
+        self.assertEqual(store.count(), 4)
+
+    def test_readonly(self):
+        ''' Make sure a readonly store does not write into datadir '''
+        store = self._store(readonly=True)
+        self.assertEqual(store.read(None), [])
+        self.assertEqual(list(store.walk()), [])
+        self.assertEqual(os.listdir(self.datadir), [])
+        self.assertRaises(RuntimeError, store.append, _result(0))
+        store = self._store(split_interval=4)
+        for timestamp in range(6):
+            store.append(_result(timestamp))
+        store.close()
+        filep = open(store._path(None), 'ab')
+        filep.write('{"timestamp": 6, "uu')
+        filep.close()
+        size = os.path.getsize(store._path(None))
+        store = self._store(split_interval=4, readonly=True)
+        self.assertEqual(_timestamps(store.walk()), [5, 4, 3, 2, 1, 0])
+        self.assertEqual(store.count(), 6)
+        self.assertEqual(os.path.getsize(store._path(None)), size)
+
+    def test_migrate(self):
+        ''' Make sure we convert the old pickle files '''
+        _write_pickles(self.datadir, 'test', 3 * SPLIT_INTERVAL + 7)
+        store = self._store()
+        self.assertEqual(store.count(), 3 * SPLIT_INTERVAL + 7)
+        self.assertEqual(len(store.read(None)), 7)
+        self.assertEqual(_timestamps(store.read(2)), range(SPLIT_INTERVAL))
+        self.assertEqual(os.listdir(self.datadir).count('test.pickle'), 0)
+        self.assertEqual(len([name for name in os.listdir(self.datadir)
+                              if name.startswith('test.pickle')]), 0)
+        store.append(_result(3 * SPLIT_INTERVAL + 7))
+        self.assertEqual(len(store.read(None)), 8)
+
+class FakeProxy(object):
+    ''' Fake backend proxy '''
+
+    def __init__(self, datadir):
+        self.datadir = datadir
+        self.touched = []
+
+    def datadir_touch(self, components):
+        ''' Touch a file below datadir '''
+        self.touched.append(components[0])
+        path = os.path.join(self.datadir, components[0])
+        open(path, 'ab').close()
+        return path
+
+class TestBackendNeubot(unittest.TestCase):
+    ''' Make sure the Neubot backend uses the segment store '''
+
+    def setUp(self):
+        self.datadir = tempfile.mkdtemp()
+        self.proxy = FakeProxy(self.datadir)
+        self.backend = BackendNeubot(self.proxy)
+        DATABASE.set_path(os.path.join(self.datadir, 'database.sqlite3'))
+
+    def tearDown(self):
+        DATABASE.close()
+        shutil.rmtree(self.datadir)
+
+    def test_generic(self):
+        ''' Make sure we store and walk generic results '''
+        for timestamp in range(5):
+            self.backend.store_generic('dash', _result(timestamp))
+        self.assertEqual(self.proxy.touched, ['dash.jsonl'])
+        self.assertEqual(_timestamps(self.backend.walk_generic('dash', None)),
+                         range(5))
+        self.assertEqual(self.backend.walk_generic('dash', 0), [])
+        self.assertEqual(_timestamps(self.backend.walk_generic_range('dash',
+                         1, 3)), [3, 2, 1])
+
+    def test_read_path(self):
+        ''' Make sure walking does not write into datadir '''
+        self.assertEqual(self.backend.walk_generic('dash', None), [])
+        self.assertEqual(list(self.backend.walk_generic_range('dash',
+                         -1, -1)), [])
+        self.assertEqual(os.listdir(self.datadir), [])
+        for timestamp in range(5):
+            BackendNeubot(self.proxy).store_generic('dash',
+                                                    _result(timestamp))
+        DATABASE.connection().execute('DELETE FROM aggregate;')
+        del self.proxy.touched[:]
+        names = sorted(os.listdir(self.datadir))
+        self.assertEqual(_timestamps(self.backend.walk_generic('dash', None)),
+                         range(5))
+        self.assertEqual(_timestamps(self.backend.walk_generic_range('dash',
+                         1, 3)), [3, 2, 1])
+        self.assertEqual(sorted(os.listdir(self.datadir)), names)
+        self.assertEqual(self.proxy.touched, [])
+        self.assertFalse(table_aggregate.has_test(DATABASE.connection(),
+                                                  'dash'))
+
+    def test_invalid(self):
+        ''' Make sure we don't walk outside datadir '''
+        self.assertEqual(self.backend.walk_generic('../../etc/x', None), [])
+        self.assertEqual(self.backend.walk_generic_range('../x', -1, -1), [])
+        self.assertRaises(RuntimeError, self.backend.store_generic,
+                          '../x', {})
+
+#
+# Store and walk benchmark: we save COUNT results, as the old pickle
+# files would, and we measure the average latency of STORES stores,
+# the latency of walking all the results, as /api/data does without
+# since and until, and the latency of walking the last RECENT results.
+# The old code appends to an in-memory list and pickles the whole
+# list at each store, and unpickles whole files when walking.
+#
+
+STORES = 1000
+RECENT = 100
+
+class LegacyStore(object):
+    ''' The old pickle-based generic store '''
+
+    def __init__(self, datadir, name):
+        self.path = os.path.join(datadir, '%s.pickle' % name)
+        self.results = None
+
+    def append(self, result):
+        ''' Store a result '''
+        if self.results is None:
+            filep = open(self.path, 'rb')
+            self.results = pickle.loads(filep.read())
+            filep.close()
+        if len(self.results) >= SPLIT_INTERVAL:
+            tmppath = self.path + '.' + str(SPLIT_NUM_FILES)
+            if os.path.isfile(tmppath):
+                os.unlink(tmppath)
+            for index in range(SPLIT_NUM_FILES, 0, -1):
+                srcpath = self.path + '.' + str(index - 1)
+                if os.path.isfile(srcpath):
+                    os.rename(srcpath, self.path + '.' + str(index))
+            filep = open(self.path + '.0', 'wb')
+            pickle.dump(self.results, filep)
+            filep.close()
+            self.results = []
+        self.results.append(result)
+        filep = open(self.path, 'wb')
+        pickle.dump(self.results, filep)
+        filep.close()
+
+    def walk(self, since=-1, until=-1):
+        ''' Walk results as the old /api/data did '''
+        lst = []
+        for index in [None] + range(16):
+            path = self.path
+            if index is not None:
+                path += '.' + str(index)
+            if not os.path.isfile(path):
+                break
+            filep = open(path, 'rb')
+            tmp = pickle.loads(filep.read())
+            filep.close()
+            found_start = False
+            for elem in reversed(tmp):
+                if until >= 0 and elem['timestamp'] > until:
+                    continue
+                if since >= 0 and elem['timestamp'] < since:
+                    found_start = True
+                    break
+                lst.append(elem)
+            if found_start:
+                break
+        return lst
+
+def _measure(store, count):
+    ''' Return store, full walk and recent walk latency '''
+    begin = utils.ticks()
+    for timestamp in range(count, count + STORES):
+        store.append(_result(timestamp))
+    store_latency = (utils.ticks() - begin) / STORES
+    begin = utils.ticks()
+    length = len(list(store.walk()))
+    walk_latency = utils.ticks() - begin
+    begin = utils.ticks()
+    recent = len(list(store.walk(count + STORES - RECENT)))
+    recent_latency = utils.ticks() - begin
+    assert length > SPLIT_INTERVAL and recent == RECENT
+    return store_latency, walk_latency, recent_latency
+
+def benchmark():
+    ''' Compare the pickle files and the segment store '''
+    sys.stdout.write('Generic results store and walk latency:\n')
+    for count in (10000, 100000):
+        for name in ('pickle', 'segments'):
+            datadir = tempfile.mkdtemp()
+            _write_pickles(datadir, 'test', count)
+            if name == 'pickle':
+                store = LegacyStore(datadir, 'test')
+            else:
+                store = SegmentStore(datadir, 'test')
+                store.count()
+            latencies = _measure(store, count)
+            shutil.rmtree(datadir)
+            sys.stdout.write('  %6d results, %-8s: store %s, walk %s, '
+              'walk last %d %s\n' % (count, name,
+              utils.time_formatter(latencies[0]),
+              utils.time_formatter(latencies[1]), RECENT,
+              utils.time_formatter(latencies[2])))
+
+if __name__ == '__main__':
+    benchmark()
+    unittest.main()
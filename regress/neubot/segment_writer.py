@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+
+#
+# Copyright (c) 2013
+#     Nexa Center for Internet & Society, Politecnico di Torino (DAUIN),
+#     and Simone Basso <bassosimone@gmail.com>
+#
+# This file is part of Neubot <http://www.neubot.org/>.
+#
+# Neubot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Neubot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Neubot.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+''' Regression test and benchmark for neubot/segment_writer.py '''
+
+import StringIO
+import gzip
+import logging
+import os
+import pwd
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+if __name__ == '__main__':
+    sys.path.insert(0, '.')
+
+from neubot.backend import BackendProxy
+from neubot.backend_null import BackendNull
+from neubot.compat import json
+from neubot.config import CONFIG
+
+from neubot import segment_writer
+from neubot import utils
+
+#
+# We're accessing private methods and we don't maintain
+# unittest, so we don't care about the number of methods.
+#
+# pylint: disable=W0212,R0904
+#
+
+# 2013-05-12T10:20:30.5Z
+THETIME = 1368354030.5
+
+def _result(index):
+    ''' Create a result '''
+    return {
+        'timestamp': int(THETIME) + index,
+        'uuid': '0964312e-f451-4579-9984-3954dcfdeb42',
+        'real_address': '130.192.91.211',
+        'remote_address': '194.116.85.211',
+        'connect_time': 0.0123,
+        'download_speed': 1187400.0 + index,
+        'upload_speed': 456000.0,
+        'latency': 0.0241,
+        'platform': 'linux2',
+        'neubot_version': '0.004016007',
+    }
+
+class FakePoller(object):
+    ''' Fake poller '''
+
+    def __init__(self):
+        self.tasks = []
+
+    def sched(self, delta, func, *args):
+        ''' Schedule task '''
+        self.tasks.append((delta, func, args))
+
+class TestSegmentWriter(unittest.TestCase):
+    ''' Regression test for SegmentWriter '''
+
+    def setUp(self):
+        self.datadir = tempfile.mkdtemp()
+        self.poller = FakePoller()
+        self.saved = CONFIG.conf.copy()
+
+    def tearDown(self):
+        CONFIG.conf.update(self.saved)
+        shutil.rmtree(self.datadir)
+
+    def _touch(self, components):
+        ''' Touch a file below datadir '''
+        path = self.datadir
+        for component in components[:-1]:
+            path = os.path.join(path, component)
+            if not os.path.isdir(path):
+                os.mkdir(path)
+        path = os.path.join(path, components[-1])
+        open(path, 'ab').close()
+        return path
+
+    def _writer(self, **kwargs):
+        ''' Create a writer '''
+        for name, value in kwargs.items():
+            CONFIG.conf['mlab.segment.' + name] = value
+        return segment_writer.SegmentWriter('speedtest', self._touch,
+                                            self.poller)
+
+    def _segments(self):
+        ''' Return the segments below datadir '''
+        result = []
+        for dirpath, _, filenames in os.walk(self.datadir):
+            for filename in filenames:
+                if filename.endswith('.jsonl.gz'):
+                    result.append(os.path.join(dirpath, filename))
+        return sorted(result)
+
+    def test_roundtrip(self):
+        ''' Make sure we can read back all and individual results '''
+        writer = self._writer()
+        for index in range(10):
+            writer.append(_result(index), THETIME + index)
+        writer.close()
+
+        segments = self._segments()
+        self.assertEqual(segments, [os.path.join(self.datadir, '2013', '05',
+          '12', '20130512T10:20:30.500000000Z_speedtest.jsonl.gz')])
+
+        filep = gzip.open(segments[0])
+        lines = filep.read().splitlines()
+        filep.close()
+        self.assertEqual([json.loads(line) for line in lines],
+                         [_result(index) for index in range(10)])
+
+        entries = segment_writer.read_index(segments[0])
+        self.assertEqual(len(entries), 10)
+        for index, (offset, length, name) in enumerate(entries):
+            self.assertEqual(name, segment_writer.result_name(
+                             THETIME + index, 'speedtest'))
+            self.assertEqual(segment_writer.read_result(segments[0],
+                             offset, length), _result(index))
+
+        # An extracted member is what the old code would have saved
+        offset, length, name = entries[3]
+        filep = open(segments[0], 'rb')
+        filep.seek(offset)
+        member = gzip.GzipFile(fileobj=StringIO.StringIO(filep.read(length)))
+        filep.close()
+        self.assertEqual(json.load(member), _result(3))
+
+    def test_flush(self):
+        ''' Make sure we buffer results and flush on size and time '''
+        writer = self._writer(flush_interval=3600, flush_size=1024)
+        writer.append(_result(0), THETIME)
+        self.assertEqual(os.path.getsize(writer.path), 0)
+        self.assertEqual(len(self.poller.tasks), 1)
+        while writer.buffer:
+            writer.append(_result(0), THETIME)
+        self.assertTrue(os.path.getsize(writer.path) >= 1024)
+        self.assertEqual(len(self.poller.tasks), 1)
+
+        writer.append(_result(0), THETIME)
+        size = os.path.getsize(writer.path)
+        self.poller.tasks.pop(0)[1]()
+        self.assertEqual(os.path.getsize(writer.path), size)
+        self.assertEqual(len(self.poller.tasks), 1)
+        writer.oldest -= 3600
+        self.poller.tasks.pop(0)[1]()
+        self.assertTrue(os.path.getsize(writer.path) > size)
+        self.assertEqual(writer.buffer, [])
+        self.assertEqual(len(self.poller.tasks), 0)
+
+    def test_rotate(self):
+        ''' Make sure we rotate on size, time and day change '''
+        writer = self._writer(flush_interval=0, rotate_size=2048,
+                              rotate_interval=60)
+        thetime = THETIME
+        while len(self._segments()) < 2:
+            thetime += 0.001
+            writer.append(_result(0), thetime)
+        writer.append(_result(0), thetime + 60)
+        self.assertEqual(len(self._segments()), 3)
+        writer.append(_result(0), thetime + 86400)
+        writer.close()
+        segments = self._segments()
+        self.assertEqual(len(segments), 4)
+        self.assertTrue('/2013/05/13/' in segments[-1])
+        self.assertTrue(os.path.getsize(segments[0]) >= 2048)
+
+    def test_truncated(self):
+        ''' Make sure we recover from truncated segments '''
+        writer = self._writer()
+        for index in range(5):
+            writer.append(_result(index), THETIME + index)
+        writer.close()
+        path = self._segments()[0]
+        entries = segment_writer.read_index(path)
+        filep = open(path, 'rb')
+        content = filep.read()
+        filep.close()
+        filep = open(path + '.idx', 'rb')
+        index = filep.read()
+        filep.close()
+
+        for size in range(len(content)):
+            complete = [entry for entry in entries
+                        if entry[0] + entry[1] <= size]
+            filep = open(path, 'wb')
+            filep.write(content[:size])
+            filep.close()
+            filep = open(path + '.idx', 'wb')
+            filep.write(index)
+            filep.close()
+
+            members = list(segment_writer.iter_members(path))
+            self.assertEqual([member[:3] for member in members], complete)
+            self.assertEqual(segment_writer.read_index(path), complete)
+
+            self.assertEqual(segment_writer.repair(path), len(complete))
+            self.assertEqual(segment_writer.read_index(path), complete)
+            filep = gzip.open(path)
+            lines = filep.read().splitlines()
+            filep.close()
+            self.assertEqual(len(lines), len(complete))
+
+    def test_truncated_index(self):
+        ''' Make sure we ignore a truncated index line '''
+        writer = self._writer()
+        for index in range(3):
+            writer.append(_result(index), THETIME + index)
+        writer.close()
+        path = self._segments()[0]
+        entries = segment_writer.read_index(path)
+        filep = open(path + '.idx', 'rb')
+        index = filep.read()
+        filep.close()
+        filep = open(path + '.idx', 'wb')
+        filep.write(index[:-3])
+        filep.close()
+        self.assertEqual(segment_writer.read_index(path), entries[:2])
+        segment_writer.repair(path)
+        self.assertEqual(segment_writer.read_index(path), entries)
+
+#
+# Throughput benchmark: we save RESULTS results with the real
+# backend proxy, i.e. making sure that files belong to the right
+# user and have the right permissions, first with the old code,
+# which creates a file per result, and then with segments.
+#
+
+RESULTS = 5000
+
+class LegacyBackendMLab(BackendNull):
+    ''' The old M-Lab backend '''
+
+    def store_generic(self, test, results):
+        ''' Save a result into its own file '''
+        thetime = time.time()
+        gmt = time.gmtime(thetime)
+        nanosec = int((thetime % 1.0) * 1000000000)
+        components = [
+                      time.strftime('%Y', gmt),
+                      time.strftime('%m', gmt),
+                      time.strftime('%d', gmt),
+                      '%s.%09dZ_%s.gz' % (
+                        time.strftime('%Y%m%dT%H:%M:%S', gmt),
+                        nanosec, test)
+                     ]
+        fullpath = self.proxy.datadir_touch(components)
+        filep = gzip.open(fullpath, 'ab')
+        json.dump(results, filep)
+        filep.close()
+
+def measure_throughput(legacy):
+    ''' Return results per second and number of files '''
+    datadir = tempfile.mkdtemp()
+    proxy = BackendProxy()
+    proxy.really_init_datadir(pwd.getpwuid(os.getuid())[0], datadir)
+    proxy.use_backend('mlab')
+    if legacy:
+        proxy.backend = LegacyBackendMLab(proxy)
+    level = logging.getLogger().level
+    logging.getLogger().setLevel(logging.INFO)
+    begin = utils.ticks()
+    for index in range(RESULTS):
+        proxy.store_generic('speedtest', _result(index))
+    proxy.flush()
+    elapsed = utils.ticks() - begin
+    logging.getLogger().setLevel(level)
+    files = sum([len(filenames) for _, _, filenames in os.walk(datadir)])
+    shutil.rmtree(datadir)
+    return RESULTS / elapsed, files
+
+class TestThroughput(unittest.TestCase):
+    ''' Make sure we can save thousands of results per minute '''
+
+    def test_throughput(self):
+        ''' Make sure we save at least 10000 results per minute '''
+        speed, files = measure_throughput(False)
+        self.assertTrue(speed * 60 > 10000)
+        self.assertTrue(files <= 4)
+
+def benchmark():
+    ''' Compare a file per result with segments '''
+    sys.stdout.write('Saving %d M-Lab results:\n' % RESULTS)
+    for name, legacy in (('file per result', True), ('segments', False)):
+        speed, files = measure_throughput(legacy)
+        sys.stdout.write('  %-15s: %d results/min (%d files)\n' % (name,
+                         speed * 60, files))
+
+if __name__ == '__main__':
+    benchmark()
+    unittest.main()
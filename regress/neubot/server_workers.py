@@ -0,0 +1,390 @@
+#!/usr/bin/env python
+
+#
+# Copyright (c) 2013
+#     Nexa Center for Internet & Society, Politecnico di Torino (DAUIN),
+#     and Simone Basso <bassosimone@gmail.com>
+#
+# This file is part of Neubot <http://www.neubot.org/>.
+#
+# Neubot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Neubot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Neubot.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+''' Regression test and load test for neubot/server_workers.py '''
+
+import StringIO
+import logging
+import os
+import signal
+import socket
+import struct
+import sys
+import time
+import unittest
+
+if __name__ == '__main__':
+    sys.path.insert(0, '.')
+
+from neubot.config import CONFIG
+from neubot.database import DATABASE
+from neubot.handler import Handler
+from neubot.http.message import Message
+from neubot.negotiate.server import NegotiateServer
+from neubot.negotiate.server import NegotiateServerModule
+from neubot.poller import POLLER
+from neubot.server_workers import QUEUE_POSITION
+from neubot.server_workers import TABLE_DEL
+from neubot.server_workers import TABLE_SET
+from neubot.stream import Stream
+from neubot.utils_random import RANDOMBLOCKS
+
+from neubot.compat import json
+
+from neubot import server_workers
+from neubot import utils
+from neubot import utils_net
+
+#
+# We're accessing private methods and we don't maintain
+# unittest, so we don't care about the number of methods.
+#
+# pylint: disable=W0212,R0904
+#
+
+class FakeChannel(object):
+    ''' Fake IPC channel that records messages '''
+
+    def __init__(self):
+        self.messages = []
+
+    def send(self, message):
+        ''' Record message '''
+        self.messages.append(message)
+
+class MinimalHttpStream(object):
+    ''' Minimal HTTP stream '''
+
+    def __init__(self):
+        self.response = None
+        self.opaque = None
+        self.peername = ('abc', 0)
+        self.closed = False
+
+    def send_response(self, request, response):
+        ''' Record the response '''
+        self.response = response
+
+    def close(self):
+        ''' Pretend to close the stream '''
+        self.closed = True
+
+    def atclose(self, func):
+        ''' Pretend to register atclose hook '''
+
+    def unregister_atclose(self, func):
+        ''' Pretend to unregister atclose hook '''
+
+class TestSharedTable(unittest.TestCase):
+    ''' Regression test for SharedTable '''
+
+    def test_replication(self):
+        ''' Make sure changes are sent and applied '''
+        channel = FakeChannel()
+        table = server_workers.SharedTable('x', channel)
+        table['a'] = 1
+        table.add('b')
+        del table['a']
+        self.assertEqual(channel.messages, [(TABLE_SET, 'x', 'a', 1),
+                                            (TABLE_SET, 'x', 'b', True),
+                                            (TABLE_DEL, 'x', 'a')])
+        self.assertEqual(table, {'b': True})
+
+        other = server_workers.SharedTable('x', FakeChannel())
+        for message in channel.messages:
+            other.apply_remote(message)
+        self.assertEqual(other, {'b': True})
+        self.assertEqual(other.channel.messages, [])
+
+class TestMasterQueue(unittest.TestCase):
+    ''' Regression test for the global negotiate queue '''
+
+    def setUp(self):
+        self.master = server_workers.Master()
+        self.channels = [FakeChannel(), FakeChannel()]
+        for index, channel in enumerate(self.channels):
+            self.master.workers[channel] = index
+
+    def test_join_leave(self):
+        ''' Make sure positions are global and updated on leave '''
+        for ticket in range(4):
+            self.master.queue_join(self.channels[ticket % 2], ticket)
+        self.assertEqual(self.channels[0].messages, [
+                         (QUEUE_POSITION, 0, 0), (QUEUE_POSITION, 2, 2)])
+        self.assertEqual(self.channels[1].messages, [
+                         (QUEUE_POSITION, 1, 1), (QUEUE_POSITION, 3, 3)])
+
+        del self.channels[0].messages[:]
+        del self.channels[1].messages[:]
+        self.master.queue_wait(self.channels[0], 2)
+        self.master.queue_wait(self.channels[1], 3)
+        self.assertEqual(self.channels[0].messages, [])
+        self.assertEqual(self.channels[1].messages, [])
+        self.master.queue_leave(self.channels[1], 1)
+        self.assertEqual(self.channels[0].messages, [(QUEUE_POSITION, 2, 1)])
+        self.assertEqual(self.channels[1].messages, [(QUEUE_POSITION, 3, 2)])
+
+    def test_waiting_only(self):
+        ''' Make sure we notify only the waiting entries, and we
+            respond at once to waits that arrive late '''
+        saved = CONFIG['negotiate.parallelism']
+        CONFIG['negotiate.parallelism'] = 1
+        try:
+            for ticket in range(4):
+                self.master.queue_join(self.channels[0], ticket)
+            self.assertEqual(self.master.stats.unchoked, 1)
+            self.master.queue_wait(self.channels[0], 3)
+            del self.channels[0].messages[:]
+            self.master.queue_leave(self.channels[0], 0)
+            self.assertEqual(self.channels[0].messages, [
+                             (QUEUE_POSITION, 3, 2)])
+            self.assertEqual(self.master.stats.unchoked, 2)
+
+            del self.channels[0].messages[:]
+            self.master.queue_leave(self.channels[0], 1)
+            self.assertEqual(self.channels[0].messages, [])
+            self.master.queue_wait(self.channels[0], 2)
+            self.master.queue_wait(self.channels[0], 3)
+            self.assertEqual(self.channels[0].messages, [
+                             (QUEUE_POSITION, 2, 0), (QUEUE_POSITION, 3, 1)])
+            self.assertEqual(self.master.stats.unchoked, 3)
+        finally:
+            CONFIG['negotiate.parallelism'] = saved
+
+    def test_red(self):
+        ''' Make sure RED drops when the global queue is long '''
+        for ticket in range(CONFIG['negotiate.max_thresh']):
+            self.master.queue.append((self.channels[1], ticket))
+        self.master.queue_join(self.channels[0], 'x')
+        self.assertEqual(self.channels[0].messages, [
+                         (QUEUE_POSITION, 'x', None)])
+
+    def test_worker_died(self):
+        ''' Make sure a dead worker's streams leave the queue '''
+        for ticket in range(4):
+            self.master.queue_join(self.channels[ticket % 2], ticket)
+        self.master.queue_wait(self.channels[1], 1)
+        self.master.queue_wait(self.channels[1], 3)
+        del self.channels[1].messages[:]
+
+        # The worker is still exiting when we see EOF
+        pid = os.fork()
+        if pid == 0:
+            time.sleep(0.2)
+            os._exit(0)
+        self.master.workers[self.channels[0]] = pid
+        self.master._handle_eof(self.channels[0])
+        self.assertRaises(OSError, os.waitpid, pid, os.WNOHANG)
+
+        self.assertEqual(list(self.master.queue), [(self.channels[1], 1),
+                                             (self.channels[1], 3)])
+        self.assertEqual(self.channels[1].messages, [
+                         (QUEUE_POSITION, 1, 0), (QUEUE_POSITION, 3, 1)])
+
+class TestPrefork(unittest.TestCase):
+    ''' Regression test for prefork() '''
+
+    def test_database(self):
+        ''' Make sure workers do not use the master's database '''
+        rfile, wfile = os.pipe()
+        saved, DATABASE.dbc = DATABASE.dbc, object()
+        try:
+            master, worker = server_workers.prefork(1)
+            if worker:
+                DATABASE._summarize_later()
+                os.write(wfile, str(int(DATABASE.dbc is None and
+                                        not DATABASE.summarizing)))
+                os._exit(0)
+        finally:
+            DATABASE.dbc = saved
+        os.close(wfile)
+        self.assertEqual(os.read(rfile, 1), '1')
+        os.close(rfile)
+        for channel in list(master.workers):
+            POLLER.close(channel)
+        self.assertEqual(master.workers, {})
+
+class TestNegotiateCoordinator(unittest.TestCase):
+    ''' Make sure the negotiate server uses the global queue '''
+
+    def test_negotiate(self):
+        ''' Make sure we respond when the master tells the position '''
+        channel = FakeChannel()
+        coordinator = server_workers.QueueCoordinator(channel)
+        server = NegotiateServer(None)
+        server.coordinator = coordinator
+        server.register_module('abc', NegotiateServerModule())
+
+        stream = MinimalHttpStream()
+        request = Message(uri='/negotiate/abc')
+        request.body = StringIO.StringIO('{}')
+        server.process_request(stream, request)
+
+        # No response until the master tells us the position
+        self.assertEqual(stream.response, None)
+        ticket = channel.messages[0][1]
+        coordinator.position_changed(ticket, 7)
+        body = json.loads(stream.response.body)
+        self.assertEqual(body['queue_pos'], 7)
+
+        # The next request is delayed until the position changes
+        stream.response = None
+        request = Message(uri='/negotiate/abc')
+        request.body = StringIO.StringIO('{}')
+        server.process_request(stream, request)
+        self.assertEqual(stream.response, None)
+        self.assertEqual(channel.messages[-1],
+                         (server_workers.QUEUE_WAIT, ticket))
+        coordinator.position_changed(ticket, 0)
+        body = json.loads(stream.response.body)
+        self.assertEqual(body['queue_pos'], 0)
+        self.assertEqual(body['unchoked'], 1)
+
+        # Leaving the queue on close
+        server._leave_coordinator(stream, None)
+        self.assertEqual(channel.messages[-1],
+                         (server_workers.QUEUE_LEAVE, ticket))
+        self.assertEqual(len(coordinator), 0)
+
+    def test_rejected(self):
+        ''' Make sure we close the stream when RED drops it '''
+        channel = FakeChannel()
+        coordinator = server_workers.QueueCoordinator(channel)
+        server = NegotiateServer(None)
+        server.coordinator = coordinator
+        stream = MinimalHttpStream()
+        server.process_request(stream, Message(uri='/negotiate/abc'))
+        coordinator.position_changed(channel.messages[0][1], None)
+        self.assertTrue(stream.closed)
+        self.assertEqual(server.known, set())
+
+#
+# Load test: each worker serves a CPU-bound chargen, similar to the
+# speedtest download, and the clients run in separate processes.
+#
+
+LOAD_PORT = 54321
+LOAD_CLIENTS = 8
+LOAD_DURATION = 1.0
+
+class ChargenServer(Handler):
+    ''' Chargen server for the load test '''
+
+    def handle_accept(self, listener, sock, sslconfig, sslcert):
+        Stream(sock, self._connection_made, self._connection_lost,
+               sslconfig, sslcert, None)
+
+    def _connection_made(self, stream):
+        ''' Send our pid then random data forever '''
+        stream.send(struct.pack('!I', os.getpid()), self._send_block)
+
+    @staticmethod
+    def _connection_lost(stream):
+        ''' Invoked when the client goes away '''
+
+    def _send_block(self, stream):
+        ''' Send a block of random data '''
+        stream.send(RANDOMBLOCKS.get_block(), self._send_block)
+
+def _run_server(workers, ready):
+    ''' Run the server with the given number of workers '''
+    # Clients hang up while we are sending: don't log the EPIPEs
+    logging.getLogger().setLevel(logging.CRITICAL)
+    utils_net.set_listen_reuseport(True)
+    master, worker = server_workers.prefork(workers)
+    if master:
+        signal.signal(signal.SIGTERM, lambda signo, frame: master.terminate())
+    else:
+        signal.signal(signal.SIGTERM, lambda signo, frame: POLLER.break_loop())
+        ChargenServer().listen(('127.0.0.1', LOAD_PORT), False, False, '')
+        os.write(ready, 'x')
+    POLLER.loop()
+    os._exit(0)
+
+def _run_client(wfile):
+    ''' Download for LOAD_DURATION seconds and report '''
+    for _ in range(50):
+        try:
+            sock = socket.create_connection(('127.0.0.1', LOAD_PORT))
+            break
+        except socket.error:
+            time.sleep(0.1)
+    else:
+        os._exit(1)
+    pid = struct.unpack('!I', sock.recv(4, socket.MSG_WAITALL))[0]
+    total, begin = 0, utils.ticks()
+    while utils.ticks() - begin < LOAD_DURATION:
+        total += len(sock.recv(262144))
+    os.write(wfile, '%d %d\n' % (pid, total))
+    os._exit(0)
+
+def load_test(workers):
+    ''' Measure aggregate throughput with the given number of workers '''
+    rready, wready = os.pipe()
+    server = os.fork()
+    if server == 0:
+        os.close(rready)
+        _run_server(workers, wready)
+    os.close(wready)
+    for _ in range(workers):
+        os.read(rready, 1)
+    os.close(rready)
+
+    rfile, wfile = os.pipe()
+    clients = []
+    for _ in range(LOAD_CLIENTS):
+        pid = os.fork()
+        if pid == 0:
+            _run_client(wfile)
+        clients.append(pid)
+    os.close(wfile)
+    for pid in clients:
+        os.waitpid(pid, 0)
+    lines = os.fdopen(rfile).read().split()
+
+    os.kill(server, signal.SIGTERM)
+    os.waitpid(server, 0)
+
+    pids = set(lines[0::2])
+    total = sum(int(value) for value in lines[1::2])
+    sys.stdout.write('  %d workers: %s (%d workers used)\n' % (workers,
+                     utils.speed_formatter(total / LOAD_DURATION),
+                     len(pids)))
+    assert len(lines) == 2 * LOAD_CLIENTS
+    return pids
+
+def main():
+    ''' Run the load test, then the unit tests '''
+    sys.stdout.write('Load test with %d clients (%d CPUs):\n' % (
+                     LOAD_CLIENTS, os.sysconf('SC_NPROCESSORS_ONLN')))
+    spread = []
+    for workers in (1, 2, 4):
+        pids = load_test(workers)
+        if workers > 1:
+            spread.append(len(pids))
+    # A single run may occasionally see one worker win every accept()
+    assert max(spread) > 1
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+
+#
+# Copyright (c) 2013
+#     Nexa Center for Internet & Society, Politecnico di Torino (DAUIN),
+#     and Simone Basso <bassosimone@gmail.com>
+#
+# This file is part of Neubot <http://www.neubot.org/>.
+#
+# Neubot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Neubot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Neubot.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+''' Regression test and vectored send benchmark for neubot/utils_net.py '''
+
+import socket
+import sys
+import unittest
+
+if __name__ == '__main__':
+    sys.path.insert(0, '.')
+
+from neubot.config import CONFIG
+from neubot.net import stream as net_stream
+from neubot.pollable import SUCCESS
+from neubot.stream import Stream
+
+from neubot import utils
+from neubot import utils_net
+
+#
+# We're accessing private methods and we don't maintain
+# unittest, so we don't care about the number of methods.
+#
+# pylint: disable=W0212,R0904
+#
+
+def _loopback_pair():
+    ''' Return a connected pair of TCP sockets '''
+    lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    lsock.bind(('127.0.0.1', 0))
+    lsock.listen(1)
+    left = socket.create_connection(lsock.getsockname())
+    right = lsock.accept()[0]
+    lsock.close()
+    return left, right
+
+def _recv_all(sock, count):
+    ''' Receive exactly count bytes from sock '''
+    data = []
+    while count > 0:
+        data.append(sock.recv(count))
+        if not data[-1]:
+            break
+        count -= len(data[-1])
+    return ''.join(data)
+
+class TestConsumeVector(unittest.TestCase):
+    ''' Regression test for consume_vector() '''
+
+    def test_boundaries(self):
+        ''' Make sure we drop fully-sent buffers '''
+        vector = ['abc', 'de', 'f']
+        self.assertEqual(utils_net.consume_vector(vector, 0), vector)
+        self.assertEqual(utils_net.consume_vector(vector, 3), ['de', 'f'])
+        self.assertEqual(utils_net.consume_vector(vector, 5), ['f'])
+        self.assertEqual(utils_net.consume_vector(vector, 6), [])
+
+    def test_partial(self):
+        ''' Make sure we slice a partially-sent buffer '''
+        result = utils_net.consume_vector(['abc', 'de', 'f'], 4)
+        self.assertEqual([str(elem) for elem in result], ['e', 'f'])
+        result = utils_net.consume_vector(result, 0)
+        self.assertEqual([str(elem) for elem in result], ['e', 'f'])
+
+class TestCoalesceVector(unittest.TestCase):
+    ''' Regression test for coalesce_vector() '''
+
+    def test_coalesce(self):
+        ''' Make sure we join small buffers and keep large ones '''
+        large = 'x' * utils_net.SENDV_COPY_MAX
+        result = utils_net.coalesce_vector(['GET ', '/', ' HTTP/1.1\r\n',
+          '\r\n', large, '\r\n', '', large])
+        self.assertEqual(result, ['GET / HTTP/1.1\r\n\r\n', large,
+                                  '\r\n', large])
+        self.assertTrue(result[1] is large)
+        self.assertEqual(utils_net.coalesce_vector([]), [])
+
+class TestSendv(unittest.TestCase):
+    ''' Regression test for sendv() '''
+
+    def setUp(self):
+        self.left, self.right = _loopback_pair()
+
+    def tearDown(self):
+        self.left.close()
+        self.right.close()
+
+    def _sendv(self):
+        ''' Send a vector of buffers and check what we receive '''
+        vector = ['abc', buffer('0123456789', 5), 'x' * 100000]
+        count = utils_net.sendv(self.left, vector)
+        self.assertTrue(count > 0)
+        self.assertEqual(_recv_all(self.right, count),
+                         ''.join(str(elem) for elem in vector)[:count])
+
+    def test_sendv(self):
+        ''' Make sure we send the buffers using the vectored send '''
+        self._sendv()
+
+    def test_fallback(self):
+        ''' Make sure we join buffers when there is no vectored send '''
+        saved = utils_net.SENDV
+        utils_net.SENDV = None
+        try:
+            self._sendv()
+        finally:
+            utils_net.SENDV = saved
+
+    def test_iov_max(self):
+        ''' Make sure we don't pass more than IOV_MAX buffers '''
+        vector = ['a'] * (utils_net.IOV_MAX + 10)
+        self.assertEqual(utils_net.sendv(self.left, vector),
+                         utils_net.IOV_MAX)
+
+class ShortWriteWrapper(object):
+    ''' Stream wrapper that sends at most maxcount bytes '''
+
+    def __init__(self, maxcount):
+        self.maxcount = maxcount
+        self.data = []
+        self.calls = 0
+
+    def sosend(self, octets):
+        ''' Emulates a short send() '''
+        self.calls += 1
+        octets = str(octets)[:self.maxcount]
+        self.data.append(octets)
+        return SUCCESS, len(octets)
+
+    def sosendv(self, vector):
+        ''' Emulates a short vectored send() '''
+        self.calls += 1
+        octets = ''.join(str(elem) for elem in vector)[:self.maxcount]
+        self.data.append(octets)
+        return SUCCESS, len(octets)
+
+class TestStreamSendList(unittest.TestCase):
+    ''' Make sure neubot/stream.py sends lists of strings '''
+
+    def setUp(self):
+        self.left, self.right = _loopback_pair()
+        self.complete = 0
+
+    def tearDown(self):
+        self.left.close()
+        self.right.close()
+
+    def _send(self, maxcount, vector):
+        ''' Send vector using short writes '''
+        stream = Stream(self.left, self._connection_made,
+                        self._connection_lost, None, None, None)
+        stream.sock = ShortWriteWrapper(maxcount)
+        stream.send(vector, self._send_complete)
+        while not self.complete:
+            stream.handle_write()
+        self.assertEqual(self.complete, 1)
+        self.assertEqual(''.join(stream.sock.data), ''.join(vector))
+        self.assertEqual(stream.bytes_out, len(''.join(vector)))
+        self.assertEqual(stream.send_octets, '')
+        return stream.sock.calls
+
+    def _connection_made(self, stream):
+        ''' Invoked when the stream is ready '''
+
+    def _connection_lost(self, stream):
+        ''' Invoked when the stream is closed '''
+
+    def _send_complete(self, stream):
+        ''' Invoked when the send is complete '''
+        self.complete += 1
+
+    def test_single_call(self):
+        ''' Make sure we send the list with a single call '''
+        body = 'x' * 4096
+        self.assertEqual(self._send(65536, ['HTTP/1.1 ', '200', ' Ok\r\n',
+                         '\r\n', body, '\r\n', body]), 1)
+
+    def test_short_writes(self):
+        ''' Make sure we handle short writes across the buffers '''
+        vector = ['Header: value\r\n', 'y' * 2000, '\r\n', 'z' * 3000]
+        for maxcount in (1, 7, 1024, 2015, 5016):
+            self.complete = 0
+            self._send(maxcount, vector)
+
+#
+# Syscalls-per-megabyte benchmark: we send HTTP-chunked-like data,
+# i.e. a chunk line, a body piece and a CRLF, using neubot/net/stream.py
+# over loopback and we count the number of send calls.
+#
+
+PIECE_SIZE = 1400
+BENCH_BYTES = 8 << 20
+
+class CountingWrapper(net_stream.SocketWrapper):
+    ''' Count the number of send calls '''
+
+    def __init__(self, sock, can_sendv):
+        net_stream.SocketWrapper.__init__(self, sock, False)
+        self.can_sendv = can_sendv
+        self.calls = 0
+
+    def sosend(self, octets):
+        self.calls += 1
+        return net_stream.SocketWrapper.sosend(self, octets)
+
+    def sosendv(self, vector):
+        self.calls += 1
+        return net_stream.SocketWrapper.sosendv(self, vector)
+
+class BenchmarkPoller(object):
+    ''' Minimal poller for the benchmark '''
+
+    def set_writable(self, stream):
+        ''' Nothing to do '''
+    def unset_writable(self, stream):
+        ''' Nothing to do '''
+
+def benchmark_sendv(can_sendv):
+    ''' Return syscalls per MByte and elapsed time '''
+    left, right = _loopback_pair()
+    left.setblocking(False)
+    right.setblocking(False)
+
+    conf = CONFIG.copy()
+    stream = net_stream.Stream(BenchmarkPoller())
+    stream.attach(BenchmarkPoller(), left, conf)
+    stream.sock = CountingWrapper(left, can_sendv)
+    complete = []
+    stream.send_complete = lambda: complete.append(True)
+
+    piece = 'x' * PIECE_SIZE
+    total = 0
+    begin = utils.ticks()
+    while total < BENCH_BYTES:
+        for _ in range(64):
+            stream.start_send('%x\r\n' % PIECE_SIZE)
+            stream.start_send(piece)
+            stream.start_send('\r\n')
+        total += 64 * (PIECE_SIZE + 7)
+        del complete[:]
+        while not complete:
+            stream.handle_write()
+            try:
+                while right.recv(1 << 20):
+                    pass
+            except socket.error:
+                pass
+    elapsed = utils.ticks() - begin
+
+    left.close()
+    right.close()
+    return stream.sock.calls / (total / float(1 << 20)), elapsed
+
+def benchmark():
+    ''' Compare vectored and non-vectored send '''
+    sys.stdout.write('Sending %s in %d-byte chunks:\n' % (
+      utils.unit_formatter(BENCH_BYTES, unit='B'), PIECE_SIZE))
+    results = {}
+    for name, can_sendv in (('send', False), ('sendv', True)):
+        calls, elapsed = benchmark_sendv(can_sendv)
+        results[name] = calls
+        sys.stdout.write('  %-5s: %.1f syscalls per MByte, %s\n' % (name,
+                         calls, utils.time_formatter(elapsed)))
+    assert results['sendv'] < results['send']
+
+if __name__ == '__main__':
+    benchmark()
+    unittest.main()
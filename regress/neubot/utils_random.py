@@ -22,18 +22,77 @@
 
 ''' Unit test for neubot/utils_random.py '''
 
+import socket
 import sys
+import zlib
 
 sys.path.insert(0, '.')
 
 from neubot import utils
 
 BEFORE = utils.ticks()
+from neubot.utils_random import PAYLOAD
 from neubot.utils_random import RANDOMBLOCKS
 from neubot.utils_random import RandomBody
 ELAPSED = utils.ticks() - BEFORE
 print('Time to import: %s' % (utils.time_formatter(ELAPSED)))
 
+from neubot.bytegen_speedtest import BytegenSpeedtest
+from neubot.config import CONFIG
+from neubot.net.stream import Stream
+
+from neubot import utils_random
+
+class ServingPoller(object):
+    ''' Minimal poller for serving a body '''
+
+    def set_writable(self, stream):
+        ''' Nothing to do '''
+    def unset_writable(self, stream):
+        ''' Nothing to do '''
+
+def serve(body):
+    ''' Serve body over loopback and return the types of the
+        buffers passed to the socket '''
+    lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    lsock.bind(('127.0.0.1', 0))
+    lsock.listen(1)
+    left = socket.create_connection(lsock.getsockname())
+    right = lsock.accept()[0]
+    lsock.close()
+    left.setblocking(False)
+    right.setblocking(False)
+
+    stream = Stream(ServingPoller())
+    stream.attach(ServingPoller(), left, CONFIG.copy())
+    complete = []
+    stream.send_complete = lambda: complete.append(True)
+    types = set()
+    sosend, sosendv = stream.sock.sosend, stream.sock.sosendv
+    def record(vector):
+        ''' Record the types of large buffers '''
+        for elem in vector:
+            if len(elem) >= 65536:
+                types.add(type(elem))
+    stream.sock.sosend = lambda octets: (record([octets]), sosend(octets))[1]
+    stream.sock.sosendv = lambda vector: (record(vector), sosendv(vector))[1]
+
+    stream.start_send(body)
+    total = 0
+    while not complete:
+        stream.handle_write()
+        try:
+            while True:
+                data = right.recv(1 << 20)
+                if not data:
+                    break
+                total += len(data)
+        except socket.error:
+            pass
+    left.close()
+    right.close()
+    return total, types
+
 def main():
 
     ''' Unit test for neubot/utils_random.py '''
@@ -55,13 +114,40 @@ def main():
     assert(len(filep.read()) == 789)
     filep.seek(7)
 
-    begin, total = utils.ticks(), 0
-    while total < 1073741824:
-        total += len(RANDOMBLOCKS.get_block())
-    elapsed = utils.ticks() - begin
+    # The payload must not be trivially compressible
+    block = RANDOMBLOCKS.get_block()
+    assert(len(zlib.compress(block, 9)) > len(block) * 0.99)
+
+    # Slices wrapping around the end of the region are contiguous
+    PAYLOAD.offset = utils_random.REGION_SIZE - 10
+    block = str(PAYLOAD.get(20))
+    assert(block == str(PAYLOAD.region[utils_random.REGION_SIZE - 10:
+                                       utils_random.REGION_SIZE]) +
+                    str(PAYLOAD.region[:10]))
+    assert(len(PAYLOAD.get(utils_random.MAXSLICE + 1)) ==
+           utils_random.MAXSLICE)
+
+    # Slices are views, not copies
+    assert(sys.getsizeof(RANDOMBLOCKS.get_buffer()) < 1024)
+    assert(str(PAYLOAD.get(1024)) != str(PAYLOAD.get(1024)))
+
+    # Serving a body does not copy the payload
+    total, types = serve(RandomBody(16 << 20))
+    assert(total == 16 << 20)
+    assert(types and str not in types)
+    total, types = serve(BytegenSpeedtest(0.5))
+    assert(total > 0)
+    assert(types and str not in types)
+
+    for name, func in (('get_block', RANDOMBLOCKS.get_block),
+                       ('get_buffer', RANDOMBLOCKS.get_buffer)):
+        begin, total = utils.ticks(), 0
+        while total < 1073741824:
+            total += len(func())
+        elapsed = utils.ticks() - begin
 
-    print('Elapsed: %s' % utils.time_formatter(elapsed))
-    print('Speed: %s' % utils.speed_formatter(total/elapsed))
+        print('%s: elapsed: %s' % (name, utils.time_formatter(elapsed)))
+        print('%s: speed: %s' % (name, utils.speed_formatter(total/elapsed)))
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+
+#
+# Copyright (c) 2013
+#     Nexa Center for Internet & Society, Politecnico di Torino (DAUIN),
+#     and Simone Basso <bassosimone@gmail.com>
+#
+# This file is part of Neubot <http://www.neubot.org/>.
+#
+# Neubot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Neubot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Neubot.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+''' Regression test and benchmark for neubot/web100.py '''
+
+import os
+import shutil
+import socket
+import struct
+import sys
+import tempfile
+import unittest
+
+if __name__ == '__main__':
+    sys.path.insert(0, '.')
+
+from neubot import utils
+from neubot import utils_net
+from neubot import web100
+
+#
+# We're accessing private methods and we don't maintain
+# unittest, so we don't care about the number of methods.
+#
+# pylint: disable=W0212,R0904
+#
+
+# The header of a web100 kernel (with fake X_ variables)
+HEADER = os.sep.join([os.path.dirname(os.path.abspath(__file__)),
+                      'web100_header.txt'])
+
+PACK = {
+        web100.INTEGER: '=I',
+        web100.INTEGER32: '=I',
+        web100.COUNTER32: '=I',
+        web100.GAUGE32: '=I',
+        web100.UNSIGNED32: '=I',
+        web100.COUNTER64: '=Q',
+        web100.INET_PORT_NUMBER: '=H',
+        web100.INET_ADDRESS: '=17s',
+        web100.OCTET: '=B',
+       }
+
+class FakeProc(object):
+
+    ''' Fake /proc/web100 tree '''
+
+    def __init__(self):
+        self.procdir = tempfile.mkdtemp()
+        self.saved = web100.PROCDIR
+        shutil.copy(HEADER, os.sep.join([self.procdir, 'header']))
+        web100.PROCDIR = self.procdir
+        web100.WEB100_INDEX.clear()
+        self.hdr = web100.web100_init()
+        self.next_cid = 1000
+
+    def close(self):
+        ''' Remove the fake tree '''
+        web100.PROCDIR = self.saved
+        web100.WEB100_INDEX.clear()
+        shutil.rmtree(self.procdir)
+
+    def connect(self, local, remote, ipv6=False, cid=None):
+        ''' Create the directory of a connection, return its spec '''
+        if cid is None:
+            cid = self.next_cid
+            self.next_cid += 1
+        dirname = os.sep.join([self.procdir, str(cid)])
+        os.mkdir(dirname)
+        spec = '%s %s' % (utils_net.format_epnt_web100(local),
+                          utils_net.format_epnt_web100(remote))
+        filep = open(os.sep.join([dirname, 'spec-ascii']), 'w')
+        filep.write(spec + '\n')
+        filep.close()
+        self.update(cid, local, remote, ipv6)
+        return spec
+
+    def update(self, cid, local, remote, ipv6=False, counter=0):
+        ''' Write the read file of a connection '''
+        data = bytearray('\xaa' * 512)  # Garbage in the X_ variables
+        for name, (off, kind, size) in self.hdr['/read'].items():
+            if name in ('LocalAddress', 'RemAddress'):
+                address = local[0] if name == 'LocalAddress' else remote[0]
+                if ipv6:
+                    value = socket.inet_pton(socket.AF_INET6, address) + '\0'
+                else:
+                    value = socket.inet_aton(address) + '\0' * 13
+            elif name == 'LocalAddressType':
+                value = web100.ADDRTYPE_IPV6 if ipv6 else web100.ADDRTYPE_IPV4
+            elif name == 'LocalPort':
+                value = local[1]
+            elif name == 'RemPort':
+                value = remote[1]
+            elif kind == web100.COUNTER64:
+                value = (1 << 40) + off + counter
+            else:
+                value = off + counter
+            data[off:off + size] = struct.pack(PACK[kind], value)
+        filep = open(os.sep.join([self.procdir, str(cid), 'read']), 'wb')
+        filep.write(str(data))
+        filep.close()
+
+    def disconnect(self, cid):
+        ''' Remove the directory of a connection '''
+        shutil.rmtree(os.sep.join([self.procdir, str(cid)]))
+
+#
+# The implementation before the compiled struct and the index, which
+# we use as a reference and in the benchmark.
+#
+
+def reference_snap(hdr, dirname):
+    ''' Take a snapshot one variable at a time '''
+    result = {}
+    data = web100._web100_readfile(os.sep.join([dirname, 'read']))
+    if data:
+        for name, value in hdr['/read'].items():
+            off, kind, size = value
+            result[name] = web100.CONVERT[kind](data[off:off + size])
+        web100._web100_normalise_addr(result, 'LocalAddress',
+                                      'LocalAddressType')
+        web100._web100_normalise_addr(result, 'RemAddress',
+                                      'LocalAddressType')
+    return result
+
+def reference_find_dirname(spec):
+    ''' Find a dirname reading the spec of all directories '''
+    matching = []
+    for name in os.listdir(web100.PROCDIR):
+        dirname = os.sep.join([web100.PROCDIR, name])
+        if not os.path.isdir(dirname):
+            continue
+        tmp = os.sep.join([dirname, 'spec-ascii'])
+        if not os.path.isfile(tmp):
+            continue
+        data = web100._web100_readfile(tmp).strip()
+        if data == spec:
+            matching.append(dirname)
+    if len(matching) == 1:
+        return matching[0]
+    return ''
+
+class TestWeb100(unittest.TestCase):
+    ''' Regression test for web100 '''
+
+    def setUp(self):
+        self.proc = FakeProc()
+
+    def tearDown(self):
+        self.proc.close()
+
+    def test_header(self):
+        ''' Make sure we skip X_ variables '''
+        hdr = self.proc.hdr
+        self.assertEqual(sorted(hdr.keys()), ['/read', '/spec', '/tune'])
+        self.assertTrue('DataBytesOut' in hdr['/read'])
+        self.assertFalse('X_Rcvbuf' in hdr['/read'])
+        self.assertFalse('_X_Reserved' in hdr['/read'])
+
+    def test_snap(self):
+        ''' Make sure the compiled snap is the same as the reference '''
+        self.proc.connect(('130.192.91.211', 8080), ('10.0.0.1', 54321))
+        dirname = os.sep.join([self.proc.procdir, '1000'])
+        result = web100.web100_snap(self.proc.hdr, dirname)
+        self.assertEqual(result, reference_snap(self.proc.hdr, dirname))
+        self.assertEqual(result['LocalAddress'], '82c05bd3')
+        self.assertEqual(result['RemAddress'], '0a000001')
+        self.assertEqual(result['LocalPort'], 8080)
+        self.assertEqual(result['RemPort'], 54321)
+        offset = self.proc.hdr['/read']['DataBytesOut'][0]
+        self.assertEqual(result['DataBytesOut'], (1 << 40) + offset)
+        self.proc.update(1000, ('130.192.91.211', 8080), ('10.0.0.1', 54321),
+                         counter=7)
+        result = web100.web100_snap(self.proc.hdr, dirname)
+        self.assertEqual(result['DataBytesOut'], (1 << 40) + offset + 7)
+        self.assertEqual(result, reference_snap(self.proc.hdr, dirname))
+
+    def test_snap_ipv6(self):
+        ''' Make sure we handle IPv6 addresses '''
+        self.proc.connect(('2001:db8::1', 8080), ('2001:db8::2', 1234),
+                          ipv6=True)
+        dirname = os.sep.join([self.proc.procdir, '1000'])
+        result = web100.web100_snap(self.proc.hdr, dirname)
+        self.assertEqual(result, reference_snap(self.proc.hdr, dirname))
+        self.assertEqual(result['LocalAddress'],
+                         '20010db8000000000000000000000001')
+        self.assertEqual(result['RemAddress'],
+                         '20010db8000000000000000000000002')
+
+    def test_snap_missing(self):
+        ''' Make sure we return {} when the connection is gone '''
+        dirname = os.sep.join([self.proc.procdir, '1000'])
+        self.assertEqual(web100.web100_snap(self.proc.hdr, dirname), {})
+        self.assertEqual(web100.web100_snap({}, dirname), {})
+
+    def test_compile(self):
+        ''' Make sure we compile each group once '''
+        group = self.proc.hdr['/read']
+        compiled, names, others = web100._web100_compile(group)
+        self.assertTrue(web100._web100_compile(group)[0] is compiled)
+        self.assertEqual(sorted(names), sorted(group.keys()))
+        self.assertEqual(others, [])
+        self.assertTrue(compiled.size <= 512)
+
+    def test_compile_overlap(self):
+        ''' Make sure we handle overlapping variables '''
+        group = {'A': (0, web100.COUNTER64, 8), 'B': (4, web100.COUNTER32, 4),
+                 'C': (10, web100.INET_PORT_NUMBER, 2)}
+        compiled, names, others = web100._web100_compile(group)
+        self.assertEqual(compiled.format, '=Q2xH')
+        self.assertEqual(names, ('A', 'C'))
+        self.assertEqual(others, [('B', 4, web100.COUNTER32, 4)])
+
+    def test_find(self):
+        ''' Make sure we find the directory of a connection '''
+        spec1 = self.proc.connect(('130.192.91.211', 8080), ('10.0.0.1', 1))
+        spec2 = self.proc.connect(('130.192.91.211', 8080), ('10.0.0.1', 2))
+        self.assertEqual(web100.web100_find_dirname(self.proc.hdr, spec2),
+                         os.sep.join([self.proc.procdir, '1001']))
+        self.assertEqual(web100.web100_find_dirname(self.proc.hdr, spec1),
+                         os.sep.join([self.proc.procdir, '1000']))
+        self.assertEqual(web100.web100_find_dirname(self.proc.hdr, 'x y'),
+                         '')
+        self.assertEqual(web100.web100_find_dirname({}, spec1), '')
+
+    def test_find_ipv6(self):
+        ''' Make sure we work around the ::: kernel bug '''
+        cid = 1000
+        dirname = os.sep.join([self.proc.procdir, str(cid)])
+        os.mkdir(dirname)
+        filep = open(os.sep.join([dirname, 'spec-ascii']), 'w')
+        filep.write('2001:db8:::1.8080 2001:db8::2.1234\n')
+        filep.close()
+        self.assertEqual(web100.web100_find_dirname(self.proc.hdr,
+          '2001:db8::1.8080 2001:db8::2.1234'), dirname)
+
+    def test_find_reads_once(self):
+        ''' Make sure we read the spec of each directory once '''
+        specs = [self.proc.connect(('130.192.91.211', 8080),
+                 ('10.0.0.1', port)) for port in range(1, 11)]
+        reads = []
+        saved = web100._web100_readfile
+        def readfile(path):
+            ''' Count reads '''
+            reads.append(path)
+            return saved(path)
+        web100._web100_readfile = readfile
+        try:
+            for spec in specs:
+                self.assertTrue(web100.web100_find_dirname(self.proc.hdr,
+                                                           spec))
+            self.assertEqual(len(reads), 10)
+            spec = self.proc.connect(('130.192.91.211', 8080),
+                                     ('10.0.0.1', 11))
+            self.assertTrue(web100.web100_find_dirname(self.proc.hdr, spec))
+            self.assertEqual(len(reads), 11)
+        finally:
+            web100._web100_readfile = saved
+
+    def test_find_reused(self):
+        ''' Make sure we notice closed connections and reused specs '''
+        spec = self.proc.connect(('130.192.91.211', 8080), ('10.0.0.1', 1))
+        self.assertEqual(web100.web100_find_dirname(self.proc.hdr, spec),
+                         os.sep.join([self.proc.procdir, '1000']))
+        self.proc.disconnect(1000)
+        self.assertEqual(web100.web100_find_dirname(self.proc.hdr, spec), '')
+        self.assertEqual(web100.WEB100_INDEX.specs, {})
+        self.proc.connect(('130.192.91.211', 8080), ('10.0.0.1', 1))
+        self.assertEqual(web100.web100_find_dirname(self.proc.hdr, spec),
+                         os.sep.join([self.proc.procdir, '1001']))
+
+    def test_find_multiple(self):
+        ''' Make sure we don't guess with multiple matches '''
+        spec = self.proc.connect(('130.192.91.211', 8080), ('10.0.0.1', 1))
+        self.proc.connect(('130.192.91.211', 8080), ('10.0.0.1', 1))
+        self.assertEqual(web100.web100_find_dirname(self.proc.hdr, spec), '')
+        self.proc.disconnect(1000)
+        self.assertEqual(web100.web100_find_dirname(self.proc.hdr, spec),
+                         os.sep.join([self.proc.procdir, '1001']))
+
+#
+# Benchmark: CONNECTIONS raw tests run concurrently, and each second
+# the server snaps at web100 for each connection.  We also measure
+# how long it takes to find the directory of a new connection.
+#
+
+CONNECTIONS = 300
+ROUNDS = 10
+
+def benchmark():
+    ''' Compare the old and the new web100 code '''
+    proc = FakeProc()
+    specs = [proc.connect(('130.192.91.211', 8080), ('10.%d.%d.1' % (
+             index >> 8, index & 255), 40000 + index)) for index in range(
+             CONNECTIONS)]
+    dirnames = [os.sep.join([proc.procdir, str(1000 + index)])
+                for index in range(CONNECTIONS)]
+    sys.stdout.write('Web100 with %d concurrent connections:\n' %
+                     CONNECTIONS)
+
+    for label, find, snap in (('before', reference_find_dirname,
+                               lambda dirname: reference_snap(proc.hdr,
+                                                              dirname)),
+                              ('after', lambda spec: web100.
+                               web100_find_dirname(proc.hdr, spec),
+                               lambda dirname: web100.web100_snap(proc.hdr,
+                                                                  dirname))):
+        web100.WEB100_INDEX.clear()
+        begin = utils.ticks()
+        for spec in specs:
+            find(spec)
+        find_time = (utils.ticks() - begin) / CONNECTIONS
+        begin = utils.ticks()
+        for _ in range(ROUNDS):
+            for dirname in dirnames:
+                snap(dirname)
+        snap_time = (utils.ticks() - begin) / ROUNDS
+        sys.stdout.write('  %-6s: find %s per connection, snap %s per '
+          'second (all connections)\n' % (label, utils.time_formatter(
+          find_time), utils.time_formatter(snap_time)))
+
+    proc.close()
+
+if __name__ == '__main__':
+    benchmark()
+    unittest.main()